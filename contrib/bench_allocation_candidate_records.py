@@ -0,0 +1,124 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Compare the CPU time and memory needed to build allocation candidates as
+the lightweight records used internally by the placement allocation candidate
+code against building them as versioned objects.
+
+Builds, for a number of compute nodes that each draw DISK_GB from one of a
+number of sharing providers, the allocation requests and provider summaries
+both ways, including the per-anchor copies and the consolidation the
+candidate code makes.
+
+Run with python 3 from an environment with the placement requirements
+installed:
+
+    python contrib/bench_allocation_candidate_records.py [NODES] [SHARING]
+"""
+
+import copy
+import sys
+import timeit
+import tracemalloc
+
+from oslo_utils import uuidutils
+
+from nova.api.openstack.placement.objects import resource_provider as rp_obj
+
+
+def _providers(count):
+    return [(i, uuidutils.generate_uuid()) for i in range(count)]
+
+
+def build_objects(nodes, sharing):
+    summaries = [
+        rp_obj.ProviderSummary(
+            resource_provider=rp_obj.ResourceProvider(
+                id=rp_id, uuid=rp_uuid, root_provider_uuid=rp_uuid),
+            resources=[
+                rp_obj.ProviderSummaryResource(
+                    resource_class=rc, capacity=100, used=0, max_unit=100)
+                for rc in ('VCPU', 'MEMORY_MB', 'DISK_GB')],
+            traits=[rp_obj.Trait(name='HW_CPU_X86_AVX2')])
+        for rp_id, rp_uuid in nodes + sharing]
+    areqs = []
+    for summary in summaries[:len(nodes)]:
+        rp = summary.resource_provider
+        for ss in summaries[len(nodes):]:
+            areq = rp_obj.AllocationRequest(
+                anchor_root_provider_uuid=rp.uuid,
+                resource_requests=[
+                    rp_obj.AllocationRequestResource(
+                        resource_provider=rp, resource_class='VCPU',
+                        amount=1),
+                    rp_obj.AllocationRequestResource(
+                        resource_provider=ss.resource_provider,
+                        resource_class='DISK_GB', amount=10)])
+            areq = copy.deepcopy(areq)
+            areqs.append(rp_obj.AllocationRequest(
+                anchor_root_provider_uuid=rp.uuid,
+                resource_requests=[copy.deepcopy(arr)
+                                   for arr in areq.resource_requests]))
+    return areqs, summaries
+
+
+def build_records(nodes, sharing):
+    summaries = [
+        rp_obj._ProviderSummaryRecord(
+            resource_provider=rp_obj._ProviderRecord(
+                id=rp_id, uuid=rp_uuid, root_provider_uuid=rp_uuid),
+            resources=[
+                rp_obj._ProviderSummaryResourceRecord(
+                    resource_class=rc, capacity=100, used=0, max_unit=100)
+                for rc in ('VCPU', 'MEMORY_MB', 'DISK_GB')],
+            traits=[rp_obj._TraitRecord(name='HW_CPU_X86_AVX2')])
+        for rp_id, rp_uuid in nodes + sharing]
+    areqs = []
+    for summary in summaries[:len(nodes)]:
+        rp = summary.resource_provider
+        for ss in summaries[len(nodes):]:
+            areq = rp_obj._AllocationRequestRecord(
+                anchor_root_provider_uuid=rp.uuid,
+                resource_requests=[
+                    rp_obj._AllocationRequestResourceRecord(
+                        resource_provider=rp, resource_class='VCPU',
+                        amount=1),
+                    rp_obj._AllocationRequestResourceRecord(
+                        resource_provider=ss.resource_provider,
+                        resource_class='DISK_GB', amount=10)])
+            areqs.append(rp_obj._consolidate_allocation_requests([areq]))
+    return areqs, summaries
+
+
+def measure(name, func, nodes, sharing):
+    seconds = min(timeit.repeat(lambda: func(nodes, sharing),
+                                number=1, repeat=3))
+    tracemalloc.start()
+    result = func(nodes, sharing)
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    del result
+    print('%-8s %8.3f s %10.1f MiB' % (name, seconds, peak / 2.0 ** 20))
+
+
+def main():
+    node_count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    sharing_count = int(sys.argv[2]) if len(sys.argv) > 2 else 4
+    nodes = _providers(node_count)
+    sharing = _providers(sharing_count)
+    print('%d compute nodes, %d sharing providers, %d allocation requests' %
+          (node_count, sharing_count, node_count * sharing_count))
+    measure('objects', build_objects, nodes, sharing)
+    measure('records', build_records, nodes, sharing)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,187 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Records of the changes made to the placement data, which the per-process
+caches read at the start of a request to find out whether the data they hold
+is still current.
+
+Rarely changed data (resource classes and traits) has a counter, a record of
+the placement_versions table that the writers increment in the same
+transaction as the change they make, so reading the counters is a primary
+key lookup however large the other tables are. Incrementing a counter locks
+its record until the transaction ends, which is only acceptable for such
+infrequent administrative writes.
+
+Writers of the data of resource providers (the providers themselves, their
+inventories, usages, traits and aggregates) instead append a record per
+changed provider to the resource_provider_changes table, flagged when the
+change alters the topology of the provider graph. Appending takes no lock
+that concurrent writers wait on, and the auto-increment IDs of the records
+order the changes. The IDs are handed out when the records are inserted and
+not when they are committed, so a reader may see a record before those of
+lower IDs: a Position holds the highest ID the reader has seen along with
+the lower IDs whose records it has not seen yet, which are looked up again
+until they appear or time out as rolled back. Records of old changes are
+pruned; a reader that fell that far behind has to load everything again.
+"""
+
+import collections
+import time
+
+from oslo_db import exception as db_exc
+import six
+import sqlalchemy as sa
+from sqlalchemy import sql
+
+from nova.api.openstack.placement import db_api
+from nova.db.sqlalchemy import api_models as models
+
+_VERSION_TBL = models.PlacementVersion.__table__
+_CHANGE_TBL = models.ResourceProviderChange.__table__
+
+# Names of the counters
+RESOURCE_CLASSES = 'resource_classes'
+TRAITS = 'traits'
+TRAIT_DELETIONS = 'trait_deletions'
+
+# Records of provider changes are pruned every _PRUNE_INTERVAL records,
+# keeping the last _KEEP_CHANGES.
+_PRUNE_INTERVAL = 100
+_KEEP_CHANGES = 10000
+# A reader loading everything looks for the records not committed yet among
+# the last _GAP_WINDOW ones, and stops looking for a record that has not
+# appeared after _GAP_TIMEOUT seconds, as its transaction was rolled back.
+_GAP_WINDOW = 1000
+_GAP_TIMEOUT = 120
+
+# last: highest ID of the records of provider changes the reader has seen
+# missing: tuple, sorted by ID, of (ID, time the reader first missed it) of
+#          the lower IDs whose records the reader has not seen yet
+Position = collections.namedtuple('Position', 'last missing')
+
+
+def bump(ctx, name):
+    """Increments the named counter and returns its new version. Must be
+    called in the transaction making the change, as late as possible since
+    concurrent writers wait on the counter until the transaction ends.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param name: name of the counter
+    """
+    cond = _VERSION_TBL.c.name == name
+    upd_stmt = _VERSION_TBL.update().where(cond).values(
+        version=_VERSION_TBL.c.version + 1)
+    if not ctx.session.execute(upd_stmt).rowcount:
+        ins_stmt = _VERSION_TBL.insert().values(name=name, version=1)
+        try:
+            with ctx.session.begin_nested():
+                ctx.session.execute(ins_stmt)
+        except db_exc.DBDuplicateEntry:
+            # Another writer created the counter first
+            ctx.session.execute(upd_stmt)
+    sel = sa.select([_VERSION_TBL.c.version]).where(cond)
+    return ctx.session.execute(sel).scalar()
+
+
+def record_provider_changes(ctx, rp_ids, topology=False):
+    """Records that the supplied providers changed.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param rp_ids: iterable of internal IDs of the changed providers
+    :param topology: whether the change nested, deleted or reparented the
+                     providers, or changed their traits or aggregates
+    """
+    for rp_id in sorted(set(rp_ids)):
+        ins_stmt = _CHANGE_TBL.insert().values(
+            resource_provider_id=rp_id, topology=topology)
+        change_id = ctx.session.execute(ins_stmt).inserted_primary_key[0]
+        if change_id % _PRUNE_INTERVAL == 0:
+            _prune(ctx, change_id)
+
+
+def _prune(ctx, change_id):
+    """Deletes the records that are more than _KEEP_CHANGES older than the
+    supplied one. Only the writer of the record with that ID prunes, and the
+    records are deleted by primary key rather than by range, so that
+    concurrent writers do not lock the records others insert or prune.
+    """
+    sel = sa.select([_CHANGE_TBL.c.id]).where(
+        _CHANGE_TBL.c.id <= change_id - _KEEP_CHANGES)
+    old_ids = [r[0] for r in ctx.session.execute(sel)]
+    if old_ids:
+        del_stmt = _CHANGE_TBL.delete().where(_CHANGE_TBL.c.id.in_(old_ids))
+        ctx.session.execute(del_stmt)
+
+
+def get_versions(ctx, names):
+    """Returns a tuple of the current versions of the named counters, in the
+    order of the names. A counter that was never incremented is at 0.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param names: list of names of counters
+    """
+    sel = sa.select([_VERSION_TBL.c.name, _VERSION_TBL.c.version])
+    sel = sel.where(_VERSION_TBL.c.name.in_(names))
+    versions = dict(ctx.session.execute(sel).fetchall())
+    return tuple(versions.get(name, 0) for name in names)
+
+
+def get_provider_changes(ctx, since=None):
+    """Returns a tuple of (the current Position, list of (internal ID of a
+    provider, whether the change altered the topology) of the changes
+    committed since the supplied Position).
+
+    The list is None if the changes cannot be told apart, because since is
+    None, the records were pruned or the IDs went back on the primary
+    database, as they do when the database is recreated. The caller has to
+    load everything again. IDs going back on the replica only mean that it
+    lags behind what the caller read before, so the supplied Position is
+    returned with no changes.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param since: Position the caller is up to date with, or None
+    """
+    sel = sa.select([sql.func.max(_CHANGE_TBL.c.id)])
+    last = ctx.session.execute(sel).scalar() or 0
+    if since is not None and last == since.last and not since.missing:
+        return since, []
+    if (since is not None and last < since.last and
+            db_api.reading_replica(ctx)):
+        return since, []
+    known = (since is not None and since.last <= last and
+             last - since.last <= _KEEP_CHANGES)
+    if not known:
+        # Only the recent records not committed yet are of interest
+        since = Position(max(last - _GAP_WINDOW, 0), ())
+
+    missing = dict(since.missing)
+    cond = sa.and_(_CHANGE_TBL.c.id > since.last, _CHANGE_TBL.c.id <= last)
+    if missing:
+        cond = sa.or_(cond, _CHANGE_TBL.c.id.in_(sorted(missing)))
+    sel = sa.select([_CHANGE_TBL.c.id, _CHANGE_TBL.c.resource_provider_id,
+                     _CHANGE_TBL.c.topology]).where(cond)
+    changes = []
+    seen = set()
+    for change_id, rp_id, topology in ctx.session.execute(sel):
+        seen.add(change_id)
+        changes.append((rp_id, bool(topology)))
+
+    now = time.time()
+    for change_id in six.moves.range(since.last + 1, last + 1):
+        missing[change_id] = now
+    missing = tuple(sorted(
+        (change_id, noticed) for change_id, noticed in missing.items()
+        if change_id not in seen and now - noticed < _GAP_TIMEOUT and
+        change_id > last - _KEEP_CHANGES))
+    position = Position(last, missing)
+    if not known:
+        return position, None
+    return position, changes
@@ -0,0 +1,115 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Configuration options that are only consumed by the placement API service.
+
+The options are registered into the existing ``[placement]`` group when this
+module is imported.
+"""
+
+from oslo_config import cfg
+
+CONF = cfg.CONF
+
+placement_opts = [
+    cfg.StrOpt('allocation_candidates_engine',
+        default='sql',
+        choices=['sql', 'memory'],
+        help="""
+The engine used to answer ``GET /allocation_candidates`` requests.
+
+* ``sql``: Every request is answered by querying the placement database.
+* ``memory``: Each API worker process keeps a snapshot of resource providers,
+  inventories, usages, traits and aggregates in memory and answers requests
+  from it. The snapshot is checked against the database at the start of every
+  request and only the providers that changed are reloaded. If the ``numpy``
+  library is installed, capacity is checked for all providers at once using
+  vectorized operations.
+
+Both engines return the same results. The ``memory`` engine trades memory in
+each API worker for less database load and lower latency on large
+deployments.
+"""),
+    cfg.StrOpt('allocation_claim_mode',
+        default='generation',
+        choices=['generation', 'guarded'],
+        help="""
+How concurrent writes of allocations against the same resource provider are
+detected.
+
+* ``generation``: Capacity is checked before the allocations are written and
+  the write fails with a conflict, and is retried, if the generation of any of
+  the resource providers involved changed in the meantime.
+* ``guarded``: The summed usage of each resource class on each resource
+  provider is claimed with a single conditional statement that only succeeds
+  while there is capacity left. Resource provider generations are still
+  incremented, but are not compared, so writes of allocations against the same
+  resource provider no longer fail with a conflict and are not retried. They
+  are still serialized: incrementing the generation of a resource provider
+  locks its record until the write is committed, so each write waits for the
+  previous one to finish.
+"""),
+    cfg.IntOpt('allocation_conflict_retry_count',
+        default=10,
+        min=1,
+        help="""
+The number of times, including the first one, that a write of allocations is
+attempted when it fails because the generation of one of the resource
+providers involved changed while it was being written. Set to 1 to never
+retry.
+"""),
+    cfg.FloatOpt('allocation_conflict_retry_interval',
+        default=0.01,
+        min=0,
+        help="""
+The number of seconds to wait, at most, before the first retry of a write of
+allocations that met a resource provider generation conflict. The upper bound
+doubles for each further retry and the actual wait is chosen at random below
+it, so that writers that collided spread out. Set to 0 to retry straight away.
+"""),
+    cfg.FloatOpt('allocation_conflict_retry_max_interval',
+        default=0.5,
+        min=0,
+        help="""
+The number of seconds to wait, at most, before any retry of a write of
+allocations that met a resource provider generation conflict.
+"""),
+    cfg.FloatOpt('replica_max_lag',
+        default=1.0,
+        min=0,
+        help="""
+The number of seconds by which the replica of the placement database,
+configured with ``[placement_database]/slave_connection``, is assumed to lag
+behind the primary database.
+
+When a replica is configured, the ``GET /allocation_candidates`` and
+``GET /usages`` requests read from it. For this many seconds after an API
+worker process handled a request that writes, it sends these requests to the
+primary database instead, so that they see that write. Only the writes
+handled by the same API worker process are accounted for: these requests may
+still miss a write handled by another worker, and any write if the replica
+lags further behind. The actual replication lag is not measured. Requests
+that return generations used for subsequent writes, and all writes, always
+use the primary database. Set to 0 to always read these requests from the
+replica.
+"""),
+]
+
+
+def register_opts(conf):
+    conf.register_opts(placement_opts, group='placement')
+
+
+def list_opts():
+    return {'placement': placement_opts}
+
+
+register_opts(CONF)
@@ -0,0 +1,149 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Retry policy and contention counters for writes of allocations.
+
+AllocationList.replace_all() retries a write of allocations that failed
+because a resource provider generation changed underneath it. The RetryPolicy
+returned by get_retry_policy() decides how many times, and how long to wait
+before each retry. By default it is built from the
+``[placement]/allocation_conflict_retry_*`` options and waits for a jittered,
+exponentially growing interval so that writers that collided do not collide
+again straight away. A different policy can be plugged in with
+set_retry_policy().
+
+Every provider whose generation was found to have changed is counted in the
+per-process ContentionCounters returned by get_contention_counters(), so that
+the resource providers, often sharing providers, that writers most often
+collide on can be identified. The most contended ones are logged whenever a
+write runs out of retries.
+"""
+
+import collections
+import random
+import threading
+import time
+
+from nova.api.openstack.placement import conf as placement_conf
+
+CONF = placement_conf.CONF
+
+_POLICY = None
+_COUNTERS = None
+
+
+class RetryPolicy(object):
+    """Decides how often, and after how long a wait, a write that hit a
+    resource provider generation conflict is attempted again.
+    """
+
+    def __init__(self, attempts, interval, max_interval):
+        """
+        :param attempts: The number of times the write is attempted in total.
+        :param interval: Seconds to wait, at most, before the first retry. The
+                         upper bound doubles for every further retry. Zero
+                         retries straight away.
+        :param max_interval: Seconds to wait, at most, before any retry.
+        """
+        self.attempts = attempts
+        self.interval = interval
+        self.max_interval = max_interval
+
+    @classmethod
+    def from_conf(cls, conf=CONF):
+        return cls(conf.placement.allocation_conflict_retry_count,
+                   conf.placement.allocation_conflict_retry_interval,
+                   conf.placement.allocation_conflict_retry_max_interval)
+
+    def backoff(self, retry):
+        """Returns the number of seconds to wait before the supplied retry,
+        counting from zero. The wait is chosen at random up to an exponentially
+        growing bound ("full jitter") so that the writers that collided spread
+        out instead of colliding again.
+        """
+        if not self.interval:
+            return 0
+        bound = min(self.max_interval, self.interval * (2 ** retry))
+        return random.uniform(0, bound)
+
+    def wait(self, retry):
+        delay = self.backoff(retry)
+        if delay:
+            time.sleep(delay)
+
+
+class ContentionCounters(object):
+    """Thread-safe counters, keyed by resource provider UUID, of the
+    generation conflicts met by writes of allocations in this process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._conflicts = collections.Counter()
+        self._exhausted = collections.Counter()
+
+    def record_conflict(self, rp_uuids):
+        """Counts a conflict on each of the supplied providers."""
+        with self._lock:
+            self._conflicts.update(rp_uuids)
+
+    def record_exhausted(self, rp_uuids):
+        """Counts a write involving each of the supplied providers that was
+        given up on after running out of retries.
+        """
+        with self._lock:
+            self._exhausted.update(rp_uuids)
+
+    def get(self, rp_uuid):
+        """Returns a dict of the ``conflicts`` and ``retries_exhausted``
+        counts of the supplied provider.
+        """
+        with self._lock:
+            return {'conflicts': self._conflicts[rp_uuid],
+                    'retries_exhausted': self._exhausted[rp_uuid]}
+
+    def most_contended(self, limit=None):
+        """Returns a list of tuples of (provider UUID, conflicts), with the
+        providers that met the most conflicts first.
+        """
+        with self._lock:
+            return self._conflicts.most_common(limit)
+
+    def reset(self):
+        with self._lock:
+            self._conflicts.clear()
+            self._exhausted.clear()
+
+
+def get_retry_policy():
+    """Returns the RetryPolicy plugged in with set_retry_policy() or, if there
+    is none, one built from the current configuration.
+    """
+    if _POLICY is not None:
+        return _POLICY
+    return RetryPolicy.from_conf()
+
+
+def set_retry_policy(policy):
+    """Plugs in the supplied RetryPolicy, or any object with the same
+    ``attempts`` attribute and ``wait(retry)`` method, in place of the
+    configured one. Passing None restores the configured policy.
+    """
+    global _POLICY
+    _POLICY = policy
+
+
+def get_contention_counters():
+    """Returns the ContentionCounters of this process."""
+    global _COUNTERS
+    if _COUNTERS is None:
+        _COUNTERS = ContentionCounters()
+    return _COUNTERS
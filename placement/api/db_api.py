@@ -11,14 +11,27 @@
 #    under the License.
 """Database context manager for placement database connection, kept in its
 own file so the nova db_api (which has cascading imports) is not imported.
+
+When a ``slave_connection`` is configured next to the ``connection`` of the
+placement database, the GET handlers decorated with replica_reader() read
+from that replica. Everything else uses the primary database.
 """
 
+import functools
+import time
 
 from oslo_db.sqlalchemy import enginefacade
 
+from nova.api.openstack.placement import conf as placement_conf
+
+CONF = placement_conf.CONF
 
 placement_context_manager = enginefacade.transaction_context()
 
+# The time at which this process last handled a request that may have written
+# to the placement database.
+_LAST_WRITE = 0
+
 
 def _get_db_conf(conf_group):
     return dict(conf_group.items())
@@ -35,6 +48,63 @@ def configure(conf):
             **_get_db_conf(conf.placement_database))
 
 
+def note_write():
+    """Records that this process has just handled a request that may have
+    written to the placement database, so that replica_reader() handlers read
+    from the primary database until the replica has caught up.
+    """
+    global _LAST_WRITE
+    _LAST_WRITE = time.time()
+
+
+def replica_reader(f):
+    """Decorator for a GET handler that may read from the replica of the
+    placement database.
+
+    The handler runs in an async reader transaction, which oslo.db sends to
+    the ``slave_connection`` if there is one and to the primary database
+    otherwise. The object methods it calls must therefore only read, in
+    ``reader.allow_async`` transactions. Handlers whose response is the basis
+    of a following write, such as those returning a generation, must see the
+    writes that preceded them and are not decorated.
+
+    For ``[placement]/replica_max_lag`` seconds after this process handled a
+    write, the handler reads from the primary database instead, so that the
+    requests served by the same process after a write see it. Writes handled
+    by other processes are not accounted for, and the actual lag of the
+    replica is not measured: the per-process caches check reading_replica()
+    so as not to go back to older data than they already hold.
+    """
+    @functools.wraps(f)
+    def wrapper(req):
+        if time.time() - _LAST_WRITE < CONF.placement.replica_max_lag:
+            return f(req)
+        context = req.environ['placement.context']
+        context.reads_replica = _has_replica()
+        try:
+            with placement_context_manager.async_.using(context):
+                return f(req)
+        finally:
+            context.reads_replica = False
+    return wrapper
+
+
+def _has_replica():
+    """Returns whether a replica of the placement database is configured."""
+    facade = placement_context_manager.get_legacy_facade()
+    return facade.get_engine(use_slave=True) is not facade.get_engine()
+
+
+def reading_replica(context):
+    """Returns whether the supplied context reads from the replica of the
+    placement database, which may lag behind the primary database and behind
+    what earlier requests read.
+
+    :param context: `nova.context.RequestContext` or DbContext
+    """
+    return getattr(context, 'reads_replica', False)
+
+
 def get_placement_engine():
     return placement_context_manager.get_legacy_facade().get_engine()
 
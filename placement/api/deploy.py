@@ -98,6 +98,7 @@ def update_database():
     ctx = db_api.DbContext()
     resource_provider.ensure_trait_sync(ctx)
     resource_provider.ensure_rc_cache(ctx)
+    resource_provider.ensure_lookup_caches(ctx)
 
 
 # NOTE(cdent): Althought project_name is no longer used because of the
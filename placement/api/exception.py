@@ -179,6 +179,10 @@ class TraitInUse(_BaseException):
     msg_fmt = _("The trait %(name)s is in use by a resource provider.")
 
 
+class ResourceProviderNotFound(NotFound):
+    msg_fmt = _("No such resource provider(s): %(uuids)s.")
+
+
 class TraitNotFound(NotFound):
     msg_fmt = _("No such trait(s): %(names)s.")
 
@@ -28,16 +28,19 @@ import webob
 
 from oslo_log import log as logging
 
+from nova.api.openstack.placement import db_api
 from nova.api.openstack.placement import exception
 from nova.api.openstack.placement.handlers import aggregate
 from nova.api.openstack.placement.handlers import allocation
 from nova.api.openstack.placement.handlers import allocation_candidate
 from nova.api.openstack.placement.handlers import inventory
+from nova.api.openstack.placement.handlers import provider_update
 from nova.api.openstack.placement.handlers import resource_class
 from nova.api.openstack.placement.handlers import resource_provider
 from nova.api.openstack.placement.handlers import root
 from nova.api.openstack.placement.handlers import trait
 from nova.api.openstack.placement.handlers import usage
+from nova.api.openstack.placement.objects import resource_provider as rp_obj
 from nova.api.openstack.placement import util
 from nova.i18n import _
 
@@ -99,6 +102,12 @@ ROUTE_DECLARATIONS = {
     '/resource_providers/{uuid}/allocations': {
         'GET': allocation.list_for_resource_provider,
     },
+    '/resource_provider_updates': {
+        'POST': provider_update.update_resource_providers,
+    },
+    '/resource_provider_trees/{uuid}': {
+        'PUT': provider_update.sync_resource_provider_tree,
+    },
     '/allocations': {
         'POST': allocation.set_allocations,
     },
@@ -143,7 +152,17 @@ def dispatch(environ, start_response, mapper):
     # We can't reach this code without action being present.
     handler = result.pop('action')
     environ['wsgiorg.routing_args'] = ((), result)
-    return handler(environ, start_response)
+    context = environ.get('placement.context')
+    if context is not None:
+        # Another API worker may have changed what this process has cached
+        rp_obj.validate_caches(context)
+    if environ['REQUEST_METHOD'] in ('GET', 'HEAD'):
+        return handler(environ, start_response)
+    try:
+        return handler(environ, start_response)
+    finally:
+        # The replica may not have this write yet when the next reads come
+        db_api.note_write()
 
 
 def handle_405(environ, start_response):
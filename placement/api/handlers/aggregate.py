@@ -51,6 +51,21 @@ def _send_aggregates(req, resource_provider, aggregate_uuids):
     return response
 
 
+def _aggregates_etag(want_version, resource_provider):
+    """Return the entity tag of the aggregates of the provider, or None if
+    the wanted microversion does not support conditional requests.
+
+    Before microversion 1.19 setting aggregates does not increment the
+    provider generation, so the internal IDs of the aggregates are part of
+    the tag.
+    """
+    if not want_version.matches(util.ETAG_MICROVERSION):
+        return None
+    return util.make_etag(
+        want_version, resource_provider.id, resource_provider.generation,
+        *resource_provider.get_aggregate_ids())
+
+
 def _serialize_aggregates(aggregate_uuids):
     return {'aggregates': aggregate_uuids}
 
@@ -88,16 +103,25 @@ def get_aggregates(req):
     If the resource provider does not exist return a 404.
 
     On success return a 200 with an application/json body containing a
-    list of aggregate uuids.
+    list of aggregate uuids. If the request has an If-None-Match header that
+    matches the current entity tag, return a 304 instead.
     """
     context = req.environ['placement.context']
     context.can(policies.LIST)
+    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
     uuid = util.wsgi_path_item(req.environ, 'uuid')
     resource_provider = rp_obj.ResourceProvider.get_by_uuid(
         context, uuid)
+    etag = _aggregates_etag(want_version, resource_provider)
+    not_modified = util.check_if_none_match(req, etag)
+    if not_modified is not None:
+        return not_modified
     aggregate_uuids = resource_provider.get_aggregates()
 
-    return _send_aggregates(req, resource_provider, aggregate_uuids)
+    response = _send_aggregates(req, resource_provider, aggregate_uuids)
+    if etag:
+        response.etag = etag
+    return response
 
 
 @wsgi_wrapper.PlacementWsgify
@@ -115,6 +139,7 @@ def set_aggregates(req):
     uuid = util.wsgi_path_item(req.environ, 'uuid')
     resource_provider = rp_obj.ResourceProvider.get_by_uuid(
         context, uuid)
+    util.check_if_match(req, _aggregates_etag(want_version, resource_provider))
     data = util.extract_json(req.body, put_schema)
     if consider_generation:
         # Check for generation conflict
@@ -12,6 +12,8 @@
 """Placement API handlers for setting and deleting allocations."""
 
 import collections
+import itertools
+import operator
 import uuid
 
 from oslo_log import log as logging
@@ -53,6 +55,17 @@ def _last_modified_from_allocations(allocations, want_version):
     return last_modified
 
 
+def _consumer_etag(context, consumer_uuid, want_version):
+    """Return the entity tag of the allocations of the consumer, or None if
+    the wanted microversion does not support conditional requests.
+    """
+    if not want_version.matches(util.ETAG_MICROVERSION):
+        return None
+    return util.make_etag(
+        want_version, *rp_obj.AllocationList.get_marker_by_consumer_id(
+            context, consumer_uuid))
+
+
 def _serialize_allocations_for_consumer(allocations, want_version):
     """Turn a list of allocations into a dict by resource provider uuid.
 
@@ -107,10 +120,12 @@ def _serialize_allocations_for_consumer(allocations, want_version):
     return result
 
 
-def _serialize_allocations_for_resource_provider(allocations,
-                                                 resource_provider,
-                                                 want_version):
-    """Turn a list of allocations into a dict by consumer id.
+def _stream_allocations_for_resource_provider(rows, resource_provider,
+                                              want_version, links=None):
+    """Turn rows of allocations, as returned by
+    get_allocation_rows_by_provider(), into a dict by consumer id and yield
+    its JSON encoding one consumer at a time, so that neither the dict nor
+    the whole document is ever built.
 
     {'resource_provider_generation': GENERATION,
      'allocations':
@@ -129,28 +144,30 @@ def _serialize_allocations_for_resource_provider(allocations,
            },
            # Generation for consumer >= 1.28
            'consumer_generation': 0
-       }
+       },
+     # Link to the next page >= 1.34, if there may be one
+     'links': [{'rel': 'next', 'href': NEXT_PAGE_URL}]
     }
     """
     show_consumer_gen = want_version.matches((1, 28))
-    allocation_data = collections.defaultdict(dict)
-    for allocation in allocations:
-        key = allocation.consumer.uuid
-        if 'resources' not in allocation_data[key]:
-            allocation_data[key]['resources'] = {}
-
-        resource_class = allocation.resource_class
-        allocation_data[key]['resources'][resource_class] = allocation.used
-
+    yield b'{"allocations": {'
+    separator = ''
+    # The rows are ordered by consumer id
+    for consumer_id, consumer_rows in itertools.groupby(
+            rows, key=operator.itemgetter(0)):
+        data = {'resources': {}}
+        for _consumer_id, consumer_gen, resource_class, used in consumer_rows:
+            data['resources'][resource_class] = used
         if show_consumer_gen:
-            consumer_gen = None
-            if allocation.consumer is not None:
-                consumer_gen = allocation.consumer.generation
-            allocation_data[key]['consumer_generation'] = consumer_gen
-
-    result = {'allocations': allocation_data}
-    result['resource_provider_generation'] = resource_provider.generation
-    return result
+            data['consumer_generation'] = consumer_gen
+        yield encodeutils.to_utf8('%s%s: %s' % (
+            separator, jsonutils.dumps(consumer_id), jsonutils.dumps(data)))
+        separator = ', '
+    yield encodeutils.to_utf8('}, "resource_provider_generation": %d' %
+                              resource_provider.generation)
+    if links:
+        yield encodeutils.to_utf8(', "links": %s' % jsonutils.dumps(links))
+    yield b'}'
 
 
 # TODO(cdent): Extracting this is useful, for reuse by reshaper code,
@@ -169,11 +186,18 @@ def create_allocation_list(context, data, consumers):
     """
     allocation_objects = []
 
+    # Look up the providers of all consumers at once
+    rp_uuids = set()
+    for consumer_data in data.values():
+        rp_uuids.update(consumer_data['allocations'])
+    rp_objs = {}
+    if rp_uuids:
+        rp_objs = _resource_providers_by_uuid(context, rp_uuids)
+
     for consumer_uuid in data:
         allocations = data[consumer_uuid]['allocations']
         consumer = consumers[consumer_uuid]
         if allocations:
-            rp_objs = _resource_providers_by_uuid(context, allocations.keys())
             for resource_provider_uuid in allocations:
                 resource_provider = rp_objs[resource_provider_uuid]
                 resources = allocations[resource_provider_uuid]['resources']
@@ -207,6 +231,13 @@ def list_for_consumer(req):
     # NOTE(cdent): There is no way for a 404 to be returned here,
     # only an empty result. We do not have a way to validate a
     # consumer id.
+    # The entity tag is taken before the allocations are read, so that it
+    # can only be older than the representation, never newer.
+    etag = _consumer_etag(context, consumer_id, want_version)
+    not_modified = util.check_if_none_match(req, etag)
+    if not_modified is not None:
+        return not_modified
+
     allocations = rp_obj.AllocationList.get_all_by_consumer_id(
         context, consumer_id)
 
@@ -221,23 +252,36 @@ def list_for_consumer(req):
     if want_version.matches((1, 15)):
         response.last_modified = last_modified
         response.cache_control = 'no-cache'
+    if etag:
+        response.etag = etag
     return response
 
 
 @wsgi_wrapper.PlacementWsgify
 @util.check_accept('application/json')
 def list_for_resource_provider(req):
-    """List allocations associated with a resource provider."""
-    # TODO(cdent): On a shared resource provider (for example a
-    # giant disk farm) this list could get very long. At the moment
-    # we have no facility for limiting the output. Given that we are
-    # using a dict of dicts for the output we are potentially limiting
-    # ourselves in terms of sorting and filtering.
+    """List allocations associated with a resource provider.
+
+    The allocations are read as plain rows, without any write, and the
+    response body is streamed one consumer at a time. From microversion
+    1.34 the consumers can be paged through with the limit and marker
+    query parameters.
+    """
     context = req.environ['placement.context']
     context.can(policies.RP_ALLOC_LIST)
     want_version = req.environ[microversion.MICROVERSION_ENVIRON]
     uuid = util.wsgi_path_item(req.environ, 'uuid')
 
+    limit = marker = None
+    if want_version.matches((1, 34)):
+        util.validate_query_params(req, schema.GET_RP_ALLOCATIONS_SCHEMA_V1_34)
+        # JSONschema has already confirmed that limit has the form
+        # of an integer.
+        limit = req.GET.get('limit')
+        if limit is not None:
+            limit = int(limit)
+        marker = req.GET.get('marker')
+
     # confirm existence of resource provider so we get a reasonable
     # 404 instead of empty list
     try:
@@ -247,19 +291,27 @@ def list_for_resource_provider(req):
             _("Resource provider '%(rp_uuid)s' not found: %(error)s") %
             {'rp_uuid': uuid, 'error': exc})
 
-    allocs = rp_obj.AllocationList.get_all_by_resource_provider(context, rp)
-
-    output = _serialize_allocations_for_resource_provider(
-        allocs, rp, want_version)
-    last_modified = _last_modified_from_allocations(allocs, want_version)
-    allocations_json = jsonutils.dumps(output)
+    rows = rp_obj.get_allocation_rows_by_provider(
+        context, rp, limit=limit, marker=marker)
+    links = None
+    if limit is not None and rows:
+        last_consumer_id = rows[-1][0]
+        if len(set(row[0] for row in rows)) == limit:
+            # There may be more consumers after the last one of this page
+            links = [{
+                'rel': 'next',
+                'href': util.next_page_url(req, last_consumer_id),
+            }]
 
     response = req.response
     response.status = 200
-    response.body = encodeutils.to_utf8(allocations_json)
+    response.app_iter = _stream_allocations_for_resource_provider(
+        rows, rp, want_version, links=links)
     response.content_type = 'application/json'
     if want_version.matches((1, 15)):
-        response.last_modified = last_modified
+        # The allocations of a provider are not read with their
+        # timestamps, so "now" is the last modified time.
+        response.last_modified = timeutils.utcnow(with_timezone=True)
         response.cache_control = 'no-cache'
     return response
 
@@ -273,23 +325,19 @@ def _resource_providers_by_uuid(ctx, rp_uuids):
     :raises: `webob.exc.HTTPBadRequest` if any of the UUIDs do not refer to
              an existing resource provider.
     """
-    res = {}
-    for rp_uuid in rp_uuids:
-        # TODO(jaypipes): Clearly, this is not efficient to do one query for
-        # each resource provider UUID in the allocations instead of doing a
-        # single query for all the UUIDs. However, since
-        # ResourceProviderList.get_all_by_filters() is way too complicated for
-        # this purpose and doesn't raise NotFound anyway, we'll do this.
-        # Perhaps consider adding a ResourceProviderList.get_all_by_uuids()
-        # later on?
-        try:
-            res[rp_uuid] = rp_obj.ResourceProvider.get_by_uuid(ctx, rp_uuid)
-        except exception.NotFound:
-            raise webob.exc.HTTPBadRequest(
-                _("Allocation for resource provider '%(rp_uuid)s' "
-                  "that does not exist.") %
-                {'rp_uuid': rp_uuid})
-    return res
+    try:
+        rps = rp_obj.ResourceProviderList.get_all_by_uuids(ctx, rp_uuids)
+    except exception.ResourceProviderNotFound as exc:
+        # The UUIDs of all the missing providers, separated by commas
+        missing = exc.kwargs['uuids']
+        if ', ' in missing:
+            msg = _("Allocation for resource providers '%(rp_uuids)s' "
+                    "that do not exist.") % {'rp_uuids': missing}
+        else:
+            msg = _("Allocation for resource provider '%(rp_uuid)s' "
+                    "that does not exist.") % {'rp_uuid': missing}
+        raise webob.exc.HTTPBadRequest(msg)
+    return {rp.uuid: rp for rp in rps}
 
 
 def _new_allocations(context, resource_provider, consumer, resources):
@@ -337,11 +385,13 @@ def _set_allocations_for_consumer(req, schema):
             _('Malformed consumer_uuid: %(consumer_uuid)s') %
             {'consumer_uuid': consumer_uuid})
     consumer_uuid = str(uuid.UUID(consumer_uuid))
+    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
+    util.check_if_match(
+        req, _consumer_etag(context, consumer_uuid, want_version))
     data = util.extract_json(req.body, schema)
     allocation_data = data['allocations']
 
     # Normalize allocation data to dict.
-    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
     if not want_version.matches((1, 12)):
         allocations_dict = {}
         # Allocation are list-ish, transform to dict-ish
@@ -469,25 +519,15 @@ def set_allocations(req):
     # First, ensure that all consumers referenced in the payload actually
     # exist. And if not, create them. Keep a record of auto-created consumers
     # so we can clean them up if the end allocation replace_all() fails.
+    # All consumer generations are checked before any consumer record is
+    # created, so a conflict leaves nothing behind to clean up.
     consumers = {}  # dict of Consumer objects, keyed by consumer UUID
     new_consumers_created = []
-    for consumer_uuid in data:
-        project_id = data[consumer_uuid]['project_id']
-        user_id = data[consumer_uuid]['user_id']
-        consumer_generation = data[consumer_uuid].get('consumer_generation')
-        try:
-            consumer, new_consumer_created = util.ensure_consumer(
-                context, consumer_uuid, project_id, user_id,
-                consumer_generation, want_version)
-            if new_consumer_created:
-                new_consumers_created.append(consumer)
-            consumers[consumer_uuid] = consumer
-        except Exception:
-            # If any errors (for instance, a consumer generation conflict)
-            # occur when ensuring consumer records above, make sure we delete
-            # any auto-created consumers.
-            _delete_consumers(new_consumers_created)
-            raise
+    ensured = util.ensure_consumers(context, data, want_version)
+    for consumer_uuid, (consumer, new_consumer_created) in ensured.items():
+        if new_consumer_created:
+            new_consumers_created.append(consumer)
+        consumers[consumer_uuid] = consumer
 
     # Create a sequence of allocation objects to be used in one
     # AllocationList.replace_all() call, which will mean all the changes
@@ -530,6 +570,9 @@ def delete_allocations(req):
     context = req.environ['placement.context']
     context.can(policies.ALLOC_DELETE)
     consumer_uuid = util.wsgi_path_item(req.environ, 'consumer_uuid')
+    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
+    util.check_if_match(
+        req, _consumer_etag(context, consumer_uuid, want_version))
 
     allocations = rp_obj.AllocationList.get_all_by_consumer_id(
         context, consumer_uuid)
@@ -20,6 +20,7 @@ from oslo_utils import timeutils
 import six
 import webob
 
+from nova.api.openstack.placement import db_api
 from nova.api.openstack.placement import exception
 from nova.api.openstack.placement import microversion
 from nova.api.openstack.placement.objects import resource_provider as rp_obj
@@ -30,6 +31,10 @@ from nova.api.openstack.placement import util
 from nova.api.openstack.placement import wsgi_wrapper
 from nova.i18n import _
 
+# The minimum number of characters of the allocation candidates response body
+# that are sent at once.
+_STREAM_CHUNK_SIZE = 64 * 1024
+
 
 def _transform_allocation_requests_dict(alloc_reqs):
     """Turn supplied list of AllocationRequest objects into a list of
@@ -58,17 +63,19 @@ def _transform_allocation_requests_dict(alloc_reqs):
         ...
     ]
     """
-    results = []
+    return [_allocation_request_dict(ar) for ar in alloc_reqs]
 
-    for ar in alloc_reqs:
-        # A default dict of {$rp_uuid: "resources": {})
-        rp_resources = collections.defaultdict(lambda: dict(resources={}))
-        for rr in ar.resource_requests:
-            res_dict = rp_resources[rr.resource_provider.uuid]['resources']
-            res_dict[rr.resource_class] = rr.amount
-        results.append(dict(allocations=rp_resources))
 
-    return results
+def _allocation_request_dict(ar):
+    """Turn a single AllocationRequest object into the dict format described
+    by _transform_allocation_requests_dict().
+    """
+    # A default dict of {$rp_uuid: "resources": {})
+    rp_resources = collections.defaultdict(lambda: dict(resources={}))
+    for rr in ar.resource_requests:
+        res_dict = rp_resources[rr.resource_provider.uuid]['resources']
+        res_dict[rr.resource_class] = rr.amount
+    return dict(allocations=rp_resources)
 
 
 def _transform_allocation_requests_list(alloc_reqs):
@@ -94,26 +101,29 @@ def _transform_allocation_requests_list(alloc_reqs):
         }, ...
     ]
     """
-    results = []
-    for ar in alloc_reqs:
-        provider_resources = collections.defaultdict(dict)
-        for rr in ar.resource_requests:
-            res_dict = provider_resources[rr.resource_provider.uuid]
-            res_dict[rr.resource_class] = rr.amount
-
-        allocs = [
-            {
-                "resource_provider": {
-                    "uuid": rp_uuid,
-                },
-                "resources": resources,
-            } for rp_uuid, resources in provider_resources.items()
-        ]
-        alloc = {
-            "allocations": allocs
-        }
-        results.append(alloc)
-    return results
+    return [_allocation_request_list(ar) for ar in alloc_reqs]
+
+
+def _allocation_request_list(ar):
+    """Turn a single AllocationRequest object into the list format described
+    by _transform_allocation_requests_list().
+    """
+    provider_resources = collections.defaultdict(dict)
+    for rr in ar.resource_requests:
+        res_dict = provider_resources[rr.resource_provider.uuid]
+        res_dict[rr.resource_class] = rr.amount
+
+    allocs = [
+        {
+            "resource_provider": {
+                "uuid": rp_uuid,
+            },
+            "resources": resources,
+        } for rp_uuid, resources in provider_resources.items()
+    ]
+    return {
+        "allocations": allocs
+    }
 
 
 def _transform_provider_summaries(p_sums, requests, want_version):
@@ -168,39 +178,50 @@ def _transform_provider_summaries(p_sums, requests, want_version):
        }
     }
     """
-    include_traits = want_version.matches((1, 17))
-    include_all_resources = want_version.matches((1, 27))
-    enable_nested_providers = want_version.matches((1, 29))
+    requested_resources = _requested_resources(requests)
+    return {
+        ps.resource_provider.uuid: _provider_summary(
+            ps, requested_resources, want_version)
+        for ps in p_sums
+    }
 
-    ret = {}
-    requested_resources = set()
 
+def _requested_resources(requests):
+    """Return the set of resource classes requested in any request group."""
+    requested_resources = set()
     for requested_group in requests.values():
         requested_resources |= set(requested_group.resources)
+    return requested_resources
+
+
+def _provider_summary(ps, requested_resources, want_version):
+    """Turn a single ProviderSummary object into the dict of provider and
+    inventory information described by _transform_provider_summaries().
+    """
+    include_traits = want_version.matches((1, 17))
+    include_all_resources = want_version.matches((1, 27))
+    enable_nested_providers = want_version.matches((1, 29))
 
     # if include_all_resources is false, only requested resources are
     # included in the provider_summaries.
-    for ps in p_sums:
-        resources = {
-            psr.resource_class: {
-                'capacity': psr.capacity,
-                'used': psr.used,
-            } for psr in ps.resources if (
-                include_all_resources or
-                psr.resource_class in requested_resources)
-        }
-
-        ret[ps.resource_provider.uuid] = {'resources': resources}
-
-        if include_traits:
-            ret[ps.resource_provider.uuid]['traits'] = [
-                t.name for t in ps.traits]
-
-        if enable_nested_providers:
-            ret[ps.resource_provider.uuid]['parent_provider_uuid'] = (
-                ps.resource_provider.parent_provider_uuid)
-            ret[ps.resource_provider.uuid]['root_provider_uuid'] = (
-                ps.resource_provider.root_provider_uuid)
+    resources = {
+        psr.resource_class: {
+            'capacity': psr.capacity,
+            'used': psr.used,
+        } for psr in ps.resources if (
+            include_all_resources or
+            psr.resource_class in requested_resources)
+    }
+
+    ret = {'resources': resources}
+
+    if include_traits:
+        ret['traits'] = [t.name for t in ps.traits]
+
+    if enable_nested_providers:
+        ret['parent_provider_uuid'] = (
+            ps.resource_provider.parent_provider_uuid)
+        ret['root_provider_uuid'] = ps.resource_provider.root_provider_uuid
 
     return ret
 
@@ -268,9 +289,60 @@ def _transform_allocation_candidates(alloc_cands, requests, want_version):
     }
 
 
+def _stream_allocation_candidates(alloc_cands, requests, want_version):
+    """Generate the JSON serialization of the supplied AllocationCandidates
+    object, in the format returned by _transform_allocation_candidates(), as
+    a series of UTF-8 encoded chunks.
+
+    Only one allocation request or provider summary is turned into a dict
+    and serialized at a time, so the memory needed does not grow with the
+    size of the response beyond the AllocationCandidates object itself.
+    """
+    # exclude nested providers with old microversions
+    if not want_version.matches((1, 29)):
+        alloc_cands = _exclude_nested_providers(alloc_cands)
+
+    if want_version.matches((1, 12)):
+        a_req_transform = _allocation_request_dict
+    else:
+        a_req_transform = _allocation_request_list
+    requested_resources = _requested_resources(requests)
+
+    def _pieces():
+        yield '{"allocation_requests": ['
+        for index, ar in enumerate(alloc_cands.allocation_requests):
+            if index:
+                yield ', '
+            yield jsonutils.dumps(a_req_transform(ar))
+        yield '], "provider_summaries": {'
+        for index, ps in enumerate(alloc_cands.provider_summaries):
+            if index:
+                yield ', '
+            yield jsonutils.dumps(ps.resource_provider.uuid)
+            yield ': '
+            yield jsonutils.dumps(
+                _provider_summary(ps, requested_resources, want_version))
+        yield '}}'
+
+    # Send the pieces in chunks of at least _STREAM_CHUNK_SIZE characters
+    # rather than one at a time.
+    chunk = []
+    size = 0
+    for piece in _pieces():
+        chunk.append(piece)
+        size += len(piece)
+        if size >= _STREAM_CHUNK_SIZE:
+            yield encodeutils.to_utf8(''.join(chunk))
+            chunk = []
+            size = 0
+    if chunk:
+        yield encodeutils.to_utf8(''.join(chunk))
+
+
 @wsgi_wrapper.PlacementWsgify
 @microversion.version_handler('1.10')
 @util.check_accept('application/json')
+@db_api.replica_reader
 def list_allocation_candidates(req):
     """GET a JSON object with a list of allocation requests and a JSON object
     of provider summary objects
@@ -312,7 +384,7 @@ def list_allocation_candidates(req):
                   'more than one "resources{N}" parameter.'))
 
     try:
-        cands = rp_obj.AllocationCandidates.get_by_requests(
+        cands = rp_obj.AllocationCandidates.get_records_by_requests(
             context, requests, limit=limit, group_policy=group_policy)
     except exception.ResourceClassNotFound as exc:
         raise webob.exc.HTTPBadRequest(
@@ -322,9 +394,10 @@ def list_allocation_candidates(req):
         raise webob.exc.HTTPBadRequest(six.text_type(exc))
 
     response = req.response
-    trx_cands = _transform_allocation_candidates(cands, requests, want_version)
-    json_data = jsonutils.dumps(trx_cands)
-    response.body = encodeutils.to_utf8(json_data)
+    # The body is serialized as the server sends it, instead of as a whole
+    # up front, to bound the memory used by large responses.
+    response.app_iter = _stream_allocation_candidates(
+        cands, requests, want_version)
     response.content_type = 'application/json'
     if want_version.matches((1, 15)):
         response.cache_control = 'no-cache'
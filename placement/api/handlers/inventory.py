@@ -259,10 +259,13 @@ def get_inventories(req):
     """GET a list of inventories.
 
     On success return a 200 with an application/json body representing
-    a collection of inventories.
+    a collection of inventories. If the request has an If-None-Match header
+    that matches the current entity tag, return a 304 without reading the
+    inventories.
     """
     context = req.environ['placement.context']
     context.can(policies.LIST)
+    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
     uuid = util.wsgi_path_item(req.environ, 'uuid')
     try:
         rp = rp_obj.ResourceProvider.get_by_uuid(context, uuid)
@@ -271,9 +274,18 @@ def get_inventories(req):
             _("No resource provider with uuid %(uuid)s found : %(error)s") %
              {'uuid': uuid, 'error': exc})
 
+    # Any change to the inventories increments the provider generation.
+    etag = util.make_etag(want_version, rp.id, rp.generation)
+    not_modified = util.check_if_none_match(req, etag)
+    if not_modified is not None:
+        return not_modified
+
     inv_list = rp_obj.InventoryList.get_all_by_resource_provider(context, rp)
 
-    return _send_inventories(req, rp, inv_list)
+    response = _send_inventories(req, rp, inv_list)
+    if etag:
+        response.etag = etag
+    return response
 
 
 @wsgi_wrapper.PlacementWsgify
@@ -319,14 +331,20 @@ def set_inventories(req):
     If any inventory to be created or updated has settings which are
     invalid (for example reserved exceeds capacity), return a 400.
 
+    If the request has an If-Match header that does not match the current
+    entity tag, return a 412.
+
     On success return a 200 with an application/json body representing
     the inventories.
     """
     context = req.environ['placement.context']
     context.can(policies.UPDATE)
+    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
     uuid = util.wsgi_path_item(req.environ, 'uuid')
     resource_provider = rp_obj.ResourceProvider.get_by_uuid(
         context, uuid)
+    util.check_if_match(req, util.make_etag(
+        want_version, resource_provider.id, resource_provider.generation))
 
     data = _extract_inventories(req.body, schema.PUT_INVENTORY_SCHEMA)
     if data['resource_provider_generation'] != resource_provider.generation:
@@ -381,14 +399,19 @@ def delete_inventories(req):
 
     Delete inventory as required to reset all the inventory.
     If an inventory to be deleted is in use, return a 409 Conflict.
+    If the request has an If-Match header that does not match the current
+    entity tag, return a 412.
     On success return a 204 No content.
     Return 405 Method Not Allowed if the wanted microversion does not match.
     """
     context = req.environ['placement.context']
     context.can(policies.DELETE)
+    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
     uuid = util.wsgi_path_item(req.environ, 'uuid')
     resource_provider = rp_obj.ResourceProvider.get_by_uuid(
         context, uuid)
+    util.check_if_match(req, util.make_etag(
+        want_version, resource_provider.id, resource_provider.generation))
 
     inventories = rp_obj.InventoryList(objects=[])
 
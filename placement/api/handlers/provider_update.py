@@ -0,0 +1,338 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Placement API handlers for updating many resource providers at once."""
+
+import copy
+
+from oslo_db import exception as db_exc
+from oslo_serialization import jsonutils
+from oslo_utils import encodeutils
+import webob
+
+from nova.api.openstack.placement import errors
+from nova.api.openstack.placement import exception
+from nova.api.openstack.placement.handlers import inventory
+from nova.api.openstack.placement import microversion
+from nova.api.openstack.placement.objects import resource_provider as rp_obj
+from nova.api.openstack.placement.policies import resource_provider as policies
+from nova.api.openstack.placement.schemas import provider_update as schema
+from nova.api.openstack.placement import util
+from nova.api.openstack.placement import wsgi_wrapper
+from nova.i18n import _
+
+
+def _make_inventory_list(resource_provider, inventories):
+    """Returns an InventoryList from the inventories of one provider in the
+    request body, filling in the defaults.
+    """
+    inv_list = []
+    for res_class, raw_inventory in inventories.items():
+        inventory_data = copy.copy(inventory.INVENTORY_DEFAULTS)
+        inventory_data.update(raw_inventory)
+        inv_list.append(inventory._make_inventory_object(
+            resource_provider, res_class, **inventory_data))
+    return rp_obj.InventoryList(objects=inv_list)
+
+
+def _get_traits_by_name(context, provider_data):
+    """Returns a dict, keyed by name, of the Trait objects of every trait
+    named in the request body, looked up with a single query.
+
+    :raises: webob.exc.HTTPBadRequest if any trait does not exist.
+    """
+    names = set()
+    for data in provider_data.values():
+        names.update(data.get('traits', []))
+    if not names:
+        return {}
+    trait_objs = rp_obj.TraitList.get_all(
+        context, filters={'name_in': list(names)})
+    traits = {trait.name: trait for trait in trait_objs}
+    missing = names - set(traits)
+    if missing:
+        raise webob.exc.HTTPBadRequest(
+            _("No such trait %s") % ', '.join(sorted(missing)))
+    return traits
+
+
+def _make_provider_update(want_version, rp, rp_data, traits):
+    """Returns a ProviderUpdate from the data of one provider in the request
+    body.
+
+    :param traits: dict, keyed by name, of the Trait objects named anywhere
+                   in the request body.
+    :raises: webob.exc.HTTPBadRequest if any inventory is invalid.
+    """
+    inventories = rp_traits = None
+    if 'inventories' in rp_data:
+        inventories = _make_inventory_list(rp, rp_data['inventories'])
+        try:
+            inventory._validate_inventory_capacity(want_version, inventories)
+        except exception.InvalidInventoryCapacity as exc:
+            raise webob.exc.HTTPBadRequest(
+                _('Unable to update inventory for resource provider '
+                  '%(rp_uuid)s: %(error)s') % {'rp_uuid': rp.uuid,
+                                              'error': exc})
+    if 'traits' in rp_data:
+        rp_traits = [traits[name] for name in rp_data['traits']]
+    return rp_obj.ProviderUpdate(
+        rp, inventories, rp_traits, rp_data.get('aggregates'))
+
+
+def _send_generations(req, rps):
+    """Returns a 200 response whose application/json body gives the
+    generation of each of the supplied resource providers.
+    """
+    response_body = {
+        'resource_providers': {
+            rp.uuid: {'resource_provider_generation': rp.generation}
+            for rp in rps
+        }
+    }
+    req.response.status = 200
+    req.response.body = encodeutils.to_utf8(jsonutils.dumps(response_body))
+    req.response.content_type = 'application/json'
+    return req.response
+
+
+@wsgi_wrapper.PlacementWsgify
+@microversion.version_handler('1.31')
+@util.require_content('application/json')
+def update_resource_providers(req):
+    """POST to replace the inventories, traits and aggregates of many
+    resource providers in a single transaction.
+
+    Each provider in the body carries the generation it is expected to
+    have and any of its inventories, traits and aggregates. What is left
+    out is not changed.
+
+    If any provider does not exist, or any inventory or trait is invalid,
+    return a 400.
+    If the generation of any provider is out of sync, return a 409 naming
+    every such provider. Nothing is changed.
+
+    On success return a 200 with an application/json body giving the new
+    generation of each provider.
+    """
+    context = req.environ['placement.context']
+    context.can(policies.BULK_UPDATE)
+    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
+    data = util.extract_json(req.body, schema.POST_PROVIDER_UPDATES_SCHEMA)
+    provider_data = data['resource_providers']
+
+    try:
+        rps = rp_obj.ResourceProviderList.get_all_by_uuids(
+            context, provider_data)
+    except exception.ResourceProviderNotFound as exc:
+        raise webob.exc.HTTPBadRequest(
+            _("No resource provider with uuid %(uuids)s found") %
+            {'uuids': exc.kwargs['uuids']})
+    rps = {rp.uuid: rp for rp in rps}
+
+    conflicts = sorted(
+        rp_uuid for rp_uuid, rp in rps.items()
+        if rp.generation !=
+        provider_data[rp_uuid]['resource_provider_generation'])
+    if conflicts:
+        raise webob.exc.HTTPConflict(
+            _('resource provider generation conflict: %(rp_uuids)s') %
+            {'rp_uuids': ', '.join(conflicts)},
+            comment=errors.CONCURRENT_UPDATE)
+
+    traits = _get_traits_by_name(context, provider_data)
+    updates = [
+        _make_provider_update(want_version, rp, provider_data[rp_uuid], traits)
+        for rp_uuid, rp in rps.items()
+    ]
+
+    try:
+        rp_obj.update_providers(context, updates)
+    except exception.ResourceClassNotFound as exc:
+        raise webob.exc.HTTPBadRequest(
+            _('Unknown resource class in inventory: %(error)s') %
+            {'error': exc})
+    except exception.InventoryWithResourceClassNotFound as exc:
+        raise webob.exc.HTTPConflict(
+            _('Race condition detected when setting inventory: '
+              '%(error)s') % {'error': exc})
+    except (exception.ConcurrentUpdateDetected,
+            db_exc.DBDuplicateEntry) as exc:
+        raise webob.exc.HTTPConflict(
+            _('update conflict: %(error)s') % {'error': exc},
+            comment=errors.CONCURRENT_UPDATE)
+    except exception.InventoryInUse as exc:
+        raise webob.exc.HTTPConflict(
+            _('update conflict: %(error)s') % {'error': exc},
+            comment=errors.INVENTORY_INUSE)
+    except exception.InvalidInventoryCapacity as exc:
+        raise webob.exc.HTTPBadRequest(
+            _('Unable to update inventory: %(error)s') % {'error': exc})
+
+    return _send_generations(req, rps.values())
+
+
+def _check_tree(root_uuid, provider_data):
+    """Checks that the providers in the request body form a single tree
+    whose root is the provider identified by root_uuid.
+
+    :raises: webob.exc.HTTPBadRequest if they do not.
+    """
+    if root_uuid not in provider_data:
+        raise webob.exc.HTTPBadRequest(
+            _('The root resource provider %(rp_uuid)s is not in the tree.') %
+            {'rp_uuid': root_uuid})
+    for rp_uuid, rp_data in provider_data.items():
+        parent_uuid = rp_data.get('parent_provider_uuid')
+        if rp_uuid == root_uuid:
+            if parent_uuid is not None:
+                raise webob.exc.HTTPBadRequest(
+                    _('The root resource provider %(rp_uuid)s cannot have '
+                      'a parent.') % {'rp_uuid': rp_uuid})
+            continue
+        if parent_uuid is None:
+            raise webob.exc.HTTPBadRequest(
+                _('Resource provider %(rp_uuid)s has no parent, but only '
+                  'the root resource provider may have none.') %
+                {'rp_uuid': rp_uuid})
+        # Walk up to the root. A tree has no path longer than the number of
+        # its providers.
+        seen = set([rp_uuid])
+        while parent_uuid != root_uuid:
+            if parent_uuid not in provider_data:
+                raise webob.exc.HTTPBadRequest(
+                    _('The parent %(parent_uuid)s of resource provider '
+                      '%(rp_uuid)s is not in the tree.') %
+                    {'parent_uuid': parent_uuid, 'rp_uuid': rp_uuid})
+            if parent_uuid in seen:
+                raise webob.exc.HTTPBadRequest(
+                    _('Resource provider %(rp_uuid)s is in a loop.') %
+                    {'rp_uuid': rp_uuid})
+            seen.add(parent_uuid)
+            parent_uuid = provider_data[parent_uuid].get(
+                'parent_provider_uuid')
+
+
+@wsgi_wrapper.PlacementWsgify
+@microversion.version_handler('1.32')
+@util.require_content('application/json')
+def sync_resource_provider_tree(req):
+    """PUT the desired state of a whole tree of resource providers, which
+    is reached in a single transaction.
+
+    Providers of the tree that are not in the body are deleted and those in
+    the body that do not exist yet are created. The names of the others are
+    updated. The inventories, traits and aggregates of each provider are
+    replaced by those in the body. What is left out is not changed.
+
+    Each existing provider in the body carries the generation it is
+    expected to have, and each new one carries none. If any of them is out
+    of sync, return a 409 naming every such provider. Nothing is changed.
+
+    If the body does not describe a tree rooted at the provider in the URL,
+    or any inventory or trait is invalid, return a 400.
+
+    On success return a 200 with an application/json body giving the
+    generation of each provider of the tree.
+    """
+    root_uuid = util.wsgi_path_item(req.environ, 'uuid')
+    context = req.environ['placement.context']
+    context.can(policies.SYNC_TREE)
+    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
+    data = util.extract_json(req.body, schema.PUT_PROVIDER_TREE_SCHEMA)
+    provider_data = data['resource_providers']
+    _check_tree(root_uuid, provider_data)
+
+    stored = rp_obj.ResourceProviderList.get_all_by_filters(
+        context, filters={'in_tree': root_uuid})
+    stored_by_uuid = {rp.uuid: rp for rp in stored}
+    root = stored_by_uuid.get(root_uuid)
+    if root is not None and root.parent_provider_uuid is not None:
+        raise webob.exc.HTTPBadRequest(
+            _('Resource provider %(rp_uuid)s is not a root resource '
+              'provider.') % {'rp_uuid': root_uuid})
+
+    conflicts = []
+    for rp_uuid, rp_data in provider_data.items():
+        generation = None
+        if rp_uuid in stored_by_uuid:
+            generation = stored_by_uuid[rp_uuid].generation
+        if rp_data.get('resource_provider_generation') != generation:
+            conflicts.append(rp_uuid)
+    if conflicts:
+        raise webob.exc.HTTPConflict(
+            _('resource provider generation conflict: %(rp_uuids)s') %
+            {'rp_uuids': ', '.join(sorted(conflicts))},
+            comment=errors.CONCURRENT_UPDATE)
+
+    traits = _get_traits_by_name(context, provider_data)
+    rps = []
+    desired = []
+    for rp_uuid, rp_data in provider_data.items():
+        parent_uuid = rp_data.get('parent_provider_uuid')
+        rp = stored_by_uuid.get(rp_uuid)
+        if rp is None:
+            rp = rp_obj.ResourceProvider(
+                context, uuid=rp_uuid, name=rp_data['name'],
+                parent_provider_uuid=parent_uuid)
+        else:
+            if rp.parent_provider_uuid != parent_uuid:
+                raise webob.exc.HTTPBadRequest(
+                    _('Unable to move resource provider %(rp_uuid)s: '
+                      're-parenting a provider is not currently allowed.') %
+                    {'rp_uuid': rp_uuid})
+            if rp.name != rp_data['name']:
+                rp.name = rp_data['name']
+        rps.append(rp)
+        desired.append(
+            _make_provider_update(want_version, rp, rp_data, traits))
+
+    try:
+        rp_obj.sync_provider_tree(context, stored, desired)
+    except db_exc.DBDuplicateEntry as exc:
+        if set(exc.columns) <= set(['uuid', 'name']):
+            raise webob.exc.HTTPConflict(
+                _('Conflicting resource provider %(columns)s already '
+                  'exists.') % {'columns': ', '.join(exc.columns)},
+                comment=errors.DUPLICATE_NAME)
+        raise webob.exc.HTTPConflict(
+            _('update conflict: %(error)s') % {'error': exc},
+            comment=errors.CONCURRENT_UPDATE)
+    except exception.ConcurrentUpdateDetected as exc:
+        raise webob.exc.HTTPConflict(
+            _('update conflict: %(error)s') % {'error': exc},
+            comment=errors.CONCURRENT_UPDATE)
+    except exception.ResourceProviderInUse as exc:
+        raise webob.exc.HTTPConflict(
+            _('Unable to delete resource provider from the tree: '
+              '%(error)s') % {'error': exc},
+            comment=errors.PROVIDER_IN_USE)
+    except exception.ObjectActionError as exc:
+        raise webob.exc.HTTPBadRequest(
+            _('Unable to save resource provider tree %(rp_uuid)s: '
+              '%(error)s') % {'rp_uuid': root_uuid, 'error': exc})
+    except exception.ResourceClassNotFound as exc:
+        raise webob.exc.HTTPBadRequest(
+            _('Unknown resource class in inventory: %(error)s') %
+            {'error': exc})
+    except exception.InventoryWithResourceClassNotFound as exc:
+        raise webob.exc.HTTPConflict(
+            _('Race condition detected when setting inventory: '
+              '%(error)s') % {'error': exc})
+    except exception.InventoryInUse as exc:
+        raise webob.exc.HTTPConflict(
+            _('update conflict: %(error)s') % {'error': exc},
+            comment=errors.INVENTORY_INUSE)
+    except exception.InvalidInventoryCapacity as exc:
+        raise webob.exc.HTTPBadRequest(
+            _('Unable to update inventory: %(error)s') % {'error': exc})
+
+    return _send_generations(req, rps)
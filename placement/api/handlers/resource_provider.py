@@ -45,27 +45,39 @@ def _serialize_links(environ, resource_provider):
     return links
 
 
-def _serialize_provider(environ, resource_provider, want_version):
-    data = {
-        'uuid': resource_provider.uuid,
-        'name': resource_provider.name,
-        'generation': resource_provider.generation,
-        'links': _serialize_links(environ, resource_provider)
-    }
-    if want_version.matches((1, 14)):
-        data['parent_provider_uuid'] = resource_provider.parent_provider_uuid
-        data['root_provider_uuid'] = resource_provider.root_provider_uuid
+# The fields of a resource provider that can be selected with the fields
+# query parameter of GET /resource_providers, from microversion 1.33.
+PROVIDER_FIELDS = ('uuid', 'name', 'generation', 'links',
+                   'parent_provider_uuid', 'root_provider_uuid')
+
+
+def _serialize_provider(environ, resource_provider, want_version,
+                        fields=None):
+    if fields is None:
+        fields = PROVIDER_FIELDS
+        if not want_version.matches((1, 14)):
+            # The parent and root providers are shown from 1.14
+            fields = ('uuid', 'name', 'generation', 'links')
+    data = {}
+    for field in fields:
+        if field == 'links':
+            data['links'] = _serialize_links(environ, resource_provider)
+        else:
+            data[field] = getattr(resource_provider, field)
     return data
 
 
-def _serialize_providers(environ, resource_providers, want_version):
+def _serialize_providers(environ, resource_providers, want_version,
+                         fields=None):
     output = []
     last_modified = None
-    get_last_modified = want_version.matches((1, 15))
+    # Timestamps are not read when only some fields are wanted
+    get_last_modified = want_version.matches((1, 15)) and fields is None
     for provider in resource_providers:
         if get_last_modified:
             last_modified = util.pick_last_modified(last_modified, provider)
-        provider_data = _serialize_provider(environ, provider, want_version)
+        provider_data = _serialize_provider(environ, provider, want_version,
+                                            fields=fields)
         output.append(provider_data)
     last_modified = last_modified or timeutils.utcnow(with_timezone=True)
     return ({"resource_providers": output}, last_modified)
@@ -195,7 +207,9 @@ def list_resource_providers(req):
     want_version = req.environ[microversion.MICROVERSION_ENVIRON]
 
     schema = rp_schema.GET_RPS_SCHEMA_1_0
-    if want_version.matches((1, 18)):
+    if want_version.matches((1, 33)):
+        schema = rp_schema.GET_RPS_SCHEMA_1_33
+    elif want_version.matches((1, 18)):
         schema = rp_schema.GET_RPS_SCHEMA_1_18
     elif want_version.matches((1, 14)):
         schema = rp_schema.GET_RPS_SCHEMA_1_14
@@ -224,9 +238,27 @@ def list_resource_providers(req):
                 value = util.normalize_traits_qs_param(
                     value, allow_forbidden=allow_forbidden)
             filters[attr] = value
+
+    # JSONschema has already confirmed that limit has the form
+    # of an integer.
+    limit = req.GET.get('limit')
+    if limit is not None:
+        limit = int(limit)
+    marker = req.GET.get('marker')
+    fields = rp_fields = None
+    if 'fields' in req.GET:
+        fields = util.normalize_fields_qs_param(
+            req.GET['fields'], PROVIDER_FIELDS)
+        # Only the columns of the selected fields are read. The links and
+        # the marker of the next page only need the uuid, which is
+        # always read.
+        rp_fields = set(fields) - set(['links'])
     try:
         resource_providers = rp_obj.ResourceProviderList.get_all_by_filters(
-            context, filters)
+            context, filters, limit=limit, marker=marker, fields=rp_fields)
+    except exception.ResourceProviderNotFound as exc:
+        raise webob.exc.HTTPBadRequest(
+            _('Invalid marker: %(error)s') % {'error': exc})
     except exception.ResourceClassNotFound as exc:
         raise webob.exc.HTTPBadRequest(
             _('Invalid resource class in resources parameter: %(error)s') %
@@ -238,7 +270,13 @@ def list_resource_providers(req):
 
     response = req.response
     output, last_modified = _serialize_providers(
-        req.environ, resource_providers, want_version)
+        req.environ, resource_providers, want_version, fields=fields)
+    if limit is not None and len(resource_providers) == limit:
+        # There may be more providers after the last one of this page
+        output['links'] = [{
+            'rel': 'next',
+            'href': util.next_page_url(req, resource_providers[-1].uuid),
+        }]
     response.body = encodeutils.to_utf8(jsonutils.dumps(output))
     response.content_type = 'application/json'
     if want_version.matches((1, 15)):
@@ -194,6 +194,12 @@ def list_traits_for_resource_provider(req):
             _("No resource provider with uuid %(uuid)s found: %(error)s") %
              {'uuid': uuid, 'error': exc})
 
+    # Any change to the traits increments the provider generation.
+    etag = util.make_etag(want_version, rp.id, rp.generation)
+    not_modified = util.check_if_none_match(req, etag)
+    if not_modified is not None:
+        return not_modified
+
     traits = rp_obj.TraitList.get_all_by_resource_provider(context, rp)
     response_body, last_modified = _serialize_traits(traits, want_version)
     response_body["resource_provider_generation"] = rp.generation
@@ -201,6 +207,8 @@ def list_traits_for_resource_provider(req):
     if want_version.matches((1, 15)):
         req.response.last_modified = last_modified
         req.response.cache_control = 'no-cache'
+    if etag:
+        req.response.etag = etag
 
     req.response.status = 200
     req.response.body = encodeutils.to_utf8(jsonutils.dumps(response_body))
@@ -221,6 +229,8 @@ def update_traits_for_resource_provider(req):
     traits = data['traits']
     resource_provider = rp_obj.ResourceProvider.get_by_uuid(
         context, uuid)
+    util.check_if_match(req, util.make_etag(
+        want_version, resource_provider.id, resource_provider.generation))
 
     if resource_provider.generation != rp_gen:
         raise webob.exc.HTTPConflict(
@@ -256,9 +266,12 @@ def update_traits_for_resource_provider(req):
 def delete_traits_for_resource_provider(req):
     context = req.environ['placement.context']
     context.can(policies.RP_TRAIT_DELETE)
+    want_version = req.environ[microversion.MICROVERSION_ENVIRON]
     uuid = util.wsgi_path_item(req.environ, 'uuid')
 
     resource_provider = rp_obj.ResourceProvider.get_by_uuid(context, uuid)
+    util.check_if_match(req, util.make_etag(
+        want_version, resource_provider.id, resource_provider.generation))
     try:
         resource_provider.set_traits(rp_obj.TraitList(objects=[]))
     except exception.ConcurrentUpdateDetected as e:
@@ -16,6 +16,7 @@ from oslo_utils import encodeutils
 from oslo_utils import timeutils
 import webob
 
+from nova.api.openstack.placement import db_api
 from nova.api.openstack.placement import exception
 from nova.api.openstack.placement import microversion
 from nova.api.openstack.placement.objects import resource_provider as rp_obj
@@ -82,6 +83,7 @@ def list_usages(req):
 @wsgi_wrapper.PlacementWsgify
 @microversion.version_handler('1.9')
 @util.check_accept('application/json')
+@db_api.replica_reader
 def get_total_usages(req):
     """GET the sum of usages for a project or a project/user.
 
@@ -0,0 +1,198 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Process-wide caches of trait name and placement aggregate UUID to internal
+ID mappings.
+
+Like the ResourceClassCache, each cache holds an immutable snapshot that is
+read without taking any lock. A lookup of a key that is not in the snapshot
+checks a marker of the table with a single aggregate query and only reads
+the table if it changed. Rows are normally only ever added to these tables,
+so a changed table is usually caught up by reading just the rows with an ID
+above the highest one already cached. Anything else, such as a deleted trait,
+makes the whole table be read again.
+
+Keys are never renamed, so a hit can only be stale once its row is deleted.
+Placement aggregates are never deleted. Traits are, and deleting one
+increments the TRAIT_DELETIONS change counter: expire() is given its current
+version at the start of every request and drops a snapshot loaded before the
+deletion, whichever API worker made it.
+"""
+
+import collections
+
+from oslo_concurrency import lockutils
+import six
+import sqlalchemy as sa
+from sqlalchemy import sql
+
+from nova.api.openstack.placement import change_log
+from nova.api.openstack.placement import db_api
+from nova.db.sqlalchemy import api_models as models
+
+_VERSION_TBL = models.PlacementVersion.__table__
+
+# The version is that of the change counter of the cache, if it has one,
+# when the snapshot was taken.
+_Snapshot = collections.namedtuple('_Snapshot', 'marker ids version')
+
+_EMPTY = _Snapshot(None, {}, None)
+
+
+class _LookupCache(object):
+    """A cache of the internal IDs of the rows of a table, keyed by the value
+    of a unique column of the table.
+    """
+
+    # The table and its unique key column, set by subclasses
+    _TABLE = None
+    _KEY = None
+    _LOCKNAME = None
+    # The change counter incremented whenever a row is deleted, if rows of
+    # the table can be
+    _COUNTER = None
+
+    def __init__(self, ctx):
+        """
+        :param ctx: `nova.context.RequestContext` from which we can grab a
+                    `SQLAlchemy.Connection` object to use for any DB lookups.
+        """
+        self.ctx = ctx
+        self._snapshot = _EMPTY
+        self._stats = collections.Counter()
+
+    def clear(self):
+        """Drops the snapshot, so that the next lookup that misses reads the
+        whole table again.
+        """
+        self._snapshot = _EMPTY
+
+    def expire(self, version):
+        """Drops the snapshot if it was taken at another version of the
+        change counter of the cache.
+
+        :param version: current version of the counter, as returned by
+                        change_log.get_versions()
+        """
+        snapshot_version = self._snapshot.version
+        if snapshot_version is not None and snapshot_version != version:
+            self._snapshot = _EMPTY
+
+    def stats(self):
+        """Returns a dict of the number of keys looked up that were found in
+        the cache (``hits``) or not (``misses``), and of the times the table
+        was read to catch up (``refreshes``) or read whole (``reloads``).
+        The counts are not synchronized and may be slightly off under
+        concurrent lookups.
+        """
+        return {key: self._stats[key]
+                for key in ('hits', 'misses', 'refreshes', 'reloads')}
+
+    def _marker_from_db(self, conn):
+        tbl = self._TABLE
+        sel = sa.select([
+            sql.func.count(tbl.c.id),
+            sql.func.max(tbl.c.id),
+            sql.func.max(tbl.c.created_at),
+        ])
+        return tuple(conn.execute(sel).fetchone())
+
+    def _version_from_db(self, conn):
+        if self._COUNTER is None:
+            return None
+        sel = sa.select([_VERSION_TBL.c.version]).where(
+            _VERSION_TBL.c.name == self._COUNTER)
+        return conn.execute(sel).scalar() or 0
+
+    def _select_rows(self, after_id=None):
+        tbl = self._TABLE
+        sel = sa.select([tbl.c[self._KEY], tbl.c.id])
+        if after_id is not None:
+            sel = sel.where(tbl.c.id > after_id)
+        return sel
+
+    def _refresh(self):
+        """Returns the current snapshot, replacing it first if the table
+        changed since it was taken.
+        """
+        with lockutils.lock(self._LOCKNAME):
+            snapshot = self._snapshot
+            reader = db_api.placement_context_manager.reader.allow_async
+            with reader.connection.using(self.ctx) as conn:
+                # Read first, so that a row deleted while the table is read
+                # expires the snapshot at the next request.
+                version = self._version_from_db(conn)
+                marker = self._marker_from_db(conn)
+                if marker == snapshot.marker:
+                    return snapshot
+                max_id = snapshot.marker[1] if snapshot.marker else None
+                if max_id is not None and (marker[1] or 0) > max_id:
+                    # Only read the rows added since the snapshot was taken
+                    ids = dict(snapshot.ids)
+                    ids.update(
+                        (r[0], r[1]) for r in
+                        conn.execute(self._select_rows(max_id)))
+                    if len(ids) == marker[0]:
+                        self._stats['refreshes'] += 1
+                        snapshot = self._snapshot = _Snapshot(
+                            marker, ids, version)
+                        return snapshot
+                # Rows were removed or the snapshot is empty: read it all
+                ids = {r[0]: r[1]
+                       for r in conn.execute(self._select_rows())}
+                self._stats['reloads'] += 1
+                snapshot = self._snapshot = _Snapshot(marker, ids, version)
+                return snapshot
+
+    def ids_from_keys(self, keys):
+        """Returns a dict, keyed by the supplied keys, of the internal IDs of
+        the rows having them. Keys that match no row are left out.
+
+        :param keys: iterable of the values of the unique key column
+        """
+        ids = self._snapshot.ids
+        found = {}
+        missing = []
+        for key in keys:
+            key = six.text_type(key)
+            row_id = ids.get(key)
+            if row_id is None:
+                missing.append(key)
+            else:
+                found[key] = row_id
+        self._stats['hits'] += len(found)
+        if missing:
+            self._stats['misses'] += len(missing)
+            ids = self._refresh().ids
+            for key in missing:
+                row_id = ids.get(key)
+                if row_id is not None:
+                    found[key] = row_id
+        return found
+
+
+class TraitCache(_LookupCache):
+    """A cache of trait internal IDs, keyed by trait name."""
+
+    _TABLE = models.Trait.__table__
+    _KEY = 'name'
+    _LOCKNAME = 'trait_cache'
+    _COUNTER = change_log.TRAIT_DELETIONS
+
+
+class AggregateCache(_LookupCache):
+    """A cache of placement aggregate internal IDs, keyed by aggregate
+    UUID.
+    """
+
+    _TABLE = models.PlacementAggregate.__table__
+    _KEY = 'uuid'
+    _LOCKNAME = 'aggregate_cache'
@@ -0,0 +1,178 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Command line management of the placement database.
+
+Run the online data migrations of placement with::
+
+    python -m nova.api.openstack.placement.manage db online_data_migrations
+
+The configuration is read from the same files as the rest of nova, such as
+``/etc/nova/nova.conf``.
+"""
+
+from __future__ import print_function
+
+import functools
+import sys
+
+from oslo_config import cfg
+from oslo_log import log as logging
+import pbr.version
+import prettytable
+
+from nova.api.openstack.placement import db_api
+from nova.api.openstack.placement.objects import consumer as consumer_obj
+from nova.api.openstack.placement.objects import resource_provider as rp_obj
+from nova import conf
+from nova.i18n import _
+
+LOG = logging.getLogger(__name__)
+
+version_info = pbr.version.VersionInfo('nova')
+
+# The number of records each online data migration is asked to handle at a
+# time when no --max-count is given
+_DEFAULT_BATCH_SIZE = 50
+
+# The online data migrations, run in this order. Each is called with a
+# context and the maximum number of records to migrate, and returns a tuple
+# of (the number of records found needing the migration, the number
+# migrated).
+online_migrations = (
+    # API database migration 065 requires these two to be complete
+    rp_obj.set_root_provider_ids,
+    consumer_obj.create_incomplete_consumers,
+    rp_obj.repair_provider_closure,
+    rp_obj.repair_provider_usages,
+)
+
+
+class DbCommands(object):
+
+    def __init__(self, config):
+        self.config = config
+
+    def _run_online_migrations(self, ctx, max_count):
+        """Runs each online data migration until max_count records have been
+        migrated in total.
+
+        Returns a tuple of (a dict, keyed by the name of the migrations, of
+        tuples of (the number of records found, the number migrated), whether
+        any migration raised an exception).
+        """
+        ran = 0
+        exceptions = False
+        migrations = {}
+        for migration_meth in online_migrations:
+            name = migration_meth.__name__
+            try:
+                found, done = migration_meth(ctx, max_count - ran)
+            except Exception:
+                LOG.exception("Error attempting to run %s", name)
+                print(_("Error attempting to run %s") % name)
+                exceptions = True
+                found = done = 0
+            if found:
+                print(_('%(total)i rows matched query %(meth)s, %(done)i '
+                        'migrated') % {'total': found, 'meth': name,
+                                       'done': done})
+            migrations[name] = (found, done)
+            ran += done
+            if ran >= max_count:
+                break
+        return migrations, exceptions
+
+    def db_online_data_migrations(self):
+        """Runs the online data migrations in batches until they are
+        complete, or only once if --max-count is given.
+
+        Returns 0 once every migration is complete, 1 if --max-count was
+        given and records may be left to migrate, 2 if any migration raised
+        an exception and 127 if --max-count is not a positive number.
+        """
+        max_count = self.config.command.max_count
+        limited = max_count is not None
+        if limited:
+            if max_count < 1:
+                print(_('Must supply a positive value for max-count'))
+                return 127
+        else:
+            max_count = _DEFAULT_BATCH_SIZE
+            print(_('Running batches of %i until complete') % max_count)
+
+        ctx = db_api.DbContext()
+        totals = {}
+        failed = False
+        ran = None
+        while ran != 0:
+            ran = 0
+            migrations, exceptions = self._run_online_migrations(
+                ctx, max_count)
+            failed = failed or exceptions
+            for name, (found, done) in migrations.items():
+                total_found, total_done = totals.get(name, (0, 0))
+                totals[name] = (total_found + found, total_done + done)
+                ran += done
+            if limited:
+                break
+
+        table = prettytable.PrettyTable(
+            [_('Migration'), _('Total Found'), _('Completed')])
+        for name in sorted(totals):
+            table.add_row([name, totals[name][0], totals[name][1]])
+        print(table)
+
+        if failed:
+            print(_('Some migrations failed unexpectedly. Check the log for '
+                    'details.'))
+            return 2
+        # Without a limit the loop only ends once nothing is left to migrate
+        if ran:
+            return 1
+        return 0
+
+
+def add_db_command_parsers(subparsers, config):
+    command_object = DbCommands(config)
+
+    parser = subparsers.add_parser('db')
+    db_parser = parser.add_subparsers(description='database commands')
+
+    migrate_parser = db_parser.add_parser(
+        'online_data_migrations',
+        help=_('Run the online data migrations of placement, which must be '
+               'complete before the next database upgrade.'))
+    migrate_parser.add_argument(
+        '--max-count', metavar='<number>', type=int,
+        help=_('Maximum number of records to migrate. Without it, the '
+               'migrations run in batches until they are complete.'))
+    migrate_parser.set_defaults(
+        func=command_object.db_online_data_migrations)
+
+
+def main(argv=sys.argv):
+    config = conf.CONF
+    add_db_cmd_parsers = functools.partial(
+        add_db_command_parsers, config=config)
+    command_opt = cfg.SubCommandOpt(
+        'db', dest='command', title='Command',
+        help=_('Available DB commands'), handler=add_db_cmd_parsers)
+    config.register_cli_opt(command_opt)
+    logging.register_options(config)
+    config(argv[1:], project='nova', version=version_info.version_string())
+    logging.setup(config, 'nova')
+    db_api.configure(config)
+    return config.command.func()
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -75,6 +75,15 @@ VERSIONS = [
              # the resource class is not in the requested resources.
     '1.28',  # Add support for consumer generation
     '1.29',  # Support nested providers in GET /allocation_candidates API.
+    '1.30',  # Add ETags and conditional requests on provider inventories,
+             # traits and aggregates and on consumer allocations.
+    '1.31',  # Add POST /resource_provider_updates to update the
+             # inventories, traits and aggregates of many providers at once.
+    '1.32',  # Add PUT /resource_provider_trees/{uuid} to sync a whole
+             # provider tree at once.
+    '1.33',  # Add limit, marker and fields to GET /resource_providers.
+    '1.34',  # Add limit and marker to
+             # GET /resource_providers/{uuid}/allocations.
 ]
 
 
@@ -85,8 +85,20 @@ def delete_consumers_if_no_allocations(ctx, consumer_uuids):
     ctx.session.execute(del_stmt)
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_consumer_by_uuid(ctx, uuid):
+    res = _get_consumers_by_uuids(ctx, [uuid])
+    if not res:
+        raise exception.ConsumerNotFound(uuid=uuid)
+
+    return res[uuid]
+
+
+@db_api.placement_context_manager.reader.allow_async
+def _get_consumers_by_uuids(ctx, uuids):
+    """Returns a dict, keyed by consumer UUID, of dicts of information about
+    the consumers with the supplied UUIDs. Unknown UUIDs are ignored.
+    """
     # The SQL for this looks like the following:
     # SELECT
     #   c.id, c.uuid,
@@ -98,7 +110,7 @@ def _get_consumer_by_uuid(ctx, uuid):
     #  ON c.project_id = p.id
     # INNER JOIN users u
     #  ON c.user_id = u.id
-    # WHERE c.uuid = $uuid
+    # WHERE c.uuid IN ($uuids)
     consumers = sa.alias(CONSUMER_TBL, name="c")
     projects = sa.alias(project_obj.PROJECT_TBL, name="p")
     users = sa.alias(user_obj.USER_TBL, name="u")
@@ -118,12 +130,25 @@ def _get_consumer_by_uuid(ctx, uuid):
     c_to_u_join = sa.join(
         c_to_p_join, users, consumers.c.user_id == users.c.id)
     sel = sa.select(cols).select_from(c_to_u_join)
-    sel = sel.where(consumers.c.uuid == uuid)
-    res = ctx.session.execute(sel).fetchone()
-    if not res:
-        raise exception.ConsumerNotFound(uuid=uuid)
+    sel = sel.where(consumers.c.uuid.in_(set(uuids)))
+    return {r['uuid']: dict(r) for r in ctx.session.execute(sel)}
+
 
-    return dict(res)
+@db_api.placement_context_manager.writer
+def _create_consumers(ctx, consumers):
+    """Creates records for all the supplied Consumer objects in one statement.
+
+    :raises: `exception.ConsumerExists` if any of them already exists, in
+             which case none are created.
+    """
+    try:
+        ctx.session.execute(
+            CONSUMER_TBL.insert(),
+            [{'uuid': c.uuid, 'project_id': c.project.id,
+              'user_id': c.user.id} for c in consumers])
+    except db_exc.DBDuplicateEntry:
+        raise exception.ConsumerExists(
+            uuid=', '.join(sorted(c.uuid for c in consumers)))
 
 
 @db_api.placement_context_manager.writer
@@ -153,6 +178,37 @@ def _increment_consumer_generation(ctx, consumer):
     return new_generation
 
 
+@db_api.placement_context_manager.writer
+def increment_generations(ctx, consumers):
+    """Increments the generation of each of the supplied consumers with a
+    single compare-and-swap UPDATE statement, supplying the currently-known
+    generation of each consumer.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param consumers: iterable of `Consumer` objects whose generation should
+                      be updated. The generation field of each is set to the
+                      new value if the update succeeds.
+    :raises nova.exception.ConcurrentUpdateDetected: if another thread updated
+            the view of the allocations of any of the consumers in between the
+            time when its object was originally read and the call which
+            modified the consumers' state
+    """
+    consumers = sorted(consumers, key=lambda consumer: consumer.id)
+    if not consumers:
+        return
+    cond = sa.or_(*[
+        sa.and_(CONSUMER_TBL.c.id == consumer.id,
+                CONSUMER_TBL.c.generation == consumer.generation)
+        for consumer in consumers])
+    upd_stmt = CONSUMER_TBL.update().where(cond).values(
+        generation=CONSUMER_TBL.c.generation + 1)
+    res = ctx.session.execute(upd_stmt)
+    if res.rowcount != len(consumers):
+        raise exception.ConcurrentUpdateDetected
+    for consumer in consumers:
+        consumer.generation += 1
+
+
 @db_api.placement_context_manager.writer
 def _delete_consumer(ctx, consumer):
     """Deletes the supplied consumer.
@@ -199,6 +255,31 @@ class Consumer(base.VersionedObject, base.TimestampedObject):
         res = _get_consumer_by_uuid(ctx, uuid)
         return cls._from_db_object(ctx, cls(ctx), res)
 
+    @classmethod
+    def get_all_by_uuids(cls, ctx, uuids):
+        """Returns a dict, keyed by consumer UUID, of Consumer objects for the
+        supplied UUIDs that have a consumer record, fetched in one query.
+        """
+        res = _get_consumers_by_uuids(ctx, uuids)
+        return {uuid: cls._from_db_object(ctx, cls(ctx), db_consumer)
+                for uuid, db_consumer in res.items()}
+
+    @classmethod
+    def create_all(cls, ctx, consumers):
+        """Creates the records of all the supplied, not yet created, Consumer
+        objects with a single insert and fills in their IDs and generations.
+
+        :raises: `exception.ConsumerExists` if any of them already exists, in
+                 which case none are created.
+        """
+        _create_consumers(ctx, consumers)
+        res = _get_consumers_by_uuids(ctx, [c.uuid for c in consumers])
+        for consumer in consumers:
+            db_consumer = res[consumer.uuid]
+            consumer.id = db_consumer['id']
+            consumer.generation = db_consumer['generation']
+            consumer.obj_reset_changes()
+
     def create(self):
         @db_api.placement_context_manager.writer
         def _create_in_db(ctx):
@@ -40,7 +40,7 @@ def ensure_incomplete_project(ctx):
     return res.inserted_primary_key[0]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_project_by_external_id(ctx, external_id):
     projects = sa.alias(PROJECT_TBL, name="p")
     cols = [
@@ -58,6 +58,39 @@ def _get_project_by_external_id(ctx, external_id):
     return dict(res)
 
 
+@db_api.placement_context_manager.reader.allow_async
+def _get_projects_by_external_ids(ctx, external_ids):
+    """Returns a dict, keyed by external ID, of dicts of information about the
+    projects with the supplied external IDs. Unknown IDs are ignored.
+    """
+    projects = sa.alias(PROJECT_TBL, name="p")
+    cols = [
+        projects.c.id,
+        projects.c.external_id,
+        projects.c.updated_at,
+        projects.c.created_at
+    ]
+    sel = sa.select(cols)
+    sel = sel.where(projects.c.external_id.in_(external_ids))
+    return {r['external_id']: dict(r) for r in ctx.session.execute(sel)}
+
+
+@db_api.placement_context_manager.writer
+def _create_projects(ctx, external_ids):
+    """Creates records for all the supplied external IDs in one statement.
+
+    :raises: `exception.ProjectExists` if any of them already exists, in which
+             case none are created.
+    """
+    try:
+        ctx.session.execute(
+            PROJECT_TBL.insert(),
+            [{'external_id': external_id} for external_id in external_ids])
+    except db_exc.DBDuplicateEntry:
+        raise exception.ProjectExists(
+            external_id=', '.join(sorted(external_ids)))
+
+
 @base.VersionedObjectRegistry.register_if(False)
 class Project(base.VersionedObject):
 
@@ -80,6 +113,32 @@ class Project(base.VersionedObject):
         res = _get_project_by_external_id(ctx, external_id)
         return cls._from_db_object(ctx, cls(ctx), res)
 
+    @classmethod
+    def get_or_create_all(cls, ctx, external_ids):
+        """Returns a dict, keyed by external ID, of Project objects for all the
+        supplied external IDs, creating the records that do not exist yet.
+
+        The lookup and creation take a constant number of queries however
+        many IDs are supplied.
+        """
+        external_ids = set(external_ids)
+        res = _get_projects_by_external_ids(ctx, external_ids)
+        missing = external_ids - set(res)
+        if missing:
+            try:
+                _create_projects(ctx, missing)
+            except exception.ProjectExists:
+                # Another thread created some of them already, so create the
+                # rest one at a time
+                for external_id in missing:
+                    try:
+                        cls(ctx, external_id=external_id).create()
+                    except exception.ProjectExists:
+                        pass
+            res = _get_projects_by_external_ids(ctx, external_ids)
+        return {external_id: cls._from_db_object(ctx, cls(ctx), db_project)
+                for external_id, db_project in res.items()}
+
     def create(self):
         @db_api.placement_context_manager.writer
         def _create_in_db(ctx):
@@ -23,7 +23,6 @@ import random
 
 import os_traits
 from oslo_concurrency import lockutils
-from oslo_config import cfg
 from oslo_db import api as oslo_db_api
 from oslo_db import exception as db_exc
 from oslo_log import log as logging
@@ -37,18 +36,27 @@ from sqlalchemy import func
 from sqlalchemy import sql
 from sqlalchemy.sql import null
 
+from nova.api.openstack.placement import change_log
+from nova.api.openstack.placement import conf as placement_conf
+from nova.api.openstack.placement import contention
 from nova.api.openstack.placement import db_api
 from nova.api.openstack.placement import exception
+from nova.api.openstack.placement import lookup_cache
 from nova.api.openstack.placement.objects import consumer as consumer_obj
 from nova.api.openstack.placement.objects import project as project_obj
 from nova.api.openstack.placement.objects import user as user_obj
+from nova.api.openstack.placement import provider_snapshot
 from nova.api.openstack.placement import resource_class_cache as rc_cache
+from nova.api.openstack.placement import topology_cache
+from nova.api.openstack.placement import trait_index
 from nova.db.sqlalchemy import api_models as models
 from nova.i18n import _
 from nova import rc_fields
 
 _TRAIT_TBL = models.Trait.__table__
 _ALLOC_TBL = models.Allocation.__table__
+_USAGE_TBL = models.ResourceProviderUsage.__table__
+_CLOSURE_TBL = models.ResourceProviderClosure.__table__
 _INV_TBL = models.Inventory.__table__
 _RP_TBL = models.ResourceProvider.__table__
 # Not used in this file but used in tests.
@@ -60,14 +68,21 @@ _PROJECT_TBL = models.Project.__table__
 _USER_TBL = models.User.__table__
 _CONSUMER_TBL = models.Consumer.__table__
 _RC_CACHE = None
+_SNAPSHOT_CACHE = None
+_TRAIT_CACHE = None
+_AGG_CACHE = None
+_TOPOLOGY_CACHE = None
 _TRAIT_LOCK = 'trait_sync'
+# The number of most contended providers logged when a write of allocations
+# runs out of retries
+_MOST_CONTENDED_LOGGED = 5
 _TRAITS_SYNCED = False
 
-CONF = cfg.CONF
+CONF = placement_conf.CONF
 LOG = logging.getLogger(__name__)
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def ensure_rc_cache(ctx):
     """Ensures that a singleton resource class cache has been created in the
     module's scope.
@@ -81,6 +96,78 @@ def ensure_rc_cache(ctx):
     _RC_CACHE = rc_cache.ResourceClassCache(ctx)
 
 
+def ensure_lookup_caches(ctx):
+    """Ensures that the singleton trait and aggregate ID caches have been
+    created in the module's scope.
+
+    :param ctx: `nova.context.RequestContext` that may be used to grab a DB
+                connection.
+    """
+    global _TRAIT_CACHE
+    global _AGG_CACHE
+    if _TRAIT_CACHE is None:
+        _TRAIT_CACHE = lookup_cache.TraitCache(ctx)
+    if _AGG_CACHE is None:
+        _AGG_CACHE = lookup_cache.AggregateCache(ctx)
+
+
+@db_api.placement_context_manager.reader.allow_async
+def validate_caches(ctx):
+    """Drops the data cached by this process that other processes changed
+    since it was loaded. Called at the start of every request, so that a
+    request never sees a resource class or trait that another API worker
+    renamed or deleted before the request came in.
+
+    :param ctx: `nova.context.RequestContext` that may be used to grab a DB
+                connection.
+    """
+    (rc_version, trait_version) = change_log.get_versions(
+        ctx, [change_log.RESOURCE_CLASSES, change_log.TRAIT_DELETIONS])
+    if _RC_CACHE is not None:
+        _RC_CACHE.expire(rc_version)
+    if _TRAIT_CACHE is not None:
+        _TRAIT_CACHE.expire(trait_version)
+
+
+def _get_provider_snapshot(ctx):
+    """Returns the current in-memory ProviderSnapshot, creating the
+    module-scoped snapshot cache on first use and refreshing the snapshot if
+    the database has changed since it was taken.
+
+    :param ctx: `nova.context.RequestContext` that may be used to grab a DB
+                connection.
+    """
+    global _SNAPSHOT_CACHE
+    if _SNAPSHOT_CACHE is None:
+        _SNAPSHOT_CACHE = provider_snapshot.ProviderSnapshotCache()
+    return _SNAPSHOT_CACHE.get(ctx)
+
+
+def _get_topology(ctx):
+    """Returns the current topology_cache.Topology, creating the
+    module-scoped topology cache on first use and reloading the topology if
+    the database has changed since it was loaded.
+
+    :param ctx: `nova.context.RequestContext` that may be used to grab a DB
+                connection.
+    """
+    global _TOPOLOGY_CACHE
+    if _TOPOLOGY_CACHE is None:
+        _TOPOLOGY_CACHE = topology_cache.TopologyCache()
+    return _TOPOLOGY_CACHE.get(ctx)
+
+
+def _topology_changed(ctx, rp_ids):
+    """Records a topology change of the supplied providers, so that every
+    process reloads the topology it cached. Called whenever the traits or
+    aggregates of a provider change.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param rp_ids: iterable of internal IDs of the changed providers
+    """
+    change_log.record_provider_changes(ctx, rp_ids, topology=True)
+
+
 @oslo_db_api.wrap_db_retry(max_retries=5, retry_on_deadlock=True)
 # Bug #1760322: If the caller raises an exception, we don't want the trait
 # sync rolled back; so use an .independent transaction
@@ -117,6 +204,7 @@ def _trait_sync(ctx):
     if batch_args:
         try:
             ctx.session.execute(ins, batch_args)
+            change_log.bump(ctx, change_log.TRAITS)
             LOG.info("Synced traits from os_traits into API DB: %s",
                      need_sync)
         except db_exc.DBDuplicateEntry:
@@ -174,10 +262,9 @@ def _delete_inventory_from_provider(ctx, rp, to_delete):
                       delete.
     """
     allocation_query = sa.select(
-        [_ALLOC_TBL.c.resource_class_id.label('resource_class')]).where(
-             sa.and_(_ALLOC_TBL.c.resource_provider_id == rp.id,
-                     _ALLOC_TBL.c.resource_class_id.in_(to_delete))
-         ).group_by(_ALLOC_TBL.c.resource_class_id)
+        [_USAGE_TBL.c.resource_class_id.label('resource_class')]).where(
+             sa.and_(_USAGE_TBL.c.resource_provider_id == rp.id,
+                     _USAGE_TBL.c.resource_class_id.in_(to_delete)))
     allocations = ctx.session.execute(allocation_query).fetchall()
     if allocations:
         resource_classes = ', '.join([_RC_CACHE.string_from_id(alloc[0])
@@ -232,10 +319,10 @@ def _update_inventory_for_provider(ctx, rp, inv_list, to_update):
         rc_str = _RC_CACHE.string_from_id(rc_id)
         inv_record = inv_list.find(rc_str)
         allocation_query = sa.select(
-            [func.sum(_ALLOC_TBL.c.used).label('usage')]).\
+            [_USAGE_TBL.c.used.label('usage')]).\
             where(sa.and_(
-                _ALLOC_TBL.c.resource_provider_id == rp.id,
-                _ALLOC_TBL.c.resource_class_id == rc_id))
+                _USAGE_TBL.c.resource_provider_id == rp.id,
+                _USAGE_TBL.c.resource_class_id == rc_id))
         allocations = ctx.session.execute(allocation_query).first()
         if (allocations
             and allocations['usage'] is not None
@@ -279,9 +366,62 @@ def _increment_provider_generation(ctx, rp):
     res = ctx.session.execute(upd_stmt)
     if res.rowcount != 1:
         raise exception.ResourceProviderConcurrentUpdateDetected()
+    change_log.record_provider_changes(ctx, [rp.id])
     return new_generation
 
 
+def _increment_provider_generations(ctx, rps):
+    """Increments the generation of each of the supplied providers with a
+    single compare-and-swap UPDATE statement, supplying the currently-known
+    generation of each provider.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param rps: iterable of `ResourceProvider` objects whose generation should
+                be updated. The generation field of each is set to the new
+                value if the update succeeds.
+    :raises nova.exception.ConcurrentUpdateDetected: if another thread updated
+            the view of the inventory or allocations of any of the resource
+            providers in between the time when its object was originally read
+            and the call to set the allocations.
+    """
+    rps = sorted(rps, key=lambda rp: rp.id)
+    if not rps:
+        return
+    cond = sa.or_(*[
+        sa.and_(_RP_TBL.c.id == rp.id, _RP_TBL.c.generation == rp.generation)
+        for rp in rps])
+    upd_stmt = _RP_TBL.update().where(cond).values(
+        generation=_RP_TBL.c.generation + 1)
+    res = ctx.session.execute(upd_stmt)
+    if res.rowcount != len(rps):
+        raise exception.ResourceProviderConcurrentUpdateDetected()
+    for rp in rps:
+        rp.generation += 1
+    change_log.record_provider_changes(ctx, [rp.id for rp in rps])
+
+
+def _bump_provider_generations(ctx, rps):
+    """Increments the generation of each of the supplied providers without
+    comparing it with the currently-known generation, and sets the generation
+    field of each to the new value.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param rps: iterable of `ResourceProvider` objects whose generation should
+                be updated.
+    """
+    rps = {rp.id: rp for rp in rps}
+    if not rps:
+        return
+    upd_stmt = _RP_TBL.update().where(_RP_TBL.c.id.in_(rps)).values(
+        generation=_RP_TBL.c.generation + 1)
+    ctx.session.execute(upd_stmt)
+    sel = sa.select([_RP_TBL.c.id, _RP_TBL.c.generation]).where(
+        _RP_TBL.c.id.in_(rps))
+    for rp_id, generation in ctx.session.execute(sel):
+        rps[rp_id].generation = generation
+    change_log.record_provider_changes(ctx, rps)
+
+
 @db_api.placement_context_manager.writer
 def _add_inventory(context, rp, inventory):
     """Add one Inventory that wasn't already on the provider.
@@ -380,7 +520,7 @@ def _set_inventory(context, rp, inv_list):
     return exceeded
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_provider_by_uuid(context, uuid):
     """Given a UUID, return a dict of information about the resource provider
     from the database.
@@ -388,12 +528,25 @@ def _get_provider_by_uuid(context, uuid):
     :raises: NotFound if no such provider was found
     :param uuid: The UUID to look up
     """
+    res = _get_providers_by_uuids(context, [uuid])
+    if not res:
+        raise exception.NotFound(
+            'No resource provider with uuid %s found' % uuid)
+    return res[0]
+
+
+@db_api.placement_context_manager.reader.allow_async
+def _get_providers_by_uuids(context, uuids):
+    """Given an iterable of UUIDs, return a list of dicts of information about
+    the resource providers from the database. UUIDs that do not match a
+    provider are ignored.
+
+    :param uuids: The UUIDs to look up
+    """
     rpt = sa.alias(_RP_TBL, name="rp")
     parent = sa.alias(_RP_TBL, name="parent")
     root = sa.alias(_RP_TBL, name="root")
-    # TODO(jaypipes): Change this to an inner join when we are sure all
-    # root_provider_id values are NOT NULL
-    rp_to_root = sa.outerjoin(rpt, root, rpt.c.root_provider_id == root.c.id)
+    rp_to_root = sa.join(rpt, root, rpt.c.root_provider_id == root.c.id)
     rp_to_parent = sa.outerjoin(rp_to_root, parent,
         rpt.c.parent_provider_id == parent.c.id)
     cols = [
@@ -406,15 +559,12 @@ def _get_provider_by_uuid(context, uuid):
         rpt.c.updated_at,
         rpt.c.created_at,
     ]
-    sel = sa.select(cols).select_from(rp_to_parent).where(rpt.c.uuid == uuid)
-    res = context.session.execute(sel).fetchone()
-    if not res:
-        raise exception.NotFound(
-            'No resource provider with uuid %s found' % uuid)
-    return dict(res)
+    sel = sa.select(cols).select_from(rp_to_parent).where(
+        rpt.c.uuid.in_(set(uuids)))
+    return [dict(r) for r in context.session.execute(sel)]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_aggregates_by_provider_id(context, rp_id):
     join_statement = sa.join(
         _AGG_TBL, _RP_AGG_TBL, sa.and_(
@@ -424,7 +574,17 @@ def _get_aggregates_by_provider_id(context, rp_id):
     return [r[0] for r in context.session.execute(sel).fetchall()]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
+def _get_aggregate_ids_by_provider_id(context, rp_id):
+    # Only the primary key of resource_provider_aggregates is read, the
+    # aggregate UUIDs are not joined in.
+    sel = sa.select([_RP_AGG_TBL.c.aggregate_id])
+    sel = sel.where(_RP_AGG_TBL.c.resource_provider_id == rp_id)
+    sel = sel.order_by(_RP_AGG_TBL.c.aggregate_id)
+    return [r[0] for r in context.session.execute(sel).fetchall()]
+
+
+@db_api.placement_context_manager.reader.allow_async
 def _anchors_for_sharing_providers(context, rp_ids, get_id=False):
     """Given a list of internal IDs of sharing providers, returns a set of
     tuples of (sharing provider UUID, anchor provider UUID), where each of
@@ -440,8 +600,27 @@ def _anchors_for_sharing_providers(context, rp_ids, get_id=False):
 
     If get_id is True, it returns a set of tuples of (sharing provider ID,
     anchor provider ID) instead.
+
+    The anchors of providers having the MISC_SHARES_VIA_AGGREGATE trait are
+    taken from the topology cache. Only the other providers are looked up.
     """
-    # SELECT sps.uuid, COALESCE(rps.uuid, shr_with_sps.uuid)
+    sharing = _get_topology(context).sharing
+    res = set()
+    others = []
+    for rp_id in rp_ids:
+        sp = sharing.get(rp_id)
+        if sp is None:
+            others.append(rp_id)
+            continue
+        for anchor_id, anchor_uuid in sp.anchors:
+            if get_id:
+                res.add((rp_id, anchor_id))
+            else:
+                res.add((sp.uuid, anchor_uuid))
+    if not others:
+        return res
+
+    # SELECT sps.uuid, rps.uuid
     # FROM resource_providers AS sps
     # INNER JOIN resource_provider_aggregates AS shr_aggs
     #   ON sps.id = shr_aggs.resource_provider_id
@@ -449,7 +628,7 @@ def _anchors_for_sharing_providers(context, rp_ids, get_id=False):
     #   ON shr_aggs.aggregate_id = shr_with_sps_aggs.aggregate_id
     # INNER JOIN resource_providers AS shr_with_sps
     #   ON shr_with_sps_aggs.resource_provider_id = shr_with_sps.id
-    # LEFT JOIN resource_providers AS rps
+    # INNER JOIN resource_providers AS rps
     #   ON shr_with_sps.root_provider_id = rps.id
     # WHERE sps.id IN $(RP_IDs)
     rps = sa.alias(_RP_TBL, name='rps')
@@ -466,22 +645,15 @@ def _anchors_for_sharing_providers(context, rp_ids, get_id=False):
         join_chain, shr_with_sps,
         shr_with_sps_aggs.c.resource_provider_id == shr_with_sps.c.id)
     if get_id:
-        # TODO(yikun): Change `func.coalesce(shr_with_sps.c.root_provider_id,
-        # shr_with_sps.c.id)` to `shr_with_sps.c.root_provider_id` when we are
-        # sure all root_provider_id values are NOT NULL
-        sel = sa.select([sps.c.id, func.coalesce(
-            shr_with_sps.c.root_provider_id, shr_with_sps.c.id)])
+        sel = sa.select([sps.c.id, shr_with_sps.c.root_provider_id])
     else:
-        # TODO(efried): Change this to an inner join and change
-        # 'func.coalesce(rps.c.uuid, shr_with_sps.c.uuid)' to `rps.c.uuid`
-        # when we are sure all root_provider_id values are NOT NULL
-        join_chain = sa.outerjoin(
+        join_chain = sa.join(
             join_chain, rps, shr_with_sps.c.root_provider_id == rps.c.id)
-        sel = sa.select([sps.c.uuid, func.coalesce(rps.c.uuid,
-                                                   shr_with_sps.c.uuid)])
+        sel = sa.select([sps.c.uuid, rps.c.uuid])
     sel = sel.select_from(join_chain)
-    sel = sel.where(sps.c.id.in_(rp_ids))
-    return set([(r[0], r[1]) for r in context.session.execute(sel).fetchall()])
+    sel = sel.where(sps.c.id.in_(others))
+    res.update((r[0], r[1]) for r in context.session.execute(sel).fetchall())
+    return res
 
 
 @db_api.placement_context_manager.writer
@@ -510,8 +682,12 @@ def _set_aggregates(context, resource_provider, provided_aggregates,
     # aggregate with the provided uuid. In this way we only
     # create a new row in the PlacementAggregate table if the
     # aggregate uuid has never been seen before. Code further
-    # below will update the associations.
+    # below will update the associations. Aggregates are never deleted, so
+    # any already in the aggregate cache need not be looked for.
+    known_aggs = _AGG_CACHE.ids_from_keys(to_add) if to_add else {}
     for agg_uuid in to_add:
+        if agg_uuid in known_aggs:
+            continue
         found_agg = context.session.query(models.PlacementAggregate.uuid).\
             filter_by(uuid=agg_uuid).first()
         if not found_agg:
@@ -547,9 +723,10 @@ def _set_aggregates(context, resource_provider, provided_aggregates,
     if increment_generation:
         resource_provider.generation = _increment_provider_generation(
             context, resource_provider)
+    _topology_changed(context, [rp_id])
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_traits_by_provider_id(context, rp_id):
     t = sa.alias(_TRAIT_TBL, name='t')
     rpt = sa.alias(_RP_TRAIT_TBL, name='rpt')
@@ -629,9 +806,119 @@ def _set_traits(context, rp, traits):
     if to_add:
         _add_traits_to_provider(context, rp.id, to_add)
     rp.generation = _increment_provider_generation(context, rp)
+    _topology_changed(context, [rp.id])
+
 
+# The new state of one resource provider for update_providers(). Any of
+# inventories (an InventoryList), traits (a list of Trait objects) and
+# aggregates (a list of aggregate UUIDs) may be None to leave it unchanged.
+ProviderUpdate = collections.namedtuple(
+    'ProviderUpdate', 'resource_provider inventories traits aggregates')
+
+
+@db_api.placement_context_manager.writer
+def update_providers(context, updates):
+    """Replaces the inventories, traits and aggregates of many resource
+    providers in a single transaction. Either all of them are changed or,
+    if any exception is raised, none of them.
 
-@db_api.placement_context_manager.reader
+    The generation of each ResourceProvider object is checked and
+    incremented once for each of its inventories, traits and aggregates
+    that is replaced, and the objects are left with their new generations.
+
+    :param updates: iterable of ProviderUpdate namedtuples.
+    :raises nova.exception.ConcurrentUpdateDetected: if another thread updated
+            any of the resource providers since its object was read.
+    :raises `exception.ResourceClassNotFound`, `exception.InventoryInUse`:
+            as _set_inventory().
+    """
+    exceeded = []
+    # Providers are changed in the order of their internal IDs, so that
+    # concurrent bulk updates lock the rows in the same order.
+    for update in sorted(updates, key=lambda u: u.resource_provider.id):
+        rp = update.resource_provider
+        if update.inventories is not None:
+            exceeded.extend(_set_inventory(context, rp, update.inventories))
+        if update.traits is not None:
+            _set_traits(context, rp, update.traits)
+        if update.aggregates is not None:
+            _set_aggregates(context, rp, update.aggregates,
+                            increment_generation=True)
+    for uuid, rclass in exceeded:
+        LOG.warning('Resource provider %(uuid)s is now over-'
+                    'capacity for %(resource)s',
+                    {'uuid': uuid, 'resource': rclass})
+
+
+def _tree_depth(rp, by_uuid):
+    """Returns the number of ancestors of the supplied ResourceProvider,
+    following parent_provider_uuid through the by_uuid dict.
+    """
+    depth = 0
+    while rp.parent_provider_uuid is not None:
+        rp = by_uuid[rp.parent_provider_uuid]
+        depth += 1
+    return depth
+
+
+@db_api.placement_context_manager.writer
+def sync_provider_tree(context, stored, desired):
+    """Turns a tree of resource providers into the desired one in a single
+    transaction, creating, renaming and deleting providers and replacing
+    their inventories, traits and aggregates as update_providers() does.
+
+    :param stored: list of the ResourceProvider objects of the tree, as read
+                   by the caller, or an empty list for a new tree.
+    :param desired: list of ProviderUpdate namedtuples, one for each provider
+                    of the desired tree. Each resource_provider is either one
+                    of stored, whose name may have been changed, or a new
+                    ResourceProvider object to be created. Its parent must
+                    be in desired as well.
+    :raises nova.exception.ConcurrentUpdateDetected: if providers were added
+            to or removed from the tree, or any provider to delete was
+            updated, since stored was read.
+    :raises `exception.ResourceProviderInUse`: if a provider to delete has
+            allocations.
+    :raises `db_exc.DBDuplicateEntry`: if a provider to create or rename
+            clashes with another one.
+    :raises: as update_providers().
+    """
+    stored_by_uuid = {rp.uuid: rp for rp in stored}
+    if stored:
+        root = next(rp for rp in stored if rp.parent_provider_uuid is None)
+        sel = _subtree_select(root.id)
+        current = set(r[0] for r in context.session.execute(sel))
+        if current != set(rp.id for rp in stored):
+            raise exception.ResourceProviderConcurrentUpdateDetected()
+
+    keep = set(update.resource_provider.uuid for update in desired)
+    to_delete = [rp for rp in stored if rp.uuid not in keep]
+    # Children go before their parents, which is only possible once they
+    # have none left.
+    to_delete.sort(key=lambda rp: _tree_depth(rp, stored_by_uuid),
+                   reverse=True)
+    for rp in to_delete:
+        # This checks that the provider has not changed since it was read
+        _increment_provider_generation(context, rp)
+        rp.destroy()
+
+    desired_by_uuid = {update.resource_provider.uuid: update.resource_provider
+                       for update in desired}
+    to_create = []
+    for rp in desired_by_uuid.values():
+        if 'id' not in rp:
+            to_create.append(rp)
+        elif rp.obj_what_changed():
+            rp.save()
+    # Parents go before their children, which need them to exist.
+    to_create.sort(key=lambda rp: _tree_depth(rp, desired_by_uuid))
+    for rp in to_create:
+        rp.create()
+
+    update_providers(context, desired)
+
+
+@db_api.placement_context_manager.reader.allow_async
 def _has_child_providers(context, rp_id):
     """Returns True if the supplied resource provider has any child providers,
     False otherwise
@@ -644,17 +931,221 @@ def _has_child_providers(context, rp_id):
     return False
 
 
+def _add_provider_to_closure(context, rp_id, parent_id):
+    """Records a new provider, and its ancestors if it has a parent, in the
+    resource_provider_closure table.
+
+    :param rp_id: Internal ID of the new provider
+    :param parent_id: Internal ID of its parent provider, or None
+    """
+    rows = [{'ancestor_id': rp_id, 'descendant_id': rp_id, 'depth': 0}]
+    if parent_id is not None:
+        sel = sa.select([_CLOSURE_TBL.c.ancestor_id, _CLOSURE_TBL.c.depth])
+        sel = sel.where(_CLOSURE_TBL.c.descendant_id == parent_id)
+        rows.extend({'ancestor_id': r[0], 'descendant_id': rp_id,
+                     'depth': r[1] + 1}
+                    for r in context.session.execute(sel))
+    context.session.execute(_CLOSURE_TBL.insert(), rows)
+
+
+def _move_subtree_in_closure(context, rp_id, parent_id):
+    """Moves the provider identified by rp_id, along with all of its
+    descendants, below a new parent in the resource_provider_closure table.
+
+    :param rp_id: Internal ID of the provider being parented
+    :param parent_id: Internal ID of its new parent provider
+    """
+    sel = sa.select([_CLOSURE_TBL.c.descendant_id, _CLOSURE_TBL.c.depth])
+    sel = sel.where(_CLOSURE_TBL.c.ancestor_id == rp_id)
+    descendants = [(r[0], r[1]) for r in context.session.execute(sel)]
+    desc_ids = [d[0] for d in descendants]
+    # Unlink the subtree from the ancestors it had outside of itself
+    del_stmt = _CLOSURE_TBL.delete().where(sa.and_(
+        _CLOSURE_TBL.c.descendant_id.in_(desc_ids),
+        ~_CLOSURE_TBL.c.ancestor_id.in_(desc_ids)))
+    context.session.execute(del_stmt)
+    # And link every provider of the subtree to every ancestor of the parent
+    sel = sa.select([_CLOSURE_TBL.c.ancestor_id, _CLOSURE_TBL.c.depth])
+    sel = sel.where(_CLOSURE_TBL.c.descendant_id == parent_id)
+    rows = [{'ancestor_id': anc_id, 'descendant_id': desc_id,
+             'depth': anc_depth + desc_depth + 1}
+            for anc_id, anc_depth in context.session.execute(sel)
+            for desc_id, desc_depth in descendants]
+    if rows:
+        context.session.execute(_CLOSURE_TBL.insert(), rows)
+
+
+@db_api.placement_context_manager.reader.allow_async
+def _is_descendant(context, rp_id, ancestor_id):
+    """Returns True if the provider identified by rp_id is the provider
+    identified by ancestor_id or one of its descendants, False otherwise.
+    """
+    sel = sa.select([_CLOSURE_TBL.c.depth])
+    sel = sel.where(sa.and_(_CLOSURE_TBL.c.ancestor_id == ancestor_id,
+                            _CLOSURE_TBL.c.descendant_id == rp_id))
+    return context.session.execute(sel).fetchone() is not None
+
+
+def _subtree_select(ancestor_id):
+    """Returns a select of the internal IDs of the provider identified by
+    ancestor_id and of all of its descendants.
+    """
+    sel = sa.select([_CLOSURE_TBL.c.descendant_id])
+    return sel.where(_CLOSURE_TBL.c.ancestor_id == ancestor_id)
+
+
+def _closure_from_parents(parents):
+    """Given a dict, keyed by internal provider ID, of the internal ID of the
+    parent of that provider, returns a dict, keyed by internal provider ID, of
+    dicts, keyed by the internal IDs of its ancestors and itself, of their
+    depth above the provider.
+    """
+    closure = {}
+    for rp_id in parents:
+        ancestors = closure[rp_id] = {}
+        ancestor_id = rp_id
+        # Stop at a loop rather than follow it forever
+        while ancestor_id is not None and ancestor_id not in ancestors:
+            ancestors[ancestor_id] = len(ancestors)
+            ancestor_id = parents.get(ancestor_id)
+    return closure
+
+
+def _wrong_closure_select():
+    """Returns a select of the internal IDs, labelled rp_id, of the providers
+    whose records of resource_provider_closure do not follow from the record
+    of their parent: providers without the record of themselves, providers
+    without a record for an ancestor of their parent, and providers that are
+    gone or have records no ancestor of their parent explains.
+
+    A provider whose parent's own records are incomplete may only be found
+    once those are repaired.
+    """
+    rp = sa.alias(_RP_TBL, name="rp")
+    clo = sa.alias(_CLOSURE_TBL, name="clo")
+    parent_clo = sa.alias(_CLOSURE_TBL, name="parent_clo")
+
+    # SELECT rp.id FROM resource_providers AS rp
+    # LEFT JOIN resource_provider_closure AS clo
+    #   ON clo.ancestor_id = rp.id AND clo.descendant_id = rp.id
+    #   AND clo.depth = 0
+    # WHERE clo.ancestor_id IS NULL
+    no_self = sa.select([rp.c.id.label('rp_id')]).select_from(sa.outerjoin(
+        rp, clo, sa.and_(clo.c.ancestor_id == rp.c.id,
+                         clo.c.descendant_id == rp.c.id,
+                         clo.c.depth == 0)))
+    no_self = no_self.where(clo.c.ancestor_id.is_(None))
+
+    # SELECT rp.id FROM resource_providers AS rp
+    # INNER JOIN resource_provider_closure AS parent_clo
+    #   ON parent_clo.descendant_id = rp.parent_provider_id
+    # LEFT JOIN resource_provider_closure AS clo
+    #   ON clo.ancestor_id = parent_clo.ancestor_id
+    #   AND clo.descendant_id = rp.id AND clo.depth = parent_clo.depth + 1
+    # WHERE clo.ancestor_id IS NULL
+    join = sa.join(rp, parent_clo,
+                   parent_clo.c.descendant_id == rp.c.parent_provider_id)
+    join = sa.outerjoin(join, clo, sa.and_(
+        clo.c.ancestor_id == parent_clo.c.ancestor_id,
+        clo.c.descendant_id == rp.c.id,
+        clo.c.depth == parent_clo.c.depth + 1))
+    missing = sa.select([rp.c.id.label('rp_id')]).select_from(join)
+    missing = missing.where(clo.c.ancestor_id.is_(None))
+
+    # SELECT clo.descendant_id FROM resource_provider_closure AS clo
+    # LEFT JOIN resource_providers AS rp ON rp.id = clo.descendant_id
+    # LEFT JOIN resource_provider_closure AS parent_clo
+    #   ON parent_clo.descendant_id = rp.parent_provider_id
+    #   AND parent_clo.ancestor_id = clo.ancestor_id
+    #   AND parent_clo.depth = clo.depth - 1
+    # WHERE parent_clo.ancestor_id IS NULL
+    # AND NOT (clo.ancestor_id = clo.descendant_id AND clo.depth = 0
+    #          AND rp.id IS NOT NULL)
+    join = sa.outerjoin(clo, rp, rp.c.id == clo.c.descendant_id)
+    join = sa.outerjoin(join, parent_clo, sa.and_(
+        parent_clo.c.descendant_id == rp.c.parent_provider_id,
+        parent_clo.c.ancestor_id == clo.c.ancestor_id,
+        parent_clo.c.depth == clo.c.depth - 1))
+    extra = sa.select([clo.c.descendant_id.label('rp_id')]).select_from(join)
+    extra = extra.where(sa.and_(
+        parent_clo.c.ancestor_id.is_(None),
+        sa.not_(sa.and_(clo.c.ancestor_id == clo.c.descendant_id,
+                        clo.c.depth == 0,
+                        rp.c.id.isnot(None)))))
+
+    return sa.union(no_self, missing, extra)
+
+
+def _load_parents(ctx, rp_ids):
+    """Returns a dict, keyed by internal provider ID, of the internal ID of
+    the parent of that provider, for the supplied providers that exist and
+    all of their ancestors.
+    """
+    parents = {}
+    to_load = set(rp_ids)
+    while to_load:
+        sel = sa.select([_RP_TBL.c.id, _RP_TBL.c.parent_provider_id])
+        sel = sel.where(_RP_TBL.c.id.in_(sorted(to_load)))
+        loaded = {r[0]: r[1] for r in ctx.session.execute(sel)}
+        parents.update(loaded)
+        to_load = set(parent_id for parent_id in loaded.values()
+                      if parent_id is not None) - set(parents)
+    return parents
+
+
 @db_api.placement_context_manager.writer
-def _set_root_provider_id(context, rp_id, root_id):
-    """Simply sets the root_provider_id value for a provider identified by
-    rp_id. Used in online data migration.
+def repair_provider_closure(ctx, batch_size):
+    """Rewrites the records of resource_provider_closure of the providers
+    whose ancestors they do not match, such as providers created by services
+    that did not maintain the table yet.
+
+    Returns a tuple of (the number of providers with wrong records found, the
+    number corrected), both limited to batch_size, since this is the expected
+    return format for data migration routines.
+    """
+    wrong = sa.alias(_wrong_closure_select(), name="wrong")
+    sel = sa.select([wrong.c.rp_id]).order_by(wrong.c.rp_id)
+    rp_ids = [r[0] for r in ctx.session.execute(sel.limit(batch_size))]
+    if not rp_ids:
+        return 0, 0
+    expected = _closure_from_parents(_load_parents(ctx, rp_ids))
+    del_stmt = _CLOSURE_TBL.delete().where(
+        _CLOSURE_TBL.c.descendant_id.in_(rp_ids))
+    ctx.session.execute(del_stmt)
+    rows = [{'ancestor_id': anc_id, 'descendant_id': rp_id, 'depth': depth}
+            for rp_id in rp_ids
+            for anc_id, depth in expected.get(rp_id, {}).items()]
+    if rows:
+        ctx.session.execute(_CLOSURE_TBL.insert(), rows)
+    return len(rp_ids), len(rp_ids)
 
-    :param rp_id: Internal ID of the provider to update
-    :param root_id: Value to set root provider to
+
+@db_api.placement_context_manager.writer
+def set_root_provider_ids(context, batch_size):
+    """Sets the root_provider_id of the providers that have none, records
+    written before nested providers existed, to their own ID. Such a provider
+    has no parent, so it is the root of its own tree.
+
+    Returns a tuple containing two identical elements with the number of
+    providers updated, since this is the expected return format for data
+    migration routines.
     """
-    upd = _RP_TBL.update().where(_RP_TBL.c.id == rp_id)
-    upd = upd.values(root_provider_id=root_id)
+    sel = sa.select([_RP_TBL.c.id])
+    sel = sel.where(_RP_TBL.c.root_provider_id.is_(None))
+    sel = sel.order_by(_RP_TBL.c.id).limit(batch_size)
+    rp_ids = [r[0] for r in context.session.execute(sel)]
+    if not rp_ids:
+        return 0, 0
+    upd = _RP_TBL.update().where(_RP_TBL.c.id.in_(rp_ids))
+    upd = upd.values(root_provider_id=_RP_TBL.c.id)
     context.session.execute(upd)
+    for rp_id in rp_ids:
+        # Such an old record may also predate the closure table
+        if not _is_descendant(context, rp_id, rp_id):
+            _add_provider_to_closure(context, rp_id, None)
+    # The sharing providers are anchored to the roots of the trees
+    change_log.record_provider_changes(context, rp_ids, topology=True)
+    return len(rp_ids), len(rp_ids)
 
 
 ProviderIds = collections.namedtuple(
@@ -676,7 +1167,7 @@ def _provider_ids_from_rp_ids(context, rp_ids):
     # FROM resource_providers AS rp
     # LEFT JOIN resource_providers AS parent
     #   ON rp.parent_provider_id = parent.id
-    # LEFT JOIN resource_providers AS root
+    # INNER JOIN resource_providers AS root
     #   ON rp.root_provider_id = root.id
     # WHERE rp.id IN ($rp_ids)
     me = sa.alias(_RP_TBL, name="me")
@@ -690,9 +1181,7 @@ def _provider_ids_from_rp_ids(context, rp_ids):
         root.c.id.label('root_id'),
         root.c.uuid.label('root_uuid'),
     ]
-    # TODO(jaypipes): Change this to an inner join when we are sure all
-    # root_provider_id values are NOT NULL
-    me_to_root = sa.outerjoin(me, root, me.c.root_provider_id == root.c.id)
+    me_to_root = sa.join(me, root, me.c.root_provider_id == root.c.id)
     me_to_parent = sa.outerjoin(me_to_root, parent,
         me.c.parent_provider_id == parent.c.id)
     sel = sa.select(cols).select_from(me_to_parent)
@@ -719,7 +1208,7 @@ def _provider_ids_from_uuid(context, uuid):
     # FROM resource_providers AS rp
     # LEFT JOIN resource_providers AS parent
     #   ON rp.parent_provider_id = parent.id
-    # LEFT JOIN resource_providers AS root
+    # INNER JOIN resource_providers AS root
     #   ON rp.root_provider_id = root.id
     me = sa.alias(_RP_TBL, name="me")
     parent = sa.alias(_RP_TBL, name="parent")
@@ -732,9 +1221,7 @@ def _provider_ids_from_uuid(context, uuid):
         root.c.id.label('root_id'),
         root.c.uuid.label('root_uuid'),
     ]
-    # TODO(jaypipes): Change this to an inner join when we are sure all
-    # root_provider_id values are NOT NULL
-    me_to_root = sa.outerjoin(me, root, me.c.root_provider_id == root.c.id)
+    me_to_root = sa.join(me, root, me.c.root_provider_id == root.c.id)
     me_to_parent = sa.outerjoin(me_to_root, parent,
         me.c.parent_provider_id == parent.c.id)
     sel = sa.select(cols).select_from(me_to_parent)
@@ -799,12 +1286,7 @@ def _provider_ids_matching_aggregates(context, member_of, rp_ids=None):
     for members in member_of:
         for member in members:
             agg_uuids.add(member)
-    agg_tbl = sa.alias(_AGG_TBL, name='aggs')
-    agg_sel = sa.select([agg_tbl.c.uuid, agg_tbl.c.id])
-    agg_sel = agg_sel.where(agg_tbl.c.uuid.in_(agg_uuids))
-    agg_uuid_map = {
-        r[0]: r[1] for r in context.session.execute(agg_sel).fetchall()
-    }
+    agg_uuid_map = _AGG_CACHE.ids_from_keys(agg_uuids)
 
     rp_tbl = sa.alias(_RP_TBL, name='rp')
     join_chain = rp_tbl
@@ -941,6 +1423,13 @@ class ResourceProvider(base.VersionedObject, base.TimestampedObject):
         """Get the aggregate uuids associated with this resource provider."""
         return _get_aggregates_by_provider_id(self._context, self.id)
 
+    def get_aggregate_ids(self):
+        """Get the sorted internal IDs of the aggregates associated with this
+        resource provider. They change whenever the associations do, so they
+        can stand in for the aggregate uuids without reading them.
+        """
+        return _get_aggregate_ids_by_provider_id(self._context, self.id)
+
     def set_aggregates(self, aggregate_uuids, increment_generation=False):
         """Set the aggregate uuids associated with this resource provider.
 
@@ -1006,6 +1495,9 @@ class ResourceProvider(base.VersionedObject, base.TimestampedObject):
             context.session.add(db_rp)
             context.session.flush()
             self.root_provider_uuid = self.uuid
+        _add_provider_to_closure(context, db_rp.id, parent_id)
+        change_log.record_provider_changes(
+            context, [db_rp.id], topology=parent_id is not None)
 
     @staticmethod
     @db_api.placement_context_manager.writer
@@ -1037,6 +1529,11 @@ class ResourceProvider(base.VersionedObject, base.TimestampedObject):
         RPT_model = models.ResourceProviderTrait
         context.session.query(RPT_model).\
                 filter(RPT_model.resource_provider_id == _id).delete()
+        # The provider has no children, so only its own records of the
+        # closure remain
+        del_stmt = _CLOSURE_TBL.delete().where(
+            _CLOSURE_TBL.c.descendant_id == _id)
+        context.session.execute(del_stmt)
         # set root_provider_id to null to make deletion possible
         context.session.query(models.ResourceProvider).\
             filter(models.ResourceProvider.id == _id,
@@ -1052,12 +1549,13 @@ class ResourceProvider(base.VersionedObject, base.TimestampedObject):
             raise exception.CannotDeleteParentResourceProvider()
         if not result:
             raise exception.NotFound()
+        change_log.record_provider_changes(context, [_id], topology=True)
 
     @db_api.placement_context_manager.writer
     def _update_in_db(self, context, id, updates):
-        # A list of resource providers in the same tree with the
-        # resource provider to update
-        same_tree = []
+        # The new parent of a provider that had none
+        new_parent_ids = None
+        reparented = False
         if 'parent_provider_uuid' in updates:
             # TODO(jaypipes): For now, "re-parenting" and "un-parenting" are
             # not possible. If the provider already had a parent, we don't
@@ -1089,22 +1587,17 @@ class ResourceProvider(base.VersionedObject, base.TimestampedObject):
                     # have one. We have to check that by this new parent we
                     # don't create a loop in the tree. Basically the new parent
                     # cannot be the RP itself or one of its descendants.
-                    # However as the RP's current parent is None the above
-                    # condition is the same as "the new parent cannot be any RP
-                    # from the current RP tree".
-                    same_tree = ResourceProviderList.get_all_by_filters(
-                        context,
-                        filters={'in_tree': self.uuid})
-                    rp_uuids_in_the_same_tree = [rp.uuid for rp in same_tree]
-                    if parent_uuid in rp_uuids_in_the_same_tree:
+                    if _is_descendant(context, parent_ids.id, id):
                         raise exception.ObjectActionError(
                             action='update',
                             reason=_('creating loop in the provider tree is '
                                      'not allowed.'))
+                    new_parent_ids = parent_ids
 
                 updates['root_provider_id'] = parent_ids.root_id
                 updates['parent_provider_id'] = parent_ids.id
                 self.root_provider_uuid = parent_ids.root_uuid
+                reparented = True
             else:
                 if my_ids.parent_id is not None:
                     raise exception.ObjectActionError(
@@ -1117,20 +1610,6 @@ class ResourceProvider(base.VersionedObject, base.TimestampedObject):
         db_rp.update(updates)
         context.session.add(db_rp)
 
-        # We should also update the root providers of resource providers
-        # originally in the same tree. If re-parenting is supported,
-        # this logic should be changed to update only descendents of the
-        # re-parented resource providers, not all the providers in the tree.
-        for rp in same_tree:
-            # If the parent is not updated, this clause is skipped since the
-            # `same_tree` has no element.
-            rp.root_provider_uuid = parent_ids.root_uuid
-            db_rp = context.session.query(
-                models.ResourceProvider).filter_by(id=rp.id).first()
-            data = {'root_provider_id': parent_ids.root_id}
-            db_rp.update(data)
-            context.session.add(db_rp)
-
         try:
             context.session.flush()
         except sqla_exc.IntegrityError:
@@ -1141,24 +1620,31 @@ class ResourceProvider(base.VersionedObject, base.TimestampedObject):
                     action='update',
                     reason=_('parent provider UUID does not exist.'))
 
+        if new_parent_ids is not None:
+            # The descendants of the provider move to the tree of the parent
+            upd = _RP_TBL.update().where(_RP_TBL.c.id.in_(_subtree_select(id)))
+            upd = upd.values(root_provider_id=new_parent_ids.root_id)
+            context.session.execute(upd)
+            _move_subtree_in_closure(context, id, new_parent_ids.id)
+            rp_ids = [r[0] for r in context.session.execute(
+                _subtree_select(id))]
+        else:
+            rp_ids = [id]
+        change_log.record_provider_changes(
+            context, rp_ids, topology=reparented)
+
     @staticmethod
-    @db_api.placement_context_manager.writer  # For online data migration
     def _from_db_object(context, resource_provider, db_resource_provider):
-        # Online data migration to populate root_provider_id
-        # TODO(jaypipes): Remove when all root_provider_id values are NOT NULL
-        if db_resource_provider['root_provider_uuid'] is None:
-            rp_id = db_resource_provider['id']
-            uuid = db_resource_provider['uuid']
-            db_resource_provider['root_provider_uuid'] = uuid
-            _set_root_provider_id(context, rp_id, rp_id)
+        # Fields that were not read, see ResourceProviderList, are left unset
         for field in resource_provider.fields:
-            setattr(resource_provider, field, db_resource_provider[field])
+            if field in db_resource_provider:
+                setattr(resource_provider, field, db_resource_provider[field])
         resource_provider._context = context
         resource_provider.obj_reset_changes()
         return resource_provider
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_providers_with_shared_capacity(ctx, rc_id, amount, member_of=None):
     """Returns a list of resource provider IDs (internal IDs, not UUIDs)
     that have capacity for a requested amount of a resource and indicate that
@@ -1203,95 +1689,61 @@ def _get_providers_with_shared_capacity(ctx, rc_id, amount, member_of=None):
                       resource providers that *directly* belong to the
                       aggregates referenced.
     """
-    # The SQL we need to generate here looks like this:
+    # The providers having the MISC_SHARES_VIA_AGGREGATE trait are taken from
+    # the topology cache, so that only their capacity needs checking. The SQL
+    # we need to generate here looks like this:
     #
-    # SELECT rp.id
-    # FROM resource_providers AS rp
-    #   INNER JOIN resource_provider_traits AS rpt
-    #     ON rp.id = rpt.resource_provider_id
-    #   INNER JOIN traits AS t
-    #     ON rpt.trait_id = t.id
-    #     AND t.name = "MISC_SHARES_VIA_AGGREGATE"
-    #   INNER JOIN inventories AS inv
-    #     ON rp.id = inv.resource_provider_id
-    #     AND inv.resource_class_id = $rc_id
-    #   LEFT JOIN (
-    #     SELECT resource_provider_id, SUM(used) as used
-    #     FROM allocations
-    #     WHERE resource_class_id = $rc_id
-    #     GROUP BY resource_provider_id
-    #   ) AS usage
-    #     ON rp.id = usage.resource_provider_id
-    # WHERE COALESCE(usage.used, 0) + $amount <= (
-    #   inv.total - inv.reserved) * inv.allocation_ratio
-    # ) AND
+    # SELECT inv.resource_provider_id
+    # FROM inventories AS inv
+    #   LEFT JOIN resource_provider_usages AS usage
+    #     ON inv.resource_provider_id = usage.resource_provider_id
+    #     AND usage.resource_class_id = $rc_id
+    # WHERE inv.resource_provider_id IN ($SHARING_RP_IDs) AND
+    #   inv.resource_class_id = $rc_id AND
+    #   COALESCE(usage.used, 0) + $amount <= (
+    #     inv.total - inv.reserved) * inv.allocation_ratio
+    #   ) AND
     #   inv.min_unit <= $amount AND
     #   inv.max_unit >= $amount AND
     #   $amount % inv.step_size = 0
-    # GROUP BY rp.id
-
-    rp_tbl = sa.alias(_RP_TBL, name='rp')
-    inv_tbl = sa.alias(_INV_TBL, name='inv')
-    t_tbl = sa.alias(_TRAIT_TBL, name='t')
-    rpt_tbl = sa.alias(_RP_TRAIT_TBL, name='rpt')
+    sharing_ids = set(_get_topology(ctx).sharing)
+    if not sharing_ids:
+        return []
 
-    rp_to_rpt_join = sa.join(
-        rp_tbl, rpt_tbl,
-        rp_tbl.c.id == rpt_tbl.c.resource_provider_id,
-    )
+    # If 'member_of' has values, do a separate lookup to identify the
+    # resource providers that meet the member_of constraints.
+    if member_of:
+        sharing_ids &= set(_provider_ids_matching_aggregates(ctx, member_of))
+        if not sharing_ids:
+            # Short-circuit. The user either asked for a non-existing
+            # aggregate or there were no sharing providers that matched
+            # the requirements...
+            return []
 
-    rpt_to_t_join = sa.join(
-        rp_to_rpt_join, t_tbl,
-        sa.and_(
-            rpt_tbl.c.trait_id == t_tbl.c.id,
-            # The traits table wants unicode trait names, but os_traits
-            # presents native str, so we need to cast.
-            t_tbl.c.name == six.text_type(os_traits.MISC_SHARES_VIA_AGGREGATE),
-        ),
-    )
+    inv_tbl = sa.alias(_INV_TBL, name='inv')
+    usage = sa.alias(_USAGE_TBL, name='usage')
 
-    rp_to_inv_join = sa.join(
-        rpt_to_t_join, inv_tbl,
+    inv_to_usage_join = sa.outerjoin(
+        inv_tbl, usage,
         sa.and_(
-            rpt_tbl.c.resource_provider_id == inv_tbl.c.resource_provider_id,
-            inv_tbl.c.resource_class_id == rc_id,
+            inv_tbl.c.resource_provider_id == usage.c.resource_provider_id,
+            usage.c.resource_class_id == rc_id,
         ),
     )
 
-    usage = sa.select([_ALLOC_TBL.c.resource_provider_id,
-                       sql.func.sum(_ALLOC_TBL.c.used).label('used')])
-    usage = usage.where(_ALLOC_TBL.c.resource_class_id == rc_id)
-    usage = usage.group_by(_ALLOC_TBL.c.resource_provider_id)
-    usage = sa.alias(usage, name='usage')
-
-    inv_to_usage_join = sa.outerjoin(
-        rp_to_inv_join, usage,
-        inv_tbl.c.resource_provider_id == usage.c.resource_provider_id,
-    )
-
     where_conds = sa.and_(
+        inv_tbl.c.resource_provider_id.in_(sharing_ids),
+        inv_tbl.c.resource_class_id == rc_id,
         func.coalesce(usage.c.used, 0) + amount <= (
             inv_tbl.c.total - inv_tbl.c.reserved) * inv_tbl.c.allocation_ratio,
         inv_tbl.c.min_unit <= amount,
         inv_tbl.c.max_unit >= amount,
         amount % inv_tbl.c.step_size == 0)
 
-    # If 'member_of' has values, do a separate lookup to identify the
-    # resource providers that meet the member_of constraints.
-    if member_of:
-        rps_in_aggs = _provider_ids_matching_aggregates(ctx, member_of)
-        if not rps_in_aggs:
-            # Short-circuit. The user either asked for a non-existing
-            # aggregate or there were no resource providers that matched
-            # the requirements...
-            return []
-        where_conds.append(rp_tbl.c.id.in_(rps_in_aggs))
+    sel = sa.select([inv_tbl.c.resource_provider_id])
+    sel = sel.select_from(inv_to_usage_join).where(where_conds)
 
-    sel = sa.select([rp_tbl.c.id]).select_from(inv_to_usage_join)
-    sel = sel.where(where_conds)
-    sel = sel.group_by(rp_tbl.c.id)
-
-    return [r[0] for r in ctx.session.execute(sel)]
+    return sorted(r[0] for r in ctx.session.execute(sel))
 
 
 @base.VersionedObjectRegistry.register_if(False)
@@ -1302,8 +1754,9 @@ class ResourceProviderList(base.ObjectListBase, base.VersionedObject):
     }
 
     @staticmethod
-    @db_api.placement_context_manager.reader
-    def _get_all_by_filters_from_db(context, filters):
+    @db_api.placement_context_manager.reader.allow_async
+    def _get_all_by_filters_from_db(context, filters, limit=None, marker=None,
+                                    fields=None):
         # Eg. filters can be:
         #  filters = {
         #      'name': <name>,
@@ -1341,25 +1794,41 @@ class ResourceProviderList(base.ObjectListBase, base.VersionedObject):
         root_rp = sa.alias(_RP_TBL, name="root_rp")
         parent_rp = sa.alias(_RP_TBL, name="parent_rp")
 
-        cols = [
-            rp.c.id,
-            rp.c.uuid,
-            rp.c.name,
-            rp.c.generation,
-            rp.c.updated_at,
-            rp.c.created_at,
-            root_rp.c.uuid.label("root_provider_uuid"),
-            parent_rp.c.uuid.label("parent_provider_uuid"),
-        ]
-
-        # TODO(jaypipes): Convert this to an inner join once all
-        # root_provider_id values are NOT NULL
-        rp_to_root = sa.outerjoin(rp, root_rp,
-            rp.c.root_provider_id == root_rp.c.id)
-        rp_to_parent = sa.outerjoin(rp_to_root, parent_rp,
-            rp.c.parent_provider_id == parent_rp.c.id)
+        if fields is None:
+            fields = ResourceProvider.fields
+        # The internal ID and UUID are always read, to filter and to page
+        cols = [rp.c.id, rp.c.uuid]
+        cols.extend(rp.c[field] for field in
+                    ('name', 'generation', 'updated_at', 'created_at')
+                    if field in fields)
+        # The root and parent providers are only joined when they are
+        # wanted.
+        rp_to_parent = rp
+        group_by = [rp.c.id]
+        if 'root_provider_uuid' in fields:
+            rp_to_parent = sa.join(rp_to_parent, root_rp,
+                rp.c.root_provider_id == root_rp.c.id)
+            cols.append(root_rp.c.uuid.label("root_provider_uuid"))
+            group_by.append(root_rp.c.uuid)
+        if 'parent_provider_uuid' in fields:
+            rp_to_parent = sa.outerjoin(rp_to_parent, parent_rp,
+                rp.c.parent_provider_id == parent_rp.c.id)
+            cols.append(parent_rp.c.uuid.label("parent_provider_uuid"))
+            group_by.append(parent_rp.c.uuid)
 
         query = sa.select(cols).select_from(rp_to_parent)
+        if limit is not None or marker is not None:
+            # Keyset pagination: the providers are returned in the order of
+            # their internal IDs, starting after the one of the marker, so
+            # each page is an index range scan however deep it is.
+            query = query.order_by(rp.c.id)
+            if marker is not None:
+                marker_ids = _provider_ids_from_uuid(context, marker)
+                if marker_ids is None:
+                    raise exception.ResourceProviderNotFound(uuids=marker)
+                query = query.where(rp.c.id > marker_ids.id)
+            if limit is not None:
+                query = query.limit(limit)
 
         if name:
             query = query.where(rp.c.name == name)
@@ -1371,20 +1840,16 @@ class ResourceProviderList(base.ObjectListBase, base.VersionedObject):
             # within its "provider tree". So, we look up the resource provider
             # having the UUID specified by the 'in_tree' parameter and grab the
             # root_provider_id value of that record. We can then ask for only
-            # those resource providers having a root_provider_id of that value.
+            # the descendants of that root provider, which the closure table
+            # holds, including the root itself.
             tree_uuid = filters.pop('in_tree')
             tree_ids = _provider_ids_from_uuid(context, tree_uuid)
             if tree_ids is None:
                 # List operations should simply return an empty list when a
                 # non-existing resource provider UUID is given.
                 return []
-            root_id = tree_ids.root_id
-            # TODO(jaypipes): Remove this OR condition when root_provider_id
-            # is not nullable in the database and all resource provider records
-            # have populated the root provider ID.
-            where_cond = sa.or_(rp.c.id == root_id,
-                rp.c.root_provider_id == root_id)
-            query = query.where(where_cond)
+            query = query.where(
+                rp.c.id.in_(_subtree_select(tree_ids.root_id)))
 
         # If 'member_of' has values, do a separate lookup to identify the
         # resource providers that meet the member_of constraints.
@@ -1398,28 +1863,23 @@ class ResourceProviderList(base.ObjectListBase, base.VersionedObject):
             query = query.where(rp.c.id.in_(rps_in_aggs))
 
         # If 'required' has values, add a filter to limit results to providers
-        # possessing *all* of the listed traits.
-        if required:
-            trait_map = _trait_ids_from_names(context, required)
-            if len(trait_map) != len(required):
-                missing = required - set(trait_map)
-                raise exception.TraitNotFound(names=', '.join(missing))
-            rp_ids = _get_provider_ids_having_all_traits(context, trait_map)
-            if not rp_ids:
-                # If no providers have the required traits, we're done
-                return []
-            query = query.where(rp.c.id.in_(rp_ids))
-
-        # If 'forbidden' has values, filter out those providers that have
-        # that trait as one their traits.
-        if forbidden:
-            trait_map = _trait_ids_from_names(context, forbidden)
-            if len(trait_map) != len(forbidden):
-                missing = forbidden - set(trait_map)
-                raise exception.TraitNotFound(names=', '.join(missing))
-            rp_ids = _get_provider_ids_having_any_trait(context, trait_map)
-            if rp_ids:
-                query = query.where(~rp.c.id.in_(rp_ids))
+        # possessing *all* of the listed traits. If 'forbidden' has values,
+        # filter out those providers that have that trait as one their traits.
+        if required or forbidden:
+            required_map = {}
+            forbidden_map = {}
+            if required:
+                required_map = _trait_ids_from_names(context, required)
+                if len(required_map) != len(required):
+                    missing = required - set(required_map)
+                    raise exception.TraitNotFound(names=', '.join(missing))
+            if forbidden:
+                forbidden_map = _trait_ids_from_names(context, forbidden)
+                if len(forbidden_map) != len(forbidden):
+                    missing = forbidden - set(forbidden_map)
+                    raise exception.TraitNotFound(names=', '.join(missing))
+            query = query.where(sa.and_(
+                *_trait_conds(rp.c.id, required_map, forbidden_map)))
 
         if not resources:
             # Returns quickly the list in case we don't need to check the
@@ -1434,12 +1894,7 @@ class ResourceProviderList(base.ObjectListBase, base.VersionedObject):
         # FROM resource_providers AS rp
         # JOIN inventories AS inv
         # ON rp.id = inv.resource_provider_id
-        # LEFT JOIN (
-        #    SELECT resource_provider_id, resource_class_id, SUM(used) AS used
-        #    FROM allocations
-        #    WHERE resource_class_id IN ($RESOURCE_CLASSES)
-        #    GROUP BY resource_provider_id, resource_class_id
-        # ) AS usage
+        # LEFT JOIN resource_provider_usages AS usage
         #     ON inv.resource_provider_id = usage.resource_provider_id
         #     AND inv.resource_class_id = usage.resource_class_id
         # AND (inv.resource_class_id = $X AND (used + $AMOUNT_X <= (
@@ -1466,13 +1921,7 @@ class ResourceProviderList(base.ObjectListBase, base.VersionedObject):
             rp.c.id == _INV_TBL.c.resource_provider_id)
 
         # Now, below is the LEFT JOIN for getting the allocations usage
-        usage = sa.select([_ALLOC_TBL.c.resource_provider_id,
-                           _ALLOC_TBL.c.resource_class_id,
-                           sql.func.sum(_ALLOC_TBL.c.used).label('used')])
-        usage = usage.where(_ALLOC_TBL.c.resource_class_id.in_(resources))
-        usage = usage.group_by(_ALLOC_TBL.c.resource_provider_id,
-                               _ALLOC_TBL.c.resource_class_id)
-        usage = sa.alias(usage, name='usage')
+        usage = sa.alias(_USAGE_TBL, name='usage')
         usage_join = sa.outerjoin(inv_join, usage,
             sa.and_(
                 usage.c.resource_provider_id == (
@@ -1495,7 +1944,7 @@ class ResourceProviderList(base.ObjectListBase, base.VersionedObject):
             for (r_idx, amount) in resources.items()]
         query = query.select_from(usage_join)
         query = query.where(sa.or_(*where_clauses))
-        query = query.group_by(rp.c.id, root_rp.c.uuid, parent_rp.c.uuid)
+        query = query.group_by(*group_by)
         # NOTE(sbauza): Only RPs having all the asked resources can be provided
         query = query.having(sql.func.count(
             sa.distinct(_INV_TBL.c.resource_class_id)) == len(resources))
@@ -1504,7 +1953,8 @@ class ResourceProviderList(base.ObjectListBase, base.VersionedObject):
         return [dict(r) for r in res]
 
     @classmethod
-    def get_all_by_filters(cls, context, filters=None):
+    def get_all_by_filters(cls, context, filters=None, limit=None,
+                           marker=None, fields=None):
         """Returns a list of `ResourceProvider` objects that have sufficient
         resources in their inventories to satisfy the amounts specified in the
         `filters` parameter.
@@ -1522,8 +1972,38 @@ class ResourceProviderList(base.ObjectListBase, base.VersionedObject):
                         `resources` is a dict of amounts keyed by resource
                         classes.
         :type filters: dict
+        :param limit: The maximum number of providers to return. When it or
+                      marker is given, the providers are ordered by their
+                      internal IDs.
+        :param marker: The UUID of the provider after which to start, the
+                       last one of the previous page.
+        :param fields: The names of the `ResourceProvider` fields to load,
+                       or None for all of them. The others are left unset.
+        :raises: `exception.ResourceProviderNotFound` if the marker does not
+                 exist.
         """
-        resource_providers = cls._get_all_by_filters_from_db(context, filters)
+        resource_providers = cls._get_all_by_filters_from_db(
+            context, filters, limit=limit, marker=marker, fields=fields)
+        return base.obj_make_list(context, cls(context),
+                                  ResourceProvider, resource_providers)
+
+    @classmethod
+    def get_all_by_uuids(cls, context, uuids):
+        """Returns a list of `ResourceProvider` objects, one for each of the
+        supplied UUIDs, fetched with a single query.
+
+        :param context: `nova.context.RequestContext` that may be used to grab
+                        a DB connection.
+        :param uuids: An iterable of resource provider UUIDs.
+        :raises: `exception.ResourceProviderNotFound` naming every UUID that
+                 does not refer to an existing resource provider.
+        """
+        uuids = set(uuids)
+        resource_providers = _get_providers_by_uuids(context, uuids)
+        missing = uuids - set(rp['uuid'] for rp in resource_providers)
+        if missing:
+            raise exception.ResourceProviderNotFound(
+                uuids=', '.join(sorted(missing)))
         return base.obj_make_list(context, cls(context),
                                   ResourceProvider, resource_providers)
 
@@ -1549,7 +2029,7 @@ class Inventory(base.VersionedObject, base.TimestampedObject):
         return int((self.total - self.reserved) * self.allocation_ratio)
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_inventory_by_provider_id(ctx, rp_id):
     inv = sa.alias(_INV_TBL, name="i")
     cols = [
@@ -1624,15 +2104,168 @@ class Allocation(base.VersionedObject, base.TimestampedObject):
     }
 
 
+def _get_usage_removed_by(ctx, where):
+    """Returns a dict, keyed by tuples of (provider ID, resource class ID), of
+    the negated summed amounts of the allocations matching the supplied
+    condition. Passing the result to _update_provider_usages() after deleting
+    those allocations keeps the summed usages in step.
+    """
+    sel = sa.select([_ALLOC_TBL.c.resource_provider_id,
+                     _ALLOC_TBL.c.resource_class_id,
+                     sql.func.sum(_ALLOC_TBL.c.used)])
+    sel = sel.where(where)
+    sel = sel.group_by(_ALLOC_TBL.c.resource_provider_id,
+                       _ALLOC_TBL.c.resource_class_id)
+    return {(r[0], r[1]): -r[2] for r in ctx.session.execute(sel)}
+
+
+def _update_provider_usages(ctx, deltas):
+    """Applies changes in allocated amounts to the summed usages in the
+    resource_provider_usages table. Must be called in the same transaction
+    that writes the allocations.
+
+    A usage record only exists while there are allocations of its resource
+    class against its provider, just as a SUM() over the allocations table
+    grouped by provider and resource class would only return a row then.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param deltas: dict, keyed by tuples of (provider ID, resource class ID),
+                   of the amount by which the usage changed
+    """
+    # Sorted so that concurrent writers lock the records in the same order
+    for (rp_id, rc_id), delta in sorted(deltas.items()):
+        if not delta:
+            continue
+        cond = sa.and_(_USAGE_TBL.c.resource_provider_id == rp_id,
+                       _USAGE_TBL.c.resource_class_id == rc_id)
+        upd_stmt = _USAGE_TBL.update().where(cond).values(
+            used=_USAGE_TBL.c.used + delta)
+        res = ctx.session.execute(upd_stmt)
+        if res.rowcount:
+            if delta < 0:
+                del_stmt = _USAGE_TBL.delete().where(
+                    sa.and_(cond, _USAGE_TBL.c.used <= 0))
+                ctx.session.execute(del_stmt)
+        elif delta > 0:
+            ins_stmt = _USAGE_TBL.insert().values(
+                resource_provider_id=rp_id, resource_class_id=rc_id,
+                used=delta)
+            try:
+                with ctx.session.begin_nested():
+                    ctx.session.execute(ins_stmt)
+            except db_exc.DBDuplicateEntry:
+                # Another writer created the usage first, so add to it
+                ctx.session.execute(upd_stmt)
+        else:
+            LOG.warning('Summed usage of resource class %(rc)s on resource '
+                        'provider %(rp)s is missing. Run the usage repair to '
+                        'correct it.', {'rc': rc_id, 'rp': rp_id})
+    change_log.record_provider_changes(
+        ctx, [rp_id for (rp_id, _rc_id), delta in deltas.items() if delta])
+
+
+def _claim_provider_usages(ctx, claims, rp_uuids):
+    """Adds the supplied amounts to the summed usages in the
+    resource_provider_usages table, using a single conditional statement per
+    provider and resource class that only succeeds while the usage stays
+    within the capacity of the inventory. Must be called in the same
+    transaction that writes the allocations.
+
+    Unlike checking capacity first and comparing provider generations
+    afterwards, this does not conflict with concurrent writes that claim the
+    same inventory as long as there is room for all of them.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param claims: dict, keyed by tuples of (provider ID, resource class ID),
+                   of the amount to add to the usage
+    :param rp_uuids: dict of provider UUIDs, keyed by provider ID, used to
+                     report a claim that exceeds capacity
+    :raises `exception.InvalidAllocationCapacityExceeded` if any inventory
+            would be exhausted by the claim.
+    """
+    # Sorted so that concurrent writers lock the records in the same order
+    for (rp_id, rc_id), amount in sorted(claims.items()):
+        if not amount:
+            continue
+        inv_cond = sa.and_(_INV_TBL.c.resource_provider_id == rp_id,
+                           _INV_TBL.c.resource_class_id == rc_id)
+        capacity = sa.select([
+            (_INV_TBL.c.total - _INV_TBL.c.reserved) *
+            _INV_TBL.c.allocation_ratio]).where(inv_cond).as_scalar()
+        # UPDATE resource_provider_usages
+        # SET used = used + $amount
+        # WHERE resource_provider_id = $rp_id
+        # AND resource_class_id = $rc_id
+        # AND used + $amount <= (
+        #   SELECT (total - reserved) * allocation_ratio
+        #   FROM inventories
+        #   WHERE resource_provider_id = $rp_id
+        #   AND resource_class_id = $rc_id)
+        usage_cond = sa.and_(_USAGE_TBL.c.resource_provider_id == rp_id,
+                             _USAGE_TBL.c.resource_class_id == rc_id)
+        upd_stmt = _USAGE_TBL.update().where(sa.and_(
+            usage_cond, _USAGE_TBL.c.used + amount <= capacity)).values(
+                used=_USAGE_TBL.c.used + amount)
+        claimed = ctx.session.execute(upd_stmt).rowcount == 1
+        if not claimed:
+            sel = sa.select([_USAGE_TBL.c.used]).where(usage_cond)
+            if ctx.session.execute(sel).fetchone() is None:
+                # There is no usage yet, so the inventory alone bounds it.
+                # INSERT INTO resource_provider_usages
+                # SELECT resource_provider_id, resource_class_id, $amount
+                # FROM inventories
+                # WHERE resource_provider_id = $rp_id
+                # AND resource_class_id = $rc_id
+                # AND (total - reserved) * allocation_ratio >= $amount
+                ins_sel = sa.select([
+                    _INV_TBL.c.resource_provider_id,
+                    _INV_TBL.c.resource_class_id,
+                    sa.literal(amount)]).where(sa.and_(
+                        inv_cond,
+                        (_INV_TBL.c.total - _INV_TBL.c.reserved) *
+                        _INV_TBL.c.allocation_ratio >= amount))
+                ins_stmt = _USAGE_TBL.insert().from_select(
+                    ['resource_provider_id', 'resource_class_id', 'used'],
+                    ins_sel)
+                try:
+                    with ctx.session.begin_nested():
+                        res = ctx.session.execute(ins_stmt)
+                    claimed = res.rowcount == 1
+                except db_exc.DBDuplicateEntry:
+                    # Another writer created the usage first, so claim from it
+                    claimed = ctx.session.execute(upd_stmt).rowcount == 1
+        if not claimed:
+            rc_str = _RC_CACHE.string_from_id(rc_id)
+            LOG.warning("Over capacity for %(rc)s on resource provider "
+                        "%(rp)s. Needed: %(needed)s",
+                        {'rc': rc_str, 'rp': rp_uuids[rp_id],
+                         'needed': amount})
+            raise exception.InvalidAllocationCapacityExceeded(
+                resource_class=rc_str, resource_provider=rp_uuids[rp_id])
+    change_log.record_provider_changes(
+        ctx, [rp_id for (rp_id, _rc_id), amount in claims.items() if amount])
+
+
 @db_api.placement_context_manager.writer
 def _delete_allocations_for_consumer(ctx, consumer_id):
     """Deletes any existing allocations that correspond to the allocations to
     be written. This is wrapped in a transaction, so if the write subsequently
     fails, the deletion will also be rolled back.
     """
-    del_sql = _ALLOC_TBL.delete().where(
-        _ALLOC_TBL.c.consumer_id == consumer_id)
+    _delete_allocations_for_consumers(ctx, [consumer_id])
+
+
+@db_api.placement_context_manager.writer
+def _delete_allocations_for_consumers(ctx, consumer_ids):
+    """Deletes all existing allocations of the supplied consumers with a
+    single DELETE statement. This is wrapped in a transaction, so if the write
+    subsequently fails, the deletion will also be rolled back.
+    """
+    where = _ALLOC_TBL.c.consumer_id.in_(consumer_ids)
+    removed = _get_usage_removed_by(ctx, where)
+    del_sql = _ALLOC_TBL.delete().where(where)
     ctx.session.execute(del_sql)
+    _update_provider_usages(ctx, removed)
 
 
 @db_api.placement_context_manager.writer
@@ -1640,8 +2273,141 @@ def _delete_allocations_by_ids(ctx, alloc_ids):
     """Deletes allocations having an internal id value in the set of supplied
     IDs
     """
-    del_sql = _ALLOC_TBL.delete().where(_ALLOC_TBL.c.id.in_(alloc_ids))
+    where = _ALLOC_TBL.c.id.in_(alloc_ids)
+    removed = _get_usage_removed_by(ctx, where)
+    del_sql = _ALLOC_TBL.delete().where(where)
     ctx.session.execute(del_sql)
+    _update_provider_usages(ctx, removed)
+
+
+def _insert_allocations(ctx, allocs):
+    """Writes the records of the supplied allocations with a single
+    multi-row INSERT statement and sets the id field of each Allocation
+    object from the inserted records.
+
+    The allocations of the consumers involved must have been deleted earlier
+    in the same transaction, so that the only records of those consumers are
+    the ones inserted here.
+
+    :param ctx: `nova.context.RequestContext` that contains an oslo_db Session
+    :param allocs: list of tuples of (Allocation, resource class ID)
+    """
+    if not allocs:
+        return
+    ctx.session.execute(_ALLOC_TBL.insert(), [
+        {
+            'resource_provider_id': alloc.resource_provider.id,
+            'resource_class_id': rc_id,
+            'consumer_id': alloc.consumer.uuid,
+            'used': alloc.used,
+        }
+        for alloc, rc_id in allocs])
+
+    # A multi-row INSERT does not return the ids of the records, so read them
+    # back in the order they were inserted.
+    sel = sa.select([_ALLOC_TBL.c.id,
+                     _ALLOC_TBL.c.resource_provider_id,
+                     _ALLOC_TBL.c.resource_class_id,
+                     _ALLOC_TBL.c.consumer_id])
+    sel = sel.where(_ALLOC_TBL.c.consumer_id.in_(
+        set(alloc.consumer.uuid for alloc, _rc_id in allocs)))
+    sel = sel.order_by(_ALLOC_TBL.c.id)
+    ids = collections.defaultdict(collections.deque)
+    for rec in ctx.session.execute(sel):
+        ids[(rec[1], rec[2], rec[3])].append(rec[0])
+    for alloc, rc_id in allocs:
+        key = (alloc.resource_provider.id, rc_id, alloc.consumer.uuid)
+        alloc.id = ids[key].popleft()
+        alloc.obj_reset_changes()
+
+
+@db_api.placement_context_manager.reader.allow_async
+def verify_provider_usages(ctx):
+    """Compares the summed usages in the resource_provider_usages table with
+    the allocations they summarize.
+
+    Returns a dict, keyed by tuples of (provider ID, resource class ID), of
+    tuples of (recorded usage, actual usage) for every usage that is wrong. A
+    missing record is reported as a recorded usage of None and allocations
+    that are all gone as an actual usage of None. Both are read by a single
+    statement, so that they are consistent with each other while allocations
+    are being written.
+    """
+    def _sums():
+        sel = sa.select([_ALLOC_TBL.c.resource_provider_id,
+                         _ALLOC_TBL.c.resource_class_id,
+                         sql.func.sum(_ALLOC_TBL.c.used).label('used')])
+        sel = sel.group_by(_ALLOC_TBL.c.resource_provider_id,
+                           _ALLOC_TBL.c.resource_class_id)
+        return sa.alias(sel, name='sums')
+
+    def _on(sums):
+        return sa.and_(
+            sums.c.resource_provider_id == _USAGE_TBL.c.resource_provider_id,
+            sums.c.resource_class_id == _USAGE_TBL.c.resource_class_id)
+
+    # The recorded usages with the sums of their allocations...
+    sums = _sums()
+    recorded = sa.select([_USAGE_TBL.c.resource_provider_id,
+                          _USAGE_TBL.c.resource_class_id,
+                          _USAGE_TBL.c.used,
+                          sums.c.used])
+    recorded = recorded.select_from(
+        sa.outerjoin(_USAGE_TBL, sums, _on(sums)))
+    # ...and the sums of allocations without a recorded usage
+    sums = _sums()
+    unrecorded = sa.select([sums.c.resource_provider_id,
+                            sums.c.resource_class_id,
+                            sa.null(),
+                            sums.c.used])
+    unrecorded = unrecorded.select_from(
+        sa.outerjoin(sums, _USAGE_TBL, _on(sums)))
+    unrecorded = unrecorded.where(_USAGE_TBL.c.resource_provider_id.is_(None))
+    sel = sa.union_all(recorded, unrecorded)
+    return {(r[0], r[1]): (r[2], r[3]) for r in ctx.session.execute(sel)
+            if r[2] != r[3]}
+
+
+@db_api.placement_context_manager.writer
+def repair_provider_usages(ctx, batch_size):
+    """Corrects summed usages in the resource_provider_usages table that do
+    not match the allocations they summarize, as found by
+    verify_provider_usages().
+
+    Allocations may be written while the repair runs, so each correction is
+    applied as a delta to the recorded usage, the way the writers of
+    allocations change it, rather than overwriting the changes they make.
+
+    Returns a tuple of (the number of wrong usages found, the number
+    corrected), both limited to batch_size, since this is the expected return
+    format for data migration routines.
+    """
+    wrong = sorted(verify_provider_usages(ctx).items())[:batch_size]
+    for (rp_id, rc_id), (recorded, actual) in wrong:
+        cond = sa.and_(_USAGE_TBL.c.resource_provider_id == rp_id,
+                       _USAGE_TBL.c.resource_class_id == rc_id)
+        delta = (actual or 0) - (recorded or 0)
+        upd_stmt = _USAGE_TBL.update().where(cond).values(
+            used=_USAGE_TBL.c.used + delta)
+        if recorded is None:
+            ins_stmt = _USAGE_TBL.insert().values(
+                resource_provider_id=rp_id, resource_class_id=rc_id,
+                used=actual)
+            try:
+                with ctx.session.begin_nested():
+                    ctx.session.execute(ins_stmt)
+            except db_exc.DBDuplicateEntry:
+                # A writer created the usage since, so add to it
+                ctx.session.execute(upd_stmt)
+        else:
+            ctx.session.execute(upd_stmt)
+            if actual is None:
+                del_stmt = _USAGE_TBL.delete().where(
+                    sa.and_(cond, _USAGE_TBL.c.used == 0))
+                ctx.session.execute(del_stmt)
+    change_log.record_provider_changes(
+        ctx, [rp_id for (rp_id, _rc_id), _usages in wrong])
+    return len(wrong), len(wrong)
 
 
 def _check_capacity_exceeded(ctx, allocs):
@@ -1674,13 +2440,7 @@ def _check_capacity_exceeded(ctx, allocs):
     # FROM resource_providers AS rp
     # JOIN inventories AS i1
     # ON rp.id = i1.resource_provider_id
-    # LEFT JOIN (
-    #    SELECT resource_provider_id, resource_class_id, SUM(used) AS used
-    #    FROM allocations
-    #    WHERE resource_class_id IN ($RESOURCE_CLASSES)
-    #    AND resource_provider_id IN ($RESOURCE_PROVIDERS)
-    #    GROUP BY resource_provider_id, resource_class_id
-    # ) AS allocs
+    # LEFT JOIN resource_provider_usages AS allocs
     # ON inv.resource_provider_id = allocs.resource_provider_id
     # AND inv.resource_class_id = allocs.resource_class_id
     # WHERE rp.id IN ($RESOURCE_PROVIDERS)
@@ -1692,15 +2452,7 @@ def _check_capacity_exceeded(ctx, allocs):
                        for a in allocs])
     provider_uuids = set([a.resource_provider.uuid for a in allocs])
     provider_ids = set([a.resource_provider.id for a in allocs])
-    usage = sa.select([_ALLOC_TBL.c.resource_provider_id,
-                       _ALLOC_TBL.c.resource_class_id,
-                       sql.func.sum(_ALLOC_TBL.c.used).label('used')])
-    usage = usage.where(
-            sa.and_(_ALLOC_TBL.c.resource_class_id.in_(rc_ids),
-                    _ALLOC_TBL.c.resource_provider_id.in_(provider_ids)))
-    usage = usage.group_by(_ALLOC_TBL.c.resource_provider_id,
-                           _ALLOC_TBL.c.resource_class_id)
-    usage = sa.alias(usage, name='usage')
+    usage = sa.alias(_USAGE_TBL, name='usage')
 
     inv_join = sql.join(_RP_TBL, _INV_TBL,
             sql.and_(_RP_TBL.c.id == _INV_TBL.c.resource_provider_id,
@@ -1810,7 +2562,7 @@ def _check_capacity_exceeded(ctx, allocs):
     return res_providers
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_allocations_by_provider_id(ctx, rp_id):
     allocs = sa.alias(_ALLOC_TBL, name="a")
     consumers = sa.alias(_CONSUMER_TBL, name="c")
@@ -1824,8 +2576,7 @@ def _get_allocations_by_provider_id(ctx, rp_id):
         allocs.c.created_at,
         consumers.c.id.label("consumer_id"),
         consumers.c.generation.label("consumer_generation"),
-        sql.func.coalesce(
-            consumers.c.uuid, allocs.c.consumer_id).label("consumer_uuid"),
+        consumers.c.uuid.label("consumer_uuid"),
         projects.c.id.label("project_id"),
         projects.c.external_id.label("project_external_id"),
         users.c.id.label("user_id"),
@@ -1844,7 +2595,7 @@ def _get_allocations_by_provider_id(ctx, rp_id):
     return [dict(r) for r in ctx.session.execute(sel)]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_allocations_by_consumer_uuid(ctx, consumer_uuid):
     allocs = sa.alias(_ALLOC_TBL, name="a")
     rp = sa.alias(_RP_TBL, name="rp")
@@ -1861,8 +2612,7 @@ def _get_allocations_by_consumer_uuid(ctx, consumer_uuid):
         allocs.c.used,
         consumer.c.id.label("consumer_id"),
         consumer.c.generation.label("consumer_generation"),
-        sql.func.coalesce(
-            consumer.c.uuid, allocs.c.consumer_id).label("consumer_uuid"),
+        consumer.c.uuid.label("consumer_uuid"),
         project.c.id.label("project_id"),
         project.c.external_id.label("project_external_id"),
         user.c.id.label("user_id"),
@@ -1883,89 +2633,86 @@ def _get_allocations_by_consumer_uuid(ctx, consumer_uuid):
     return [dict(r) for r in ctx.session.execute(sel)]
 
 
-@db_api.placement_context_manager.writer.independent
-def _create_incomplete_consumers_for_provider(ctx, rp_id):
-    # TODO(jaypipes): Remove in Stein after a blocker migration is added.
-    """Creates consumer record if consumer relationship between allocations ->
-    consumers table is missing for any allocation on the supplied provider
-    internal ID, using the "incomplete consumer" project and user CONF options.
+@db_api.placement_context_manager.reader.allow_async
+def _get_allocations_marker_by_consumer_uuid(ctx, consumer_uuid):
+    """Returns a tuple of the values that the allocations of the consumer, as
+    returned by _get_allocations_by_consumer_uuid(), depend on: the internal
+    ID, generation, project and user of the consumer followed by the internal
+    ID and generation of each provider it has allocations against. The
+    allocations themselves are not read, any change to them increments the
+    generation of the consumer.
     """
-    alloc_to_consumer = sa.outerjoin(
-        _ALLOC_TBL, consumer_obj.CONSUMER_TBL,
-        _ALLOC_TBL.c.consumer_id == consumer_obj.CONSUMER_TBL.c.uuid)
-    sel = sa.select([_ALLOC_TBL.c.consumer_id])
-    sel = sel.select_from(alloc_to_consumer)
-    sel = sel.where(
-        sa.and_(
-            _ALLOC_TBL.c.resource_provider_id == rp_id,
-            consumer_obj.CONSUMER_TBL.c.id.is_(None)))
-    missing = ctx.session.execute(sel).fetchall()
-    if missing:
-        # Do a single INSERT for all missing consumer relationships for the
-        # provider
-        incomplete_proj_id = project_obj.ensure_incomplete_project(ctx)
-        incomplete_user_id = user_obj.ensure_incomplete_user(ctx)
-
-        cols = [
-            _ALLOC_TBL.c.consumer_id,
-            incomplete_proj_id,
-            incomplete_user_id,
-        ]
-        sel = sa.select(cols)
-        sel = sel.select_from(alloc_to_consumer)
-        sel = sel.where(
-            sa.and_(
-                _ALLOC_TBL.c.resource_provider_id == rp_id,
-                consumer_obj.CONSUMER_TBL.c.id.is_(None)))
-        target_cols = ['uuid', 'project_id', 'user_id']
-        ins_stmt = consumer_obj.CONSUMER_TBL.insert().from_select(
-            target_cols, sel)
-        res = ctx.session.execute(ins_stmt)
-        if res.rowcount > 0:
-            LOG.info("Online data migration to fix incomplete consumers "
-                     "for resource provider %s has been run. Migrated %d "
-                     "incomplete consumer records on the fly.", rp_id,
-                     res.rowcount)
-
-
-@db_api.placement_context_manager.writer.independent
-def _create_incomplete_consumer(ctx, consumer_id):
-    # TODO(jaypipes): Remove in Stein after a blocker migration is added.
-    """Creates consumer record if consumer relationship between allocations ->
-    consumers table is missing for the supplied consumer UUID, using the
-    "incomplete consumer" project and user CONF options.
+    allocs = sa.alias(_ALLOC_TBL, name="a")
+    rp = sa.alias(_RP_TBL, name="rp")
+    consumer = sa.alias(_CONSUMER_TBL, name="c")
+    cols = [
+        consumer.c.id,
+        consumer.c.generation,
+        consumer.c.project_id,
+        consumer.c.user_id,
+        rp.c.id,
+        rp.c.generation,
+    ]
+    rp_join = sa.join(allocs, rp, allocs.c.resource_provider_id == rp.c.id)
+    consumer_join = sa.join(rp_join, consumer,
+                            allocs.c.consumer_id == consumer.c.uuid)
+    sel = sa.select(cols).select_from(consumer_join).distinct()
+    sel = sel.where(allocs.c.consumer_id == consumer_uuid)
+    sel = sel.order_by(rp.c.id)
+    res = ctx.session.execute(sel).fetchall()
+    if not res:
+        return ()
+    return tuple(res[0][:4]) + tuple(
+        itertools.chain.from_iterable(r[4:] for r in res))
+
+
+@db_api.placement_context_manager.reader.allow_async
+def get_allocation_rows_by_provider(ctx, rp, limit=None, marker=None):
+    """Returns the allocations against the supplied resource provider as a
+    list of (consumer_uuid, consumer_generation, resource_class, used)
+    tuples, ordered by consumer UUID, without building any object for them.
+
+    :param rp: The ResourceProvider whose allocations to read.
+    :param limit: The maximum number of consumers whose allocations to
+                  return. Either all or none of the allocations of a consumer
+                  are returned.
+    :param marker: The UUID of the consumer after which to start, the last
+                   one of the previous page.
     """
-    alloc_to_consumer = sa.outerjoin(
-        _ALLOC_TBL, consumer_obj.CONSUMER_TBL,
-        _ALLOC_TBL.c.consumer_id == consumer_obj.CONSUMER_TBL.c.uuid)
-    sel = sa.select([_ALLOC_TBL.c.consumer_id])
-    sel = sel.select_from(alloc_to_consumer)
-    sel = sel.where(
-        sa.and_(
-            _ALLOC_TBL.c.consumer_id == consumer_id,
-            consumer_obj.CONSUMER_TBL.c.id.is_(None)))
-    missing = ctx.session.execute(sel).fetchall()
-    if missing:
-        incomplete_proj_id = project_obj.ensure_incomplete_project(ctx)
-        incomplete_user_id = user_obj.ensure_incomplete_user(ctx)
-
-        ins_stmt = consumer_obj.CONSUMER_TBL.insert().values(
-            uuid=consumer_id, project_id=incomplete_proj_id,
-            user_id=incomplete_user_id)
-        res = ctx.session.execute(ins_stmt)
-        if res.rowcount > 0:
-            LOG.info("Online data migration to fix incomplete consumers "
-                     "for consumer %s has been run. Migrated %d incomplete "
-                     "consumer records on the fly.", consumer_id, res.rowcount)
+    allocs = sa.alias(_ALLOC_TBL, name="a")
+    consumers = sa.alias(_CONSUMER_TBL, name="c")
+    where = allocs.c.resource_provider_id == rp.id
+    if marker is not None:
+        where = sa.and_(where, allocs.c.consumer_id > marker)
+    if limit is not None:
+        # Pick the consumers of the page first, so that the page has all of
+        # their allocations
+        page_sel = sa.select([allocs.c.consumer_id]).where(where)
+        page_sel = page_sel.distinct().order_by(allocs.c.consumer_id)
+        page_sel = page_sel.limit(limit)
+        consumer_ids = [r[0] for r in ctx.session.execute(page_sel)]
+        if not consumer_ids:
+            return []
+        where = sa.and_(allocs.c.resource_provider_id == rp.id,
+                        allocs.c.consumer_id.in_(consumer_ids))
+    alloc_to_consumer = sa.join(
+        allocs, consumers, allocs.c.consumer_id == consumers.c.uuid)
+    cols = [
+        allocs.c.consumer_id,
+        consumers.c.generation,
+        allocs.c.resource_class_id,
+        allocs.c.used,
+    ]
+    sel = sa.select(cols).select_from(alloc_to_consumer).where(where)
+    sel = sel.order_by(allocs.c.consumer_id)
+    return [(consumer_id, generation, _RC_CACHE.string_from_id(rc_id), used)
+            for consumer_id, generation, rc_id, used
+            in ctx.session.execute(sel)]
 
 
 @base.VersionedObjectRegistry.register_if(False)
 class AllocationList(base.ObjectListBase, base.VersionedObject):
 
-    # The number of times to retry set_allocations if there has
-    # been a resource provider (not consumer) generation coflict.
-    RP_CONFLICT_RETRY_COUNT = 10
-
     fields = {
         'objects': fields.ListOfObjectsField('Allocation'),
     }
@@ -1993,8 +2740,7 @@ class AllocationList(base.ObjectListBase, base.VersionedObject):
         # provides a clean slate for the consumers mentioned in the list of
         # allocations being manipulated.
         consumer_ids = set(alloc.consumer.uuid for alloc in allocs)
-        for consumer_id in consumer_ids:
-            _delete_allocations_for_consumer(context, consumer_id)
+        _delete_allocations_for_consumers(context, consumer_ids)
 
         # Before writing any allocation records, we check that the submitted
         # allocations do not cause any inventory capacity to be exceeded for
@@ -2017,6 +2763,8 @@ class AllocationList(base.ObjectListBase, base.VersionedObject):
         # allocation is using a resource class that does not exist.
         visited_consumers = {}
         visited_rps = _check_capacity_exceeded(context, allocs)
+        added = collections.defaultdict(int)
+        to_insert = []
         for alloc in allocs:
             if alloc.consumer.id not in visited_consumers:
                 visited_consumers[alloc.consumer.id] = alloc.consumer
@@ -2027,27 +2775,29 @@ class AllocationList(base.ObjectListBase, base.VersionedObject):
             # continue
             if alloc.used == 0:
                 continue
-            consumer_id = alloc.consumer.uuid
-            rp = alloc.resource_provider
             rc_id = _RC_CACHE.id_from_string(alloc.resource_class)
-            ins_stmt = _ALLOC_TBL.insert().values(
-                    resource_provider_id=rp.id,
-                    resource_class_id=rc_id,
-                    consumer_id=consumer_id,
-                    used=alloc.used)
-            res = context.session.execute(ins_stmt)
-            alloc.id = res.lastrowid
-            alloc.obj_reset_changes()
-
-        # Generation checking happens here. If the inventory for this resource
-        # provider changed out from under us, this will raise a
-        # ConcurrentUpdateDetected which can be caught by the caller to choose
-        # to try again. It will also rollback the transaction so that these
-        # changes always happen atomically.
-        for rp in visited_rps.values():
-            rp.generation = _increment_provider_generation(context, rp)
-        for consumer in visited_consumers.values():
-            consumer.increment_generation()
+            to_insert.append((alloc, rc_id))
+            added[(alloc.resource_provider.id, rc_id)] += alloc.used
+        _insert_allocations(context, to_insert)
+        if CONF.placement.allocation_claim_mode == 'guarded':
+            # The capacity check above was made against what this transaction
+            # read. The claim checks it again against what is committed, and
+            # raises InvalidAllocationCapacityExceeded if a concurrent write
+            # took the room meanwhile, so the generations need no comparison.
+            _claim_provider_usages(
+                context, added,
+                {rp.id: rp.uuid for rp in visited_rps.values()})
+            _bump_provider_generations(context, visited_rps.values())
+        else:
+            _update_provider_usages(context, added)
+            # Generation checking happens here. If the inventory for any of
+            # the resource providers changed out from under us, this will
+            # raise a ConcurrentUpdateDetected which can be caught by the
+            # caller to choose to try again. It will also rollback the
+            # transaction so that these changes always happen atomically.
+            _increment_provider_generations(context, visited_rps.values())
+        consumer_obj.increment_generations(
+            context, visited_consumers.values())
         # If any consumers involved in this transaction ended up having no
         # allocations, delete the consumer records. Exclude consumers that had
         # *some resource* in the allocation list with a total > 0 since clearly
@@ -2060,7 +2810,6 @@ class AllocationList(base.ObjectListBase, base.VersionedObject):
 
     @classmethod
     def get_all_by_resource_provider(cls, context, rp):
-        _create_incomplete_consumers_for_provider(context, rp.id)
         db_allocs = _get_allocations_by_provider_id(context, rp.id)
         # Build up a list of Allocation objects, setting the Allocation object
         # fields to the same-named database record field we got from
@@ -2091,7 +2840,6 @@ class AllocationList(base.ObjectListBase, base.VersionedObject):
 
     @classmethod
     def get_all_by_consumer_id(cls, context, consumer_id):
-        _create_incomplete_consumer(context, consumer_id)
         db_allocs = _get_allocations_by_consumer_uuid(context, consumer_id)
 
         if db_allocs:
@@ -2135,6 +2883,14 @@ class AllocationList(base.ObjectListBase, base.VersionedObject):
         alloc_list = cls(context, objects=objs)
         return alloc_list
 
+    @classmethod
+    def get_marker_by_consumer_id(cls, context, consumer_id):
+        """Returns a tuple of values that changes whenever the result of
+        get_all_by_consumer_id() for the same consumer does, without reading
+        the allocations.
+        """
+        return _get_allocations_marker_by_consumer_uuid(context, consumer_id)
+
     def replace_all(self):
         """Replace the supplied allocations.
 
@@ -2145,39 +2901,52 @@ class AllocationList(base.ObjectListBase, base.VersionedObject):
                Allocation object.
         """
         # Retry _set_allocations server side if there is a
-        # ResourceProviderConcurrentUpdateDetected. We don't care about
-        # sleeping, we simply want to reset the resource provider objects
-        # and try again. For sake of simplicity (and because we don't have
-        # easy access to the information) we reload all the resource
-        # providers that may be present.
-        retries = self.RP_CONFLICT_RETRY_COUNT
-        while retries:
-            retries -= 1
+        # ResourceProviderConcurrentUpdateDetected, reloading all the resource
+        # providers that may be present. The retry policy decides how long to
+        # wait first, so that writers that collided do not collide again. The
+        # providers whose generation moved are counted as contended.
+        policy = contention.get_retry_policy()
+        counters = contention.get_contention_counters()
+        alloc_rp_uuids = set(
+            alloc.resource_provider.uuid for alloc in self.objects)
+        for attempt in range(policy.attempts):
+            if attempt:
+                policy.wait(attempt - 1)
+                # Reload after the wait, so that the write is attempted again
+                # with the latest generations. We only want to reload each
+                # unique resource provider once.
+                rps = ResourceProviderList.get_all_by_uuids(
+                    self._context, alloc_rp_uuids)
+                seen_rps = {rp.uuid: rp for rp in rps}
+                changed = set()
+                for alloc in self.objects:
+                    rp = alloc.resource_provider
+                    if rp.generation != seen_rps[rp.uuid].generation:
+                        changed.add(rp.uuid)
+                    alloc.resource_provider = seen_rps[rp.uuid]
+                counters.record_conflict(changed)
             try:
                 self._set_allocations(self._context, self.objects)
                 break
             except exception.ResourceProviderConcurrentUpdateDetected:
                 LOG.debug('Retrying allocations write on resource provider '
                           'generation conflict')
-                # We only want to reload each unique resource provider once.
-                alloc_rp_uuids = set(
-                    alloc.resource_provider.uuid for alloc in self.objects)
-                seen_rps = {}
-                for rp_uuid in alloc_rp_uuids:
-                    seen_rps[rp_uuid] = ResourceProvider.get_by_uuid(
-                        self._context, rp_uuid)
-                for alloc in self.objects:
-                    rp_uuid = alloc.resource_provider.uuid
-                    alloc.resource_provider = seen_rps[rp_uuid]
         else:
             # We ran out of retries so we need to raise again.
             # The log will automatically have request id info associated with
             # it that will allow tracing back to specific allocations.
             # Attempting to extract specific consumer or resource provider
             # information from the allocations is not coherent as this
-            # could be multiple consumers and providers.
-            LOG.warning('Exceeded retry limit of %d on allocations write',
-                        self.RP_CONFLICT_RETRY_COUNT)
+            # could be multiple consumers and providers. The providers that
+            # writers of this process collided on most often are logged
+            # instead, to help finding hot spots such as sharing providers.
+            counters.record_exhausted(alloc_rp_uuids)
+            LOG.warning('Exceeded retry limit of %(attempts)d on allocations '
+                        'write. Resource providers with the most generation '
+                        'conflicts in this process: %(contended)s',
+                        {'attempts': policy.attempts,
+                         'contended': counters.most_contended(
+                             _MOST_CONTENDED_LOGGED)})
             raise exception.ResourceProviderConcurrentUpdateDetected()
 
     def delete_all(self):
@@ -2223,18 +2992,41 @@ class UsageList(base.ObjectListBase, base.VersionedObject):
     }
 
     @staticmethod
-    @db_api.placement_context_manager.reader
+    @db_api.placement_context_manager.reader.allow_async
     def _get_all_by_resource_provider_uuid(context, rp_uuid):
+        usage = models.ResourceProviderUsage
         query = (context.session.query(models.Inventory.resource_class_id,
-                 func.coalesce(func.sum(models.Allocation.used), 0))
+                 func.coalesce(usage.used, 0))
                  .join(models.ResourceProvider,
                        models.Inventory.resource_provider_id ==
                        models.ResourceProvider.id)
-                 .outerjoin(models.Allocation,
+                 .outerjoin(usage,
                             sql.and_(models.Inventory.resource_provider_id ==
-                                     models.Allocation.resource_provider_id,
+                                     usage.resource_provider_id,
                                      models.Inventory.resource_class_id ==
-                                     models.Allocation.resource_class_id))
+                                     usage.resource_class_id))
+                 .filter(models.ResourceProvider.uuid == rp_uuid))
+        result = [dict(resource_class_id=item[0], usage=item[1])
+                  for item in query.all()]
+        return result
+
+    @staticmethod
+    @db_api.placement_context_manager.reader.allow_async
+    def _get_all_by_provider_subtree(context, rp_uuid):
+        usage = models.ResourceProviderUsage
+        closure = models.ResourceProviderClosure
+        query = (context.session.query(models.Inventory.resource_class_id,
+                 func.coalesce(func.sum(usage.used), 0))
+                 .join(closure,
+                       models.Inventory.resource_provider_id ==
+                       closure.descendant_id)
+                 .join(models.ResourceProvider,
+                       closure.ancestor_id == models.ResourceProvider.id)
+                 .outerjoin(usage,
+                            sql.and_(models.Inventory.resource_provider_id ==
+                                     usage.resource_provider_id,
+                                     models.Inventory.resource_class_id ==
+                                     usage.resource_class_id))
                  .filter(models.ResourceProvider.uuid == rp_uuid)
                  .group_by(models.Inventory.resource_class_id))
         result = [dict(resource_class_id=item[0], usage=item[1])
@@ -2242,7 +3034,7 @@ class UsageList(base.ObjectListBase, base.VersionedObject):
         return result
 
     @staticmethod
-    @db_api.placement_context_manager.reader
+    @db_api.placement_context_manager.reader.allow_async
     def _get_all_by_project_user(context, project_id, user_id=None):
         query = (context.session.query(models.Allocation.resource_class_id,
                  func.coalesce(func.sum(models.Allocation.used), 0))
@@ -2265,6 +3057,14 @@ class UsageList(base.ObjectListBase, base.VersionedObject):
         usage_list = cls._get_all_by_resource_provider_uuid(context, rp_uuid)
         return base.obj_make_list(context, cls(context), Usage, usage_list)
 
+    @classmethod
+    def get_all_by_provider_subtree(cls, context, rp_uuid):
+        """Returns the usages of the provider with the supplied UUID summed
+        with those of all of its descendants, per resource class.
+        """
+        usage_list = cls._get_all_by_provider_subtree(context, rp_uuid)
+        return base.obj_make_list(context, cls(context), Usage, usage_list)
+
     @classmethod
     def get_all_by_project_user(cls, context, project_id, user_id=None):
         usage_list = cls._get_all_by_project_user(context, project_id,
@@ -2319,7 +3119,7 @@ class ResourceClass(base.VersionedObject, base.TimestampedObject):
         return obj
 
     @staticmethod
-    @db_api.placement_context_manager.reader
+    @db_api.placement_context_manager.reader.allow_async
     def _get_next_id(context):
         """Utility method to grab the next resource class identifier to use for
          user-defined resource classes.
@@ -2385,6 +3185,9 @@ class ResourceClass(base.VersionedObject, base.TimestampedObject):
         rc.update(updates)
         rc.id = next_id
         context.session.add(rc)
+        # Flush so that a duplicate name fails before the counter is locked
+        context.session.flush()
+        change_log.bump(context, change_log.RESOURCE_CLASSES)
         return rc
 
     def destroy(self):
@@ -2414,6 +3217,7 @@ class ResourceClass(base.VersionedObject, base.TimestampedObject):
                 models.ResourceClass.id == _id).delete()
         if not res:
             raise exception.NotFound()
+        change_log.bump(context, change_log.RESOURCE_CLASSES)
 
     def save(self):
         if 'id' not in self:
@@ -2438,6 +3242,7 @@ class ResourceClass(base.VersionedObject, base.TimestampedObject):
             db_rc.save(context.session)
         except db_exc.DBDuplicateEntry:
             raise exception.ResourceClassExists(resource_class=name)
+        change_log.bump(context, change_log.RESOURCE_CLASSES)
 
 
 @base.VersionedObjectRegistry.register_if(False)
@@ -2448,7 +3253,7 @@ class ResourceClassList(base.ObjectListBase, base.VersionedObject):
     }
 
     @staticmethod
-    @db_api.placement_context_manager.reader
+    @db_api.placement_context_manager.reader.allow_async
     def _get_all(context):
         customs = list(context.session.query(models.ResourceClass).all())
         return _RC_CACHE.STANDARDS + customs
@@ -2489,6 +3294,8 @@ class Trait(base.VersionedObject, base.TimestampedObject):
         trait = models.Trait()
         trait.update(updates)
         context.session.add(trait)
+        context.session.flush()
+        change_log.bump(context, change_log.TRAITS)
         return trait
 
     def create(self):
@@ -2534,6 +3341,8 @@ class Trait(base.VersionedObject, base.TimestampedObject):
             name=name).delete()
         if not res:
             raise exception.TraitNotFound(names=name)
+        change_log.bump(context, change_log.TRAITS)
+        change_log.bump(context, change_log.TRAIT_DELETIONS)
 
     def destroy(self):
         if 'name' not in self:
@@ -2548,6 +3357,8 @@ class Trait(base.VersionedObject, base.TimestampedObject):
                                               reason='ID attribute not found')
 
         self._destroy_in_db(self._context, self.id, self.name)
+        # The ID of the trait must not be handed out once it is deleted
+        _TRAIT_CACHE.clear()
 
 
 @base.VersionedObjectRegistry.register_if(False)
@@ -2668,7 +3479,120 @@ class ProviderSummary(base.VersionedObject):
         return set(res.resource_class for res in self.resources)
 
 
-@db_api.placement_context_manager.reader
+class _Record(object):
+    """Base of the lightweight records used in place of the versioned objects
+    above while allocation candidates are computed. A record has the same
+    attributes as the object it stands for, but none of the cost of field
+    coercion, change tracking or deep copying. Records are converted into
+    versioned objects only for the results that are returned, by
+    _objects_from_records().
+    """
+    __slots__ = ()
+
+    def __init__(self, **kwargs):
+        for name in self.__slots__:
+            setattr(self, name, kwargs.get(name))
+
+    def __repr__(self):
+        return '%s(%s)' % (
+            self.__class__.__name__.lstrip('_'),
+            ', '.join('%s=%r' % (name, getattr(self, name))
+                      for name in self.__slots__))
+
+
+class _ProviderRecord(_Record):
+    __slots__ = ('id', 'uuid', 'root_provider_uuid', 'parent_provider_uuid')
+
+
+class _TraitRecord(_Record):
+    __slots__ = ('name',)
+
+
+class _AllocationRequestResourceRecord(_Record):
+    __slots__ = ('resource_provider', 'resource_class', 'amount')
+
+    def __repr__(self):
+        return 'AllocationRequestResource(%s, %s=%d)' % (
+            self.resource_provider.uuid, self.resource_class, self.amount)
+
+
+class _AllocationRequestRecord(_Record):
+    __slots__ = ('anchor_root_provider_uuid', 'use_same_provider',
+                 'resource_requests')
+
+    def __repr__(self):
+        anchor = (self.anchor_root_provider_uuid or '<?>')[-8:]
+        return ('AllocationRequest(anchor=...%s, same_provider=%s, '
+                'resource_requests=[%s])' %
+                (anchor, self.use_same_provider,
+                 ', '.join([str(arr) for arr in self.resource_requests])))
+
+
+class _ProviderSummaryResourceRecord(_Record):
+    __slots__ = ('resource_class', 'capacity', 'used', 'max_unit')
+
+
+class _ProviderSummaryRecord(_Record):
+    __slots__ = ('resource_provider', 'resources', 'traits')
+
+    @property
+    def resource_class_names(self):
+        return set(res.resource_class for res in self.resources)
+
+
+class _AllocationCandidatesRecord(_Record):
+    __slots__ = ('allocation_requests', 'provider_summaries')
+
+
+def _objects_from_records(ctx, alloc_requests, summaries):
+    """Converts the supplied lists of _AllocationRequestRecord and
+    _ProviderSummaryRecord into lists of AllocationRequest and ProviderSummary
+    objects. Each provider and trait is converted once and the resulting
+    ResourceProvider or Trait object shared by everything that refers to it.
+    """
+    providers = {}
+    traits = {}
+
+    def _provider(rec):
+        rp = providers.get(rec.uuid)
+        if rp is None:
+            values = dict((name, getattr(rec, name))
+                          for name in rec.__slots__
+                          if getattr(rec, name) is not None)
+            rp = providers[rec.uuid] = ResourceProvider(ctx, **values)
+        return rp
+
+    def _trait(rec):
+        trait = traits.get(rec.name)
+        if trait is None:
+            trait = traits[rec.name] = Trait(ctx, name=rec.name)
+        return trait
+
+    areq_objs = [
+        AllocationRequest(
+            ctx, anchor_root_provider_uuid=areq.anchor_root_provider_uuid,
+            use_same_provider=bool(areq.use_same_provider),
+            resource_requests=[
+                AllocationRequestResource(
+                    ctx, resource_provider=_provider(arr.resource_provider),
+                    resource_class=arr.resource_class, amount=arr.amount)
+                for arr in areq.resource_requests])
+        for areq in alloc_requests]
+    psum_objs = [
+        ProviderSummary(
+            ctx, resource_provider=_provider(psum.resource_provider),
+            resources=[
+                ProviderSummaryResource(
+                    ctx, resource_class=psr.resource_class,
+                    capacity=psr.capacity, used=psr.used,
+                    max_unit=psr.max_unit)
+                for psr in psum.resources],
+            traits=[_trait(trait) for trait in psum.traits])
+        for psum in summaries]
+    return areq_objs, psum_objs
+
+
+@db_api.placement_context_manager.reader.allow_async
 def _get_usages_by_provider_tree(ctx, root_ids):
     """Returns a row iterator of usage records grouped by provider ID
     for all resource providers in all trees indicated in the ``root_ids``.
@@ -2686,40 +3610,17 @@ def _get_usages_by_provider_tree(ctx, root_ids):
     # FROM resource_providers AS rp
     # LEFT JOIN inventories AS inv
     #  ON rp.id = inv.resource_provider_id
-    # LEFT JOIN (
-    #   SELECT resource_provider_id, resource_class_id, SUM(used) as used
-    #   FROM allocations
-    #   JOIN resource_providers
-    #     ON allocations.resource_provider_id = resource_providers.id
-    #     AND resource_providers.root_provider_id IN($root_ids)
-    #   GROUP BY resource_provider_id, resource_class_id
-    # )
-    # AS usages
+    # LEFT JOIN resource_provider_usages AS usage
     #   ON inv.resource_provider_id = usage.resource_provider_id
     #   AND inv.resource_class_id = usage.resource_class_id
     # WHERE rp.root_provider_id IN ($root_ids)
     rpt = sa.alias(_RP_TBL, name="rp")
     inv = sa.alias(_INV_TBL, name="inv")
-    # Build our derived table (subquery in the FROM clause) that sums used
-    # amounts for resource provider and resource class
-    derived_alloc_to_rp = sa.join(
-        _ALLOC_TBL, _RP_TBL,
-        sa.and_(_ALLOC_TBL.c.resource_provider_id == _RP_TBL.c.id,
-                _RP_TBL.c.root_provider_id.in_(root_ids)))
-    usage = sa.alias(
-        sa.select([
-            _ALLOC_TBL.c.resource_provider_id,
-            _ALLOC_TBL.c.resource_class_id,
-            sql.func.sum(_ALLOC_TBL.c.used).label('used'),
-        ]).select_from(derived_alloc_to_rp).group_by(
-            _ALLOC_TBL.c.resource_provider_id,
-            _ALLOC_TBL.c.resource_class_id
-        ),
-        name='usage')
+    usage = sa.alias(_USAGE_TBL, name='usage')
     # Build a join between the resource providers and inventories table
     rpt_inv_join = sa.outerjoin(rpt, inv,
                                 rpt.c.id == inv.c.resource_provider_id)
-    # And then join to the derived table of usages
+    # And then join to the summed usages
     usage_join = sa.outerjoin(
         rpt_inv_join,
         usage,
@@ -2741,7 +3642,7 @@ def _get_usages_by_provider_tree(ctx, root_ids):
     return ctx.session.execute(query).fetchall()
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_provider_ids_having_any_trait(ctx, traits):
     """Returns a list of resource provider internal IDs that have ANY of the
     supplied traits.
@@ -2762,7 +3663,7 @@ def _get_provider_ids_having_any_trait(ctx, traits):
     return [r[0] for r in ctx.session.execute(sel)]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_provider_ids_having_all_traits(ctx, required_traits):
     """Returns a list of resource provider internal IDs that have ALL of the
     required traits.
@@ -2791,7 +3692,45 @@ def _get_provider_ids_having_all_traits(ctx, required_traits):
     return [r[0] for r in ctx.session.execute(sel)]
 
 
-@db_api.placement_context_manager.reader
+def _trait_conds(rp_id_col, required_traits, forbidden_traits):
+    """Returns a list of WHERE conditions limiting the resource providers
+    whose internal ID is in the supplied column to those having all the
+    required traits and none of the forbidden traits. The conditions are
+    correlated EXISTS and NOT EXISTS subqueries, so the database checks them
+    against the resource_provider_traits index of each provider instead of
+    being handed lists of provider IDs.
+
+    :param rp_id_col: column of the outer query holding provider IDs
+    :param required_traits: A map, keyed by trait string name, of required
+                            trait internal IDs that each provider must have
+                            associated with it
+    :param forbidden_traits: A map, keyed by trait string name, of forbidden
+                             trait internal IDs that each provider must not
+                             have associated with it
+    """
+    conds = []
+    # EXISTS (
+    #   SELECT 1 FROM resource_provider_traits AS rptt_0
+    #   WHERE rptt_0.resource_provider_id = rp.id
+    #   AND rptt_0.trait_id = $REQUIRED_TRAIT_ID)
+    # for each required trait
+    for idx, trait_id in enumerate(sorted((required_traits or {}).values())):
+        rptt = sa.alias(_RP_TRAIT_TBL, name="rptt_%d" % idx)
+        conds.append(sa.exists().where(sa.and_(
+            rptt.c.resource_provider_id == rp_id_col,
+            rptt.c.trait_id == trait_id)))
+    # NOT EXISTS (
+    #   SELECT 1 FROM resource_provider_traits AS rptt_forbid
+    #   WHERE rptt_forbid.resource_provider_id = rp.id
+    #   AND rptt_forbid.trait_id IN ($FORBIDDEN_TRAIT_IDS))
+    if forbidden_traits:
+        rptt_forbid = sa.alias(_RP_TRAIT_TBL, name="rptt_forbid")
+        conds.append(~sa.exists().where(sa.and_(
+            rptt_forbid.c.resource_provider_id == rp_id_col,
+            rptt_forbid.c.trait_id.in_(sorted(forbidden_traits.values())))))
+    return conds
+
+
 def _has_provider_trees(ctx):
     """Simple method that returns whether provider trees (i.e. nested resource
     providers) are in use in the deployment at all. This information is used to
@@ -2799,18 +3738,14 @@ def _has_provider_trees(ctx):
     information. The code paths are eminently easier to execute and follow for
     non-nested scenarios...
 
-    NOTE(jaypipes): The result of this function can be cached extensively.
+    The answer is held in the topology cache.
     """
-    sel = sa.select([_RP_TBL.c.id])
-    sel = sel.where(_RP_TBL.c.parent_provider_id.isnot(None))
-    sel = sel.limit(1)
-    res = ctx.session.execute(sel).fetchall()
-    return len(res) > 0
+    return _get_topology(ctx).has_trees
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_provider_ids_matching(ctx, resources, required_traits,
-        forbidden_traits, member_of=None):
+        forbidden_traits, member_of=None, snapshot=None):
     """Returns a list of tuples of (internal provider ID, root provider ID)
     that have available inventory to satisfy all the supplied requests for
     resources.
@@ -2831,16 +3766,12 @@ def _get_provider_ids_matching(ctx, resources, required_traits,
                       the allocation_candidates returned will only be for
                       resource providers that are members of one or more of the
                       supplied aggregates of each aggregate UUID list.
+    :param snapshot: An optional ProviderSnapshot to answer from instead of
+                     querying the database.
     """
-    trait_rps = None
-    forbidden_rp_ids = None
-    if required_traits:
-        trait_rps = _get_provider_ids_having_all_traits(ctx, required_traits)
-        if not trait_rps:
-            return []
-    if forbidden_traits:
-        forbidden_rp_ids = _get_provider_ids_having_any_trait(
-            ctx, forbidden_traits)
+    if snapshot is not None:
+        return snapshot.provider_ids_matching(
+            resources, required_traits, forbidden_traits, member_of)
 
     rpt = sa.alias(_RP_TBL, name="rp")
 
@@ -2855,36 +3786,20 @@ def _get_provider_ids_matching(ctx, resources, required_traits,
         for rc_id in resources
     }
 
-    # Dict, keyed by resource class ID, of a derived table (subquery in the
-    # FROM clause or JOIN) against the allocations table winnowed to only that
-    # resource class, grouped by resource provider.
+    # Dict, keyed by resource class ID, of an aliased table object for the
+    # summed usages table, which the join below winnows to only that resource
+    # class.
     usage_tables = {
-        rc_id: sa.alias(
-            sa.select([
-                _ALLOC_TBL.c.resource_provider_id,
-                sql.func.sum(_ALLOC_TBL.c.used).label('used'),
-            ]).where(
-                _ALLOC_TBL.c.resource_class_id == rc_id
-            ).group_by(
-                _ALLOC_TBL.c.resource_provider_id
-            ),
-            name='usage_%s' % rc_name_map[rc_id],
-        )
+        rc_id: sa.alias(_USAGE_TBL, name='usage_%s' % rc_name_map[rc_id])
         for rc_id in resources
     }
 
     sel = sa.select([rpt.c.id, rpt.c.root_provider_id])
 
     # List of the WHERE conditions we build up by iterating over the requested
-    # resources
-    where_conds = []
-
-    # First filter by the resource providers that had all the required traits
-    if trait_rps:
-        where_conds.append(rpt.c.id.in_(trait_rps))
-    # or have any forbidden trait
-    if forbidden_rp_ids:
-        where_conds.append(~rpt.c.id.in_(forbidden_rp_ids))
+    # resources, starting with the resource providers that have all the
+    # required traits and none of the forbidden traits
+    where_conds = _trait_conds(rpt.c.id, required_traits, forbidden_traits)
 
     # The chain of joins that we eventually pass to select_from()
     join_chain = rpt
@@ -2906,8 +3821,11 @@ def _get_provider_ids_matching(ctx, resources, required_traits,
         )
         rp_inv_usage_join = sa.outerjoin(
             rp_inv_join, usage_by_rc,
-            inv_by_rc.c.resource_provider_id ==
-                usage_by_rc.c.resource_provider_id,
+            sa.and_(
+                inv_by_rc.c.resource_provider_id ==
+                    usage_by_rc.c.resource_provider_id,
+                usage_by_rc.c.resource_class_id == rc_id,
+            ),
         )
         join_chain = rp_inv_usage_join
 
@@ -2940,7 +3858,7 @@ def _get_provider_ids_matching(ctx, resources, required_traits,
     return [(r[0], r[1]) for r in ctx.session.execute(sel)]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _provider_aggregates(ctx, rp_ids):
     """Given a list of resource provider internal IDs, returns a dict,
     keyed by those provider IDs, of sets of aggregate ids associated
@@ -2965,7 +3883,7 @@ def _provider_aggregates(ctx, rp_ids):
     return res
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_providers_with_resource(ctx, rc_id, amount):
     """Returns a set of tuples of (provider ID, root provider ID) of providers
     that satisfy the request for a single resource class.
@@ -2979,15 +3897,9 @@ def _get_providers_with_resource(ctx, rc_id, amount):
     # JOIN inventories AS inv
     #  ON rp.id = inv.resource_provider_id
     #  AND inv.resource_class_id = $RC_ID
-    # LEFT JOIN (
-    #  SELECT
-    #    alloc.resource_provider_id,
-    #    SUM(allocs.used) AS used
-    #  FROM allocations AS alloc
-    #  WHERE allocs.resource_class_id = $RC_ID
-    #  GROUP BY allocs.resource_provider_id
-    # ) AS usage
+    # LEFT JOIN resource_provider_usages AS usage
     #  ON inv.resource_provider_id = usage.resource_provider_id
+    #  AND usage.resource_class_id = $RC_ID
     # WHERE
     #  used + $AMOUNT <= ((total - reserved) * inv.allocation_ratio)
     #  AND inv.min_unit <= $AMOUNT
@@ -2995,13 +3907,7 @@ def _get_providers_with_resource(ctx, rc_id, amount):
     #  AND $AMOUNT % inv.step_size == 0
     rpt = sa.alias(_RP_TBL, name="rp")
     inv = sa.alias(_INV_TBL, name="inv")
-    allocs = sa.alias(_ALLOC_TBL, name="alloc")
-    usage = sa.select([
-            allocs.c.resource_provider_id,
-            sql.func.sum(allocs.c.used).label('used')])
-    usage = usage.where(allocs.c.resource_class_id == rc_id)
-    usage = usage.group_by(allocs.c.resource_provider_id)
-    usage = sa.alias(usage, name="usage")
+    usage = sa.alias(_USAGE_TBL, name="usage")
     where_conds = [
         sql.func.coalesce(usage.c.used, 0) + amount <= (
             (inv.c.total - inv.c.reserved) * inv.c.allocation_ratio),
@@ -3014,8 +3920,9 @@ def _get_providers_with_resource(ctx, rc_id, amount):
             rpt.c.id == inv.c.resource_provider_id,
             inv.c.resource_class_id == rc_id))
     inv_to_usage = sa.outerjoin(
-        rp_to_inv, usage,
-        inv.c.resource_provider_id == usage.c.resource_provider_id)
+        rp_to_inv, usage, sa.and_(
+            inv.c.resource_provider_id == usage.c.resource_provider_id,
+            usage.c.resource_class_id == rc_id))
     sel = sa.select([rpt.c.id, rpt.c.root_provider_id])
     sel = sel.select_from(inv_to_usage)
     sel = sel.where(sa.and_(*where_conds))
@@ -3024,7 +3931,7 @@ def _get_providers_with_resource(ctx, rc_id, amount):
     return res
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_trees_with_traits(ctx, rp_ids, required_traits, forbidden_traits):
     """Given a list of provider IDs, filter them to return a set of tuples of
     (provider ID, root provider ID) of providers which belong to a tree that
@@ -3113,9 +4020,9 @@ def _get_trees_with_traits(ctx, rp_ids, required_traits, forbidden_traits):
     return [(rp_id, root_id) for rp_id, root_id in res]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_trees_matching_all(ctx, resources, required_traits, forbidden_traits,
-                            sharing, member_of):
+                            sharing, member_of, snapshot=None):
     """Returns a list of two-tuples (provider internal ID, root provider
     internal ID) for providers that satisfy the request for resources.
 
@@ -3157,6 +4064,8 @@ def _get_trees_matching_all(ctx, resources, required_traits, forbidden_traits,
                       provided, the allocation_candidates returned will only be
                       for resource providers that are members of one or more of
                       the supplied aggregates in each aggregate UUID list.
+    :param snapshot: An optional ProviderSnapshot to answer from instead of
+                     querying the database.
     """
     # We first grab the provider trees that have nodes that meet the request
     # for each resource class.  Once we have this information, we'll then do a
@@ -3170,7 +4079,11 @@ def _get_trees_matching_all(ctx, resources, required_traits, forbidden_traits,
     trees_with_inv = set()
 
     for rc_id, amount in resources.items():
-        rc_provs_with_inv = _get_providers_with_resource(ctx, rc_id, amount)
+        if snapshot is not None:
+            rc_provs_with_inv = snapshot.providers_with_resource(rc_id, amount)
+        else:
+            rc_provs_with_inv = _get_providers_with_resource(
+                ctx, rc_id, amount)
         if not rc_provs_with_inv:
             # If there's no providers that have one of the resource classes,
             # then we can short-circuit
@@ -3184,8 +4097,12 @@ def _get_trees_matching_all(ctx, resources, required_traits, forbidden_traits,
             # should also get combinations of (sharing provider, anchor root)
             # in addition to (non-sharing provider, anchor root) we already
             # have.
-            rc_provs_with_inv = _anchors_for_sharing_providers(
-                                        ctx, sharing_providers, get_id=True)
+            if snapshot is not None:
+                rc_provs_with_inv = snapshot.anchors_for_sharing_providers(
+                    sharing_providers, get_id=True)
+            else:
+                rc_provs_with_inv = _anchors_for_sharing_providers(
+                    ctx, sharing_providers, get_id=True)
             rc_provs_with_inv = set(
                 (p[0], p[1], rc_id) for p in rc_provs_with_inv)
             rc_trees |= set(p[1] for p in rc_provs_with_inv)
@@ -3213,8 +4130,12 @@ def _get_trees_matching_all(ctx, resources, required_traits, forbidden_traits,
     # If 'member_of' has values, do a separate lookup to identify the
     # resource providers that meet the member_of constraints.
     if member_of:
-        rps_in_aggs = _provider_ids_matching_aggregates(ctx, member_of,
-                                                        rp_ids=trees_with_inv)
+        if snapshot is not None:
+            rps_in_aggs = snapshot.provider_ids_matching_aggregates(
+                member_of, rp_ids=trees_with_inv)
+        else:
+            rps_in_aggs = _provider_ids_matching_aggregates(
+                ctx, member_of, rp_ids=trees_with_inv)
         if not rps_in_aggs:
             # Short-circuit. The user either asked for a non-existing
             # aggregate or there were no resource providers that matched
@@ -3235,8 +4156,12 @@ def _get_trees_matching_all(ctx, resources, required_traits, forbidden_traits,
     # capacity and that set of providers (grouped by their tree) have all
     # of the required traits and none of the forbidden traits
     rp_ids_with_inv = set(p[0] for p in provs_with_inv)
-    rp_tuples_with_trait = _get_trees_with_traits(
-        ctx, rp_ids_with_inv, required_traits, forbidden_traits)
+    if snapshot is not None:
+        rp_tuples_with_trait = snapshot.trees_with_traits(
+            rp_ids_with_inv, required_traits, forbidden_traits)
+    else:
+        rp_tuples_with_trait = _get_trees_with_traits(
+            ctx, rp_ids_with_inv, required_traits, forbidden_traits)
 
     ret = [rp_tuple for rp_tuple in provs_with_inv if (
         rp_tuple[0], rp_tuple[1]) in rp_tuples_with_trait]
@@ -3244,10 +4169,10 @@ def _get_trees_matching_all(ctx, resources, required_traits, forbidden_traits,
     return ret
 
 
-def _build_provider_summaries(context, usages, prov_traits):
+def _build_provider_summaries(context, usages, prov_traits, snapshot=None):
     """Given a list of dicts of usage information and a map of providers to
     their associated string traits, returns a dict, keyed by resource provider
-    ID, of ProviderSummary objects.
+    ID, of _ProviderSummaryRecord.
 
     :param context: nova.context.RequestContext object
     :param usages: A list of dicts with the following format:
@@ -3262,35 +4187,45 @@ def _build_provider_summaries(context, usages, prov_traits):
         }
     :param prov_traits: A dict, keyed by internal resource provider ID, of
                         string trait names associated with that provider
+    :param snapshot: An optional ProviderSnapshot to answer from instead of
+                     querying the database.
     """
     # Before we go creating provider summary objects, first grab all the
     # provider information (including root, parent and UUID information) for
     # all providers involved in our operation
     rp_ids = set(usage['resource_provider_id'] for usage in usages)
-    provider_ids = _provider_ids_from_rp_ids(context, rp_ids)
+    if snapshot is not None:
+        provider_ids = {
+            rp_id: ProviderIds(*ids) for rp_id, ids in
+            snapshot.provider_ids_from_rp_ids(rp_ids).items()
+        }
+    else:
+        provider_ids = _provider_ids_from_rp_ids(context, rp_ids)
 
     # Build up a dict, keyed by internal resource provider ID, of
     # ProviderSummary objects containing one or more ProviderSummaryResource
     # objects representing the resources the provider has inventory for.
     summaries = {}
+    # One _TraitRecord per trait name, shared by all the summaries having it
+    trait_recs = {}
     for usage in usages:
         rp_id = usage['resource_provider_id']
         summary = summaries.get(rp_id)
         if not summary:
             pids = provider_ids[rp_id]
-            summary = ProviderSummary(
-                context,
-                resource_provider=ResourceProvider(
-                    context, id=pids.id, uuid=pids.uuid,
+            for tname in prov_traits[rp_id]:
+                if tname not in trait_recs:
+                    trait_recs[tname] = _TraitRecord(name=tname)
+            summary = _ProviderSummaryRecord(
+                resource_provider=_ProviderRecord(
+                    id=pids.id, uuid=pids.uuid,
                     root_provider_uuid=pids.root_uuid,
                     parent_provider_uuid=pids.parent_uuid),
                 resources=[],
+                traits=[trait_recs[tname] for tname in prov_traits[rp_id]],
             )
             summaries[rp_id] = summary
 
-        traits = prov_traits[rp_id]
-        summary.traits = [Trait(context, name=tname) for tname in traits]
-
         rc_id = usage['resource_class_id']
         if rc_id is None:
             # NOTE(tetsuro): This provider doesn't have any inventory itself.
@@ -3305,8 +4240,7 @@ def _build_provider_summaries(context, usages, prov_traits):
         allocation_ratio = usage['allocation_ratio']
         cap = int((usage['total'] - usage['reserved']) * allocation_ratio)
         rc_name = _RC_CACHE.string_from_id(rc_id)
-        rpsr = ProviderSummaryResource(
-            context,
+        rpsr = _ProviderSummaryResourceRecord(
             resource_class=rc_name,
             capacity=cap,
             used=used,
@@ -3356,10 +4290,8 @@ def _shared_allocation_request_resources(ctx, ns_rp_id, requested_resources,
             if not aggs_in_both:
                 continue
             summary = summaries[rp_id]
-            rp_uuid = summary.resource_provider.uuid
-            res_req = AllocationRequestResource(
-                ctx,
-                resource_provider=ResourceProvider(ctx, uuid=rp_uuid),
+            res_req = _AllocationRequestResourceRecord(
+                resource_provider=summary.resource_provider,
                 resource_class=_RC_CACHE.string_from_id(rc_id),
                 amount=requested_resources[rc_id],
             )
@@ -3378,8 +4310,8 @@ def _allocation_request_for_provider(ctx, requested_resources, provider):
                      resources.
     """
     resource_requests = [
-        AllocationRequestResource(
-            ctx, resource_provider=provider,
+        _AllocationRequestResourceRecord(
+            resource_provider=provider,
             resource_class=_RC_CACHE.string_from_id(rc_id),
             amount=amount,
         ) for rc_id, amount in requested_resources.items()
@@ -3388,69 +4320,62 @@ def _allocation_request_for_provider(ctx, requested_resources, provider):
     # anchor in its own tree.  If the provider is a sharing provider, the
     # caller needs to identify the other anchors with which it might be
     # associated.
-    return AllocationRequest(
-            ctx, resource_requests=resource_requests,
+    return _AllocationRequestRecord(
+            resource_requests=resource_requests,
             anchor_root_provider_uuid=provider.root_provider_uuid)
 
 
-def _check_traits_for_alloc_request(res_requests, summaries, prov_traits,
-                                    required_traits, forbidden_traits):
-    """Given a list of AllocationRequestResource objects, check if that
-    combination can provide trait constraints. If it can, returns all
-    resource provider internal IDs in play, else return an empty list.
+def _pruned_product(choice_lists, extend, state=None):
+    """Generates the combinations of one item from each of the supplied lists
+    that itertools.product(*choice_lists) would, in the same order, except
+    those pruned by ``extend``.
 
-    TODO(tetsuro): For optimization, we should move this logic to SQL in
-                   _get_trees_matching_all().
+    The combinations are built depth first. Before a partial combination is
+    extended by an item of ``choice_lists[depth]``, ``extend(state, depth,
+    item)`` is called with the state of the partial combination. It returns
+    the state of the extended combination or, if neither it nor any
+    combination starting with it can be acceptable, None. The whole branch is
+    then skipped without being generated, which is what keeps the number of
+    combinations visited far below the size of the full product when the
+    constraints are tight.
 
-    :param res_requests: a list of AllocationRequestResource objects that have
-                         resource providers to be checked if they collectively
-                         satisfy trait constraints in the required_traits and
-                         forbidden_traits parameters.
-    :param summaries: dict, keyed by resource provider ID, of ProviderSummary
-                      objects containing usage and trait information for
-                      resource providers involved in the overall request
-    :param prov_traits: A dict, keyed by internal resource provider ID, of
-                        string trait names associated with that provider
-    :param required_traits: A map, keyed by trait string name, of required
-                            trait internal IDs that each *allocation request's
-                            set of providers* must *collectively* have
-                            associated with them
-    :param forbidden_traits: A map, keyed by trait string name, of trait
-                             internal IDs that a resource provider must
-                             not have.
+    Yields tuples of (combination tuple, state of the combination).
+
+    :param choice_lists: A list of lists of items.
+    :param extend: A callable returning the state of a partial combination
+                   extended by one item, or None to prune it.
+    :param state: The state of the empty combination.
     """
-    all_prov_ids = []
-    all_traits = set()
-    for res_req in res_requests:
-        rp_uuid = res_req.resource_provider.uuid
-        for rp_id, summary in summaries.items():
-            if summary.resource_provider.uuid == rp_uuid:
+    if not choice_lists:
+        yield (), state
+        return
+    last = len(choice_lists) - 1
+    combination = []
+    states = [state]
+    iters = [iter(choice_lists[0])]
+    while iters:
+        depth = len(combination)
+        for item in iters[-1]:
+            new_state = extend(states[-1], depth, item)
+            if new_state is not None:
                 break
-        rp_traits = set(prov_traits.get(rp_id, []))
-
-        # Check if there are forbidden_traits
-        conflict_traits = set(forbidden_traits) & set(rp_traits)
-        if conflict_traits:
-            LOG.debug('Excluding resource provider %s, it has '
-                      'forbidden traits: (%s).',
-                      rp_id, ', '.join(conflict_traits))
-            return []
-
-        all_prov_ids.append(rp_id)
-        all_traits |= rp_traits
-
-    # Check if there are missing traits
-    missing_traits = set(required_traits) - all_traits
-    if missing_traits:
-        LOG.debug('Excluding a set of allocation candidate %s : '
-                  'missing traits %s are not satisfied.',
-                  all_prov_ids, ','.join(missing_traits))
-        return []
-
-    return all_prov_ids
+        else:
+            # Every item at this depth was tried: backtrack.
+            iters.pop()
+            if combination:
+                combination.pop()
+                states.pop()
+            continue
+        if depth == last:
+            yield tuple(combination) + (item,), new_state
+        else:
+            combination.append(item)
+            states.append(new_state)
+            iters.append(iter(choice_lists[depth + 1]))
 
 
-def _alloc_candidates_single_provider(ctx, requested_resources, rp_tuples):
+def _alloc_candidates_single_provider(ctx, requested_resources, rp_tuples,
+                                      snapshot=None):
     """Returns a tuple of (allocation requests, provider summaries) for a
     supplied set of requested resource amounts and resource providers. The
     supplied resource providers have capacity to satisfy ALL of the resources
@@ -3470,6 +4395,8 @@ def _alloc_candidates_single_provider(ctx, requested_resources, rp_tuples):
                                 being requested for that resource class
     :param rp_tuples: List of two-tuples of (provider ID, root provider ID)s
                       for providers that matched the requested resources
+    :param snapshot: An optional ProviderSnapshot to answer from instead of
+                     querying the database.
     """
     if not rp_tuples:
         return [], []
@@ -3477,21 +4404,41 @@ def _alloc_candidates_single_provider(ctx, requested_resources, rp_tuples):
     # Get all root resource provider IDs.
     root_ids = set(p[1] for p in rp_tuples)
 
-    # Grab usage summaries for each provider
-    usages = _get_usages_by_provider_tree(ctx, root_ids)
+    if snapshot is not None:
+        usages = snapshot.usages_by_provider_tree(root_ids)
+        prov_traits = snapshot.traits_by_provider_tree(root_ids)
+    else:
+        # Grab usage summaries for each provider
+        usages = _get_usages_by_provider_tree(ctx, root_ids)
 
-    # Get a dict, keyed by resource provider internal ID, of trait string names
-    # that provider has associated with it
-    prov_traits = _get_traits_by_provider_tree(ctx, root_ids)
+        # Get a dict, keyed by resource provider internal ID, of trait string
+        # names that provider has associated with it
+        prov_traits = _get_traits_by_provider_tree(ctx, root_ids)
 
     # Get a dict, keyed by resource provider internal ID, of ProviderSummary
     # objects for all providers
-    summaries = _build_provider_summaries(ctx, usages, prov_traits)
+    summaries = _build_provider_summaries(ctx, usages, prov_traits,
+                                          snapshot=snapshot)
 
     # Next, build up a list of allocation requests. These allocation requests
     # are AllocationRequest objects, containing resource provider UUIDs,
     # resource class names and amounts to consume from that resource provider
     alloc_requests = []
+    # Look up the anchors of all the sharing providers at once, as a dict,
+    # keyed by sharing provider UUID, of the set of anchor root UUIDs.
+    shares = os_traits.MISC_SHARES_VIA_AGGREGATE
+    sharing_ids = [rp_id for rp_id, _root_id in rp_tuples
+                   if shares in prov_traits.get(rp_id, ())]
+    anchors_by_sp = collections.defaultdict(set)
+    if sharing_ids:
+        if snapshot is not None:
+            sharing_anchors = snapshot.anchors_for_sharing_providers(
+                sharing_ids)
+        else:
+            sharing_anchors = _anchors_for_sharing_providers(
+                ctx, sharing_ids)
+        for sp_uuid, anchor in sharing_anchors:
+            anchors_by_sp[sp_uuid].add(anchor)
     for rp_id, root_id in rp_tuples:
         rp_summary = summaries[rp_id]
         req_obj = _allocation_request_for_provider(
@@ -3499,22 +4446,21 @@ def _alloc_candidates_single_provider(ctx, requested_resources, rp_tuples):
         alloc_requests.append(req_obj)
         # If this is a sharing provider, we have to include an extra
         # AllocationRequest for every possible anchor.
-        traits = [trait.name for trait in rp_summary.traits]
-        if os_traits.MISC_SHARES_VIA_AGGREGATE in traits:
-            anchors = set([p[1] for p in _anchors_for_sharing_providers(
-                ctx, [rp_summary.resource_provider.id])])
-            for anchor in anchors:
-                # We already added self
-                if anchor == rp_summary.resource_provider.root_provider_uuid:
-                    continue
-                req_obj = copy.deepcopy(req_obj)
-                req_obj.anchor_root_provider_uuid = anchor
-                alloc_requests.append(req_obj)
+        rp_rec = rp_summary.resource_provider
+        for anchor in anchors_by_sp.get(rp_rec.uuid, ()):
+            # We already added self
+            if anchor == rp_rec.root_provider_uuid:
+                continue
+            # The resource requests are never modified, so the copy for
+            # each anchor can share them.
+            alloc_requests.append(_AllocationRequestRecord(
+                resource_requests=req_obj.resource_requests,
+                anchor_root_provider_uuid=anchor))
     return alloc_requests, list(summaries.values())
 
 
 def _alloc_candidates_multiple_providers(ctx, requested_resources,
-        required_traits, forbidden_traits, rp_tuples):
+        required_traits, forbidden_traits, rp_tuples, snapshot=None):
     """Returns a tuple of (allocation requests, provider summaries) for a
     supplied set of requested resource amounts and tuples of
     (rp_id, root_id, rc_id). The supplied resource provider trees have
@@ -3539,6 +4485,8 @@ def _alloc_candidates_multiple_providers(ctx, requested_resources,
     :param rp_tuples: List of tuples of (provider ID, anchor root provider ID,
                       resource class ID)s for providers that matched the
                       requested resources
+    :param snapshot: An optional ProviderSnapshot to answer from instead of
+                     querying the database.
     """
     if not rp_tuples:
         return [], []
@@ -3548,16 +4496,31 @@ def _alloc_candidates_multiple_providers(ctx, requested_resources,
     # they have their "anchor" providers for the second value.
     root_ids = set(p[0] for p in rp_tuples) | set(p[1] for p in rp_tuples)
 
-    # Grab usage summaries for each provider in the trees
-    usages = _get_usages_by_provider_tree(ctx, root_ids)
+    if snapshot is not None:
+        usages = snapshot.usages_by_provider_tree(root_ids)
+        prov_traits = snapshot.traits_by_provider_tree(root_ids)
+    else:
+        # Grab usage summaries for each provider in the trees
+        usages = _get_usages_by_provider_tree(ctx, root_ids)
 
-    # Get a dict, keyed by resource provider internal ID, of trait string names
-    # that provider has associated with it
-    prov_traits = _get_traits_by_provider_tree(ctx, root_ids)
+        # Get a dict, keyed by resource provider internal ID, of trait string
+        # names that provider has associated with it
+        prov_traits = _get_traits_by_provider_tree(ctx, root_ids)
 
     # Get a dict, keyed by resource provider internal ID, of ProviderSummary
     # objects for all providers
-    summaries = _build_provider_summaries(ctx, usages, prov_traits)
+    summaries = _build_provider_summaries(ctx, usages, prov_traits,
+                                          snapshot=snapshot)
+
+    # Index the traits of the providers in the trees as bitmasks, so that the
+    # trait constraints of every combination of providers below are checked
+    # with a few integer operations whatever the number of traits requested.
+    prov_trait_index = trait_index.TraitIndex(prov_traits)
+    required_mask = prov_trait_index.required_mask(required_traits or [])
+    if required_mask is None:
+        # No provider in the trees has one of the required traits
+        return [], list(summaries.values())
+    forbidden_mask = prov_trait_index.forbidden_mask(forbidden_traits or [])
 
     # Get a dict, keyed by root provider internal ID, of a dict, keyed by
     # resource class internal ID, of lists of AllocationRequestResource objects
@@ -3566,8 +4529,8 @@ def _alloc_candidates_multiple_providers(ctx, requested_resources,
     for rp_id, root_id, rc_id in rp_tuples:
         rp_summary = summaries[rp_id]
         tree_dict[root_id][rc_id].append(
-            AllocationRequestResource(
-                ctx, resource_provider=rp_summary.resource_provider,
+            _AllocationRequestResourceRecord(
+                resource_provider=rp_summary.resource_provider,
                 resource_class=_RC_CACHE.string_from_id(rc_id),
                 amount=requested_resources[rc_id]))
 
@@ -3576,10 +4539,29 @@ def _alloc_candidates_multiple_providers(ctx, requested_resources,
     # resource class names and amounts to consume from that resource provider
     alloc_requests = []
 
-    # Build a list of lists of provider internal IDs that end up in
+    # Build a set of tuples of provider internal IDs that end up in
     # allocation request objects. This is used to ensure we don't end up
     # having allocation requests with duplicate sets of resource providers.
-    alloc_prov_ids = []
+    alloc_prov_ids = set()
+
+    def extend(covered, depth, arr):
+        """Extends a partial combination of AllocationRequestResource, whose
+        providers collectively have the traits in the ``covered`` mask, by
+        ``arr``. Prunes it if the provider of ``arr`` has a forbidden trait,
+        or if the required traits can no longer all be covered by the
+        providers left to choose from.
+        """
+        mask = prov_trait_index.provider_mask(arr.resource_provider.id)
+        if mask & forbidden_mask:
+            LOG.debug('Excluding resource provider %s, it has '
+                      'forbidden traits: (%s).', arr.resource_provider.id,
+                      ', '.join(prov_trait_index.traits_from_mask(
+                          mask & forbidden_mask)))
+            return None
+        covered |= mask
+        if required_mask & ~(covered | reachable[depth + 1]):
+            return None
+        return covered
 
     # Let's look into each tree
     for root_id, alloc_dict in tree_dict.items():
@@ -3596,34 +4578,56 @@ def _alloc_candidates_multiple_providers(ctx, requested_resources,
         # , which should be ordered by the resource class id.
         request_groups = [val for key, val in sorted(alloc_dict.items())]
 
+        # reachable[depth] is the mask of the traits that the providers
+        # without forbidden traits in request_groups[depth:] have between
+        # them. A partial combination that can't cover the required traits
+        # even with those is pruned.
+        reachable = [0] * (len(request_groups) + 1)
+        for depth in range(len(request_groups) - 1, -1, -1):
+            group_mask = 0
+            for arr in request_groups[depth]:
+                mask = prov_trait_index.provider_mask(
+                    arr.resource_provider.id)
+                if not mask & forbidden_mask:
+                    group_mask |= mask
+            reachable[depth] = reachable[depth + 1] | group_mask
+        if required_mask & ~reachable[0]:
+            LOG.debug('Excluding the provider tree %s: missing traits %s '
+                      'are not satisfied.', root_id,
+                      ','.join(prov_trait_index.traits_from_mask(
+                          required_mask & ~reachable[0])))
+            continue
+
         root_summary = summaries[root_id]
         root_uuid = root_summary.resource_provider.uuid
 
-        # Using itertools.product, we get all the combinations of resource
-        # providers in a tree.
+        # We get the combinations of resource providers in a tree that
+        # satisfy the trait constraints, in the order itertools.product would
+        # give all of them, pruning as early as possible.
         # For example, the sample in the comment above becomes:
         # [(ARR(rc1, ss1), ARR(rc2, ss1), ARR(rc3, ss1)),
         #  (ARR(rc1, ss1), ARR(rc2, ss2), ARR(rc3, ss1)),
         #  (ARR(rc1, ss2), ARR(rc2, ss1), ARR(rc3, ss1)),
         #  (ARR(rc1, ss2), ARR(rc2, ss2), ARR(rc3, ss1))]
-        for res_requests in itertools.product(*request_groups):
-            all_prov_ids = _check_traits_for_alloc_request(res_requests,
-                summaries, prov_traits, required_traits, forbidden_traits)
-            if (not all_prov_ids) or (all_prov_ids in alloc_prov_ids):
-                # This combination doesn't satisfy trait constraints,
-                # ...or we already have this permutation, which happens
-                # when multiple sharing providers with different resource
-                # classes are in one request.
+        for res_requests, _covered in _pruned_product(
+                request_groups, extend, 0):
+            all_prov_ids = tuple(
+                arr.resource_provider.id for arr in res_requests)
+            if all_prov_ids in alloc_prov_ids:
+                # We already have this permutation, which happens when
+                # multiple sharing providers with different resource classes
+                # are in one request.
                 continue
-            alloc_prov_ids.append(all_prov_ids)
+            alloc_prov_ids.add(all_prov_ids)
             alloc_requests.append(
-                AllocationRequest(ctx, resource_requests=list(res_requests),
-                                  anchor_root_provider_uuid=root_uuid)
+                _AllocationRequestRecord(
+                    resource_requests=list(res_requests),
+                    anchor_root_provider_uuid=root_uuid)
             )
     return alloc_requests, list(summaries.values())
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_traits_by_provider_tree(ctx, root_ids):
     """Returns a dict, keyed by provider IDs for all resource providers
     in all trees indicated in the ``root_ids``, of string trait names
@@ -3651,7 +4655,6 @@ def _get_traits_by_provider_tree(ctx, root_ids):
     return res
 
 
-@db_api.placement_context_manager.reader
 def _trait_ids_from_names(ctx, names):
     """Given a list of string trait names, returns a dict, keyed by those
     string names, of the corresponding internal integer trait ID.
@@ -3665,11 +4668,7 @@ def _trait_ids_from_names(ctx, names):
         raise ValueError(_("Expected names to be a list of string trait "
                            "names, but got an empty list."))
 
-    # Avoid SAWarnings about unicode types...
-    unames = map(six.text_type, names)
-    tt = sa.alias(_TRAIT_TBL, name='t')
-    sel = sa.select([tt.c.name, tt.c.id]).where(tt.c.name.in_(unames))
-    return {r[0]: r[1] for r in ctx.session.execute(sel)}
+    return _TRAIT_CACHE.ids_from_keys(names)
 
 
 def _rp_rc_key(rp, rc):
@@ -3704,94 +4703,162 @@ def _consolidate_allocation_requests(areqs):
         for arr in areq.resource_requests:
             key = _rp_rc_key(arr.resource_provider, arr.resource_class)
             if key not in arrs_by_rp_rc:
-                arrs_by_rp_rc[key] = copy.deepcopy(arr)
+                arrs_by_rp_rc[key] = _AllocationRequestResourceRecord(
+                    resource_provider=arr.resource_provider,
+                    resource_class=arr.resource_class, amount=arr.amount)
             else:
                 arrs_by_rp_rc[key].amount += arr.amount
-    return AllocationRequest(
+    return _AllocationRequestRecord(
         resource_requests=list(arrs_by_rp_rc.values()),
         anchor_root_provider_uuid=anchor_rp_uuid)
 
 
-def _satisfies_group_policy(areqs, group_policy, num_granular_groups):
-    """Applies group_policy to a list of AllocationRequest.
-
-    Returns True or False, indicating whether this list of
-    AllocationRequest satisfies group_policy, as follows:
-
-    * "isolate": Each AllocationRequest with use_same_provider=True
-                 is satisfied by a single resource provider.  If the "isolate"
-                 policy is in effect, each such AllocationRequest must be
-                 satisfied by a *unique* resource provider.
-    * "none" or None: Always returns True.
-
-    :param areqs: A list containing one AllocationRequest for each input
-            RequestGroup.
-    :param group_policy: String indicating how RequestGroups should interact
-            with each other.  If the value is "isolate", we will return False
-            if AllocationRequests that came from RequestGroups keyed by
-            nonempty suffixes are satisfied by the same provider.
-    :param num_granular_groups: The number of granular (use_same_provider=True)
-            RequestGroups in the request.
-    :return: True if areqs satisfies group_policy; False otherwise.
-    """
-    if group_policy != 'isolate':
-        # group_policy="none" means no filtering
-        return True
-
-    # The number of unique resource providers referenced in the request groups
-    # having use_same_provider=True must be equal to the number of granular
-    # groups.
-    num_granular_groups_in_areqs = len(set(
-        # We can reliably use the first resource_request's provider: all the
-        # resource_requests are satisfied by the same provider by definition
-        # because use_same_provider is True.
-        areq.resource_requests[0].resource_provider.uuid
-        for areq in areqs
-        if areq.use_same_provider))
-    if num_granular_groups == num_granular_groups_in_areqs:
-        return True
-    LOG.debug('Excluding the following set of AllocationRequest because '
-              'group_policy=isolate and the number of granular groups in the '
-              'set (%d) does not match the number of granular groups in the '
-              'request (%d): %s',
-              num_granular_groups_in_areqs, num_granular_groups, str(areqs))
-    return False
-
-
-def _exceeds_capacity(areq, psum_res_by_rp_rc):
-    """Checks a (consolidated) AllocationRequest against the provider summaries
-    to ensure that it does not exceed capacity.
+def _exceeds_capacity(amounts, psum_res_by_rp_rc):
+    """Checks the amounts that the AllocationRequests of a combination would
+    consume, once consolidated, against the provider summaries to ensure
+    that, taken together, they do not exceed capacity.
 
     Exceeding capacity can mean the total amount (already used plus this
     allocation) exceeds the total inventory amount; or this allocation exceeds
     the max_unit in the inventory record.
 
-    :param areq: An AllocationRequest produced by the
-            `_consolidate_allocation_requests` method.
+    :param amounts: A dict, keyed by provider + resource class via _rp_rc_key,
+            of the summed amounts to check.
     :param psum_res_by_rp_rc: A dict, keyed by provider + resource class via
             _rp_rc_key, of ProviderSummaryResource.
-    :return: True if areq exceeds capacity; False otherwise.
+    :return: True if the amounts exceed capacity; False otherwise.
     """
-    for arr in areq.resource_requests:
-        key = _rp_rc_key(arr.resource_provider, arr.resource_class)
+    for key, amount in amounts.items():
         psum_res = psum_res_by_rp_rc[key]
-        if psum_res.used + arr.amount > psum_res.capacity:
-            LOG.debug('Excluding the following AllocationRequest because used '
-                      '(%d) + amount (%d) > capacity (%d) for resource class '
-                      '%s: %s',
-                      psum_res.used, arr.amount, psum_res.capacity,
-                      arr.resource_class, str(areq))
+        rp_uuid, rc = key
+        if psum_res.used + amount > psum_res.capacity:
+            LOG.debug('Excluding AllocationRequests using provider %s because '
+                      'used (%d) + amount (%d) > capacity (%d) for resource '
+                      'class %s', rp_uuid, psum_res.used, amount,
+                      psum_res.capacity, rc)
             return True
-        if arr.amount > psum_res.max_unit:
-            LOG.debug('Excluding the following AllocationRequest because '
-                      'amount (%d) > max_unit (%d) for resource class %s: %s',
-                      arr.amount, psum_res.max_unit, arr.resource_class,
-                      str(areq))
+        if amount > psum_res.max_unit:
+            LOG.debug('Excluding AllocationRequests using provider %s because '
+                      'amount (%d) > max_unit (%d) for resource class %s',
+                      rp_uuid, amount, psum_res.max_unit, rc)
             return True
     return False
 
 
-def _merge_candidates(candidates, group_policy=None):
+def _sample(iterable, limit):
+    """Returns a uniformly random selection of `limit` items from the supplied
+    iterable, or all of them if there are fewer, in random order. Unlike
+    random.sample(), only `limit` items are held at any time ("reservoir
+    sampling").
+    """
+    reservoir = []
+    for index, item in enumerate(iterable):
+        if index < limit:
+            reservoir.append(item)
+        else:
+            replace = random.randint(0, index)
+            if replace < limit:
+                reservoir[replace] = item
+    random.shuffle(reservoir)
+    return reservoir
+
+
+def _viable_combinations(areq_lists_by_anchor, all_suffixes,
+                         psum_res_by_rp_rc, group_policy):
+    """Generates the combinations of one AllocationRequest per RequestGroup
+    for each anchor that satisfy group_policy and, once consolidated, capacity.
+    See `_merge_candidates`.
+
+    The combinations are extended one RequestGroup at a time and a partial
+    combination is abandoned as soon as it breaks group_policy or capacity, so
+    the combinations that would have started with it are never visited.
+    """
+    isolate = group_policy == 'isolate'
+
+    def extend(state, depth, areq):
+        """Extends a partial combination, whose state is a tuple of (dict of
+        summed amounts keyed by _rp_rc_key, frozenset of the UUIDs of the
+        providers of its granular AllocationRequests), by ``areq``.
+        """
+        amounts, granular_rp_uuids = state
+        # "isolate": each AllocationRequest with use_same_provider=True is
+        # satisfied by a single resource provider, which must be different
+        # from those of the other granular RequestGroups.
+        if isolate and areq.use_same_provider:
+            # We can reliably use the first resource_request's provider: all
+            # the resource_requests are satisfied by the same provider by
+            # definition because use_same_provider is True.
+            rp_uuid = areq.resource_requests[0].resource_provider.uuid
+            if rp_uuid in granular_rp_uuids:
+                LOG.debug('Excluding AllocationRequests using provider %s '
+                          'for more than one granular group because '
+                          'group_policy=isolate', rp_uuid)
+                return None
+            granular_rp_uuids = granular_rp_uuids | frozenset([rp_uuid])
+        # Since we sourced these AllocationRequests from multiple
+        # *independent* queries, it's possible that the combined result
+        # exceeds capacity where amounts of the same RP+RC are folded
+        # together. Amounts only grow as the combination is extended, so a
+        # partial combination that exceeds capacity can be abandoned.
+        added = {}
+        for arr in areq.resource_requests:
+            key = _rp_rc_key(arr.resource_provider, arr.resource_class)
+            added[key] = added.get(key, amounts.get(key, 0)) + arr.amount
+        if _exceeds_capacity(added, psum_res_by_rp_rc):
+            return None
+        amounts = dict(amounts)
+        amounts.update(added)
+        return amounts, granular_rp_uuids
+
+    for areq_lists_by_suffix in areq_lists_by_anchor.values():
+        # Filter out any entries that don't have allocation requests for
+        # *all* suffixes (i.e. all RequestGroups)
+        if set(areq_lists_by_suffix) != all_suffixes:
+            continue
+        # We go from this:
+        # areq_lists_by_suffix = {
+        #     '':   [areq__A,   areq__B,   ...],
+        #     '1':  [areq_1_A,  areq_1_B,  ...],
+        #     ...
+        #     '42': [areq_42_A, areq_42_B, ...],
+        # }
+        # to the combinations itertools.product would give, minus those
+        # pruned by extend():
+        # [ [areq__A, areq_1_A, ..., areq_42_A],  Each of these lists is one
+        #   [areq__A, areq_1_A, ..., areq_42_B],  areq_list in the loop below.
+        #   [areq__A, areq_1_B, ..., areq_42_A],  each areq_list contains one
+        #   [areq__A, areq_1_B, ..., areq_42_B],  AllocationRequest from each
+        #   [areq__B, areq_1_A, ..., areq_42_A],  RequestGroup. So taken as a
+        #   [areq__B, areq_1_A, ..., areq_42_B],  whole, each list is a viable
+        #   [areq__B, areq_1_B, ..., areq_42_A],  (preliminary) candidate to
+        #   [areq__B, areq_1_B, ..., areq_42_B],  return.
+        #   ...,
+        # ]
+        # At this point, each AllocationRequest in areq_list is still marked
+        # as use_same_provider. This is necessary to filter by group policy,
+        # which enforces how these interact with each other.
+        #
+        # _consolidate_allocation_requests() later goes from this (where
+        # 'arr' is AllocationRequestResource):
+        # [ areq__B(arrX, arrY, arrZ),
+        #   areq_1_A(arrM, arrN),
+        #   ...,
+        #   areq_42_B(arrQ)
+        # ]
+        # to this:
+        # areq_combined(arrX, arrY, arrZ, arrM, arrN, arrQ)
+        # Note that this discards the information telling us which
+        # RequestGroup led to which piece of the final AllocationRequest.
+        # We needed that to be present for the group policy; we need it to be
+        # *absent* for the final output.
+        for areq_list, _state in _pruned_product(
+                list(areq_lists_by_suffix.values()), extend,
+                ({}, frozenset())):
+            yield areq_list
+
+
+def _merge_candidates(candidates, group_policy=None, limit=None,
+                      randomize=False):
     """Given a dict, keyed by RequestGroup suffix, of tuples of
     (allocation_requests, provider_summaries), produce a single tuple of
     (allocation_requests, provider_summaries) that appropriately incorporates
@@ -3810,6 +4877,12 @@ def _merge_candidates(candidates, group_policy=None):
             with each other.  If the value is "isolate", we will filter out
             candidates where AllocationRequests that came from RequestGroups
             keyed by nonempty suffixes are satisfied by the same provider.
+    :param limit: An integer, N, representing the maximum number of
+            allocation requests to return. The merging stops at the first N
+            allocation requests, or if `randomize` is True, keeps a random
+            sampling of N of them as it goes.
+    :param randomize: If True, the order of the returned allocation requests
+            is random.
     :return: A tuple of (allocation_requests, provider_summaries).
     """
     # Build a dict, keyed by anchor root provider UUID, of dicts, keyed by
@@ -3846,61 +4919,23 @@ def _merge_candidates(candidates, group_policy=None):
                 psum_res_by_rp_rc[key] = psum_res
 
     # Create all combinations picking one AllocationRequest from each list
-    # for each anchor.
-    areqs = []
+    # for each anchor. They are generated lazily so that, with a limit, the
+    # combinations past it are never created.
     all_suffixes = set(candidates)
-    num_granular_groups = len(all_suffixes - set(['']))
-    for areq_lists_by_suffix in areq_lists_by_anchor.values():
-        # Filter out any entries that don't have allocation requests for
-        # *all* suffixes (i.e. all RequestGroups)
-        if set(areq_lists_by_suffix) != all_suffixes:
-            continue
-        # We're using itertools.product to go from this:
-        # areq_lists_by_suffix = {
-        #     '':   [areq__A,   areq__B,   ...],
-        #     '1':  [areq_1_A,  areq_1_B,  ...],
-        #     ...
-        #     '42': [areq_42_A, areq_42_B, ...],
-        # }
-        # to this:
-        # [ [areq__A, areq_1_A, ..., areq_42_A],  Each of these lists is one
-        #   [areq__A, areq_1_A, ..., areq_42_B],  areq_list in the loop below.
-        #   [areq__A, areq_1_B, ..., areq_42_A],  each areq_list contains one
-        #   [areq__A, areq_1_B, ..., areq_42_B],  AllocationRequest from each
-        #   [areq__B, areq_1_A, ..., areq_42_A],  RequestGroup. So taken as a
-        #   [areq__B, areq_1_A, ..., areq_42_B],  whole, each list is a viable
-        #   [areq__B, areq_1_B, ..., areq_42_A],  (preliminary) candidate to
-        #   [areq__B, areq_1_B, ..., areq_42_B],  return.
-        #   ...,
-        # ]
-        for areq_list in itertools.product(
-                *list(areq_lists_by_suffix.values())):
-            # At this point, each AllocationRequest in areq_list is still
-            # marked as use_same_provider. This is necessary to filter by group
-            # policy, which enforces how these interact with each other.
-            if not _satisfies_group_policy(
-                    areq_list, group_policy, num_granular_groups):
-                continue
-            # Now we go from this (where 'arr' is AllocationRequestResource):
-            # [ areq__B(arrX, arrY, arrZ),
-            #   areq_1_A(arrM, arrN),
-            #   ...,
-            #   areq_42_B(arrQ)
-            # ]
-            # to this:
-            # areq_combined(arrX, arrY, arrZ, arrM, arrN, arrQ)
-            # Note that this discards the information telling us which
-            # RequestGroup led to which piece of the final AllocationRequest.
-            # We needed that to be present for the previous filter; we need it
-            # to be *absent* for the next one (and for the final output).
-            areq = _consolidate_allocation_requests(areq_list)
-            # Since we sourced this AllocationRequest from multiple
-            # *independent* queries, it's possible that the combined result
-            # now exceeds capacity where amounts of the same RP+RC were
-            # folded together.  So do a final capacity check/filter.
-            if _exceeds_capacity(areq, psum_res_by_rp_rc):
-                continue
-            areqs.append(areq)
+    viable = _viable_combinations(
+        areq_lists_by_anchor, all_suffixes, psum_res_by_rp_rc, group_policy)
+    if limit and randomize:
+        areq_lists = _sample(viable, limit)
+    elif limit:
+        areq_lists = list(itertools.islice(viable, limit))
+    else:
+        areq_lists = list(viable)
+        if randomize:
+            random.shuffle(areq_lists)
+    # Only the kept combinations are consolidated into the AllocationRequests
+    # to return.
+    areqs = [_consolidate_allocation_requests(areq_list)
+             for areq_list in areq_lists]
 
     # It's possible we've filtered out everything.  If so, short out.
     if not areqs:
@@ -3969,14 +5004,35 @@ class AllocationCandidates(base.VersionedObject):
         """
         alloc_reqs, provider_summaries = cls._get_by_requests(
             context, requests, limit=limit, group_policy=group_policy)
+        alloc_reqs, provider_summaries = _objects_from_records(
+            context, alloc_reqs, provider_summaries)
         return cls(
             context,
             allocation_requests=alloc_reqs,
             provider_summaries=provider_summaries,
         )
 
+    @classmethod
+    def get_records_by_requests(cls, context, requests, limit=None,
+                                group_policy=None):
+        """Returns the same allocation candidates as get_by_requests(), but
+        as lightweight records that have the attributes of the versioned
+        objects without their overhead. The records are meant to be read and
+        serialized, as the API handler does, not saved or sent over RPC.
+
+        :return: An object with allocation_requests and provider_summaries
+                 attributes, which are lists of records with the attributes
+                 of AllocationRequest and ProviderSummary objects.
+        """
+        alloc_reqs, provider_summaries = cls._get_by_requests(
+            context, requests, limit=limit, group_policy=group_policy)
+        return _AllocationCandidatesRecord(
+            allocation_requests=alloc_reqs,
+            provider_summaries=provider_summaries)
+
     @staticmethod
-    def _get_by_one_request(context, request, sharing_providers, has_trees):
+    def _get_by_one_request(context, request, sharing_providers, has_trees,
+                            snapshot=None):
         """Get allocation candidates for one RequestGroup.
 
         Must be called from within an placement_context_manager.reader
@@ -3990,6 +5046,8 @@ class AllocationCandidates(base.VersionedObject):
         :param has_trees: bool indicating there is some level of nesting in the
                           environment (if there isn't, we take faster, simpler
                           code paths)
+        :param snapshot: An optional ProviderSnapshot to answer from instead
+                         of querying the database.
         :return: A tuple of (allocation_requests, provider_summaries)
                  satisfying `request`.
         """
@@ -4006,7 +5064,10 @@ class AllocationCandidates(base.VersionedObject):
                 (required_trait_map, request.required_traits),
                 (forbidden_trait_map, request.forbidden_traits)):
             if traits:
-                trait_map.update(_trait_ids_from_names(context, traits))
+                if snapshot is not None:
+                    trait_map.update(snapshot.trait_ids_from_names(traits))
+                else:
+                    trait_map.update(_trait_ids_from_names(context, traits))
                 # Double-check that we found a trait ID for each requested name
                 if len(trait_map) != len(traits):
                     missing = traits - set(trait_map)
@@ -4027,15 +5088,20 @@ class AllocationCandidates(base.VersionedObject):
                 # it should be possible to further optimize this attempt at
                 # a quick return, but we leave that to future patches for
                 # now.
-                trait_rps = _get_provider_ids_having_any_trait(
-                    context, required_trait_map)
+                if snapshot is not None:
+                    trait_rps = snapshot.provider_ids_having_any_trait(
+                        required_trait_map)
+                else:
+                    trait_rps = _get_provider_ids_having_any_trait(
+                        context, required_trait_map)
                 if not trait_rps:
                     return [], []
             rp_tuples = _get_trees_matching_all(context, resources,
                 required_trait_map, forbidden_trait_map,
-                sharing_providers, member_of)
+                sharing_providers, member_of, snapshot=snapshot)
             return _alloc_candidates_multiple_providers(context, resources,
-                required_trait_map, forbidden_trait_map, rp_tuples)
+                required_trait_map, forbidden_trait_map, rp_tuples,
+                snapshot=snapshot)
 
         # Either we are processing a single-RP request group, or there are no
         # sharing providers that (help) satisfy the request.  Get a list of
@@ -4047,34 +5113,50 @@ class AllocationCandidates(base.VersionedObject):
         # IDs.
         rp_ids = _get_provider_ids_matching(context, resources,
                                             required_trait_map,
-                                            forbidden_trait_map, member_of)
-        return _alloc_candidates_single_provider(context, resources, rp_ids)
+                                            forbidden_trait_map, member_of,
+                                            snapshot=snapshot)
+        return _alloc_candidates_single_provider(context, resources, rp_ids,
+                                                 snapshot=snapshot)
 
     @classmethod
-    # TODO(efried): This is only a writer context because it accesses the
-    # resource_providers table via ResourceProvider.get_by_uuid, which does
-    # data migration to populate the root_provider_uuid.  Change this back to a
-    # reader when that migration is no longer happening.
-    @db_api.placement_context_manager.writer
+    @db_api.placement_context_manager.reader.allow_async
     def _get_by_requests(cls, context, requests, limit=None,
                          group_policy=None):
         # TODO(jaypipes): Make a RequestGroupContext object and put these
         # pieces of information in there, passing the context to the various
         # internal functions handling that part of the request.
+        snapshot = None
+        topology = None
+        if CONF.placement.allocation_candidates_engine == 'memory':
+            snapshot = _get_provider_snapshot(context)
+        else:
+            topology = _get_topology(context)
+
         sharing = {}
         for request in requests.values():
             member_of = request.member_of
             for rc_name, amount in request.resources.items():
                 rc_id = _RC_CACHE.id_from_string(rc_name)
-                if rc_id not in sharing:
+                if rc_id in sharing:
+                    continue
+                if snapshot is not None:
+                    sharing[rc_id] = snapshot.providers_with_shared_capacity(
+                        rc_id, amount, member_of)
+                elif topology.sharing:
                     sharing[rc_id] = _get_providers_with_shared_capacity(
                         context, rc_id, amount, member_of)
-        has_trees = _has_provider_trees(context)
+                else:
+                    # No provider shares its resources, skip the lookup
+                    sharing[rc_id] = []
+        if snapshot is not None:
+            has_trees = snapshot.has_provider_trees()
+        else:
+            has_trees = topology.has_trees
 
         candidates = {}
         for suffix, request in requests.items():
             alloc_reqs, summaries = cls._get_by_one_request(
-                context, request, sharing, has_trees)
+                context, request, sharing, has_trees, snapshot=snapshot)
             LOG.debug("%s (suffix '%s') returned %d matches",
                       str(request), str(suffix), len(alloc_reqs))
             if not alloc_reqs:
@@ -4093,20 +5175,12 @@ class AllocationCandidates(base.VersionedObject):
         # each allocation request satisfies *all* the incoming `requests`.  The
         # `candidates` dict is guaranteed to contain entries for all suffixes,
         # or we would have short-circuited above.
+        # The number of allocation request objects is limited while merging,
+        # so that no objects are created only to be discarded. With
+        # randomize_allocation_candidates this is a random sampling of them.
         alloc_request_objs, summary_objs = _merge_candidates(
-                candidates, group_policy=group_policy)
-
-        # Limit the number of allocation request objects. We do this after
-        # creating all of them so that we can do a random slice without
-        # needing to mess with the complex sql above or add additional
-        # columns to the DB.
-        if limit and limit <= len(alloc_request_objs):
-            if CONF.placement.randomize_allocation_candidates:
-                alloc_request_objs = random.sample(alloc_request_objs, limit)
-            else:
-                alloc_request_objs = alloc_request_objs[:limit]
-        elif CONF.placement.randomize_allocation_candidates:
-            random.shuffle(alloc_request_objs)
+                candidates, group_policy=group_policy, limit=limit,
+                randomize=CONF.placement.randomize_allocation_candidates)
 
         # Limit summaries to only those mentioned in the allocation requests.
         if limit and limit <= len(alloc_request_objs):
@@ -40,7 +40,7 @@ def ensure_incomplete_user(ctx):
     return res.inserted_primary_key[0]
 
 
-@db_api.placement_context_manager.reader
+@db_api.placement_context_manager.reader.allow_async
 def _get_user_by_external_id(ctx, external_id):
     users = sa.alias(USER_TBL, name="u")
     cols = [
@@ -58,6 +58,39 @@ def _get_user_by_external_id(ctx, external_id):
     return dict(res)
 
 
+@db_api.placement_context_manager.reader.allow_async
+def _get_users_by_external_ids(ctx, external_ids):
+    """Returns a dict, keyed by external ID, of dicts of information about the
+    users with the supplied external IDs. Unknown IDs are ignored.
+    """
+    users = sa.alias(USER_TBL, name="u")
+    cols = [
+        users.c.id,
+        users.c.external_id,
+        users.c.updated_at,
+        users.c.created_at
+    ]
+    sel = sa.select(cols)
+    sel = sel.where(users.c.external_id.in_(external_ids))
+    return {r['external_id']: dict(r) for r in ctx.session.execute(sel)}
+
+
+@db_api.placement_context_manager.writer
+def _create_users(ctx, external_ids):
+    """Creates records for all the supplied external IDs in one statement.
+
+    :raises: `exception.UserExists` if any of them already exists, in which
+             case none are created.
+    """
+    try:
+        ctx.session.execute(
+            USER_TBL.insert(),
+            [{'external_id': external_id} for external_id in external_ids])
+    except db_exc.DBDuplicateEntry:
+        raise exception.UserExists(
+            external_id=', '.join(sorted(external_ids)))
+
+
 @base.VersionedObjectRegistry.register_if(False)
 class User(base.VersionedObject):
 
@@ -80,6 +113,32 @@ class User(base.VersionedObject):
         res = _get_user_by_external_id(ctx, external_id)
         return cls._from_db_object(ctx, cls(ctx), res)
 
+    @classmethod
+    def get_or_create_all(cls, ctx, external_ids):
+        """Returns a dict, keyed by external ID, of User objects for all the
+        supplied external IDs, creating the records that do not exist yet.
+
+        The lookup and creation take a constant number of queries however
+        many IDs are supplied.
+        """
+        external_ids = set(external_ids)
+        res = _get_users_by_external_ids(ctx, external_ids)
+        missing = external_ids - set(res)
+        if missing:
+            try:
+                _create_users(ctx, missing)
+            except exception.UserExists:
+                # Another thread created some of them already, so create the
+                # rest one at a time
+                for external_id in missing:
+                    try:
+                        cls(ctx, external_id=external_id).create()
+                    except exception.UserExists:
+                        pass
+            res = _get_users_by_external_ids(ctx, external_ids)
+        return {external_id: cls._from_db_object(ctx, cls(ctx), db_user)
+                for external_id, db_user in res.items()}
+
     def create(self):
         @db_api.placement_context_manager.writer
         def _create_in_db(ctx):
@@ -22,6 +22,8 @@ CREATE = PREFIX % 'create'
 SHOW = PREFIX % 'show'
 UPDATE = PREFIX % 'update'
 DELETE = PREFIX % 'delete'
+BULK_UPDATE = PREFIX % 'bulk_update'
+SYNC_TREE = PREFIX % 'sync_tree'
 
 rules = [
     policy.DocumentedRuleDefault(
@@ -79,6 +81,30 @@ rules = [
             }
         ],
         scope_types=['system']),
+    policy.DocumentedRuleDefault(
+        BULK_UPDATE,
+        base.RULE_ADMIN_API,
+        "Update the inventories, traits and aggregates of many resource "
+        "providers at once.",
+        [
+            {
+                'method': 'POST',
+                'path': '/resource_provider_updates'
+            }
+        ],
+        scope_types=['system']),
+    policy.DocumentedRuleDefault(
+        SYNC_TREE,
+        base.RULE_ADMIN_API,
+        "Create, update and delete the resource providers of a tree, and "
+        "their inventories, traits and aggregates, at once.",
+        [
+            {
+                'method': 'PUT',
+                'path': '/resource_provider_trees/{uuid}'
+            }
+        ],
+        scope_types=['system']),
 ]
 
 
@@ -0,0 +1,703 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""An in-memory snapshot of the provider information used to compute
+allocation candidates.
+
+When CONF.placement.allocation_candidates_engine is "memory", each API worker
+keeps one ProviderSnapshot of every resource provider along with its
+inventories, summed allocations, traits and aggregates. The query methods of
+the snapshot mirror, result for result, the SQL helpers in
+nova.api.openstack.placement.objects.resource_provider that the allocation
+candidate code would otherwise call.
+
+The snapshot is checked at the start of every request against the change
+log of nova.api.openstack.placement.change_log. Only the providers recorded
+as changed since the snapshot was taken have their record, inventories,
+summed usages, traits and aggregates reloaded. Trait names, which change
+rarely, are reloaded whole when their change counter moves.
+
+If numpy is available, the capacity checks are made against a columnar
+_CapacityIndex so that every requested resource class is evaluated for every
+provider as a vectorized boolean mask instead of one provider at a time.
+"""
+
+import collections
+import copy
+
+from oslo_concurrency import lockutils
+from oslo_log import log as logging
+from oslo_utils import importutils
+import os_traits
+import six
+import sqlalchemy as sa
+
+from nova.api.openstack.placement import change_log
+from nova.api.openstack.placement import db_api
+from nova.api.openstack.placement import trait_index
+from nova.db.sqlalchemy import api_models as models
+from nova.i18n import _
+
+np = importutils.try_import('numpy')
+
+_RP_TBL = models.ResourceProvider.__table__
+_INV_TBL = models.Inventory.__table__
+_USAGE_TBL = models.ResourceProviderUsage.__table__
+_TRAIT_TBL = models.Trait.__table__
+_RP_TRAIT_TBL = models.ResourceProviderTrait.__table__
+_AGG_TBL = models.PlacementAggregate.__table__
+_RP_AGG_TBL = models.ResourceProviderAggregate.__table__
+_LOCKNAME = 'provider_snapshot'
+
+LOG = logging.getLogger(__name__)
+
+ProviderRecord = collections.namedtuple(
+    'ProviderRecord', 'id uuid generation parent_id root_id')
+
+InventoryRecord = collections.namedtuple(
+    'InventoryRecord',
+    'total reserved min_unit max_unit step_size allocation_ratio')
+
+# providers: change_log.Position the providers are up to date with
+# traits: version of the TRAITS change counter
+Markers = collections.namedtuple('Markers', 'providers traits')
+
+
+def _get_markers(ctx, previous=None):
+    """Returns a tuple of (Markers of the current database state, set of the
+    IDs of the providers changed since the previous snapshot was taken, or
+    None if everything has to be loaded again).
+
+    :param previous: ProviderSnapshot to check, or None
+    """
+    since = previous.markers.providers if previous is not None else None
+    position, changes = change_log.get_provider_changes(ctx, since)
+    (traits,) = change_log.get_versions(ctx, [change_log.TRAITS])
+    if (previous is not None and traits < previous.markers.traits and
+            db_api.reading_replica(ctx)):
+        # The replica lags behind what the previous snapshot was read from
+        traits = previous.markers.traits
+    changed = None
+    if changes is not None:
+        changed = set(rp_id for rp_id, _topology in changes)
+    return Markers(position, traits), changed
+
+
+def _load_providers(ctx, rp_ids=None):
+    sel = sa.select([_RP_TBL.c.id, _RP_TBL.c.uuid, _RP_TBL.c.generation,
+                     _RP_TBL.c.parent_provider_id,
+                     _RP_TBL.c.root_provider_id])
+    if rp_ids is not None:
+        sel = sel.where(_RP_TBL.c.id.in_(rp_ids))
+    return {r[0]: ProviderRecord(*r) for r in ctx.session.execute(sel)}
+
+
+def _load_inventories(ctx, rp_ids=None):
+    sel = sa.select([
+        _INV_TBL.c.resource_provider_id,
+        _INV_TBL.c.resource_class_id,
+        _INV_TBL.c.total,
+        _INV_TBL.c.reserved,
+        _INV_TBL.c.min_unit,
+        _INV_TBL.c.max_unit,
+        _INV_TBL.c.step_size,
+        _INV_TBL.c.allocation_ratio,
+    ])
+    if rp_ids is not None:
+        sel = sel.where(_INV_TBL.c.resource_provider_id.in_(rp_ids))
+    res = collections.defaultdict(dict)
+    for r in ctx.session.execute(sel):
+        res[r[0]][r[1]] = InventoryRecord(*r[2:])
+    return res
+
+
+def _load_provider_traits(ctx, rp_ids=None):
+    sel = sa.select([_RP_TRAIT_TBL.c.resource_provider_id,
+                     _RP_TRAIT_TBL.c.trait_id])
+    if rp_ids is not None:
+        sel = sel.where(_RP_TRAIT_TBL.c.resource_provider_id.in_(rp_ids))
+    res = collections.defaultdict(set)
+    for r in ctx.session.execute(sel):
+        res[r[0]].add(r[1])
+    return {rp_id: frozenset(trait_ids) for rp_id, trait_ids in res.items()}
+
+
+def _load_usages(ctx, rp_ids=None):
+    sel = sa.select([_USAGE_TBL.c.resource_provider_id,
+                     _USAGE_TBL.c.resource_class_id,
+                     _USAGE_TBL.c.used])
+    if rp_ids is not None:
+        sel = sel.where(_USAGE_TBL.c.resource_provider_id.in_(rp_ids))
+    res = collections.defaultdict(dict)
+    for r in ctx.session.execute(sel):
+        res[r[0]][r[1]] = r[2]
+    return dict(res)
+
+
+def _load_aggregates(ctx, rp_ids=None):
+    """Returns a tuple of (dict, keyed by provider ID, of frozensets of
+    aggregate IDs, dict of aggregate internal IDs keyed by aggregate UUID).
+    """
+    join = sa.join(_RP_AGG_TBL, _AGG_TBL,
+                   _RP_AGG_TBL.c.aggregate_id == _AGG_TBL.c.id)
+    sel = sa.select([_RP_AGG_TBL.c.resource_provider_id,
+                     _AGG_TBL.c.id, _AGG_TBL.c.uuid]).select_from(join)
+    if rp_ids is not None:
+        sel = sel.where(_RP_AGG_TBL.c.resource_provider_id.in_(rp_ids))
+    prov_aggs = collections.defaultdict(set)
+    agg_ids = {}
+    for rp_id, agg_id, agg_uuid in ctx.session.execute(sel):
+        prov_aggs[rp_id].add(agg_id)
+        agg_ids[agg_uuid] = agg_id
+    prov_aggs = {rp_id: frozenset(aggs) for rp_id, aggs in prov_aggs.items()}
+    return prov_aggs, agg_ids
+
+
+def _load_trait_ids(ctx):
+    sel = sa.select([_TRAIT_TBL.c.name, _TRAIT_TBL.c.id])
+    return {r[0]: r[1] for r in ctx.session.execute(sel)}
+
+
+def _replace_providers(previous, changed, loaded):
+    """Returns a copy of the supplied dict, keyed by provider ID, of data of
+    the previous snapshot, with the entries of the changed providers replaced
+    by the loaded ones. Changed providers that were not loaded are dropped.
+    """
+    if not changed:
+        return previous
+    res = {rp_id: value for rp_id, value in previous.items()
+           if rp_id not in changed}
+    res.update(loaded)
+    return res
+
+
+class _CapacityIndex(object):
+    """A columnar copy of the inventories and usages of a snapshot.
+
+    Each provider has a row and each resource class a set of numpy columns
+    holding, for every row, whether the provider has inventory of the class,
+    its usable capacity, the amount used and the min_unit, max_unit and
+    step_size constraints. Testing a set of requested amounts is then one
+    vectorized pass per resource class instead of a Python loop per provider.
+    """
+
+    _COLUMNS = ('present', 'capacity', 'used', 'min_unit', 'max_unit',
+                'step_size')
+
+    def __init__(self, rp_ids, positions, columns):
+        """
+        :param rp_ids: numpy array of provider IDs, indexed by row
+        :param positions: dict of rows keyed by provider ID
+        :param columns: dict, keyed by resource class ID, of dicts of numpy
+                        arrays keyed by the names in _COLUMNS
+        """
+        self.rp_ids = rp_ids
+        self.positions = positions
+        self.columns = columns
+
+    @staticmethod
+    def _new_column(count):
+        return {
+            'present': np.zeros(count, dtype=bool),
+            'capacity': np.zeros(count, dtype=np.float64),
+            'used': np.zeros(count, dtype=np.int64),
+            'min_unit': np.zeros(count, dtype=np.int64),
+            'max_unit': np.zeros(count, dtype=np.int64),
+            # Never zero, so that the modulo in provider_ids_with_capacity()
+            # is safe for rows without inventory of the class
+            'step_size': np.ones(count, dtype=np.int64),
+        }
+
+    @staticmethod
+    def _set_row(col, pos, inv, used):
+        col['present'][pos] = True
+        col['capacity'][pos] = (
+            (inv.total - inv.reserved) * inv.allocation_ratio)
+        col['used'][pos] = used
+        col['min_unit'][pos] = inv.min_unit
+        col['max_unit'][pos] = inv.max_unit
+        col['step_size'][pos] = inv.step_size or 1
+
+    @classmethod
+    def build(cls, inventories, usages):
+        """Returns a new _CapacityIndex for the supplied inventories and
+        usages, in the format used by ProviderSnapshot.
+        """
+        rp_ids = sorted(rp_id for rp_id, invs in inventories.items() if invs)
+        positions = {rp_id: pos for pos, rp_id in enumerate(rp_ids)}
+        columns = {}
+        for rp_id in rp_ids:
+            rp_usages = usages.get(rp_id, {})
+            for rc_id, inv in inventories[rp_id].items():
+                col = columns.get(rc_id)
+                if col is None:
+                    col = columns[rc_id] = cls._new_column(len(rp_ids))
+                cls._set_row(col, positions[rp_id], inv,
+                             rp_usages.get(rc_id, 0))
+        return cls(np.array(rp_ids, dtype=np.int64), positions, columns)
+
+    def update(self, inventories, usages, changed_rps):
+        """Returns a new _CapacityIndex with the rows of the changed providers
+        updated, sharing every unchanged column with this one. This one is
+        left untouched.
+
+        Returns None if a provider without a row gained inventory, in which
+        case a new index has to be built.
+
+        :param inventories: dict of inventories in the format used by
+                            ProviderSnapshot
+        :param usages: dict of usages in the format used by ProviderSnapshot
+        :param changed_rps: set of IDs of providers whose inventories or
+                            usages may have changed or that were deleted
+        """
+        if any(rp_id not in self.positions and inventories.get(rp_id)
+               for rp_id in changed_rps):
+            return None
+        columns = dict(self.columns)
+        copied = collections.defaultdict(set)
+
+        def _writable(rc_id, names):
+            # Copy on write, so that snapshots still in use see no change
+            col = columns.get(rc_id)
+            if col is None:
+                col = columns[rc_id] = self._new_column(len(self.rp_ids))
+                copied[rc_id].update(self._COLUMNS)
+                return col
+            missing = set(names) - copied[rc_id]
+            if missing:
+                col = columns[rc_id] = dict(col)
+                for name in missing:
+                    col[name] = col[name].copy()
+                copied[rc_id].update(missing)
+            return col
+
+        for rp_id in changed_rps:
+            pos = self.positions.get(rp_id)
+            if pos is None:
+                continue
+            invs = inventories.get(rp_id, {})
+            rp_usages = usages.get(rp_id, {})
+            for rc_id, col in list(columns.items()):
+                if rc_id not in invs and col['present'][pos]:
+                    _writable(rc_id, ['present'])['present'][pos] = False
+            for rc_id, inv in invs.items():
+                self._set_row(_writable(rc_id, self._COLUMNS), pos, inv,
+                              rp_usages.get(rc_id, 0))
+        return _CapacityIndex(self.rp_ids, self.positions, columns)
+
+    def provider_ids_with_capacity(self, resources):
+        """Returns a set of the IDs of providers having inventory of every
+        requested resource class with enough capacity for the requested
+        amount.
+
+        :param resources: dict, keyed by resource class ID, of amounts
+        """
+        mask = np.ones(len(self.rp_ids), dtype=bool)
+        for rc_id, amount in resources.items():
+            col = self.columns.get(rc_id)
+            if col is None:
+                return set()
+            mask &= col['present']
+            mask &= col['used'] + amount <= col['capacity']
+            mask &= col['min_unit'] <= amount
+            mask &= col['max_unit'] >= amount
+            mask &= amount % col['step_size'] == 0
+        return set(self.rp_ids[mask].tolist())
+
+
+@db_api.placement_context_manager.reader.allow_async
+def _load_snapshot(ctx, markers, changed, previous=None):
+    """Builds a new ProviderSnapshot reflecting the database state described
+    by the supplied markers. Anything the previous snapshot holds that is
+    known to be unchanged is reused instead of being read again.
+
+    :param markers: Markers namedtuple returned by _get_markers()
+    :param changed: set of the IDs of the providers changed since the
+                    previous snapshot was taken, as returned by
+                    _get_markers(), or None
+    :param previous: ProviderSnapshot to update, or None to load everything.
+    """
+    # IDs of the providers that are reloaded, or None if all are loaded
+    if previous is None:
+        changed = None
+    elif changed is not None and len(changed) * 2 > len(previous.providers):
+        # Cheaper to read everything than to look so many up
+        changed = None
+    if changed is None:
+        providers = _load_providers(ctx)
+        inventories = _load_inventories(ctx)
+        usages = _load_usages(ctx)
+        prov_traits = _load_provider_traits(ctx)
+        prov_aggs, agg_ids = _load_aggregates(ctx)
+    else:
+        def _reload(attr, loader):
+            loaded = loader(ctx, changed) if changed else {}
+            return _replace_providers(getattr(previous, attr), changed,
+                                      loaded)
+
+        providers = _reload('providers', _load_providers)
+        inventories = _reload('inventories', _load_inventories)
+        usages = _reload('usages', _load_usages)
+        prov_traits = _reload('traits', _load_provider_traits)
+        agg_ids = previous.agg_ids
+        loaded_aggs = {}
+        if changed:
+            loaded_aggs, loaded_ids = _load_aggregates(ctx, changed)
+            # Aggregates are never deleted, so their IDs are only added to
+            agg_ids = dict(agg_ids)
+            agg_ids.update(loaded_ids)
+        prov_aggs = _replace_providers(previous.aggregates, changed,
+                                       loaded_aggs)
+
+    if previous is not None and previous.markers.traits == markers.traits:
+        trait_ids = previous.trait_ids
+    else:
+        trait_ids = _load_trait_ids(ctx)
+
+    capacity = None
+    if np is not None:
+        if (previous is not None and previous.capacity is not None and
+                changed is not None):
+            capacity = previous.capacity.update(inventories, usages, changed)
+        if capacity is None:
+            capacity = _CapacityIndex.build(inventories, usages)
+
+    return ProviderSnapshot(markers, providers, inventories, usages,
+                            prov_traits, prov_aggs, agg_ids, trait_ids,
+                            capacity=capacity)
+
+
+class ProviderSnapshot(object):
+    """An immutable, indexed copy of the provider data needed to compute
+    allocation candidates.
+
+    A snapshot is never modified once built; refreshing produces a new
+    snapshot. Callers should therefore use a single snapshot object for the
+    whole of a request to get a consistent view.
+    """
+
+    def __init__(self, markers, providers, inventories, usages, traits,
+                 aggregates, agg_ids, trait_ids, capacity=None):
+        """Build the snapshot and its secondary indexes.
+
+        :param markers: Markers namedtuple describing the database state
+        :param providers: dict, keyed by provider ID, of ProviderRecord
+        :param inventories: dict, keyed by provider ID, of dicts, keyed by
+                            resource class ID, of InventoryRecord
+        :param usages: dict, keyed by provider ID, of dicts, keyed by resource
+                       class ID, of the summed amounts of allocations, as
+                       recorded in the resource_provider_usages table
+        :param traits: dict, keyed by provider ID, of frozensets of trait IDs
+        :param aggregates: dict, keyed by provider ID, of frozensets of
+                           aggregate IDs
+        :param agg_ids: dict, keyed by aggregate UUID, of aggregate IDs
+        :param trait_ids: dict, keyed by trait name, of trait IDs
+        :param capacity: _CapacityIndex of the inventories and usages, or None
+                         to check capacity one provider at a time
+        """
+        self.markers = markers
+        self.providers = providers
+        self.inventories = inventories
+        self.traits = traits
+        self.aggregates = aggregates
+        self.agg_ids = agg_ids
+        self.trait_ids = trait_ids
+        self.trait_names = {v: k for k, v in trait_ids.items()}
+        self.usages = usages
+        self.capacity = capacity
+
+        # Secondary indexes
+        self.providers_by_root = collections.defaultdict(list)
+        for rp in providers.values():
+            self.providers_by_root[rp.root_id].append(rp.id)
+        self.providers_by_rc = collections.defaultdict(list)
+        for rp_id, invs in inventories.items():
+            for rc_id in invs:
+                self.providers_by_rc[rc_id].append(rp_id)
+        self.providers_by_agg = collections.defaultdict(set)
+        for rp_id, aggs in aggregates.items():
+            for agg_id in aggs:
+                self.providers_by_agg[agg_id].add(rp_id)
+        self.has_trees = any(
+            rp.parent_id is not None for rp in providers.values())
+        self.trait_index = trait_index.TraitIndex(
+            traits, roots={rp.id: rp.root_id for rp in providers.values()})
+
+    def with_markers(self, markers):
+        """Returns a copy of this snapshot, sharing all of its data and
+        indexes, that describes itself with the supplied markers. Used when
+        the change log moved without any provider data changing.
+        """
+        snapshot = copy.copy(self)
+        snapshot.markers = markers
+        return snapshot
+
+    def _has_capacity(self, rp_id, rc_id, amount):
+        """Returns True if the provider has inventory of the resource class
+        that can satisfy the requested amount, applying the same checks as
+        the SQL helpers do.
+        """
+        inv = self.inventories.get(rp_id, {}).get(rc_id)
+        if inv is None:
+            return False
+        used = self.usages.get(rp_id, {}).get(rc_id, 0)
+        return (
+            used + amount <= (inv.total - inv.reserved) * inv.allocation_ratio
+            and inv.min_unit <= amount
+            and inv.max_unit >= amount
+            and amount % inv.step_size == 0)
+
+    def _provider_ids_with_capacity(self, resources):
+        """Returns a set of the IDs of providers that have capacity for all
+        of the requested resources.
+
+        :param resources: dict, keyed by resource class ID, of amounts
+        """
+        if self.capacity is not None:
+            return self.capacity.provider_ids_with_capacity(resources)
+        # Start from the resource class with the fewest providers
+        rc_ids = sorted(
+            resources, key=lambda rc: len(self.providers_by_rc.get(rc, [])))
+        rp_ids = set(self.providers_by_rc.get(rc_ids[0], []))
+        for rc_id in rc_ids[1:]:
+            rp_ids &= set(self.providers_by_rc.get(rc_id, []))
+        return set(
+            rp_id for rp_id in rp_ids
+            if all(self._has_capacity(rp_id, rc_id, amount)
+                   for rc_id, amount in resources.items()))
+
+    def has_provider_trees(self):
+        """Mirrors resource_provider._has_provider_trees()."""
+        return self.has_trees
+
+    def trait_ids_from_names(self, names):
+        """Mirrors resource_provider._trait_ids_from_names()."""
+        if not names:
+            raise ValueError(_("Expected names to be a list of string trait "
+                               "names, but got an empty list."))
+        return {six.text_type(name): self.trait_ids[name]
+                for name in names if name in self.trait_ids}
+
+    def provider_ids_having_any_trait(self, traits):
+        """Mirrors resource_provider._get_provider_ids_having_any_trait()."""
+        if not traits:
+            raise ValueError(_('traits must not be empty'))
+        return self.trait_index.provider_ids_having_any(traits.values())
+
+    def provider_ids_having_all_traits(self, required_traits):
+        """Mirrors resource_provider._get_provider_ids_having_all_traits()."""
+        if not required_traits:
+            raise ValueError(_('required_traits must not be empty'))
+        return self.trait_index.provider_ids_matching(
+            required=required_traits.values())
+
+    def provider_ids_matching_aggregates(self, member_of, rp_ids=None):
+        """Mirrors resource_provider._provider_ids_matching_aggregates()."""
+        matched = None
+        for members in member_of:
+            agg_ids = [self.agg_ids[member] for member in members
+                       if member in self.agg_ids]
+            if not agg_ids:
+                return []
+            rps = set()
+            for agg_id in agg_ids:
+                rps |= self.providers_by_agg[agg_id]
+            matched = rps if matched is None else matched & rps
+        if rp_ids:
+            matched &= set(rp_ids)
+        return sorted(matched)
+
+    def providers_with_shared_capacity(self, rc_id, amount, member_of=None):
+        """Mirrors resource_provider._get_providers_with_shared_capacity()."""
+        shares_id = self.trait_ids.get(
+            six.text_type(os_traits.MISC_SHARES_VIA_AGGREGATE))
+        res = [rp_id for rp_id in
+               self._provider_ids_with_capacity({rc_id: amount})
+               if shares_id in self.traits.get(rp_id, ())]
+        if member_of:
+            rps_in_aggs = self.provider_ids_matching_aggregates(member_of)
+            if not rps_in_aggs:
+                return []
+            rps_in_aggs = set(rps_in_aggs)
+            res = [rp_id for rp_id in res if rp_id in rps_in_aggs]
+        return sorted(res)
+
+    def anchors_for_sharing_providers(self, rp_ids, get_id=False):
+        """Mirrors resource_provider._anchors_for_sharing_providers()."""
+        res = set()
+        for sp_id in rp_ids:
+            sp = self.providers.get(sp_id)
+            if sp is None:
+                continue
+            for agg_id in self.aggregates.get(sp_id, ()):
+                for rp_id in self.providers_by_agg[agg_id]:
+                    rp = self.providers[rp_id]
+                    root = self.providers.get(rp.root_id)
+                    if get_id:
+                        anchor = (rp.root_id if rp.root_id is not None
+                                  else rp.id)
+                        res.add((sp.id, anchor))
+                    else:
+                        anchor = root.uuid if root is not None else rp.uuid
+                        res.add((sp.uuid, anchor))
+        return res
+
+    def providers_with_resource(self, rc_id, amount):
+        """Mirrors resource_provider._get_providers_with_resource()."""
+        return set((rp_id, self.providers[rp_id].root_id)
+                   for rp_id in
+                   self._provider_ids_with_capacity({rc_id: amount}))
+
+    def provider_ids_matching(self, resources, required_traits,
+                              forbidden_traits, member_of=None):
+        """Mirrors resource_provider._get_provider_ids_matching()."""
+        required = required_traits.values() if required_traits else []
+        forbidden = forbidden_traits.values() if forbidden_traits else []
+        if self.trait_index.required_mask(required) is None:
+            # No provider has one of the required traits
+            return []
+
+        if resources:
+            rp_ids = self._provider_ids_with_capacity(resources)
+        else:
+            rp_ids = set(self.providers)
+        if required or forbidden:
+            rp_ids = set(self.trait_index.provider_ids_matching(
+                required, forbidden, rp_ids=rp_ids))
+
+        if member_of:
+            rps_in_aggs = self.provider_ids_matching_aggregates(member_of)
+            if not rps_in_aggs:
+                return []
+            rp_ids &= set(rps_in_aggs)
+
+        return [(rp_id, self.providers[rp_id].root_id)
+                for rp_id in sorted(rp_ids)]
+
+    def trees_with_traits(self, rp_ids, required_traits, forbidden_traits):
+        """Mirrors resource_provider._get_trees_with_traits()."""
+        required = required_traits.values() if required_traits else []
+        forbidden = forbidden_traits.values() if forbidden_traits else []
+        roots = self.trait_index.root_ids_matching(
+            rp_ids, required, forbidden)
+        return [(rp_id, root_id) for root_id in sorted(roots)
+                for rp_id in sorted(self.providers_by_root[root_id])]
+
+    def usages_by_provider_tree(self, root_ids):
+        """Mirrors resource_provider._get_usages_by_provider_tree(), returning
+        a list of dicts with the same keys as the SQL result rows.
+        """
+        res = []
+        for root_id in sorted(set(root_ids)):
+            for rp_id in sorted(self.providers_by_root.get(root_id, [])):
+                rp = self.providers[rp_id]
+                invs = self.inventories.get(rp_id)
+                if not invs:
+                    res.append({
+                        'resource_provider_id': rp_id,
+                        'resource_provider_uuid': rp.uuid,
+                        'resource_class_id': None,
+                        'total': None,
+                        'reserved': None,
+                        'allocation_ratio': None,
+                        'max_unit': None,
+                        'used': None,
+                    })
+                    continue
+                rp_usages = self.usages.get(rp_id, {})
+                for rc_id in sorted(invs):
+                    inv = invs[rc_id]
+                    res.append({
+                        'resource_provider_id': rp_id,
+                        'resource_provider_uuid': rp.uuid,
+                        'resource_class_id': rc_id,
+                        'total': inv.total,
+                        'reserved': inv.reserved,
+                        'allocation_ratio': inv.allocation_ratio,
+                        'max_unit': inv.max_unit,
+                        'used': rp_usages.get(rc_id),
+                    })
+        return res
+
+    def traits_by_provider_tree(self, root_ids):
+        """Mirrors resource_provider._get_traits_by_provider_tree()."""
+        if not root_ids:
+            raise ValueError(_("Expected root_ids to be a list of root "
+                               "resource provider internal IDs, but got an "
+                               "empty list."))
+        res = collections.defaultdict(list)
+        for root_id in root_ids:
+            for rp_id in self.providers_by_root.get(root_id, []):
+                for trait_id in sorted(self.traits.get(rp_id, ())):
+                    res[rp_id].append(self.trait_names[trait_id])
+        return res
+
+    def provider_ids_from_rp_ids(self, rp_ids):
+        """Mirrors resource_provider._provider_ids_from_rp_ids(), returning a
+        dict, keyed by provider ID, of tuples of (id, uuid, parent_id,
+        parent_uuid, root_id, root_uuid).
+        """
+        res = {}
+        for rp_id in rp_ids:
+            rp = self.providers.get(rp_id)
+            if rp is None:
+                continue
+            parent = self.providers.get(rp.parent_id)
+            root = self.providers.get(rp.root_id)
+            res[rp_id] = (
+                rp.id, rp.uuid,
+                parent.id if parent else None,
+                parent.uuid if parent else None,
+                root.id if root else None,
+                root.uuid if root else None)
+        return res
+
+
+class ProviderSnapshotCache(object):
+    """Holds the current ProviderSnapshot for this process and refreshes it
+    when the database has changed.
+    """
+
+    def __init__(self):
+        self._snapshot = None
+
+    def clear(self):
+        with lockutils.lock(_LOCKNAME):
+            self._snapshot = None
+
+    @db_api.placement_context_manager.reader.allow_async
+    def get(self, ctx):
+        """Returns a ProviderSnapshot that is current as of the caller's
+        transaction.
+
+        :param ctx: `nova.context.RequestContext` from which we can grab a
+                    DB session.
+        """
+        snapshot = self._snapshot
+        markers, changed = _get_markers(ctx, snapshot)
+        if snapshot is not None and snapshot.markers == markers:
+            return snapshot
+        with lockutils.lock(_LOCKNAME):
+            if self._snapshot is not snapshot:
+                snapshot = self._snapshot
+                markers, changed = _get_markers(ctx, snapshot)
+            if snapshot is not None and snapshot.markers == markers:
+                return snapshot
+            if (snapshot is not None and changed == set() and
+                    snapshot.markers.traits == markers.traits):
+                # Only the records still to be committed moved the position
+                snapshot = snapshot.with_markers(markers)
+            else:
+                LOG.debug("Refreshing in-memory provider snapshot.")
+                snapshot = _load_snapshot(ctx, markers, changed,
+                                          previous=snapshot)
+            self._snapshot = snapshot
+        return snapshot
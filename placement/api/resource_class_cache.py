@@ -10,36 +10,85 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import collections
+
 from oslo_concurrency import lockutils
 import sqlalchemy as sa
 
+from nova.api.openstack.placement import change_log
 from nova.api.openstack.placement import db_api
 from nova.api.openstack.placement import exception
 from nova.db.sqlalchemy import api_models as models
 from nova import rc_fields as fields
 
 _RC_TBL = models.ResourceClass.__table__
+_VERSION_TBL = models.PlacementVersion.__table__
 _LOCKNAME = 'rc_cache'
 
+# Map of standard resource class names to their integer codes
+_STANDARD_IDS = {name: rc_id
+                 for rc_id, name in enumerate(fields.ResourceClass.STANDARD)}
+
+# An immutable copy of the custom resource classes in the database, along
+# with the version of the RESOURCE_CLASSES change counter it was loaded at.
+_Snapshot = collections.namedtuple(
+    '_Snapshot', 'marker id_cache str_cache all_cache')
+
+_EMPTY = _Snapshot(None, {}, {}, {})
 
-@db_api.placement_context_manager.reader
-def _refresh_from_db(ctx, cache):
-    """Grabs all custom resource classes from the DB table and populates the
-    supplied cache object's internal integer and string identifier dicts.
 
-    :param cache: ResourceClassCache object to refresh.
+def _marker_from_db(conn):
+    """Returns the version of the RESOURCE_CLASSES change counter, which the
+    writers increment whenever a custom resource class is created, renamed or
+    deleted.
     """
-    with db_api.placement_context_manager.reader.connection.using(ctx) as conn:
+    sel = sa.select([_VERSION_TBL.c.version]).where(
+        _VERSION_TBL.c.name == change_log.RESOURCE_CLASSES)
+    return conn.execute(sel).scalar() or 0
+
+
+def _get_marker(ctx):
+    """Returns the current version of the RESOURCE_CLASSES change counter."""
+    reader = db_api.placement_context_manager.reader.allow_async
+    with reader.connection.using(ctx) as conn:
+        return _marker_from_db(conn)
+
+
+def _refresh_from_db(ctx):
+    """Grabs all custom resource classes from the DB table and returns a new
+    _Snapshot of their integer and string identifiers.
+    """
+    reader = db_api.placement_context_manager.reader.allow_async
+    with reader.connection.using(ctx) as conn:
+        # The marker is read first: if the table changes before the rows are
+        # read, the snapshot only looks older than it is and the next miss
+        # reloads it again.
+        marker = _marker_from_db(conn)
         sel = sa.select([_RC_TBL.c.id, _RC_TBL.c.name, _RC_TBL.c.updated_at,
                          _RC_TBL.c.created_at])
         res = conn.execute(sel).fetchall()
-        cache.id_cache = {r[1]: r[0] for r in res}
-        cache.str_cache = {r[0]: r[1] for r in res}
-        cache.all_cache = {r[1]: r for r in res}
+    return _Snapshot(marker,
+                     {r[1]: r[0] for r in res},
+                     {r[0]: r[1] for r in res},
+                     {r[1]: r for r in res})
 
 
 class ResourceClassCache(object):
-    """A cache of integer and string lookup values for resource classes."""
+    """A cache of integer and string lookup values for resource classes.
+
+    Lookups read an immutable snapshot of the custom resource classes without
+    taking any lock. A lookup that misses the snapshot reads the version of
+    the RESOURCE_CLASSES change counter with a primary key lookup. Only if
+    the counter moved, for example because another API worker created a
+    resource class, is the table reloaded and the snapshot swapped for a new
+    one. A lookup of a resource class that does not exist therefore never
+    reloads the table while it is unchanged.
+
+    Hits are not checked against the database. Instead expire() is given the
+    current version of the counter at the start of every request, and drops
+    the snapshot if a resource class was renamed or deleted since it was
+    loaded.
+    """
 
     # List of dict of all standard resource classes, where every list item
     # have a form {'id': <ID>, 'name': <NAME>}
@@ -54,15 +103,47 @@ class ResourceClassCache(object):
                     `SQLAlchemy.Connection` object to use for any DB lookups.
         """
         self.ctx = ctx
-        self.id_cache = {}
-        self.str_cache = {}
-        self.all_cache = {}
+        self._snapshot = _EMPTY
 
     def clear(self):
+        """Drops the snapshot, so that the next lookup of a custom resource
+        class reloads it.
+        """
+        self._snapshot = _EMPTY
+
+    def expire(self, version):
+        """Drops the snapshot if it was loaded at another version of the
+        RESOURCE_CLASSES change counter.
+
+        :param version: current version of the counter, as returned by
+                        change_log.get_versions()
+        """
+        marker = self._snapshot.marker
+        if marker is not None and marker != version:
+            self._snapshot = _EMPTY
+
+    def _lookup(self, cache_name, key):
+        """Returns the value for key in the named dict of the snapshot,
+        refreshing the snapshot if the key is missing and the table changed.
+
+        :raises `exception.ResourceClassNotFound` if the key can't be found.
+        """
+        value = getattr(self._snapshot, cache_name).get(key)
+        if value is not None:
+            return value
         with lockutils.lock(_LOCKNAME):
-            self.id_cache = {}
-            self.str_cache = {}
-            self.all_cache = {}
+            # Another thread may have refreshed the snapshot while we waited
+            snapshot = self._snapshot
+            value = getattr(snapshot, cache_name).get(key)
+            if value is not None:
+                return value
+            if snapshot.marker is None or (
+                    _get_marker(self.ctx) != snapshot.marker):
+                snapshot = self._snapshot = _refresh_from_db(self.ctx)
+                value = getattr(snapshot, cache_name).get(key)
+                if value is not None:
+                    return value
+        raise exception.ResourceClassNotFound(resource_class=key)
 
     def id_from_string(self, rc_str):
         """Given a string representation of a resource class -- e.g. "DISK_GB"
@@ -82,17 +163,10 @@ class ResourceClassCache(object):
                 either the standard classes or the DB.
         """
         # First check the standard resource classes
-        if rc_str in fields.ResourceClass.STANDARD:
-            return fields.ResourceClass.STANDARD.index(rc_str)
-
-        with lockutils.lock(_LOCKNAME):
-            if rc_str in self.id_cache:
-                return self.id_cache[rc_str]
-            # Otherwise, check the database table
-            _refresh_from_db(self.ctx, self)
-            if rc_str in self.id_cache:
-                return self.id_cache[rc_str]
-            raise exception.ResourceClassNotFound(resource_class=rc_str)
+        rc_id = _STANDARD_IDS.get(rc_str)
+        if rc_id is not None:
+            return rc_id
+        return self._lookup('id_cache', rc_str)
 
     def all_from_string(self, rc_str):
         """Given a string representation of a resource class -- e.g. "DISK_GB"
@@ -107,20 +181,13 @@ class ResourceClassCache(object):
                  either the standard classes or the DB.
         """
         # First check the standard resource classes
-        if rc_str in fields.ResourceClass.STANDARD:
-            return {'id': fields.ResourceClass.STANDARD.index(rc_str),
+        rc_id = _STANDARD_IDS.get(rc_str)
+        if rc_id is not None:
+            return {'id': rc_id,
                     'name': rc_str,
                     'updated_at': None,
                     'created_at': None}
-
-        with lockutils.lock(_LOCKNAME):
-            if rc_str in self.all_cache:
-                return self.all_cache[rc_str]
-            # Otherwise, check the database table
-            _refresh_from_db(self.ctx, self)
-            if rc_str in self.all_cache:
-                return self.all_cache[rc_str]
-            raise exception.ResourceClassNotFound(resource_class=rc_str)
+        return self._lookup('all_cache', rc_str)
 
     def string_from_id(self, rc_id):
         """The reverse of the id_from_string() method. Given a supplied numeric
@@ -142,13 +209,4 @@ class ResourceClassCache(object):
             return fields.ResourceClass.STANDARD[rc_id]
         except IndexError:
             pass
-
-        with lockutils.lock(_LOCKNAME):
-            if rc_id in self.str_cache:
-                return self.str_cache[rc_id]
-
-            # Otherwise, check the database table
-            _refresh_from_db(self.ctx, self)
-            if rc_id in self.str_cache:
-                return self.str_cache[rc_id]
-            raise exception.ResourceClassNotFound(resource_class=rc_id)
+        return self._lookup('str_cache', rc_id)
@@ -165,3 +165,25 @@ POST_ALLOCATIONS_V1_28 = copy.deepcopy(POST_ALLOCATIONS_V1_13)
 POST_ALLOCATIONS_V1_28["patternProperties"] = {
     "^[0-9a-fA-F-]{36}$": REQUIRED_GENERATION_ALLOCS_POST
 }
+
+# Represents the allowed query string parameters to
+# GET /resource_providers/{uuid}/allocations from microversion 1.34, which
+# pages through the consumers of the allocations.
+GET_RP_ALLOCATIONS_SCHEMA_V1_34 = {
+    "type": "object",
+    "properties": {
+        "limit": {
+            # A query parameter is always a string in webOb, but
+            # we'll handle integer here as well.
+            "type": ["integer", "string"],
+            "pattern": "^[1-9][0-9]*$",
+            "minimum": 1,
+            "minLength": 1
+        },
+        "marker": {
+            "type": "string",
+            "format": "uuid",
+        },
+    },
+    "additionalProperties": False,
+}
@@ -0,0 +1,73 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Resource provider bulk update and tree sync schemas for Placement API."""
+
+import copy
+
+from nova.api.openstack.placement.schemas import aggregate
+from nova.api.openstack.placement.schemas import inventory
+from nova.api.openstack.placement.schemas import resource_provider
+from nova.api.openstack.placement.schemas import trait
+
+
+PROVIDER_UPDATE = {
+    "type": "object",
+    "properties": {
+        "resource_provider_generation": {
+            "type": "integer"
+        },
+        "inventories": copy.deepcopy(
+            inventory.PUT_INVENTORY_SCHEMA['properties']['inventories']),
+        "traits": copy.deepcopy(
+            trait.SET_TRAITS_FOR_RP_SCHEMA['properties']['traits']),
+        "aggregates": copy.deepcopy(
+            aggregate.PUT_AGGREGATES_SCHEMA_V1_19['properties']['aggregates']),
+    },
+    "required": [
+        "resource_provider_generation"
+    ],
+    "additionalProperties": False
+}
+
+
+POST_PROVIDER_UPDATES_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "resource_providers": {
+            "type": "object",
+            "minProperties": 1,
+            "patternProperties": {
+                "^[0-9a-fA-F-]{36}$": PROVIDER_UPDATE
+            },
+            "additionalProperties": False
+        }
+    },
+    "required": [
+        "resource_providers"
+    ],
+    "additionalProperties": False
+}
+
+
+# A provider of the tree in PUT /resource_provider_trees/{uuid}. The
+# generation is left out for a provider that is expected not to exist yet.
+PROVIDER_TREE_NODE = copy.deepcopy(PROVIDER_UPDATE)
+PROVIDER_TREE_NODE['properties']['name'] = copy.deepcopy(
+    resource_provider.PUT_RP_SCHEMA_V1_14['properties']['name'])
+PROVIDER_TREE_NODE['properties']['parent_provider_uuid'] = copy.deepcopy(
+    resource_provider.PUT_RP_SCHEMA_V1_14['properties']
+    ['parent_provider_uuid'])
+PROVIDER_TREE_NODE['required'] = ['name']
+
+PUT_PROVIDER_TREE_SCHEMA = copy.deepcopy(POST_PROVIDER_UPDATES_SCHEMA)
+PUT_PROVIDER_TREE_SCHEMA['properties']['resource_providers'][
+    'patternProperties'] = {"^[0-9a-fA-F-]{36}$": PROVIDER_TREE_NODE}
@@ -104,3 +104,24 @@ GET_RPS_SCHEMA_1_18 = copy.deepcopy(GET_RPS_SCHEMA_1_14)
 GET_RPS_SCHEMA_1_18['properties']['required'] = {
     "type": "string",
 }
+
+# Microversion 1.33 adds keyset pagination, with the `limit` and `marker`
+# query parameters, and the `fields` query parameter, a comma-separated list
+# of the fields to return for each resource provider, to the
+# `GET /resource_providers` API.
+GET_RPS_SCHEMA_1_33 = copy.deepcopy(GET_RPS_SCHEMA_1_18)
+GET_RPS_SCHEMA_1_33['properties']['limit'] = {
+    # A query parameter is always a string in webOb, but
+    # we'll handle integer here as well.
+    "type": ["integer", "string"],
+    "pattern": "^[1-9][0-9]*$",
+    "minimum": 1,
+    "minLength": 1
+}
+GET_RPS_SCHEMA_1_33['properties']['marker'] = {
+    "type": "string",
+    "format": "uuid",
+}
+GET_RPS_SCHEMA_1_33['properties']['fields'] = {
+    "type": "string",
+}
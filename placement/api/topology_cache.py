@@ -0,0 +1,161 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""A per-process cache of the shape of the resource provider graph that the
+allocation candidate code needs on every request: whether any provider has a
+parent, which providers have the MISC_SHARES_VIA_AGGREGATE trait and which
+trees each of those shares its resources with.
+
+None of this depends on inventories or allocations, so it stays valid until a
+provider is created under a parent, deleted or reparented, or until traits or
+aggregate associations change. The placement objects flag such changes in
+the change log of nova.api.openstack.placement.change_log, which the cache
+reads once per request from the position its topology was loaded at. Changes
+of inventories and allocations only move that position forward.
+"""
+
+import collections
+
+from oslo_concurrency import lockutils
+import os_traits
+import six
+import sqlalchemy as sa
+
+from nova.api.openstack.placement import change_log
+from nova.api.openstack.placement import db_api
+from nova.db.sqlalchemy import api_models as models
+
+_RP_TBL = models.ResourceProvider.__table__
+_TRAIT_TBL = models.Trait.__table__
+_RP_TRAIT_TBL = models.ResourceProviderTrait.__table__
+_RP_AGG_TBL = models.ResourceProviderAggregate.__table__
+_LOCKNAME = 'topology_cache'
+
+SharingProvider = collections.namedtuple('SharingProvider', 'uuid anchors')
+
+# marker: change_log.Position the topology is up to date with
+# has_trees: whether any resource provider has a parent
+# sharing: dict, keyed by internal ID of the providers having the
+#          MISC_SHARES_VIA_AGGREGATE trait, of SharingProvider, whose anchors
+#          are a frozenset of (root provider ID, root provider UUID) of the
+#          trees sharing an aggregate with it.
+Topology = collections.namedtuple('Topology', 'marker has_trees sharing')
+
+
+def _shares_join():
+    """Returns the join of the provider traits and the traits tables limited
+    to the MISC_SHARES_VIA_AGGREGATE trait.
+    """
+    return sa.join(
+        _RP_TRAIT_TBL, _TRAIT_TBL,
+        sa.and_(
+            _RP_TRAIT_TBL.c.trait_id == _TRAIT_TBL.c.id,
+            # The traits table wants unicode trait names, but os_traits
+            # presents native str, so we need to cast.
+            _TRAIT_TBL.c.name == six.text_type(
+                os_traits.MISC_SHARES_VIA_AGGREGATE)))
+
+
+def _get_marker(ctx, previous=None):
+    """Returns a tuple of (the current change_log.Position, whether the
+    topology changed since the previous one was loaded).
+
+    :param previous: Topology to check, or None
+    """
+    since = previous.marker if previous is not None else None
+    position, changes = change_log.get_provider_changes(ctx, since)
+    changed = changes is None or any(
+        topology for _rp_id, topology in changes)
+    return position, changed
+
+
+def _load_topology(ctx, marker):
+    sel = sa.select([_RP_TBL.c.id])
+    sel = sel.where(_RP_TBL.c.parent_provider_id.isnot(None)).limit(1)
+    has_trees = ctx.session.execute(sel).fetchone() is not None
+
+    # SELECT sps.id, sps.uuid, shr_with_sps.root_provider_id, rps.uuid
+    # FROM resource_providers AS sps
+    # INNER JOIN resource_provider_traits AS rpt
+    #   ON sps.id = rpt.resource_provider_id
+    # INNER JOIN traits AS t
+    #   ON rpt.trait_id = t.id
+    #   AND t.name = "MISC_SHARES_VIA_AGGREGATE"
+    # LEFT JOIN resource_provider_aggregates AS shr_aggs
+    #   ON sps.id = shr_aggs.resource_provider_id
+    # LEFT JOIN resource_provider_aggregates AS shr_with_sps_aggs
+    #   ON shr_aggs.aggregate_id = shr_with_sps_aggs.aggregate_id
+    # LEFT JOIN resource_providers AS shr_with_sps
+    #   ON shr_with_sps_aggs.resource_provider_id = shr_with_sps.id
+    # LEFT JOIN resource_providers AS rps
+    #   ON shr_with_sps.root_provider_id = rps.id
+    sps = sa.alias(_RP_TBL, name='sps')
+    rps = sa.alias(_RP_TBL, name='rps')
+    shr_aggs = sa.alias(_RP_AGG_TBL, name='shr_aggs')
+    shr_with_sps_aggs = sa.alias(_RP_AGG_TBL, name='shr_with_sps_aggs')
+    shr_with_sps = sa.alias(_RP_TBL, name='shr_with_sps')
+    join_chain = sa.join(
+        sps, _shares_join(),
+        sps.c.id == _RP_TRAIT_TBL.c.resource_provider_id)
+    join_chain = sa.outerjoin(
+        join_chain, shr_aggs, sps.c.id == shr_aggs.c.resource_provider_id)
+    join_chain = sa.outerjoin(
+        join_chain, shr_with_sps_aggs,
+        shr_aggs.c.aggregate_id == shr_with_sps_aggs.c.aggregate_id)
+    join_chain = sa.outerjoin(
+        join_chain, shr_with_sps,
+        shr_with_sps_aggs.c.resource_provider_id == shr_with_sps.c.id)
+    join_chain = sa.outerjoin(
+        join_chain, rps, shr_with_sps.c.root_provider_id == rps.c.id)
+    sel = sa.select([
+        sps.c.id, sps.c.uuid,
+        shr_with_sps.c.root_provider_id,
+        rps.c.uuid,
+    ]).select_from(join_chain)
+
+    uuids = {}
+    anchors = collections.defaultdict(set)
+    for sp_id, sp_uuid, anchor_id, anchor_uuid in ctx.session.execute(sel):
+        uuids[sp_id] = sp_uuid
+        if anchor_id is not None:
+            anchors[sp_id].add((anchor_id, anchor_uuid))
+    sharing = {sp_id: SharingProvider(sp_uuid, frozenset(anchors[sp_id]))
+               for sp_id, sp_uuid in uuids.items()}
+    return Topology(marker, has_trees, sharing)
+
+
+class TopologyCache(object):
+    """Holds the current Topology for this process."""
+
+    def __init__(self):
+        self._topology = None
+
+    @db_api.placement_context_manager.reader.allow_async
+    def get(self, ctx):
+        """Returns a Topology that is current as of the caller's transaction.
+
+        :param ctx: `nova.context.RequestContext` from which we can grab a
+                    DB session.
+        """
+        topology = self._topology
+        marker, changed = _get_marker(ctx, topology)
+        if topology is not None and topology.marker == marker:
+            return topology
+        with lockutils.lock(_LOCKNAME):
+            if self._topology is not topology:
+                topology = self._topology
+                marker, changed = _get_marker(ctx, topology)
+            if changed:
+                topology = _load_topology(ctx, marker)
+            elif topology.marker != marker:
+                topology = topology._replace(marker=marker)
+            self._topology = topology
+        return topology
@@ -0,0 +1,160 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""A bitmask index of the traits of resource providers.
+
+Every trait known to a TraitIndex is given a bit position, and the traits of
+each resource provider are held as a single integer with the bits of its
+traits set. Checks of required and forbidden traits then become an AND and an
+AND NOT of two integers per provider, whatever the number of traits in the
+request:
+
+    has all required:    mask & required == required
+    has no forbidden:    not mask & forbidden
+
+Provider trees are handled by OR-ing the masks of the providers in the tree.
+
+Traits are identified by whatever hashable key the index is built with:
+internal trait IDs when the traits were read from the resource_provider_traits
+table, trait names when they were read through _get_traits_by_provider_tree().
+"""
+
+import collections
+
+
+class TraitIndex(object):
+    """The traits of a set of resource providers, as one bitmask each."""
+
+    def __init__(self, prov_traits, roots=None):
+        """
+        :param prov_traits: dict, keyed by resource provider internal ID, of
+                            iterables of the traits of that provider.
+        :param roots: optional dict, keyed by resource provider internal ID,
+                      of the internal ID of the root provider of its tree.
+                      Needed for the tree methods only.
+        """
+        self._bits = {}
+        self.masks = {}
+        for rp_id, traits in prov_traits.items():
+            mask = 0
+            for trait in traits:
+                bit = self._bits.get(trait)
+                if bit is None:
+                    bit = self._bits[trait] = 1 << len(self._bits)
+                mask |= bit
+            if mask:
+                self.masks[rp_id] = mask
+        self.roots = roots or {}
+
+    def __len__(self):
+        """Returns the number of distinct traits in the index."""
+        return len(self._bits)
+
+    def required_mask(self, traits):
+        """Returns the mask that a provider, or tree, must have all the bits
+        of to have all of the supplied traits, or None if no provider in the
+        index has one of them, in which case nothing can match.
+        """
+        mask = 0
+        for trait in traits:
+            bit = self._bits.get(trait)
+            if bit is None:
+                return None
+            mask |= bit
+        return mask
+
+    def forbidden_mask(self, traits):
+        """Returns the mask that a provider must have none of the bits of to
+        have none of the supplied traits. Traits that no provider in the index
+        has cannot be held by any provider and are ignored.
+        """
+        mask = 0
+        for trait in traits:
+            mask |= self._bits.get(trait, 0)
+        return mask
+
+    def provider_mask(self, rp_id):
+        return self.masks.get(rp_id, 0)
+
+    def traits_from_mask(self, mask):
+        """Returns a sorted list of the traits whose bits are set in the
+        supplied mask.
+        """
+        return sorted(trait for trait, bit in self._bits.items()
+                      if mask & bit)
+
+    @staticmethod
+    def matches(mask, required, forbidden):
+        """Returns whether a provider, or tree, with the supplied mask has all
+        of the required and none of the forbidden traits.
+        """
+        return mask & required == required and not mask & forbidden
+
+    def provider_ids_matching(self, required=(), forbidden=(), rp_ids=None):
+        """Returns a list, sorted by ID, of the IDs of the providers that have
+        all of the required traits and none of the forbidden ones.
+
+        :param required: iterable of the traits each provider must have.
+        :param forbidden: iterable of the traits no provider may have.
+        :param rp_ids: optional iterable of the provider IDs to consider. If
+                       not supplied, only providers with at least one trait
+                       in the index are considered.
+        """
+        req_mask = self.required_mask(required)
+        if req_mask is None:
+            return []
+        forbid_mask = self.forbidden_mask(forbidden)
+        if rp_ids is None:
+            rp_ids = self.masks
+        masks = self.masks
+        return sorted(rp_id for rp_id in rp_ids
+                      if self.matches(masks.get(rp_id, 0), req_mask,
+                                      forbid_mask))
+
+    def provider_ids_having_any(self, traits):
+        """Returns a list, sorted by ID, of the IDs of the providers that have
+        at least one of the supplied traits.
+        """
+        any_mask = self.forbidden_mask(traits)
+        if not any_mask:
+            return []
+        return sorted(rp_id for rp_id, mask in self.masks.items()
+                      if mask & any_mask)
+
+    def root_ids_matching(self, rp_ids, required=(), forbidden=()):
+        """Returns the set of IDs of the root providers of the trees whose
+        providers, taken from the supplied ones, collectively have all of the
+        required traits while each lacking all of the forbidden ones.
+
+        Providers with a forbidden trait do not count towards the traits of
+        their tree, but do not exclude it either. A tree is only returned if
+        at least one of its supplied providers has no forbidden trait.
+
+        :param rp_ids: iterable of the provider IDs to consider. Providers
+                       missing from the ``roots`` the index was built with
+                       are ignored.
+        :param required: iterable of the traits each tree must have.
+        :param forbidden: iterable of the traits no provider may have.
+        """
+        req_mask = self.required_mask(required)
+        if req_mask is None:
+            return set()
+        forbid_mask = self.forbidden_mask(forbidden)
+        tree_masks = collections.defaultdict(int)
+        masks = self.masks
+        for rp_id in rp_ids:
+            root_id = self.roots.get(rp_id)
+            mask = masks.get(rp_id, 0)
+            if root_id is None or mask & forbid_mask:
+                continue
+            tree_masks[root_id] |= mask
+        return set(root_id for root_id, mask in tree_masks.items()
+                   if mask & req_mask == req_mask)
@@ -12,6 +12,7 @@
 """Utility methods for placement API."""
 
 import functools
+import hashlib
 import re
 
 import jsonschema
@@ -19,8 +20,10 @@ from oslo_config import cfg
 from oslo_log import log as logging
 from oslo_middleware import request_id
 from oslo_serialization import jsonutils
+from oslo_utils import encodeutils
 from oslo_utils import timeutils
 from oslo_utils import uuidutils
+from six.moves.urllib import parse
 import webob
 
 from nova.api.openstack.placement import errors
@@ -41,6 +44,9 @@ LOG = logging.getLogger(__name__)
 ENV_ERROR_CODE = 'placement.error_code'
 ERROR_CODE_MICROVERSION = (1, 23)
 
+# Conditional request-related constants
+ETAG_MICROVERSION = (1, 30)
+
 # Querystring-related constants
 _QS_RESOURCES = 'resources'
 _QS_REQUIRED = 'required'
@@ -149,6 +155,64 @@ def json_error_formatter(body, status, title, environ):
     return {'errors': [error_dict]}
 
 
+def make_etag(want_version, *parts):
+    """Return a strong entity tag for a representation that is entirely
+    determined by the wanted microversion and the supplied values, or None
+    if the microversion does not support conditional requests.
+
+    The values are typically generations and internal IDs, which are hashed
+    so that they are not exposed.
+    """
+    if not want_version.matches(ETAG_MICROVERSION):
+        return None
+    data = ':'.join(str(part) for part in (want_version,) + parts)
+    return hashlib.sha256(encodeutils.to_utf8(data)).hexdigest()
+
+
+def check_if_none_match(req, etag):
+    """Return a 304 response if the If-None-Match header of the request
+    matches the supplied entity tag, otherwise None.
+
+    The caller is expected to return the response as is, before reading
+    anything else from the database.
+    """
+    if etag is None or etag not in req.if_none_match:
+        return None
+    response = req.response
+    response.status = 304
+    response.etag = etag
+    response.cache_control = 'no-cache'
+    response.content_type = None
+    return response
+
+
+def check_if_match(req, etag):
+    """Raise a 412 if the request has an If-Match header that does not match
+    the supplied entity tag of the current representation.
+
+    :raises: webob.exc.HTTPPreconditionFailed
+    """
+    if etag is not None and etag not in req.if_match:
+        raise webob.exc.HTTPPreconditionFailed(
+            _('The resource has changed since the entity tag in the If-Match '
+              'header was sent. Please get it again and retry.'),
+            comment=errors.PRECONDITION_FAILED)
+
+
+def next_page_url(req, marker):
+    """Produce the URL of the next page of a paginated list: the URL of the
+    request with its marker query parameter replaced by the supplied one.
+
+    If SCRIPT_NAME is present, it is the mount point of the placement
+    WSGI app.
+    """
+    params = [(key, value) for key, value in req.GET.items()
+              if key != 'marker']
+    params.append(('marker', marker))
+    prefix = req.environ.get('SCRIPT_NAME', '')
+    return '%s%s?%s' % (prefix, req.path_info, parse.urlencode(params))
+
+
 def pick_last_modified(last_modified, obj):
     """Choose max of last_modified and obj.updated_at or obj.created_at.
 
@@ -356,6 +420,28 @@ def normalize_traits_qs_param(val, allow_forbidden=False):
     return ret
 
 
+def normalize_fields_qs_param(val, allowed):
+    """Parse a fields query string parameter value.
+
+    :param val: A fields query parameter value: a comma-separated string of
+                field names.
+    :param allowed: A sequence of the names of the fields that can be
+                    selected.
+    :return: A list of the selected field names, in the order of allowed.
+    :raises `webob.exc.HTTPBadRequest` if the val parameter names a field
+            that is not allowed.
+    """
+    ret = set(substr.strip() for substr in val.split(','))
+    invalid = ret - set(allowed)
+    if invalid:
+        msg = _("Invalid query string parameters: Expected 'fields' "
+                "parameter value to be a comma-separated list of "
+                "%(allowed)s. Got: %(val)s") % {
+                    'allowed': ', '.join(allowed), 'val': val}
+        raise webob.exc.HTTPBadRequest(msg)
+    return [field for field in allowed if field in ret]
+
+
 def normalize_member_of_qs_params(req, suffix=''):
     """Given a webob.Request object, validate that the member_of querystring
     parameters are correct. We begin supporting multiple member_of params in
@@ -695,3 +781,102 @@ def ensure_consumer(ctx, consumer_uuid, project_id, user_id,
             # No worries, another thread created this user already
             consumer = consumer_obj.Consumer.get_by_uuid(ctx, consumer_uuid)
     return consumer, created_new_consumer
+
+
+def ensure_consumers(ctx, consumer_data, want_version):
+    """Batched version of ensure_consumer(), which ensures there are records
+    in the consumers, projects and users table for every consumer in the
+    supplied data using a constant number of queries.
+
+    Returns a dict, keyed by consumer UUID, of tuples containing the populated
+    Consumer object and a boolean indicating whether a new Consumer object was
+    created, as ensure_consumer() does.
+
+    Every consumer generation is checked before any consumer record is
+    created or modified, so a conflict leaves the consumers untouched. The
+    missing projects and users are created before the check and are kept, as
+    ensure_consumer() also does.
+
+    :param ctx: The request context.
+    :param consumer_data: A dict, keyed by consumer UUID, of dicts with
+        ``project_id``, ``user_id`` and optional ``consumer_generation``
+        keys, in the format of the POST /allocations request body.
+    :param want_version: the microversion matcher.
+    :raises webob.exc.HTTPConflict if consumer generation is required and there
+            was a mismatch
+    """
+    requires_consumer_generation = want_version.matches((1, 28))
+    owners = {}
+    for consumer_uuid, data in consumer_data.items():
+        project_id = data['project_id']
+        user_id = data['user_id']
+        if project_id is None:
+            project_id = CONF.placement.incomplete_consumer_project_id
+            user_id = CONF.placement.incomplete_consumer_user_id
+        owners[consumer_uuid] = (project_id, user_id)
+
+    projects = project_obj.Project.get_or_create_all(
+        ctx, set(project_id for project_id, _user_id in owners.values()))
+    users = user_obj.User.get_or_create_all(
+        ctx, set(user_id for _project_id, user_id in owners.values()))
+    existing = consumer_obj.Consumer.get_all_by_uuids(ctx, owners)
+
+    res = {}
+    to_update = []
+    to_create = []
+    for consumer_uuid, (project_id, user_id) in owners.items():
+        consumer_generation = consumer_data[consumer_uuid].get(
+            'consumer_generation')
+        proj = projects[project_id]
+        user = users[user_id]
+        consumer = existing.get(consumer_uuid)
+        if consumer is None:
+            if requires_consumer_generation:
+                if consumer_generation is not None:
+                    raise webob.exc.HTTPConflict(
+                        _('consumer generation conflict - '
+                          'expected null but got %s') % consumer_generation,
+                        comment=errors.CONCURRENT_UPDATE)
+            to_create.append(consumer_obj.Consumer(
+                ctx, uuid=consumer_uuid, project=proj, user=user))
+            continue
+        if requires_consumer_generation:
+            if consumer.generation != consumer_generation:
+                raise webob.exc.HTTPConflict(
+                    _('consumer generation conflict - '
+                      'expected %(expected_gen)s but got %(got_gen)s') %
+                      {
+                          'expected_gen': consumer.generation,
+                          'got_gen': consumer_generation,
+                      },
+                      comment=errors.CONCURRENT_UPDATE)
+        # As in ensure_consumer(), a different project or user is recorded
+        # without bumping the consumer generation.
+        if (project_id != consumer.project.external_id or
+                user_id != consumer.user.external_id):
+            LOG.debug("Supplied project or user ID for consumer %s was "
+                      "different than existing record. Updating consumer "
+                      "record.", consumer_uuid)
+            consumer.project = proj
+            consumer.user = user
+            to_update.append(consumer)
+        res[consumer_uuid] = (consumer, False)
+
+    for consumer in to_update:
+        consumer.update()
+    if to_create:
+        try:
+            consumer_obj.Consumer.create_all(ctx, to_create)
+            res.update((c.uuid, (c, True)) for c in to_create)
+        except exception.ConsumerExists:
+            # Another thread created some of them already, so create the rest
+            # one at a time
+            for consumer in to_create:
+                try:
+                    consumer.create()
+                    res[consumer.uuid] = (consumer, True)
+                except exception.ConsumerExists:
+                    consumer = consumer_obj.Consumer.get_by_uuid(
+                        ctx, consumer.uuid)
+                    res[consumer.uuid] = (consumer, False)
+    return res
@@ -0,0 +1,59 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Database migrations for the closure of the resource provider trees"""
+
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Index
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import select
+from sqlalchemy import Table
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    closure = Table('resource_provider_closure', meta,
+        Column('created_at', DateTime),
+        Column('updated_at', DateTime),
+        Column('ancestor_id', Integer, primary_key=True, nullable=False),
+        Column('descendant_id', Integer, primary_key=True, nullable=False),
+        Column('depth', Integer, nullable=False),
+        Index('resource_provider_closure_descendant_id_idx',
+              'descendant_id'),
+        mysql_engine='InnoDB',
+        mysql_charset='latin1'
+    )
+
+    if migrate_engine.has_table(closure.name):
+        return
+    closure.create()
+
+    # Seed the closure from the parents of the existing providers. Anything
+    # written while the migration runs can be fixed up with the closure
+    # repair routine.
+    providers = Table('resource_providers', meta, autoload=True)
+    sel = select([providers.c.id, providers.c.parent_provider_id])
+    parents = dict((r[0], r[1]) for r in migrate_engine.execute(sel))
+    rows = []
+    for rp_id in parents:
+        ancestor_id = rp_id
+        depth = 0
+        while ancestor_id is not None and depth <= len(parents):
+            rows.append({'ancestor_id': ancestor_id, 'descendant_id': rp_id,
+                         'depth': depth})
+            ancestor_id = parents.get(ancestor_id)
+            depth += 1
+    if rows:
+        migrate_engine.execute(closure.insert(), rows)
@@ -0,0 +1,51 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Database migrations for the change log of placement"""
+
+from sqlalchemy import Boolean
+from sqlalchemy import Column
+from sqlalchemy import DateTime
+from sqlalchemy import Integer
+from sqlalchemy import MetaData
+from sqlalchemy import String
+from sqlalchemy import Table
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    versions = Table('placement_versions', meta,
+        Column('created_at', DateTime),
+        Column('updated_at', DateTime),
+        Column('name', String(64), primary_key=True, nullable=False),
+        Column('version', Integer, nullable=False),
+        mysql_engine='InnoDB',
+        mysql_charset='latin1'
+    )
+
+    changes = Table('resource_provider_changes', meta,
+        Column('created_at', DateTime),
+        Column('updated_at', DateTime),
+        Column('id', Integer, primary_key=True, nullable=False,
+               autoincrement=True),
+        Column('resource_provider_id', Integer, nullable=False),
+        Column('topology', Boolean, nullable=False, default=False),
+        mysql_engine='InnoDB',
+        mysql_charset='latin1'
+    )
+
+    # The counters start at zero when their first change creates them and the
+    # readers load everything when they start, so there is nothing to seed.
+    for table in (versions, changes):
+        if not migrate_engine.has_table(table.name):
+            table.create()
@@ -0,0 +1,50 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Require the placement online data migrations to be complete"""
+
+from sqlalchemy import func
+from sqlalchemy import MetaData
+from sqlalchemy import select
+from sqlalchemy import Table
+
+from nova import exception
+from nova.i18n import _
+
+
+def upgrade(migrate_engine):
+    meta = MetaData()
+    meta.bind = migrate_engine
+
+    providers = Table('resource_providers', meta, autoload=True)
+    count = select([func.count()]).select_from(providers).where(
+        providers.c.root_provider_id.is_(None)).scalar()
+    if count:
+        msg = _('There are still %(count)i resource providers without a root '
+                'provider. Please run "python -m '
+                'nova.api.openstack.placement.manage db '
+                'online_data_migrations" before continuing.') % {
+                    'count': count}
+        raise exception.ValidationError(detail=msg)
+
+    allocations = Table('allocations', meta, autoload=True)
+    consumers = Table('consumers', meta, autoload=True)
+    alloc_to_consumer = allocations.outerjoin(
+        consumers, allocations.c.consumer_id == consumers.c.uuid)
+    count = select([func.count()]).select_from(alloc_to_consumer).where(
+        consumers.c.id.is_(None)).scalar()
+    if count:
+        msg = _('There are still %(count)i allocations without a consumer '
+                'record. Please run "python -m '
+                'nova.api.openstack.placement.manage db '
+                'online_data_migrations" before continuing.') % {
+                    'count': count}
+        raise exception.ValidationError(detail=msg)
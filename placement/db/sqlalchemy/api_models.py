@@ -375,6 +375,63 @@ class Allocation(API_BASE):
         foreign_keys=resource_provider_id)
 
 
+class ResourceProviderUsage(API_BASE):
+    """The summed amount of allocations of a resource class against a
+    resource provider, maintained whenever allocations are written.
+    """
+
+    __tablename__ = "resource_provider_usages"
+    __table_args__ = (
+        Index('resource_provider_usages_resource_class_id_idx',
+              'resource_class_id'),
+    )
+
+    resource_provider_id = Column(Integer, primary_key=True, nullable=False)
+    resource_class_id = Column(Integer, primary_key=True, nullable=False)
+    used = Column(Integer, nullable=False)
+
+
+class ResourceProviderClosure(API_BASE):
+    """The transitive closure of the resource provider trees. There is a
+    record for every provider and each of its ancestors, including itself at
+    a depth of 0, maintained whenever providers are created, parented or
+    deleted.
+    """
+
+    __tablename__ = "resource_provider_closure"
+    __table_args__ = (
+        Index('resource_provider_closure_descendant_id_idx',
+              'descendant_id'),
+    )
+
+    ancestor_id = Column(Integer, primary_key=True, nullable=False)
+    descendant_id = Column(Integer, primary_key=True, nullable=False)
+    depth = Column(Integer, nullable=False)
+
+
+class PlacementVersion(API_BASE):
+    """A counter of the changes made to one kind of placement data,
+    incremented in the same transaction as each change.
+    """
+
+    __tablename__ = "placement_versions"
+
+    name = Column(String(64), primary_key=True, nullable=False)
+    version = Column(Integer, nullable=False)
+
+
+class ResourceProviderChange(API_BASE):
+    """Records that the data of a resource provider was changed, in the order
+    of the IDs.
+    """
+
+    __tablename__ = "resource_provider_changes"
+
+    id = Column(Integer, primary_key=True, nullable=False, autoincrement=True)
+    resource_provider_id = Column(Integer, nullable=False)
+    topology = Column(Boolean, nullable=False, default=False)
+
+
 class ResourceProviderAggregate(API_BASE):
     """Associate a resource provider with an aggregate."""
 
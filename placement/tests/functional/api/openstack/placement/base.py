@@ -67,3 +67,7 @@ class TestCase(testtools.TestCase):
         """Reset database sync flags to base state."""
         resource_provider._TRAITS_SYNCED = False
         resource_provider._RC_CACHE = None
+        resource_provider._SNAPSHOT_CACHE = None
+        resource_provider._TRAIT_CACHE = None
+        resource_provider._AGG_CACHE = None
+        resource_provider._TOPOLOGY_CACHE = None
@@ -9,13 +9,16 @@
 #    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
 #    License for the specific language governing permissions and limitations
 #    under the License.
+import fixtures
 import os_traits
 from oslo_config import cfg
 import six
 import sqlalchemy as sa
 
+from nova.api.openstack.placement import db_api
 from nova.api.openstack.placement import exception
 from nova.api.openstack.placement import lib as placement_lib
+from nova.api.openstack.placement import provider_snapshot
 from nova.api.openstack.placement.objects import resource_provider as rp_obj
 from nova import rc_fields as fields
 from nova.tests.functional.api.openstack.placement.db import test_base as tb
@@ -280,6 +283,64 @@ class ProviderDBHelperTestCase(tb.PlacementDbBaseTestCase):
         rp_obj.Trait(self.ctx, name='CUSTOM_BAR').create()
         run(['CUSTOM_BAR'], [])
 
+    def test_trait_conds(self):
+        cn1 = self._create_provider('cn1')
+        tb.set_traits(cn1, 'HW_CPU_X86_TBM')
+        cn2 = self._create_provider('cn2')
+        tb.set_traits(cn2, 'HW_CPU_X86_TBM', 'HW_CPU_X86_SGX')
+        cn3 = self._create_provider('cn3')
+        tb.set_traits(cn3, 'HW_CPU_X86_SGX')
+        cn4 = self._create_provider('cn4')
+        tmap = rp_obj._trait_ids_from_names(
+            self.ctx, ['HW_CPU_X86_TBM', 'HW_CPU_X86_SGX'])
+        tbm = {'HW_CPU_X86_TBM': tmap['HW_CPU_X86_TBM']}
+        sgx = {'HW_CPU_X86_SGX': tmap['HW_CPU_X86_SGX']}
+
+        def run(required, forbidden):
+            rpt = sa.alias(rp_obj._RP_TBL, name="rp")
+            sel = sa.select([rpt.c.id]).where(sa.and_(
+                *rp_obj._trait_conds(rpt.c.id, required, forbidden)))
+            with db_api.placement_context_manager.reader.using(self.ctx):
+                return sorted(r[0] for r in self.ctx.session.execute(sel))
+
+        self.assertEqual([], rp_obj._trait_conds(None, {}, {}))
+        self.assertEqual([cn1.id, cn2.id], run(tbm, {}))
+        self.assertEqual([cn2.id], run(tmap, {}))
+        self.assertEqual([cn1.id], run(tbm, sgx))
+        self.assertEqual([cn1.id, cn4.id], run({}, sgx))
+        self.assertEqual([], run(tmap, sgx))
+
+    def test_alloc_candidates_single_provider_sharing_anchors(self):
+        """The anchors of all the sharing providers are looked up at once."""
+        cn1 = self._create_provider('cn1', uuids.agg1)
+        ss1 = self._create_provider('ss1', uuids.agg1)
+        ss2 = self._create_provider('ss2', uuids.agg1)
+        for ss in (ss1, ss2):
+            tb.add_inventory(ss, fields.ResourceClass.DISK_GB, 2000)
+            tb.set_traits(ss, os_traits.MISC_SHARES_VIA_AGGREGATE)
+        anchors = self.useFixture(fixtures.MockPatchObject(
+            rp_obj, '_anchors_for_sharing_providers',
+            wraps=rp_obj._anchors_for_sharing_providers)).mock
+
+        disk_id = fields.ResourceClass.STANDARD.index(
+            fields.ResourceClass.DISK_GB)
+        with db_api.placement_context_manager.reader.using(self.ctx):
+            alloc_reqs, summaries = rp_obj._alloc_candidates_single_provider(
+                self.ctx, {disk_id: 100},
+                [(ss1.id, ss1.id), (ss2.id, ss2.id)])
+
+        self.assertEqual(1, anchors.call_count)
+        self.assertEqual(2, len(summaries))
+        # Each sharing provider is anchored in its own tree and in those of
+        # the other members of agg1.
+        observed = sorted(
+            (areq.resource_requests[0].resource_provider.uuid,
+             areq.anchor_root_provider_uuid) for areq in alloc_reqs)
+        expected = sorted(
+            (ss.uuid, anchor.uuid) for ss in (ss1, ss2)
+            for anchor in (cn1, ss1, ss2))
+        self.assertEqual(expected, observed)
+
 
 class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
     """Tests a variety of scenarios with both shared and non-shared resource
@@ -2285,7 +2346,7 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
         # NOTE(tetsuro): Actually we also get providers without traits here.
         # This is reported as bug#1771707 and from users' view the bug is now
         # fixed out of this _get_trees_matching_all() function by checking
-        # traits later again in _check_traits_for_alloc_request().
+        # traits later again in _alloc_candidates_multiple_providers().
         # But ideally, we'd like to have only pf1 from cn3 here using SQL
         # query in _get_trees_matching_all() function for optimization.
         # provider_names = cn_names + ['cn3_numa1_pf1']
@@ -2329,7 +2390,7 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
         # NOTE(tetsuro): Actually we also get providers without traits here.
         # This is reported as bug#1771707 and from users' view the bug is now
         # fixed out of this _get_trees_matching_all() function by checking
-        # traits later again in _check_traits_for_alloc_request().
+        # traits later again in _alloc_candidates_multiple_providers().
         # But ideally, we'd like to have only pf1 from cn3 here using SQL
         # query in _get_trees_matching_all() function for optimization.
         # provider_names = cn_names + ['cn3_numa1_pf1']
@@ -2691,3 +2752,27 @@ class AllocationCandidatesTestCase(tb.PlacementDbBaseTestCase):
         provider_names = ['cn1']
         expect_root_ids = self._get_rp_ids_matching_names(provider_names)
         self.assertEqual(expect_root_ids, tree_root_ids)
+
+
+class AllocationCandidatesMemoryEngineTestCase(AllocationCandidatesTestCase):
+    """Runs every AllocationCandidatesTestCase scenario against the in-memory
+    provider snapshot engine, which must return the same results as the SQL
+    engine.
+    """
+
+    def setUp(self):
+        super(AllocationCandidatesMemoryEngineTestCase, self).setUp()
+        CONF.set_override('allocation_candidates_engine', 'memory',
+                          group='placement')
+
+
+class AllocationCandidatesMemoryEngineNoNumpyTestCase(
+        AllocationCandidatesMemoryEngineTestCase):
+    """Runs the in-memory engine scenarios without numpy, so that capacity
+    is checked one provider at a time instead of by the _CapacityIndex.
+    """
+
+    def setUp(self):
+        super(AllocationCandidatesMemoryEngineNoNumpyTestCase, self).setUp()
+        self.useFixture(
+            fixtures.MockPatchObject(provider_snapshot, 'np', None))
@@ -0,0 +1,117 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import time
+
+import fixtures
+import sqlalchemy as sa
+
+from nova.api.openstack.placement import change_log
+from nova.api.openstack.placement import db_api
+from nova import rc_fields as fields
+from nova.tests.functional.api.openstack.placement.db import test_base as tb
+from nova.tests import uuidsentinel as uuids
+
+
+class ChangeLogTestCase(tb.PlacementDbBaseTestCase):
+
+    def _changes(self, since=None):
+        with db_api.placement_context_manager.reader.using(self.ctx):
+            return change_log.get_provider_changes(self.ctx, since)
+
+    def _record(self, rp_ids):
+        with db_api.placement_context_manager.writer.using(self.ctx):
+            change_log.record_provider_changes(self.ctx, rp_ids)
+
+    def test_bump(self):
+        with db_api.placement_context_manager.writer.using(self.ctx):
+            self.assertEqual(1, change_log.bump(self.ctx, 'foo'))
+            self.assertEqual(2, change_log.bump(self.ctx, 'foo'))
+        with db_api.placement_context_manager.reader.using(self.ctx):
+            self.assertEqual((2, 0), change_log.get_versions(
+                self.ctx, ['foo', 'bar']))
+
+    def test_provider_changes(self):
+        position, changes = self._changes()
+        self.assertEqual(change_log.Position(0, ()), position)
+        self.assertIsNone(changes)
+        cn1 = self._create_provider('cn1')
+        cn2 = self._create_provider('cn2')
+        self.assertEqual(
+            [(cn1.id, False), (cn2.id, False)],
+            sorted(self._changes(position)[1]))
+
+        position = self._changes(position)[0]
+        tb.add_inventory(cn2, fields.ResourceClass.VCPU, 8)
+        self.allocate_from_provider(cn2, fields.ResourceClass.VCPU, 2)
+        new_position, changes = self._changes(position)
+        self.assertEqual(set([(cn2.id, False)]), set(changes))
+        self.assertEqual((), new_position.missing)
+        self.assertEqual((new_position, []), self._changes(new_position))
+
+        cn1.set_aggregates([uuids.agg1])
+        self.assertIn((cn1.id, True), self._changes(new_position)[1])
+        # A recreated database starts over
+        ahead = change_log.Position(new_position.last + 100, ())
+        self.assertIsNone(self._changes(ahead)[1])
+        # Unless the IDs only went back because the replica lags behind
+        self.useFixture(fixtures.MockPatchObject(
+            db_api, 'reading_replica', return_value=True))
+        self.assertEqual((ahead, []), self._changes(ahead))
+
+    def _commit(self, change_id):
+        with self.placement_db.get_engine().connect() as conn:
+            conn.execute(change_log._CHANGE_TBL.insert().values(
+                id=change_id, resource_provider_id=change_id,
+                topology=False))
+
+    def test_uncommitted_changes(self):
+        """Changes committed after those of higher IDs are still found."""
+        self._commit(1)
+        # The transaction that inserted the second change commits after the
+        # one that inserted the third
+        self._commit(3)
+        position, changes = self._changes(change_log.Position(1, ()))
+        self.assertEqual([(3, False)], changes)
+        self.assertEqual(3, position.last)
+        self.assertEqual([2], [change_id for change_id, _noticed
+                               in position.missing])
+        self.assertEqual((position, []), self._changes(position))
+
+        self._commit(2)
+        position, changes = self._changes(position)
+        self.assertEqual([(2, False)], changes)
+        self.assertEqual(change_log.Position(3, ()), position)
+
+    def test_rolled_back_changes_time_out(self):
+        self._commit(1)
+        position = change_log.Position(1, ((2, time.time()), ))
+        self.assertEqual((position, []), self._changes(position))
+        self.useFixture(fixtures.MockPatchObject(
+            change_log, '_GAP_TIMEOUT', 0))
+        self.assertEqual((change_log.Position(1, ()), []),
+                         self._changes(position))
+
+    def test_pruned_changes(self):
+        self.useFixture(fixtures.MockPatchObject(
+            change_log, '_PRUNE_INTERVAL', 2))
+        self.useFixture(fixtures.MockPatchObject(
+            change_log, '_KEEP_CHANGES', 2))
+        for rp_id in range(1, 5):
+            self._record([rp_id])
+        start = change_log.Position(0, ())
+        self.assertIsNone(self._changes(start)[1])
+        self.assertEqual([(3, False), (4, False)],
+                         sorted(self._changes(change_log.Position(2, ()))[1]))
+        with self.placement_db.get_engine().connect() as conn:
+            sel = sa.select([change_log._CHANGE_TBL.c.id])
+            self.assertEqual([3, 4], sorted(r[0] for r in conn.execute(sel)))
@@ -82,6 +82,39 @@ class ConsumerTestCase(tb.PlacementDbBaseTestCase):
         self.assertEqual(another_proj.id, c.project.id)
         self.assertEqual(another_user.id, c.user.id)
 
+    def test_create_all_and_get_all(self):
+        consumers = [
+            consumer_obj.Consumer(
+                self.ctx, uuid=uuid, user=self.user_obj,
+                project=self.project_obj)
+            for uuid in (uuids.consumer1, uuids.consumer2)]
+        consumer_obj.Consumer.create_all(self.ctx, consumers)
+        for c in consumers:
+            self.assertIsNotNone(c.id)
+            self.assertEqual(0, c.generation)
+
+        res = consumer_obj.Consumer.get_all_by_uuids(
+            self.ctx, [uuids.consumer1, uuids.consumer2, uuids.missing])
+        self.assertEqual(set([uuids.consumer1, uuids.consumer2]), set(res))
+        self.assertEqual(consumers[0].id, res[uuids.consumer1].id)
+        self.assertEqual(self.project_obj.external_id,
+                         res[uuids.consumer1].project.external_id)
+        self.assertEqual(self.user_obj.external_id,
+                         res[uuids.consumer2].user.external_id)
+
+        # Creating an existing consumer fails and creates nothing
+        consumers = [
+            consumer_obj.Consumer(
+                self.ctx, uuid=uuid, user=self.user_obj,
+                project=self.project_obj)
+            for uuid in (uuids.consumer3, uuids.consumer1)]
+        self.assertRaises(exception.ConsumerExists,
+                          consumer_obj.Consumer.create_all,
+                          self.ctx, consumers)
+        self.assertRaises(exception.ConsumerNotFound,
+                          consumer_obj.Consumer.get_by_uuid,
+                          self.ctx, uuids.consumer3)
+
 
 @db_api.placement_context_manager.reader
 def _get_allocs_with_no_consumer_relationship(ctx):
@@ -171,47 +204,29 @@ class CreateIncompleteConsumersTestCase(base.TestCase):
         records along with the incomplete consumer project/user records.
         """
         self._create_incomplete_allocations(self.ctx)
-        # We do a "really online" online data migration for incomplete
-        # consumers when calling AllocationList.get_all_by_consumer_id() and
-        # AllocationList.get_all_by_resource_provider() and there are still
-        # incomplete consumer records. So, to simulate a situation where the
-        # operator has yet to run the nova-manage online_data_migration CLI
-        # tool completely, we first call
-        # consumer_obj.create_incomplete_consumers() with a batch size of 1.
-        # This should mean there will be two allocation records still remaining
-        # with a missing consumer record (since we create 3 total to begin
-        # with). We then query the allocations table directly to grab that
-        # consumer UUID in the allocations table that doesn't refer to a
-        # consumer table record and call
-        # AllocationList.get_all_by_consumer_id() with that consumer UUID. This
-        # should create the remaining missing consumer record "inline" in the
-        # AllocationList.get_all_by_consumer_id() method.
-        # After that happens, there should still be a single allocation record
-        # that is missing a relation to the consumers table. We call the
-        # AllocationList.get_all_by_resource_provider() method and verify that
-        # method cleans up the remaining incomplete consumers relationship.
-        res = consumer_obj.create_incomplete_consumers(self.ctx, 1)
-        self.assertEqual((1, 1), res)
-
-        # Grab the consumer UUID for the allocation record with a
-        # still-incomplete consumer record.
+        # Reading the allocations does not create the missing consumer
+        # records, only the online data migration does.
         res = _get_allocs_with_no_consumer_relationship(self.ctx)
-        self.assertEqual(2, len(res))
         still_missing = res[0][0]
-        rp_obj.AllocationList.get_all_by_consumer_id(self.ctx, still_missing)
+        allocs = rp_obj.AllocationList.get_all_by_consumer_id(
+            self.ctx, still_missing)
+        self.assertEqual(0, len(allocs))
+        rp1 = rp_obj.ResourceProvider(self.ctx, id=1)
+        allocs = rp_obj.AllocationList.get_all_by_resource_provider(
+            self.ctx, rp1)
+        self.assertEqual(0, len(allocs))
+        res = _get_allocs_with_no_consumer_relationship(self.ctx)
+        self.assertEqual(3, len(res))
 
-        # There should still be a single missing consumer relationship. Let's
-        # grab that and call AllocationList.get_all_by_resource_provider()
-        # which should clean that last one up for us.
+        # The migration works in batches, there are three allocation records
+        # with a missing consumer record to begin with.
+        res = consumer_obj.create_incomplete_consumers(self.ctx, 2)
+        self.assertEqual((2, 2), res)
         res = _get_allocs_with_no_consumer_relationship(self.ctx)
         self.assertEqual(1, len(res))
-        still_missing = res[0][0]
-        rp1 = rp_obj.ResourceProvider(self.ctx, id=1)
-        rp_obj.AllocationList.get_all_by_resource_provider(self.ctx, rp1)
+        res = consumer_obj.create_incomplete_consumers(self.ctx, 2)
+        self.assertEqual((1, 1), res)
 
-        # get_all_by_resource_provider() should have auto-completed the still
-        # missing consumer record and _check_incomplete_consumers() should
-        # assert correctly that there are no more incomplete consumer records.
         self._check_incomplete_consumers(self.ctx)
         res = consumer_obj.create_incomplete_consumers(self.ctx, 10)
         self.assertEqual((0, 0), res)
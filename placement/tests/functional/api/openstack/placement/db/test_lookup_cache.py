@@ -0,0 +1,194 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+
+from nova.api.openstack.placement import change_log
+from nova.api.openstack.placement import lookup_cache
+from nova.api.openstack.placement.objects import resource_provider as rp_obj
+from nova.tests.functional.api.openstack.placement import base
+from nova.tests import uuidsentinel as uuids
+
+
+class TestLookupCache(base.TestCase):
+
+    def setUp(self):
+        super(TestLookupCache, self).setUp()
+        db = self.placement_db
+        self.context = mock.Mock()
+        sess_mock = mock.Mock()
+        sess_mock.connection.side_effect = db.get_engine().connect
+        self.context.session = sess_mock
+        self.trait_tbl = lookup_cache.TraitCache._TABLE
+        self.agg_tbl = lookup_cache.AggregateCache._TABLE
+
+    def _add_trait(self, _id, name):
+        with self.context.session.connection() as conn:
+            conn.execute(self.trait_tbl.insert().values(id=_id, name=name))
+
+    def test_trait_cache(self):
+        """Test that traits are looked up in the database once and served
+        from the cache afterwards, and that unknown traits are left out.
+        """
+        cache = lookup_cache.TraitCache(self.context)
+        self._add_trait(10001, 'CUSTOM_GOLD')
+        self.assertEqual({'CUSTOM_GOLD': 10001},
+                         cache.ids_from_keys(['CUSTOM_GOLD', 'CUSTOM_NOPE']))
+
+        with mock.patch('sqlalchemy.select') as sel_mock:
+            self.assertEqual({'CUSTOM_GOLD': 10001},
+                             cache.ids_from_keys(['CUSTOM_GOLD']))
+            self.assertFalse(sel_mock.called)
+
+        self.assertEqual(
+            {'hits': 1, 'misses': 2, 'refreshes': 0, 'reloads': 1},
+            cache.stats())
+
+    def test_trait_cache_miss_does_not_reload(self):
+        """Test that looking up a trait that doesn't exist only reads the
+        table if it changed, and then only the rows that were added.
+        """
+        cache = lookup_cache.TraitCache(self.context)
+        self._add_trait(10001, 'CUSTOM_GOLD')
+        self.assertEqual({'CUSTOM_GOLD': 10001},
+                         cache.ids_from_keys(['CUSTOM_GOLD']))
+
+        with mock.patch.object(cache, '_select_rows',
+                               side_effect=cache._select_rows) as sel:
+            for _i in range(3):
+                self.assertEqual({}, cache.ids_from_keys(['CUSTOM_SILVER']))
+            self.assertFalse(sel.called)
+
+            # A trait created elsewhere, for example by another API worker,
+            # is found by the next lookup.
+            self._add_trait(10002, 'CUSTOM_SILVER')
+            self.assertEqual({'CUSTOM_SILVER': 10002},
+                             cache.ids_from_keys(['CUSTOM_SILVER']))
+            sel.assert_called_once_with(10001)
+        self.assertEqual(1, cache.stats()['refreshes'])
+
+    def test_trait_cache_clear(self):
+        cache = lookup_cache.TraitCache(self.context)
+        self._add_trait(10001, 'CUSTOM_GOLD')
+        self.assertEqual({'CUSTOM_GOLD': 10001},
+                         cache.ids_from_keys(['CUSTOM_GOLD']))
+        with self.context.session.connection() as conn:
+            conn.execute(self.trait_tbl.delete().where(
+                self.trait_tbl.c.id == 10001))
+        # Hits are served from the snapshot until it is cleared
+        self.assertEqual({'CUSTOM_GOLD': 10001},
+                         cache.ids_from_keys(['CUSTOM_GOLD']))
+        cache.clear()
+        self.assertEqual({}, cache.ids_from_keys(['CUSTOM_GOLD']))
+
+    def test_trait_cache_expire(self):
+        """Test that a trait deleted elsewhere, for example by another API
+        worker, is only served from the snapshot until it is expired with the
+        new version of the change counter.
+        """
+        cache = lookup_cache.TraitCache(self.context)
+        self._add_trait(10001, 'CUSTOM_GOLD')
+        self.assertEqual({'CUSTOM_GOLD': 10001},
+                         cache.ids_from_keys(['CUSTOM_GOLD']))
+        cache.expire(0)
+        self.assertEqual({'CUSTOM_GOLD': 10001},
+                         cache.ids_from_keys(['CUSTOM_GOLD']))
+        self.assertEqual(1, cache.stats()['hits'])
+
+        tbl = change_log._VERSION_TBL
+        with self.context.session.connection() as conn:
+            conn.execute(self.trait_tbl.delete().where(
+                self.trait_tbl.c.id == 10001))
+            conn.execute(tbl.insert().values(
+                name=change_log.TRAIT_DELETIONS, version=1))
+        self.assertEqual({'CUSTOM_GOLD': 10001},
+                         cache.ids_from_keys(['CUSTOM_GOLD']))
+        cache.expire(1)
+        self.assertEqual({}, cache.ids_from_keys(['CUSTOM_GOLD']))
+
+    def test_aggregate_cache_expire(self):
+        """Test that the aggregate cache, whose rows are never deleted, is
+        never expired.
+        """
+        cache = lookup_cache.AggregateCache(self.context)
+        with self.context.session.connection() as conn:
+            conn.execute(self.agg_tbl.insert().values(
+                id=1, uuid=uuids.agg1))
+        self.assertEqual({uuids.agg1: 1},
+                         cache.ids_from_keys([uuids.agg1]))
+        cache.expire(1)
+        self.assertEqual({uuids.agg1: 1},
+                         cache.ids_from_keys([uuids.agg1]))
+        self.assertEqual(1, cache.stats()['hits'])
+
+    def test_aggregate_cache(self):
+        cache = lookup_cache.AggregateCache(self.context)
+        self.assertEqual({}, cache.ids_from_keys([uuids.agg1]))
+        with self.context.session.connection() as conn:
+            conn.execute(self.agg_tbl.insert().values(
+                id=1, uuid=uuids.agg1))
+        self.assertEqual({uuids.agg1: 1},
+                         cache.ids_from_keys([uuids.agg1, uuids.agg2]))
+
+
+class TestLookupCacheInvalidation(base.TestCase):
+
+    def test_trait_destroy_clears_cache(self):
+        """Test that a trait deleted through the Trait object is no longer
+        served from the trait cache of this process.
+        """
+        trait = rp_obj.Trait(self.context, name='CUSTOM_GOLD')
+        trait.create()
+        self.assertEqual({'CUSTOM_GOLD': trait.id},
+                         rp_obj._trait_ids_from_names(
+                             self.context, ['CUSTOM_GOLD']))
+        trait.destroy()
+        self.assertEqual({}, rp_obj._trait_ids_from_names(
+            self.context, ['CUSTOM_GOLD']))
+
+    def test_trait_destroyed_by_other_process(self):
+        """Test that a trait deleted by another API worker is no longer served
+        from the trait cache of this process once a request validates the
+        caches.
+        """
+        trait = rp_obj.Trait(self.context, name='CUSTOM_GOLD')
+        trait.create()
+        self.assertEqual({'CUSTOM_GOLD': trait.id},
+                         rp_obj._trait_ids_from_names(
+                             self.context, ['CUSTOM_GOLD']))
+        # Deleting the record does not clear the cache of this process
+        rp_obj.Trait._destroy_in_db(self.context, trait.id, trait.name)
+        self.assertEqual({'CUSTOM_GOLD': trait.id},
+                         rp_obj._trait_ids_from_names(
+                             self.context, ['CUSTOM_GOLD']))
+        rp_obj.validate_caches(self.context)
+        self.assertEqual({}, rp_obj._trait_ids_from_names(
+            self.context, ['CUSTOM_GOLD']))
+
+    def test_set_aggregates_new_aggregate(self):
+        """Test that an aggregate created by associating it with a provider
+        is found by member_of once the cache has been filled.
+        """
+        rp = rp_obj.ResourceProvider(
+            self.context, name='rp', uuid=uuids.rp)
+        rp.create()
+        rp.set_aggregates([uuids.agg1])
+
+        def _get_uuids(member_of):
+            rps = rp_obj.ResourceProviderList.get_all_by_filters(
+                self.context, {'member_of': member_of})
+            return [r.uuid for r in rps]
+
+        self.assertEqual([uuids.rp], _get_uuids([[uuids.agg1]]))
+        self.assertEqual([], _get_uuids([[uuids.agg2]]))
+        rp.set_aggregates([uuids.agg1, uuids.agg2])
+        self.assertEqual([uuids.rp], _get_uuids([[uuids.agg1], [uuids.agg2]]))
@@ -10,6 +10,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import mock
+
 from nova.api.openstack.placement import exception
 from nova.api.openstack.placement.objects import project as project_obj
 from nova.tests.functional.api.openstack.placement.db import test_base as tb
@@ -29,3 +31,34 @@ class ProjectTestCase(tb.PlacementDbBaseTestCase):
         # Project ID == 1 is fake-project created in setup
         self.assertEqual(2, p.id)
         self.assertRaises(exception.ProjectExists, p.create)
+
+    def test_get_or_create_all(self):
+        res = project_obj.Project.get_or_create_all(
+            self.ctx, ['fake-project', 'new-project-1', 'new-project-2'])
+        self.assertEqual(
+            set(['fake-project', 'new-project-1', 'new-project-2']), set(res))
+        # The existing project is returned, not created again
+        self.assertEqual(self.project_obj.id, res['fake-project'].id)
+        for external_id in ('new-project-1', 'new-project-2'):
+            self.assertEqual(
+                res[external_id].id,
+                project_obj.Project.get_by_external_id(
+                    self.ctx, external_id).id)
+
+    def test_get_or_create_all_concurrent_create(self):
+        # Simulate another thread creating one of the projects between the
+        # lookup and the bulk insert
+        orig_get = project_obj._get_projects_by_external_ids
+
+        def fake_get(ctx, external_ids):
+            res = orig_get(ctx, external_ids)
+            if 'racing-project' not in res:
+                project_obj.Project(ctx, external_id='racing-project').create()
+            return res
+
+        with mock.patch.object(project_obj, '_get_projects_by_external_ids',
+                               side_effect=fake_get):
+            res = project_obj.Project.get_or_create_all(
+                self.ctx, ['racing-project', 'new-project'])
+        self.assertEqual(set(['racing-project', 'new-project']), set(res))
+        self.assertIsNotNone(res['new-project'].id)
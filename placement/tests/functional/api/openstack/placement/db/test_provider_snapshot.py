@@ -0,0 +1,322 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import fixtures
+import mock
+import os_traits
+
+from nova.api.openstack.placement import change_log
+from nova.api.openstack.placement import db_api
+from nova.api.openstack.placement import provider_snapshot
+from nova.api.openstack.placement.objects import resource_provider as rp_obj
+from nova import rc_fields as fields
+from nova.tests.functional.api.openstack.placement.db import test_base as tb
+from nova.tests import uuidsentinel as uuids
+
+
+VCPU_ID = fields.ResourceClass.STANDARD.index(fields.ResourceClass.VCPU)
+DISK_ID = fields.ResourceClass.STANDARD.index(fields.ResourceClass.DISK_GB)
+MEMORY_ID = fields.ResourceClass.STANDARD.index(
+    fields.ResourceClass.MEMORY_MB)
+
+
+class ProviderSnapshotTestCase(tb.PlacementDbBaseTestCase):
+    """Tests that the in-memory provider snapshot notices every kind of change
+    made to the database, including those that do not increment a provider
+    generation.
+    """
+
+    def setUp(self):
+        super(ProviderSnapshotTestCase, self).setUp()
+        self.cache = provider_snapshot.ProviderSnapshotCache()
+
+    def _used(self, rp, rc_id):
+        snap = self.cache.get(self.ctx)
+        return snap.usages.get(rp.id, {}).get(rc_id)
+
+    def test_unchanged_snapshot_is_reused(self):
+        cn = self._create_provider('cn')
+        tb.add_inventory(cn, fields.ResourceClass.VCPU, 8)
+        snap = self.cache.get(self.ctx)
+        self.assertIs(snap, self.cache.get(self.ctx))
+
+        tb.add_inventory(cn, fields.ResourceClass.DISK_GB, 100)
+        new_snap = self.cache.get(self.ctx)
+        self.assertIsNot(snap, new_snap)
+        self.assertEqual(set([VCPU_ID, DISK_ID]),
+                         set(new_snap.inventories[cn.id]))
+
+    def test_allocation_changes(self):
+        cn1 = self._create_provider('cn1')
+        cn2 = self._create_provider('cn2')
+        for cn in (cn1, cn2):
+            tb.add_inventory(cn, fields.ResourceClass.VCPU, 8)
+        self.assertIsNone(self._used(cn1, VCPU_ID))
+
+        consumer = tb.ensure_consumer(
+            self.ctx, self.user_obj, self.project_obj, uuids.instance)
+        self.allocate_from_provider(cn1, fields.ResourceClass.VCPU, 2,
+                                    consumer=consumer)
+        self.assertEqual(2, self._used(cn1, VCPU_ID))
+
+        # Moving the consumer to cn2 deletes the allocation against cn1
+        # without changing the generation of cn1.
+        self.allocate_from_provider(cn2, fields.ResourceClass.VCPU, 3,
+                                    consumer=consumer)
+        self.assertIsNone(self._used(cn1, VCPU_ID))
+        self.assertEqual(3, self._used(cn2, VCPU_ID))
+
+        # Deleting the allocations does not change any generation either.
+        allocs = rp_obj.AllocationList.get_all_by_consumer_id(
+            self.ctx, uuids.instance)
+        allocs.delete_all()
+        self.assertIsNone(self._used(cn2, VCPU_ID))
+
+    def test_aggregate_changes_without_generation(self):
+        cn = self._create_provider('cn')
+        self.assertEqual(
+            [], self.cache.get(self.ctx).provider_ids_matching_aggregates(
+                [[uuids.agg1]]))
+        # The pre-1.19 aggregates API does not touch the generation.
+        rp_obj._set_aggregates(self.ctx, cn, [uuids.agg1])
+        self.assertEqual(
+            [cn.id],
+            self.cache.get(self.ctx).provider_ids_matching_aggregates(
+                [[uuids.agg1]]))
+
+    def test_tree_changes(self):
+        cn = self._create_provider('cn')
+        child = self._create_provider('child')
+        snap = self.cache.get(self.ctx)
+        self.assertFalse(snap.has_provider_trees())
+
+        child.parent_provider_uuid = cn.uuid
+        child.save()
+        snap = self.cache.get(self.ctx)
+        self.assertTrue(snap.has_provider_trees())
+        ids = snap.provider_ids_from_rp_ids([child.id])[child.id]
+        self.assertEqual(
+            (child.id, child.uuid, cn.id, cn.uuid, cn.id, cn.uuid), ids)
+
+    def test_trait_changes(self):
+        cn = self._create_provider('cn')
+        tb.set_traits(cn, 'CUSTOM_FOO', os_traits.HW_CPU_X86_AVX2)
+        snap = self.cache.get(self.ctx)
+        self.assertEqual(['CUSTOM_FOO', os_traits.HW_CPU_X86_AVX2],
+                         sorted(snap.traits_by_provider_tree([cn.id])[cn.id]))
+        self.assertEqual(
+            [cn.id], snap.provider_ids_having_all_traits(
+                snap.trait_ids_from_names(['CUSTOM_FOO'])))
+
+        tb.set_traits(cn, 'CUSTOM_BAR')
+        snap = self.cache.get(self.ctx)
+        self.assertEqual(['CUSTOM_BAR'],
+                         snap.traits_by_provider_tree([cn.id])[cn.id])
+        self.assertEqual(
+            [], snap.provider_ids_having_any_trait(
+                snap.trait_ids_from_names(['CUSTOM_FOO'])))
+
+    def test_deleted_provider(self):
+        cn1 = self._create_provider('cn1')
+        cn2 = self._create_provider('cn2')
+        tb.add_inventory(cn2, fields.ResourceClass.VCPU, 8)
+        snap = self.cache.get(self.ctx)
+        self.assertIn(cn2.id, snap.providers)
+
+        cn2.destroy()
+        snap = self.cache.get(self.ctx)
+        self.assertEqual([cn1.id], list(snap.providers))
+        self.assertNotIn(cn2.id, snap.inventories)
+        self.assertEqual(set(), snap.providers_with_resource(VCPU_ID, 1))
+
+    def test_only_changed_providers_are_reloaded(self):
+        cn1 = self._create_provider('cn1')
+        cn2 = self._create_provider('cn2')
+        for cn in (cn1, cn2, self._create_provider('cn3')):
+            tb.add_inventory(cn, fields.ResourceClass.VCPU, 8)
+        snap = self.cache.get(self.ctx)
+
+        self.allocate_from_provider(cn1, fields.ResourceClass.VCPU, 2)
+        load = mock.patch.object(provider_snapshot, '_load_inventories',
+                                 wraps=provider_snapshot._load_inventories)
+        with load as mock_load:
+            new_snap = self.cache.get(self.ctx)
+        mock_load.assert_called_once_with(mock.ANY, set([cn1.id]))
+        self.assertEqual(2, new_snap.usages[cn1.id][VCPU_ID])
+        self.assertIs(snap.inventories[cn2.id], new_snap.inventories[cn2.id])
+
+    def test_rolled_back_changes_reload_nothing(self):
+        cn = self._create_provider('cn')
+        position = self.cache.get(self.ctx).markers.providers
+        # The change before this one is never committed
+        with self.placement_db.get_engine().connect() as conn:
+            conn.execute(change_log._CHANGE_TBL.insert().values(
+                id=position.last + 2, resource_provider_id=cn.id,
+                topology=False))
+        snap = self.cache.get(self.ctx)
+        self.assertEqual(1, len(snap.markers.providers.missing))
+
+        self.useFixture(fixtures.MockPatchObject(
+            change_log, '_GAP_TIMEOUT', 0))
+        new_snap = self.cache.get(self.ctx)
+        self.assertEqual((), new_snap.markers.providers.missing)
+        self.assertIs(snap.providers, new_snap.providers)
+        self.assertIs(snap.trait_index, new_snap.trait_index)
+
+    def test_lagging_replica_keeps_snapshot(self):
+        cn = self._create_provider('cn')
+        tb.set_traits(cn, 'CUSTOM_FOO')
+        snap = self.cache.get(self.ctx)
+        # Reads from a replica that has not seen any of the changes yet
+        with self.placement_db.get_engine().connect() as conn:
+            conn.execute(change_log._CHANGE_TBL.delete())
+            conn.execute(change_log._VERSION_TBL.delete())
+        with mock.patch.object(db_api, 'reading_replica', return_value=True):
+            self.assertIs(snap, self.cache.get(self.ctx))
+        # The same on the primary means that the database was recreated
+        new_snap = self.cache.get(self.ctx)
+        self.assertIsNot(snap.providers, new_snap.providers)
+        self.assertEqual(0, new_snap.markers.traits)
+
+    def test_pruned_changes_reload_everything(self):
+        cn = self._create_provider('cn')
+        snap = self.cache.get(self.ctx)
+        tb.add_inventory(cn, fields.ResourceClass.VCPU, 8)
+        get_changes = change_log.get_provider_changes
+
+        def _pruned(ctx, since):
+            return get_changes(ctx, since)[0], None
+
+        with mock.patch.object(change_log, 'get_provider_changes',
+                               side_effect=_pruned):
+            new_snap = self.cache.get(self.ctx)
+        self.assertIsNot(snap.providers, new_snap.providers)
+        self.assertEqual([VCPU_ID], list(new_snap.inventories[cn.id]))
+
+
+class CapacityIndexTestCase(tb.PlacementDbBaseTestCase):
+    """Tests that the vectorized capacity checks of the _CapacityIndex agree
+    with the checks made one provider at a time.
+    """
+
+    def setUp(self):
+        super(CapacityIndexTestCase, self).setUp()
+        if provider_snapshot.np is None:
+            self.skipTest('numpy is not installed')
+        self.cache = provider_snapshot.ProviderSnapshotCache()
+
+    def _create_providers(self):
+        small = self._create_provider('small')
+        tb.add_inventory(small, fields.ResourceClass.VCPU, 4,
+                         max_unit=8, allocation_ratio=2.0)
+        tb.add_inventory(small, fields.ResourceClass.MEMORY_MB, 2048,
+                         reserved=512)
+        stepped = self._create_provider('stepped')
+        tb.add_inventory(stepped, fields.ResourceClass.VCPU, 16,
+                         min_unit=2, max_unit=8, step_size=2)
+        tb.add_inventory(stepped, fields.ResourceClass.DISK_GB, 100)
+        full = self._create_provider('full')
+        tb.add_inventory(full, fields.ResourceClass.VCPU, 4)
+        tb.add_inventory(full, fields.ResourceClass.MEMORY_MB, 1024)
+        self.allocate_from_provider(full, fields.ResourceClass.VCPU, 3)
+        return small, stepped, full
+
+    def _assert_same_results(self, snap):
+        slow = provider_snapshot.ProviderSnapshot(
+            snap.markers, snap.providers, snap.inventories, snap.usages,
+            snap.traits, snap.aggregates, snap.agg_ids, snap.trait_ids)
+        self.assertIsNone(slow.capacity)
+        self.assertIsNotNone(snap.capacity)
+        requests = [
+            {VCPU_ID: 1},
+            {VCPU_ID: 2},
+            {VCPU_ID: 3},
+            {VCPU_ID: 8},
+            {VCPU_ID: 9},
+            {MEMORY_ID: 1024},
+            {MEMORY_ID: 1537},
+            {VCPU_ID: 1, MEMORY_ID: 512},
+            {VCPU_ID: 2, DISK_ID: 50},
+            {VCPU_ID: 2, DISK_ID: 101},
+        ]
+        for resources in requests:
+            self.assertEqual(
+                slow.provider_ids_matching(resources, {}, {}),
+                snap.provider_ids_matching(resources, {}, {}),
+                resources)
+            for rc_id, amount in resources.items():
+                self.assertEqual(
+                    slow.providers_with_resource(rc_id, amount),
+                    snap.providers_with_resource(rc_id, amount))
+
+    def test_matches_per_provider_checks(self):
+        small, stepped, full = self._create_providers()
+        snap = self.cache.get(self.ctx)
+        self._assert_same_results(snap)
+        self.assertEqual(
+            [(small.id, small.id), (stepped.id, stepped.id)],
+            snap.provider_ids_matching({VCPU_ID: 2}, {}, {}))
+        self.assertEqual(
+            [(small.id, small.id)],
+            snap.provider_ids_matching({VCPU_ID: 3}, {}, {}))
+
+    def test_usage_changes_update_index(self):
+        small, stepped, full = self._create_providers()
+        snap = self.cache.get(self.ctx)
+        self.allocate_from_provider(small, fields.ResourceClass.VCPU, 8)
+        new_snap = self.cache.get(self.ctx)
+        # Only the row of the allocated provider is updated. Columns of
+        # resource classes it has no inventory of are shared.
+        self.assertIs(snap.capacity.rp_ids, new_snap.capacity.rp_ids)
+        self.assertIs(snap.capacity.columns[DISK_ID],
+                      new_snap.capacity.columns[DISK_ID])
+        self.assertIsNot(snap.capacity.columns[VCPU_ID]['used'],
+                         new_snap.capacity.columns[VCPU_ID]['used'])
+        self._assert_same_results(new_snap)
+        self.assertEqual(
+            set([(full.id, full.id)]),
+            new_snap.providers_with_resource(VCPU_ID, 1))
+        # The old snapshot is left as it was
+        self.assertEqual(
+            set([(small.id, small.id), (full.id, full.id)]),
+            snap.providers_with_resource(VCPU_ID, 1))
+
+    def test_inventory_changes(self):
+        small, stepped, full = self._create_providers()
+        self.cache.get(self.ctx)
+        tb.add_inventory(full, fields.ResourceClass.DISK_GB, 200)
+        small.set_inventory(rp_obj.InventoryList(self.ctx, objects=[]))
+        snap = self.cache.get(self.ctx)
+        self._assert_same_results(snap)
+        self.assertEqual(
+            set([(stepped.id, stepped.id), (full.id, full.id)]),
+            snap.providers_with_resource(DISK_ID, 100))
+        self.assertEqual(set([(full.id, full.id)]),
+                         snap.providers_with_resource(MEMORY_ID, 1))
+
+        # A provider that had no inventory needs a new row
+        new = self._create_provider('new')
+        tb.add_inventory(new, fields.ResourceClass.MEMORY_MB, 1024)
+        snap = self.cache.get(self.ctx)
+        self._assert_same_results(snap)
+        self.assertEqual(set([(full.id, full.id), (new.id, new.id)]),
+                         snap.providers_with_resource(MEMORY_ID, 1))
+
+    def test_without_numpy(self):
+        self.useFixture(
+            fixtures.MockPatchObject(provider_snapshot, 'np', None))
+        small, stepped, full = self._create_providers()
+        snap = self.cache.get(self.ctx)
+        self.assertIsNone(snap.capacity)
+        self.assertEqual(
+            [(small.id, small.id), (stepped.id, stepped.id)],
+            snap.provider_ids_matching({VCPU_ID: 2}, {}, {}))
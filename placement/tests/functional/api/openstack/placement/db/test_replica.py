@@ -0,0 +1,114 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Tests of the routing of GET handlers to a replica of the placement
+database, using two SQLite databases as the primary and the replica.
+"""
+
+import os
+
+import fixtures
+from oslo_config import cfg
+from oslo_config import fixture as config_fixture
+from oslo_db.sqlalchemy import enginefacade
+import sqlalchemy as sa
+import testtools
+import webob
+
+from nova.api.openstack.placement import db_api
+
+
+CONF = cfg.CONF
+
+
+class ReplicaReaderTestCase(testtools.TestCase):
+
+    def setUp(self):
+        super(ReplicaReaderTestCase, self).setUp()
+        self.conf_fixture = self.useFixture(config_fixture.Config(CONF))
+        self.conf_fixture.config(group='placement', replica_max_lag=60)
+        self.useFixture(fixtures.MockPatchObject(db_api, '_LAST_WRITE', 0))
+
+        # Each database holds its own name, so that the reads tell where
+        # they went
+        tmpdir = self.useFixture(fixtures.TempDir()).path
+        urls = {}
+        for name in ('primary', 'replica'):
+            urls[name] = 'sqlite:///%s' % os.path.join(tmpdir, name)
+            engine = sa.create_engine(urls[name])
+            engine.execute('CREATE TABLE db (name VARCHAR(16))')
+            engine.execute("INSERT INTO db VALUES ('%s')" % name)
+            engine.dispose()
+        ctxt_mgr = enginefacade.transaction_context()
+        ctxt_mgr.configure(connection=urls['primary'],
+                           slave_connection=urls['replica'])
+        self.useFixture(fixtures.MockPatchObject(
+            db_api, 'placement_context_manager', ctxt_mgr))
+
+        @ctxt_mgr.reader.allow_async
+        def _get_name(context):
+            return context.session.execute('SELECT name FROM db').scalar()
+
+        @db_api.replica_reader
+        def handler(req):
+            context = req.environ['placement.context']
+            # A nested reader joins the transaction of the handler
+            return _get_name(context), _get_name(context)
+
+        self.get_name = _get_name
+        self.handler = handler
+
+    def _request(self):
+        req = webob.Request.blank('/')
+        req.environ['placement.context'] = db_api.DbContext()
+        return req
+
+    def test_replica_reader(self):
+        self.assertEqual(('replica', 'replica'),
+                         self.handler(self._request()))
+        # Undecorated code reads from the primary
+        self.assertEqual('primary', self.get_name(db_api.DbContext()))
+
+    def test_reading_replica(self):
+        reads = []
+
+        @db_api.replica_reader
+        def handler(req):
+            context = req.environ['placement.context']
+            reads.append(db_api.reading_replica(context))
+
+        req = self._request()
+        handler(req)
+        db_api.note_write()
+        handler(req)
+        self.assertEqual([True, False], reads)
+        self.assertFalse(db_api.reading_replica(
+            req.environ['placement.context']))
+
+    def test_reading_replica_without_replica(self):
+        ctxt_mgr = enginefacade.transaction_context()
+        ctxt_mgr.configure(connection='sqlite://')
+        self.useFixture(fixtures.MockPatchObject(
+            db_api, 'placement_context_manager', ctxt_mgr))
+
+        @db_api.replica_reader
+        def handler(req):
+            return db_api.reading_replica(req.environ['placement.context'])
+
+        self.assertFalse(handler(self._request()))
+
+    def test_replica_reader_after_write(self):
+        db_api.note_write()
+        self.assertEqual(('primary', 'primary'),
+                         self.handler(self._request()))
+        self.conf_fixture.config(group='placement', replica_max_lag=0)
+        self.assertEqual(('replica', 'replica'),
+                         self.handler(self._request()))
@@ -15,12 +15,25 @@ import mock
 
 from oslo_utils import timeutils
 
+from nova.api.openstack.placement import change_log
 from nova.api.openstack.placement import exception
 from nova.api.openstack.placement import resource_class_cache as rc_cache
 from nova import rc_fields as fields
 from nova.tests.functional.api.openstack.placement import base
 
 
+def _bump_version(conn):
+    """Increments the RESOURCE_CLASSES change counter, as the writers of
+    resource classes do.
+    """
+    tbl = change_log._VERSION_TBL
+    cond = tbl.c.name == change_log.RESOURCE_CLASSES
+    upd_stmt = tbl.update().where(cond).values(version=tbl.c.version + 1)
+    if not conn.execute(upd_stmt).rowcount:
+        conn.execute(tbl.insert().values(
+            name=change_log.RESOURCE_CLASSES, version=1))
+
+
 class TestResourceClassCache(base.TestCase):
 
     def setUp(self):
@@ -98,6 +111,7 @@ class TestResourceClassCache(base.TestCase):
                 name='IRON_NFV'
             )
             conn.execute(ins_stmt)
+            _bump_version(conn)
 
         self.assertEqual('IRON_NFV', cache.string_from_id(1001))
         self.assertEqual(1001, cache.id_from_string('IRON_NFV'))
@@ -143,3 +157,76 @@ class TestResourceClassCache(base.TestCase):
                           cache.string_from_id, 99999999)
         self.assertRaises(exception.ResourceClassNotFound,
                           cache.id_from_string, 'UNKNOWN')
+
+    def test_rc_cache_miss_does_not_reload(self):
+        """Test that looking up a resource class that doesn't exist only
+        reloads the custom resource classes if the table changed.
+        """
+        cache = rc_cache.ResourceClassCache(self.context)
+        with self.context.session.connection() as conn:
+            conn.execute(rc_cache._RC_TBL.insert().values(
+                id=1001, name='IRON_NFV'))
+        self.assertEqual(1001, cache.id_from_string('IRON_NFV'))
+
+        with mock.patch.object(rc_cache, '_refresh_from_db',
+                               side_effect=rc_cache._refresh_from_db) as ref:
+            for _i in range(3):
+                self.assertRaises(exception.ResourceClassNotFound,
+                                  cache.id_from_string, 'IRON_NVF')
+                self.assertRaises(exception.ResourceClassNotFound,
+                                  cache.string_from_id, 1002)
+            self.assertFalse(ref.called)
+
+            # A resource class created elsewhere, for example by another API
+            # worker, is found by the next lookup.
+            with self.context.session.connection() as conn:
+                conn.execute(rc_cache._RC_TBL.insert().values(
+                    id=1002, name='IRON_NVF'))
+                _bump_version(conn)
+            self.assertEqual(1002, cache.id_from_string('IRON_NVF'))
+            self.assertEqual('IRON_NVF', cache.string_from_id(1002))
+            self.assertEqual(1, ref.call_count)
+
+    def test_rc_cache_clear(self):
+        cache = rc_cache.ResourceClassCache(self.context)
+        with self.context.session.connection() as conn:
+            conn.execute(rc_cache._RC_TBL.insert().values(
+                id=1001, name='IRON_NFV'))
+        self.assertEqual(1001, cache.id_from_string('IRON_NFV'))
+        with self.context.session.connection() as conn:
+            conn.execute(rc_cache._RC_TBL.delete().where(
+                rc_cache._RC_TBL.c.id == 1001))
+        # Hits are served from the snapshot until it is cleared
+        self.assertEqual(1001, cache.id_from_string('IRON_NFV'))
+        cache.clear()
+        self.assertRaises(exception.ResourceClassNotFound,
+                          cache.id_from_string, 'IRON_NFV')
+
+    def test_rc_cache_expire(self):
+        """Test that a hit on a resource class renamed elsewhere, for example
+        by another API worker, is only served until the snapshot is expired
+        with the new version of the change counter.
+        """
+        cache = rc_cache.ResourceClassCache(self.context)
+        with self.context.session.connection() as conn:
+            conn.execute(rc_cache._RC_TBL.insert().values(
+                id=1001, name='IRON_NFV'))
+        self.assertEqual(1001, cache.id_from_string('IRON_NFV'))
+        version = rc_cache._get_marker(self.context)
+
+        # An unchanged counter keeps the snapshot
+        with mock.patch.object(rc_cache, '_refresh_from_db',
+                               side_effect=rc_cache._refresh_from_db) as ref:
+            cache.expire(version)
+            self.assertEqual(1001, cache.id_from_string('IRON_NFV'))
+            self.assertFalse(ref.called)
+
+        with self.context.session.connection() as conn:
+            conn.execute(rc_cache._RC_TBL.update().where(
+                rc_cache._RC_TBL.c.id == 1001).values(name='IRON_SILVER'))
+            _bump_version(conn)
+        self.assertEqual(1001, cache.id_from_string('IRON_NFV'))
+        cache.expire(rc_cache._get_marker(self.context))
+        self.assertRaises(exception.ResourceClassNotFound,
+                          cache.id_from_string, 'IRON_NFV')
+        self.assertEqual('IRON_SILVER', cache.string_from_id(1001))
@@ -11,13 +11,19 @@
 #    under the License.
 
 
+import collections
 import functools
+
+import fixtures
 import mock
 import os_traits
+from oslo_config import cfg
 from oslo_db import exception as db_exc
 import sqlalchemy as sa
 
 import nova
+from nova.api.openstack.placement import contention
+from nova.api.openstack.placement import db_api
 from nova.api.openstack.placement import exception
 from nova.api.openstack.placement.objects import consumer as consumer_obj
 from nova.api.openstack.placement.objects import resource_provider as rp_obj
@@ -26,6 +32,7 @@ from nova import rc_fields as fields
 from nova.tests.functional.api.openstack.placement.db import test_base as tb
 from nova.tests import uuidsentinel
 
+CONF = cfg.CONF
 
 DISK_INVENTORY = dict(
     total=200,
@@ -114,38 +121,46 @@ class ResourceProviderTestCase(tb.PlacementDbBaseTestCase):
         self.assertEqual(uuidsentinel.create_p, child.parent_provider_uuid)
         self.assertEqual(uuidsentinel.create_p, child.root_provider_uuid)
 
-    def test_root_provider_population(self):
-        """Simulate an old resource provider record in the database that has no
-        root_provider_uuid set and ensure that when grabbing the resource
-        provider object, the root_provider_uuid field in the table is set to
-        the provider's UUID.
+    def test_set_root_provider_ids(self):
+        """Simulate old resource provider records in the database that have no
+        root_provider_id set and ensure that the online data migration sets it
+        to the provider's own ID, in batches.
         """
         rp_tbl = rp_obj._RP_TBL
         conn = self.placement_db.get_engine().connect()
 
-        # First, set up a record for an "old-style" resource provider with no
-        # root provider UUID.
-        ins_stmt = rp_tbl.insert().values(
-            id=1,
-            uuid=uuidsentinel.rp1,
-            name='rp-1',
-            root_provider_id=None,
-            parent_provider_id=None,
-            generation=42,
-        )
-        conn.execute(ins_stmt)
+        # First, set up records for "old-style" resource providers with no
+        # root provider ID.
+        for rp_id, uuid in ((1, uuidsentinel.rp1), (2, uuidsentinel.rp2)):
+            ins_stmt = rp_tbl.insert().values(
+                id=rp_id,
+                uuid=uuid,
+                name='rp-%d' % rp_id,
+                root_provider_id=None,
+                parent_provider_id=None,
+                generation=42,
+            )
+            conn.execute(ins_stmt)
 
-        rp = rp_obj.ResourceProvider.get_by_uuid(self.ctx, uuidsentinel.rp1)
+        # Reads do not migrate the records, which they cannot see as they
+        # have no root provider
+        self.assertRaises(exception.NotFound,
+                          rp_obj.ResourceProvider.get_by_uuid,
+                          self.ctx, uuidsentinel.rp1)
 
-        # The ResourceProvider._from_db_object() method should have performed
-        # an online data migration, populating the root_provider_id field
-        # with the value of the id field. Let's check it happened.
-        sel_stmt = sa.select([rp_tbl.c.root_provider_id]).where(
-            rp_tbl.c.id == 1)
+        self.assertEqual((1, 1), rp_obj.set_root_provider_ids(self.ctx, 1))
+        self.assertEqual((1, 1), rp_obj.set_root_provider_ids(self.ctx, 10))
+        self.assertEqual((0, 0), rp_obj.set_root_provider_ids(self.ctx, 10))
+
+        sel_stmt = sa.select([rp_tbl.c.id, rp_tbl.c.root_provider_id])
         res = conn.execute(sel_stmt).fetchall()
-        self.assertEqual(1, res[0][0])
-        # Make sure the object root_provider_uuid is set on load
-        self.assertEqual(rp.root_provider_uuid, uuidsentinel.rp1)
+        self.assertEqual([(1, 1), (2, 2)], sorted(tuple(r) for r in res))
+        rp = rp_obj.ResourceProvider.get_by_uuid(self.ctx, uuidsentinel.rp1)
+        self.assertEqual(uuidsentinel.rp1, rp.root_provider_uuid)
+        # The records that predate the closure table get their own
+        rps = rp_obj.ResourceProviderList.get_all_by_filters(
+            self.ctx, filters={'in_tree': uuidsentinel.rp2})
+        self.assertEqual([uuidsentinel.rp2], [rp.uuid for rp in rps])
 
     def test_inherit_root_from_parent(self):
         """Tests that if we update an existing provider's parent provider UUID,
@@ -380,50 +395,6 @@ class ResourceProviderTestCase(tb.PlacementDbBaseTestCase):
         child_rp.destroy()
         root_rp.destroy()
 
-    def test_get_all_in_tree_old_records(self):
-        """Simulate an old resource provider record in the database that has no
-        root_provider_uuid set and ensure that when selecting all providers in
-        a tree, passing in that old resource provider, that we still get that
-        provider returned.
-        """
-        # Passing a non-existing resource provider UUID should return an empty
-        # list
-        rps = rp_obj.ResourceProviderList.get_all_by_filters(
-            self.ctx,
-            filters={
-                'in_tree': uuidsentinel.rp1,
-            }
-        )
-        self.assertEqual([], rps.objects)
-
-        rp_tbl = rp_obj._RP_TBL
-        conn = self.placement_db.get_engine().connect()
-
-        # First, set up a record for an "old-style" resource provider with no
-        # root provider UUID.
-        ins_stmt = rp_tbl.insert().values(
-            id=1,
-            uuid=uuidsentinel.rp1,
-            name='rp-1',
-            root_provider_id=None,
-            parent_provider_id=None,
-            generation=42,
-        )
-        conn.execute(ins_stmt)
-
-        # NOTE(jaypipes): This is just disabling the online data migration that
-        # occurs in _from_db_object() that sets root provider ID to ensure we
-        # don't have any migrations messing with the end result.
-        with mock.patch('nova.api.openstack.placement.objects.'
-                        'resource_provider._set_root_provider_id'):
-            rps = rp_obj.ResourceProviderList.get_all_by_filters(
-                self.ctx,
-                filters={
-                    'in_tree': uuidsentinel.rp1,
-                }
-            )
-        self.assertEqual(1, len(rps))
-
     def test_has_provider_trees(self):
         """The _has_provider_trees() helper method should return False unless
         there is a resource provider that is a parent.
@@ -680,6 +651,156 @@ class ResourceProviderTestCase(tb.PlacementDbBaseTestCase):
         self.assertRaises(exception.ConcurrentUpdateDetected,
                           rp.set_inventory, inv_list)
 
+    def _vcpu_inventories(self, rp, total):
+        return rp_obj.InventoryList(objects=[
+            rp_obj.Inventory(resource_provider=rp, resource_class='VCPU',
+                             total=total, reserved=0, min_unit=1,
+                             max_unit=total, step_size=1,
+                             allocation_ratio=1.0)])
+
+    def test_update_providers(self):
+        cn = self._create_provider('cn')
+        numa0 = self._create_provider('numa0', parent=cn.uuid)
+        avx = rp_obj.Trait.get_by_name(self.ctx, 'HW_CPU_X86_AVX')
+
+        rp_obj.update_providers(self.ctx, [
+            rp_obj.ProviderUpdate(cn, None, None, [uuidsentinel.agg]),
+            rp_obj.ProviderUpdate(
+                numa0, self._vcpu_inventories(numa0, 8), [avx], None),
+        ])
+
+        # One generation increment for each part that was replaced
+        self.assertEqual(1, cn.generation)
+        self.assertEqual(2, numa0.generation)
+        numa0 = rp_obj.ResourceProvider.get_by_uuid(self.ctx, numa0.uuid)
+        self.assertEqual(2, numa0.generation)
+        self.assertEqual([uuidsentinel.agg], cn.get_aggregates())
+        self.assertEqual([], numa0.get_aggregates())
+        self.assertEqual(
+            ['HW_CPU_X86_AVX'],
+            [t.name for t in rp_obj.TraitList.get_all_by_resource_provider(
+                self.ctx, numa0)])
+        invs = rp_obj.InventoryList.get_all_by_resource_provider(
+            self.ctx, numa0)
+        self.assertEqual([8], [inv.total for inv in invs])
+
+    def test_update_providers_all_or_nothing(self):
+        """Test that when the update of one provider fails, none of the
+        providers is changed.
+        """
+        rp1 = self._create_provider('rp1')
+        rp2 = self._create_provider('rp2')
+        tb.add_inventory(rp2, 'VCPU', 12)
+        self.allocate_from_provider(rp2, 'VCPU', 1)
+        rp2 = rp_obj.ResourceProvider.get_by_uuid(self.ctx, rp2.uuid)
+
+        # Removing the VCPU inventory of rp2 fails, as it is in use
+        self.assertRaises(
+            exception.InventoryInUse, rp_obj.update_providers, self.ctx, [
+                rp_obj.ProviderUpdate(
+                    rp1, self._vcpu_inventories(rp1, 8), None, None),
+                rp_obj.ProviderUpdate(
+                    rp2, rp_obj.InventoryList(objects=[]), None, None),
+            ])
+        self.assertEqual(
+            [], rp_obj.InventoryList.get_all_by_resource_provider(
+                self.ctx, rp1).objects)
+        self.assertEqual(
+            0, rp_obj.ResourceProvider.get_by_uuid(
+                self.ctx, rp1.uuid).generation)
+
+    def _get_tree(self, root_uuid):
+        return rp_obj.ResourceProviderList.get_all_by_filters(
+            self.ctx, {'in_tree': root_uuid})
+
+    def test_sync_provider_tree(self):
+        cn = rp_obj.ResourceProvider(
+            self.ctx, uuid=uuidsentinel.cn, name='cn',
+            parent_provider_uuid=None)
+        numa0 = rp_obj.ResourceProvider(
+            self.ctx, uuid=uuidsentinel.numa0, name='numa0',
+            parent_provider_uuid=uuidsentinel.cn)
+        pf0 = rp_obj.ResourceProvider(
+            self.ctx, uuid=uuidsentinel.pf0, name='pf0',
+            parent_provider_uuid=uuidsentinel.numa0)
+        # Children are listed before their parents on purpose
+        rp_obj.sync_provider_tree(self.ctx, [], [
+            rp_obj.ProviderUpdate(pf0, None, None, None),
+            rp_obj.ProviderUpdate(
+                numa0, self._vcpu_inventories(numa0, 8), None, None),
+            rp_obj.ProviderUpdate(cn, None, None, [uuidsentinel.agg]),
+        ])
+        self.assertEqual(
+            set([uuidsentinel.cn, uuidsentinel.numa0, uuidsentinel.pf0]),
+            set(rp.uuid for rp in self._get_tree(uuidsentinel.cn)))
+        self.assertEqual(1, numa0.generation)
+        self.assertEqual([uuidsentinel.agg], cn.get_aggregates())
+
+        # Remove numa0 and pf0, add numa1 and rename the compute node
+        stored = self._get_tree(uuidsentinel.cn)
+        cn = next(rp for rp in stored if rp.uuid == uuidsentinel.cn)
+        cn.name = 'cn-renamed'
+        numa1 = rp_obj.ResourceProvider(
+            self.ctx, uuid=uuidsentinel.numa1, name='numa1',
+            parent_provider_uuid=uuidsentinel.cn)
+        rp_obj.sync_provider_tree(self.ctx, stored, [
+            rp_obj.ProviderUpdate(cn, None, None, None),
+            rp_obj.ProviderUpdate(
+                numa1, self._vcpu_inventories(numa1, 4), None, None),
+        ])
+        tree = self._get_tree(uuidsentinel.cn)
+        self.assertEqual(
+            set([('cn-renamed', uuidsentinel.cn),
+                 ('numa1', uuidsentinel.numa1)]),
+            set((rp.name, rp.uuid) for rp in tree))
+        self.assertRaises(exception.NotFound,
+                          rp_obj.ResourceProvider.get_by_uuid,
+                          self.ctx, uuidsentinel.numa0)
+        self.assertEqual([uuidsentinel.agg], cn.get_aggregates())
+
+    def test_sync_provider_tree_concurrent_child(self):
+        """Test that a provider added to the tree since it was read makes
+        the sync fail rather than be left out of the desired tree.
+        """
+        cn = self._create_provider('cn')
+        stored = self._get_tree(cn.uuid)
+        self._create_provider('numa0', parent=cn.uuid)
+
+        self.assertRaises(
+            exception.ConcurrentUpdateDetected, rp_obj.sync_provider_tree,
+            self.ctx, stored, [
+                rp_obj.ProviderUpdate(
+                    stored[0], self._vcpu_inventories(stored[0], 8),
+                    None, None),
+            ])
+        self.assertEqual(
+            [], rp_obj.InventoryList.get_all_by_resource_provider(
+                self.ctx, cn).objects)
+
+    def test_sync_provider_tree_all_or_nothing(self):
+        """Test that when a provider to delete has allocations, nothing is
+        changed.
+        """
+        cn = self._create_provider('cn')
+        numa0 = self._create_provider('numa0', parent=cn.uuid)
+        tb.add_inventory(numa0, 'VCPU', 8)
+        self.allocate_from_provider(numa0, 'VCPU', 1)
+        stored = self._get_tree(cn.uuid)
+        cn = next(rp for rp in stored if rp.uuid == cn.uuid)
+        numa1 = rp_obj.ResourceProvider(
+            self.ctx, uuid=uuidsentinel.numa1, name='numa1',
+            parent_provider_uuid=cn.uuid)
+
+        self.assertRaises(
+            exception.ResourceProviderInUse, rp_obj.sync_provider_tree,
+            self.ctx, stored, [
+                rp_obj.ProviderUpdate(cn, None, None, None),
+                rp_obj.ProviderUpdate(numa1, None, None, None),
+            ])
+        self.assertEqual(
+            set([cn.uuid, numa0.uuid]),
+            set(rp.uuid for rp in self._get_tree(cn.uuid)))
+
     def test_delete_inventory_not_found(self):
         rp = self._create_provider(uuidsentinel.rp_name)
         error = self.assertRaises(exception.NotFound, rp.delete_inventory,
@@ -777,6 +898,49 @@ class ResourceProviderListTestCase(tb.PlacementDbBaseTestCase):
         self.assertEqual(1, len(resource_providers))
         self.assertEqual('rp_name_2', resource_providers[0].name)
 
+    def test_get_all_by_filters_paginated(self):
+        rps = [self._create_provider('rp_name_%d' % i) for i in range(5)]
+        for rp in rps[:4]:
+            tb.add_inventory(rp, fields.ResourceClass.VCPU, 2)
+
+        page = rp_obj.ResourceProviderList.get_all_by_filters(
+            self.ctx, limit=2)
+        self.assertEqual([rps[0].uuid, rps[1].uuid],
+                         [rp.uuid for rp in page])
+        page = rp_obj.ResourceProviderList.get_all_by_filters(
+            self.ctx, limit=2, marker=rps[1].uuid)
+        self.assertEqual([rps[2].uuid, rps[3].uuid],
+                         [rp.uuid for rp in page])
+        page = rp_obj.ResourceProviderList.get_all_by_filters(
+            self.ctx, limit=2, marker=rps[3].uuid)
+        self.assertEqual([rps[4].uuid], [rp.uuid for rp in page])
+
+        # Pages of providers filtered by resources
+        page = rp_obj.ResourceProviderList.get_all_by_filters(
+            self.ctx, {'resources': {fields.ResourceClass.VCPU: 1}},
+            limit=2, marker=rps[2].uuid)
+        self.assertEqual([rps[3].uuid], [rp.uuid for rp in page])
+
+        self.assertRaises(
+            exception.ResourceProviderNotFound,
+            rp_obj.ResourceProviderList.get_all_by_filters,
+            self.ctx, limit=2, marker=uuidsentinel.missing)
+
+    def test_get_all_by_filters_fields(self):
+        root = self._create_provider('root')
+        self._create_provider('child', parent=root.uuid)
+
+        rps = rp_obj.ResourceProviderList.get_all_by_filters(
+            self.ctx, fields=set(['name', 'parent_provider_uuid']))
+        rps = {rp.name: rp for rp in rps}
+        self.assertEqual(set(['root', 'child']), set(rps))
+        self.assertEqual(root.uuid, rps['child'].parent_provider_uuid)
+        # The uuid is always read, the fields that were not wanted are not
+        self.assertEqual(root.uuid, rps['root'].uuid)
+        self.assertFalse(rps['child'].obj_attr_is_set('root_provider_uuid'))
+        self.assertFalse(rps['child'].obj_attr_is_set('generation'))
+        self.assertFalse(rps['child'].obj_attr_is_set('updated_at'))
+
     def test_get_all_by_filters_with_resources(self):
         for rp_i in ['1', '2']:
             rp = self._create_provider('rp_name_' + rp_i)
@@ -923,6 +1087,30 @@ class ResourceProviderListTestCase(tb.PlacementDbBaseTestCase):
         self.assertEqual(1, len(traits))
         self.assertEqual('CUSTOM_TRAIT_A', traits[0].name)
 
+    def test_get_all_by_uuids(self):
+        root = self._create_provider('root')
+        child = self._create_provider('child', parent=root.uuid)
+        self._create_provider('other')
+
+        rps = rp_obj.ResourceProviderList.get_all_by_uuids(
+            self.ctx, [root.uuid, child.uuid, child.uuid])
+        rps = {rp.uuid: rp for rp in rps}
+        self.assertEqual(set([root.uuid, child.uuid]), set(rps))
+        self.assertEqual(root.uuid, rps[child.uuid].parent_provider_uuid)
+        self.assertEqual(root.uuid, rps[child.uuid].root_provider_uuid)
+        self.assertEqual(child.generation, rps[child.uuid].generation)
+
+    def test_get_all_by_uuids_missing(self):
+        rp = self._create_provider('rp')
+        exc = self.assertRaises(
+            exception.ResourceProviderNotFound,
+            rp_obj.ResourceProviderList.get_all_by_uuids,
+            self.ctx, [uuidsentinel.missing2, rp.uuid, uuidsentinel.missing1])
+        # Every missing provider is reported
+        self.assertIn(uuidsentinel.missing1, str(exc))
+        self.assertIn(uuidsentinel.missing2, str(exc))
+        self.assertNotIn(rp.uuid, str(exc))
+
 
 class TestResourceProviderAggregates(tb.PlacementDbBaseTestCase):
     def test_set_and_get_new_aggregates(self):
@@ -1261,6 +1449,40 @@ class TestAllocation(tb.PlacementDbBaseTestCase):
         self.assertEqual(allocation.resource_provider.id,
                          allocations[0].resource_provider.id)
 
+    def test_get_allocation_rows_by_provider(self):
+        rp = self._create_provider('rp')
+        tb.add_inventory(rp, fields.ResourceClass.VCPU, 8)
+        tb.add_inventory(rp, fields.ResourceClass.MEMORY_MB, 1024)
+        consumer_ids = sorted(
+            [uuidsentinel.c1, uuidsentinel.c2, uuidsentinel.c3])
+        for consumer_id in consumer_ids:
+            consumer = tb.ensure_consumer(
+                self.ctx, self.user_obj, self.project_obj, consumer_id)
+            tb.set_allocation(self.ctx, rp, consumer,
+                              {fields.ResourceClass.VCPU: 1,
+                               fields.ResourceClass.MEMORY_MB: 256})
+
+        rows = rp_obj.get_allocation_rows_by_provider(self.ctx, rp)
+        # The rows are ordered by consumer
+        self.assertEqual([c for c in consumer_ids for i in range(2)],
+                         [row[0] for row in rows])
+        generation = consumer_obj.Consumer.get_by_uuid(
+            self.ctx, consumer_ids[0]).generation
+        self.assertEqual(
+            set([(generation, fields.ResourceClass.VCPU, 1),
+                 (generation, fields.ResourceClass.MEMORY_MB, 256)]),
+            set(row[1:] for row in rows if row[0] == consumer_ids[0]))
+
+        # A page has all of the allocations of its consumers
+        rows = rp_obj.get_allocation_rows_by_provider(self.ctx, rp, limit=2)
+        self.assertEqual([c for c in consumer_ids[:2] for i in range(2)],
+                         [row[0] for row in rows])
+        rows = rp_obj.get_allocation_rows_by_provider(
+            self.ctx, rp, limit=2, marker=consumer_ids[1])
+        self.assertEqual([consumer_ids[2]] * 2, [row[0] for row in rows])
+        self.assertEqual([], rp_obj.get_allocation_rows_by_provider(
+            self.ctx, rp, limit=2, marker=consumer_ids[2]))
+
 
 class TestAllocationListCreateDelete(tb.PlacementDbBaseTestCase):
 
@@ -1328,6 +1550,82 @@ class TestAllocationListCreateDelete(tb.PlacementDbBaseTestCase):
         # If we are joining wrong, this will be a KeyError
         allocation_list.replace_all()
 
+    def test_bulk_write_several_consumers(self):
+        rp1 = self._create_provider('rp1')
+        rp2 = self._create_provider('rp2')
+        for rp in (rp1, rp2):
+            tb.add_inventory(rp, fields.ResourceClass.VCPU, 16)
+            tb.add_inventory(rp, fields.ResourceClass.MEMORY_MB, 4096)
+        inst1 = tb.ensure_consumer(
+            self.ctx, self.user_obj, self.project_obj, uuidsentinel.inst1)
+        inst2 = tb.ensure_consumer(
+            self.ctx, self.user_obj, self.project_obj, uuidsentinel.inst2)
+        # inst1 already has an allocation that is replaced
+        self.allocate_from_provider(rp2, fields.ResourceClass.VCPU, 1,
+                                    consumer=inst1)
+        rp2_gen = rp_obj.ResourceProvider.get_by_uuid(
+            self.ctx, rp2.uuid).generation
+
+        allocs = [
+            rp_obj.Allocation(
+                self.ctx, resource_provider=rp, consumer=consumer,
+                resource_class=rc, used=used)
+            for rp, consumer, rc, used in (
+                (rp1, inst1, fields.ResourceClass.VCPU, 2),
+                (rp1, inst1, fields.ResourceClass.MEMORY_MB, 1024),
+                (rp2, inst2, fields.ResourceClass.VCPU, 4),
+                (rp1, inst2, fields.ResourceClass.MEMORY_MB, 512),
+            )]
+        rp_obj.AllocationList(self.ctx, objects=allocs).replace_all()
+
+        # Every allocation got the id of its own record
+        for consumer in (inst1, inst2):
+            stored = rp_obj.AllocationList.get_all_by_consumer_id(
+                self.ctx, consumer.uuid)
+            expected = set((a.id, a.resource_provider.id, a.resource_class,
+                            a.used) for a in allocs
+                           if a.consumer.uuid == consumer.uuid)
+            self.assertEqual(
+                expected,
+                set((a.id, a.resource_provider.id, a.resource_class, a.used)
+                    for a in stored))
+            self.assertEqual(1 if consumer is inst2 else 2,
+                             stored[0].consumer.generation)
+        self.assertEqual(
+            rp2_gen + 1,
+            rp_obj.ResourceProvider.get_by_uuid(
+                self.ctx, rp2.uuid).generation)
+
+    def test_bulk_write_stale_consumer_generation(self):
+        rp1 = self._create_provider('rp1')
+        tb.add_inventory(rp1, fields.ResourceClass.VCPU, 16)
+        inst1 = tb.ensure_consumer(
+            self.ctx, self.user_obj, self.project_obj, uuidsentinel.inst1)
+        inst2 = tb.ensure_consumer(
+            self.ctx, self.user_obj, self.project_obj, uuidsentinel.inst2)
+        # Another writer bumps the generation of inst2 only
+        consumer_obj.Consumer.get_by_uuid(
+            self.ctx, inst2.uuid).increment_generation()
+
+        allocs = [
+            rp_obj.Allocation(
+                self.ctx, resource_provider=rp1, consumer=consumer,
+                resource_class=fields.ResourceClass.VCPU, used=1)
+            for consumer in (inst1, inst2)]
+        exc = self.assertRaises(
+            exception.ConcurrentUpdateDetected,
+            rp_obj.AllocationList(self.ctx, objects=allocs).replace_all)
+        # A consumer conflict is not retried like a provider conflict is
+        self.assertNotIsInstance(
+            exc, exception.ResourceProviderConcurrentUpdateDetected)
+        # Nothing was written, not even for the consumer that was current
+        self.assertEqual(
+            0, len(rp_obj.AllocationList.get_all_by_resource_provider(
+                self.ctx, rp1)))
+        self.assertEqual(
+            0, consumer_obj.Consumer.get_by_uuid(
+                self.ctx, inst1.uuid).generation)
+
     def test_allocation_list_create(self):
         max_unit = 10
         consumer_uuid = uuidsentinel.consumer
@@ -1748,44 +2046,49 @@ class TestAllocationListCreateDelete(tb.PlacementDbBaseTestCase):
             ])
 
         # Make sure the right exception happens when the retry loop expires.
-        with mock.patch.object(rp_obj.AllocationList,
-                               'RP_CONFLICT_RETRY_COUNT', 0):
+        CONF.set_override('allocation_conflict_retry_count', 1,
+                          group='placement')
+        conflict = exception.ResourceProviderConcurrentUpdateDetected
+        with mock.patch.object(alloc_list, '_set_allocations',
+                               side_effect=conflict):
             self.assertRaises(
                 exception.ResourceProviderConcurrentUpdateDetected,
                 alloc_list.replace_all)
-            mock_log.warning.assert_called_with(
-                'Exceeded retry limit of %d on allocations write', 0)
+        mock_log.warning.assert_called_with(
+            'Exceeded retry limit of %(attempts)d on allocations write. '
+            'Resource providers with the most generation conflicts in this '
+            'process: %(contended)s', {'attempts': 1, 'contended': mock.ANY})
 
         # Make sure the right thing happens after a small number of failures.
         # There's a bit of mock magic going on here to enusre that we can
         # both do some side effects on _set_allocations as well as have the
         # real behavior. Two generation conflicts and then a success.
         mock_log.reset_mock()
-        with mock.patch.object(rp_obj.AllocationList,
-                               'RP_CONFLICT_RETRY_COUNT', 3):
-            unmocked_set = functools.partial(
-                rp_obj.AllocationList._set_allocations, alloc_list)
-            with mock.patch(
-                'nova.api.openstack.placement.objects.resource_provider.'
-                'AllocationList._set_allocations') as mock_set:
-                exceptions = iter([
-                    exception.ResourceProviderConcurrentUpdateDetected(),
-                    exception.ResourceProviderConcurrentUpdateDetected(),
-                ])
-
-                def side_effect(*args, **kwargs):
-                    try:
-                        raise next(exceptions)
-                    except StopIteration:
-                        return unmocked_set(*args, **kwargs)
-
-                mock_set.side_effect = side_effect
-                alloc_list.replace_all()
-                self.assertEqual(2, mock_log.debug.call_count)
-                mock_log.debug.called_with(
-                    'Retrying allocations write on resource provider '
-                    'generation conflict')
-                self.assertEqual(3, mock_set.call_count)
+        CONF.set_override('allocation_conflict_retry_count', 3,
+                          group='placement')
+        unmocked_set = functools.partial(
+            rp_obj.AllocationList._set_allocations, alloc_list)
+        with mock.patch(
+            'nova.api.openstack.placement.objects.resource_provider.'
+            'AllocationList._set_allocations') as mock_set:
+            exceptions = iter([
+                exception.ResourceProviderConcurrentUpdateDetected(),
+                exception.ResourceProviderConcurrentUpdateDetected(),
+            ])
+
+            def side_effect(*args, **kwargs):
+                try:
+                    raise next(exceptions)
+                except StopIteration:
+                    return unmocked_set(*args, **kwargs)
+
+            mock_set.side_effect = side_effect
+            alloc_list.replace_all()
+            self.assertEqual(2, mock_log.debug.call_count)
+            mock_log.debug.called_with(
+                'Retrying allocations write on resource provider '
+                'generation conflict')
+            self.assertEqual(3, mock_set.call_count)
 
         # Confirm we're using a different rp object after the change
         # and that it has a higher generation.
@@ -1793,6 +2096,139 @@ class TestAllocationListCreateDelete(tb.PlacementDbBaseTestCase):
         self.assertEqual(original_generation, rp1.generation)
         self.assertEqual(original_generation + 1, new_rp.generation)
 
+    @db_api.placement_context_manager.writer
+    def _bump_generation(self, ctx, rp):
+        upd_stmt = rp_obj._RP_TBL.update().where(
+            rp_obj._RP_TBL.c.id == rp.id).values(
+                generation=rp_obj._RP_TBL.c.generation + 1)
+        ctx.session.execute(upd_stmt)
+
+    def test_set_allocations_retry_contention(self):
+        # Guarded claims do not compare generations, so never retry
+        CONF.set_override('allocation_claim_mode', 'generation',
+                          group='placement')
+        counters = contention.ContentionCounters()
+        self.useFixture(fixtures.MockPatchObject(
+            contention, 'get_contention_counters', return_value=counters))
+        policy = contention.RetryPolicy(2, 0.01, 0.5)
+        self.useFixture(fixtures.MockPatchObject(
+            contention, 'get_retry_policy', return_value=policy))
+        mock_sleep = self.useFixture(fixtures.MockPatch('time.sleep')).mock
+        hot = self._create_provider('hot')
+        cold = self._create_provider('cold')
+        for rp in (hot, cold):
+            tb.add_inventory(rp, fields.ResourceClass.VCPU, 8)
+        consumer = tb.ensure_consumer(
+            self.ctx, self.user_obj, self.project_obj)
+        alloc_list = rp_obj.AllocationList(self.ctx, objects=[
+            rp_obj.Allocation(
+                self.ctx, resource_provider=rp, consumer=consumer,
+                resource_class=fields.ResourceClass.VCPU, used=1)
+            for rp in (hot, cold)])
+
+        # Another writer changes the generation of one provider every time
+        real_set = rp_obj.AllocationList._set_allocations
+
+        def contended_set(ctx, allocs):
+            self._bump_generation(ctx, hot)
+            return real_set(alloc_list, ctx, allocs)
+
+        with mock.patch.object(alloc_list, '_set_allocations',
+                               side_effect=contended_set):
+            self.assertRaises(
+                exception.ResourceProviderConcurrentUpdateDetected,
+                alloc_list.replace_all)
+        self.assertEqual(1, mock_sleep.call_count)
+        self.assertEqual([(hot.uuid, 1)], counters.most_contended())
+        self.assertEqual({'conflicts': 0, 'retries_exhausted': 1},
+                         counters.get(cold.uuid))
+
+        # Without the other writer the retry succeeds, even though the
+        # generation moves while it waits, since the providers are reloaded
+        # after the wait.
+        mock_sleep.side_effect = (
+            lambda delay: self._bump_generation(self.ctx, hot))
+        alloc_list.replace_all()
+        self.assertEqual(2, mock_sleep.call_count)
+        self.assertEqual([(hot.uuid, 2)], counters.most_contended())
+
+
+class TestAllocationListCreateDeleteGuardedClaim(
+        TestAllocationListCreateDelete):
+    """Runs every TestAllocationListCreateDelete scenario with usages claimed
+    by guarded statements instead of comparing provider generations.
+    """
+
+    def setUp(self):
+        super(TestAllocationListCreateDeleteGuardedClaim, self).setUp()
+        CONF.set_override('allocation_claim_mode', 'guarded',
+                          group='placement')
+
+    @db_api.placement_context_manager.writer
+    def _claim(self, ctx, claims, rp_uuids):
+        rp_obj._claim_provider_usages(ctx, claims, rp_uuids)
+
+    @db_api.placement_context_manager.writer
+    def _concurrent_write(self, ctx, rp):
+        upd_stmt = rp_obj._RP_TBL.update().where(
+            rp_obj._RP_TBL.c.id == rp.id).values(
+                generation=rp_obj._RP_TBL.c.generation + 1)
+        ctx.session.execute(upd_stmt)
+
+    def test_claim_provider_usages(self):
+        rp = self._create_provider('rp')
+        tb.add_inventory(rp, fields.ResourceClass.VCPU, 8)
+        vcpu_id = fields.ResourceClass.STANDARD.index(
+            fields.ResourceClass.VCPU)
+        mem_id = fields.ResourceClass.STANDARD.index(
+            fields.ResourceClass.MEMORY_MB)
+        rp_uuids = {rp.id: rp.uuid}
+
+        self.assertRaises(exception.InvalidAllocationCapacityExceeded,
+                          self._claim, self.ctx, {(rp.id, vcpu_id): 9},
+                          rp_uuids)
+        self._claim(self.ctx, {(rp.id, vcpu_id): 6}, rp_uuids)
+        self.assertRaises(exception.InvalidAllocationCapacityExceeded,
+                          self._claim, self.ctx, {(rp.id, vcpu_id): 3},
+                          rp_uuids)
+        self._claim(self.ctx, {(rp.id, vcpu_id): 2}, rp_uuids)
+        # There is no inventory to claim from
+        self.assertRaises(exception.InvalidAllocationCapacityExceeded,
+                          self._claim, self.ctx, {(rp.id, mem_id): 1},
+                          rp_uuids)
+        usages = rp_obj.UsageList.get_all_by_resource_provider_uuid(
+            self.ctx, rp.uuid)
+        self.assertEqual([(fields.ResourceClass.VCPU, 8)],
+                         [(u.resource_class, u.usage) for u in usages])
+
+    def test_concurrent_generation_change_does_not_conflict(self):
+        rp = self._create_provider('rp')
+        tb.add_inventory(rp, fields.ResourceClass.VCPU, 8)
+        real_check = rp_obj._check_capacity_exceeded
+
+        def check_then_write(ctx, allocs):
+            # Another allocation write changes the generation after the
+            # capacity check read it.
+            res = real_check(ctx, allocs)
+            self._concurrent_write(ctx, rp)
+            return res
+
+        self.useFixture(fixtures.MockPatchObject(
+            rp_obj, '_check_capacity_exceeded',
+            side_effect=check_then_write))
+        generation = rp.generation
+        self.allocate_from_provider(rp, fields.ResourceClass.VCPU, 2)
+        self.assertEqual(generation + 2, rp.generation)
+        self.assertEqual(
+            generation + 2,
+            rp_obj.ResourceProvider.get_by_uuid(self.ctx, rp.uuid).generation)
+
+        CONF.set_override('allocation_claim_mode', 'generation',
+                          group='placement')
+        self.assertRaises(exception.ResourceProviderConcurrentUpdateDetected,
+                          self.allocate_from_provider, rp,
+                          fields.ResourceClass.VCPU, 2)
+
 
 class UsageListTestCase(tb.PlacementDbBaseTestCase):
 
@@ -1841,6 +2277,259 @@ class UsageListTestCase(tb.PlacementDbBaseTestCase):
         self.assertEqual(2, len(usage_list))
 
 
+class ProviderUsageSummaryTestCase(tb.PlacementDbBaseTestCase):
+    """Tests that the summed usages in resource_provider_usages follow the
+    allocations they summarize.
+    """
+
+    def setUp(self):
+        super(ProviderUsageSummaryTestCase, self).setUp()
+        self.vcpu_id = rp_obj._RC_CACHE.id_from_string(
+            fields.ResourceClass.VCPU)
+        self.cn1 = self._create_provider('cn1')
+        self.cn2 = self._create_provider('cn2')
+        for cn in (self.cn1, self.cn2):
+            tb.add_inventory(cn, fields.ResourceClass.VCPU, 8)
+
+    @db_api.placement_context_manager.reader
+    def _recorded(self, ctx):
+        sel = sa.select([rp_obj._USAGE_TBL.c.resource_provider_id,
+                         rp_obj._USAGE_TBL.c.resource_class_id,
+                         rp_obj._USAGE_TBL.c.used])
+        return {(r[0], r[1]): r[2] for r in ctx.session.execute(sel)}
+
+    @db_api.placement_context_manager.writer
+    def _corrupt_usages(self, ctx):
+        usage_tbl = rp_obj._USAGE_TBL
+        ctx.session.execute(usage_tbl.update().where(
+            usage_tbl.c.resource_provider_id == self.cn1.id).values(used=7))
+        ctx.session.execute(usage_tbl.delete().where(
+            usage_tbl.c.resource_provider_id == self.cn2.id))
+        ctx.session.execute(usage_tbl.insert().values(
+            resource_provider_id=self.cn2.id,
+            resource_class_id=self.vcpu_id + 1, used=1))
+
+    def test_follows_allocations(self):
+        inst1 = tb.ensure_consumer(
+            self.ctx, self.user_obj, self.project_obj, uuidsentinel.inst1)
+        inst2 = tb.ensure_consumer(
+            self.ctx, self.user_obj, self.project_obj, uuidsentinel.inst2)
+        self.allocate_from_provider(self.cn1, fields.ResourceClass.VCPU, 2,
+                                    consumer=inst1)
+        self.allocate_from_provider(self.cn1, fields.ResourceClass.VCPU, 3,
+                                    consumer=inst2)
+        self.assertEqual({(self.cn1.id, self.vcpu_id): 5},
+                         self._recorded(self.ctx))
+
+        # Move inst2 to cn2
+        self.allocate_from_provider(self.cn2, fields.ResourceClass.VCPU, 3,
+                                    consumer=inst2)
+        self.assertEqual({(self.cn1.id, self.vcpu_id): 2,
+                          (self.cn2.id, self.vcpu_id): 3},
+                         self._recorded(self.ctx))
+
+        # Deleting the last allocation against a provider removes its record
+        allocs = rp_obj.AllocationList.get_all_by_consumer_id(
+            self.ctx, uuidsentinel.inst1)
+        allocs.delete_all()
+        self.assertEqual({(self.cn2.id, self.vcpu_id): 3},
+                         self._recorded(self.ctx))
+        self.assertEqual({}, rp_obj.verify_provider_usages(self.ctx))
+
+    def test_failed_write_is_rolled_back(self):
+        self.allocate_from_provider(self.cn1, fields.ResourceClass.VCPU, 6)
+        self.assertRaises(exception.InvalidAllocationCapacityExceeded,
+                          self.allocate_from_provider, self.cn1,
+                          fields.ResourceClass.VCPU, 6)
+        self.assertEqual({(self.cn1.id, self.vcpu_id): 6},
+                         self._recorded(self.ctx))
+
+    def test_concurrent_first_usage(self):
+        key = (self.cn1.id, self.vcpu_id)
+
+        @db_api.placement_context_manager.writer
+        def _update(ctx):
+            execute = ctx.session.execute
+
+            def _execute(stmt, *args, **kwargs):
+                if (isinstance(stmt, sa.sql.expression.Insert) and
+                        stmt.table is rp_obj._USAGE_TBL):
+                    # Another writer creates the usage between our UPDATE
+                    # that found none and our INSERT
+                    execute(rp_obj._USAGE_TBL.insert().values(
+                        resource_provider_id=key[0],
+                        resource_class_id=key[1], used=3))
+                return execute(stmt, *args, **kwargs)
+
+            with mock.patch.object(ctx.session, 'execute',
+                                   side_effect=_execute):
+                rp_obj._update_provider_usages(ctx, {key: 2})
+
+        _update(self.ctx)
+        self.assertEqual({key: 5}, self._recorded(self.ctx))
+
+    def test_verify_and_repair(self):
+        self.allocate_from_provider(self.cn1, fields.ResourceClass.VCPU, 2)
+        self.allocate_from_provider(self.cn2, fields.ResourceClass.VCPU, 4)
+        cn1_key = (self.cn1.id, self.vcpu_id)
+        cn2_key = (self.cn2.id, self.vcpu_id)
+        stale_key = (self.cn2.id, self.vcpu_id + 1)
+        self._corrupt_usages(self.ctx)
+
+        self.assertEqual({cn1_key: (7, 2), cn2_key: (None, 4),
+                          stale_key: (1, None)},
+                         rp_obj.verify_provider_usages(self.ctx))
+        # The usages are read from the summary so they are wrong too
+        usages = rp_obj.UsageList.get_all_by_resource_provider_uuid(
+            self.ctx, self.cn1.uuid)
+        self.assertEqual(7, usages[0].usage)
+
+        self.assertEqual((2, 2),
+                         rp_obj.repair_provider_usages(self.ctx, 2))
+        self.assertEqual((1, 1),
+                         rp_obj.repair_provider_usages(self.ctx, 2))
+        self.assertEqual((0, 0),
+                         rp_obj.repair_provider_usages(self.ctx, 2))
+        self.assertEqual({cn1_key: 2, cn2_key: 4}, self._recorded(self.ctx))
+        usages = rp_obj.UsageList.get_all_by_resource_provider_uuid(
+            self.ctx, self.cn1.uuid)
+        self.assertEqual(2, usages[0].usage)
+
+
+class ProviderClosureTestCase(tb.PlacementDbBaseTestCase):
+    """Tests that the resource_provider_closure table follows the provider
+    trees as providers are created, parented and deleted.
+    """
+
+    def _closure(self):
+        """Returns a dict, keyed by provider name, of dicts, keyed by the
+        names of the ancestors of the provider, of their depth.
+        """
+        with self.placement_db.get_engine().connect() as conn:
+            sel = sa.select([rp_obj._RP_TBL.c.id, rp_obj._RP_TBL.c.name])
+            names = {r[0]: r[1] for r in conn.execute(sel)}
+            res = collections.defaultdict(dict)
+            for r in conn.execute(sa.select([rp_obj._CLOSURE_TBL])):
+                res[names[r['descendant_id']]][names[r['ancestor_id']]] = (
+                    r['depth'])
+        return dict(res)
+
+    def _get_provider(self, name):
+        return rp_obj.ResourceProvider.get_by_uuid(
+            self.ctx, getattr(uuidsentinel, name))
+
+    def _build_trees(self):
+        #      root          other
+        #       |              |
+        #     child        other_child
+        #       |
+        #   grandchild
+        self._create_provider('root')
+        self._create_provider('child', parent=uuidsentinel.root)
+        self._create_provider('grandchild', parent=uuidsentinel.child)
+        self._create_provider('other')
+        self._create_provider('other_child', parent=uuidsentinel.other)
+
+    def test_create(self):
+        self._build_trees()
+        self.assertEqual({
+            'root': {'root': 0},
+            'child': {'child': 0, 'root': 1},
+            'grandchild': {'grandchild': 0, 'child': 1, 'root': 2},
+            'other': {'other': 0},
+            'other_child': {'other_child': 0, 'other': 1},
+        }, self._closure())
+
+    def test_parent_tree(self):
+        self._build_trees()
+        other = self._get_provider('other')
+        other.parent_provider_uuid = uuidsentinel.grandchild
+        other.save()
+        self.assertEqual({
+            'root': {'root': 0},
+            'child': {'child': 0, 'root': 1},
+            'grandchild': {'grandchild': 0, 'child': 1, 'root': 2},
+            'other': {'other': 0, 'grandchild': 1, 'child': 2, 'root': 3},
+            'other_child': {'other_child': 0, 'other': 1, 'grandchild': 2,
+                            'child': 3, 'root': 4},
+        }, self._closure())
+        # The whole subtree moved to the tree of the new parent
+        other_child = self._get_provider('other_child')
+        self.assertEqual(uuidsentinel.root, other_child.root_provider_uuid)
+        rps = rp_obj.ResourceProviderList.get_all_by_filters(
+            self.ctx, filters={'in_tree': uuidsentinel.other_child})
+        self.assertEqual(5, len(rps))
+
+    def test_parent_loop(self):
+        self._build_trees()
+        other = self._get_provider('other')
+        other.parent_provider_uuid = uuidsentinel.other_child
+        exc = self.assertRaises(exception.ObjectActionError, other.save)
+        self.assertIn('creating loop in the provider tree', str(exc))
+
+    def test_delete(self):
+        self._build_trees()
+        for name in ('grandchild', 'other_child', 'other'):
+            self._get_provider(name).destroy()
+        self.assertEqual({
+            'root': {'root': 0},
+            'child': {'child': 0, 'root': 1},
+        }, self._closure())
+
+    def test_repair(self):
+        self._build_trees()
+        expected = self._closure()
+        with self.placement_db.get_engine().connect() as conn:
+            conn.execute(rp_obj._CLOSURE_TBL.delete().where(
+                rp_obj._CLOSURE_TBL.c.ancestor_id ==
+                self._get_provider('root').id))
+        # The records of a provider are checked against those of its parent,
+        # so each level of the tree is found once the one above is repaired
+        for _level in ('root', 'child', 'grandchild'):
+            self.assertEqual((1, 1),
+                             rp_obj.repair_provider_closure(self.ctx, 2))
+        self.assertEqual((0, 0), rp_obj.repair_provider_closure(self.ctx, 2))
+        self.assertEqual(expected, self._closure())
+
+    def test_repair_extra_records(self):
+        self._build_trees()
+        expected = self._closure()
+        other = self._get_provider('other')
+        with self.placement_db.get_engine().connect() as conn:
+            # A record of a wrong ancestor and the records of a provider that
+            # is gone
+            conn.execute(rp_obj._CLOSURE_TBL.insert(), [
+                {'ancestor_id': other.id,
+                 'descendant_id': self._get_provider('child').id,
+                 'depth': 1},
+                {'ancestor_id': other.id, 'descendant_id': other.id + 100,
+                 'depth': 1},
+                {'ancestor_id': other.id + 100,
+                 'descendant_id': other.id + 100, 'depth': 0},
+            ])
+        self.assertEqual((2, 2), rp_obj.repair_provider_closure(self.ctx, 2))
+        self.assertEqual((0, 0), rp_obj.repair_provider_closure(self.ctx, 2))
+        self.assertEqual(expected, self._closure())
+
+    def test_usages_by_provider_subtree(self):
+        self._build_trees()
+        for name in ('child', 'grandchild'):
+            rp = self._get_provider(name)
+            tb.add_inventory(rp, fields.ResourceClass.VCPU, 8)
+            self.allocate_from_provider(rp, fields.ResourceClass.VCPU, 2)
+        tb.add_inventory(rp, fields.ResourceClass.DISK_GB, 100)
+
+        def _usages(name):
+            usages = rp_obj.UsageList.get_all_by_provider_subtree(
+                self.ctx, getattr(uuidsentinel, name))
+            return {u.resource_class: u.usage for u in usages}
+
+        self.assertEqual({'VCPU': 4, 'DISK_GB': 0}, _usages('root'))
+        self.assertEqual({'VCPU': 4, 'DISK_GB': 0}, _usages('child'))
+        self.assertEqual({'VCPU': 2, 'DISK_GB': 0}, _usages('grandchild'))
+        self.assertEqual({}, _usages('other'))
+
+
 class ResourceClassListTestCase(tb.PlacementDbBaseTestCase):
 
     def test_get_all_no_custom(self):
@@ -2097,6 +2786,35 @@ class ResourceClassTestCase(tb.PlacementDbBaseTestCase):
                           self.ctx,
                           'CUSTOM_IRON_NFV')
 
+    def test_changed_by_other_process(self):
+        rc = rp_obj.ResourceClass(
+            self.ctx,
+            name='CUSTOM_IRON_NFV',
+        )
+        rc.create()
+        rc = rp_obj.ResourceClass.get_by_name(self.ctx, 'CUSTOM_IRON_NFV')
+
+        # Another API worker renames the resource class, which does not clear
+        # the cache of this process.
+        rp_obj.ResourceClass._save(self.ctx, rc.id, rc.name,
+                                   {'name': 'CUSTOM_IRON_SILVER'})
+        self.assertEqual(rc.id, rp_obj._RC_CACHE.id_from_string(
+            'CUSTOM_IRON_NFV'))
+
+        # The next request finds the cache out of date
+        rp_obj.validate_caches(self.ctx)
+        self.assertRaises(exception.NotFound,
+                          rp_obj.ResourceClass.get_by_name,
+                          self.ctx,
+                          'CUSTOM_IRON_NFV')
+        self.assertEqual('CUSTOM_IRON_SILVER',
+                         rp_obj._RC_CACHE.string_from_id(rc.id))
+
+        rp_obj.ResourceClass._destroy(self.ctx, rc.id, 'CUSTOM_IRON_SILVER')
+        rp_obj.validate_caches(self.ctx)
+        self.assertRaises(exception.ResourceClassNotFound,
+                          rp_obj._RC_CACHE.string_from_id, rc.id)
+
 
 class ResourceProviderTraitTestCase(tb.PlacementDbBaseTestCase):
 
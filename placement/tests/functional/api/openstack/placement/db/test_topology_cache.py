@@ -0,0 +1,117 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import os_traits
+
+from nova.api.openstack.placement import change_log
+from nova.api.openstack.placement import db_api
+from nova.api.openstack.placement.objects import resource_provider as rp_obj
+from nova.api.openstack.placement import topology_cache
+from nova import rc_fields as fields
+from nova.tests.functional.api.openstack.placement.db import test_base as tb
+from nova.tests import uuidsentinel as uuids
+
+
+class TopologyCacheTestCase(tb.PlacementDbBaseTestCase):
+    """Tests that the topology cache is reused while only inventories and
+    allocations change, and reloaded when nesting, sharing traits or
+    aggregates change, whichever process changed them.
+    """
+
+    def _topology(self):
+        return rp_obj._get_topology(self.ctx)
+
+    def test_unchanged_topology_is_reused(self):
+        cn = self._create_provider('cn', uuids.agg1)
+        topology = self._topology()
+        self.assertFalse(topology.has_trees)
+        self.assertEqual({}, topology.sharing)
+
+        tb.add_inventory(cn, fields.ResourceClass.VCPU, 8)
+        self.allocate_from_provider(cn, fields.ResourceClass.VCPU, 2)
+        # Only the position in the change log moved
+        self.assertIs(topology.sharing, self._topology().sharing)
+
+    def test_nesting(self):
+        cn = self._create_provider('cn')
+        self.assertFalse(self._topology().has_trees)
+        self._create_provider('numa0', parent=cn.uuid)
+        self.assertTrue(self._topology().has_trees)
+
+    def test_sharing(self):
+        cn = self._create_provider('cn', uuids.agg1)
+        ss = self._create_provider('ss')
+        tb.set_traits(ss, os_traits.MISC_SHARES_VIA_AGGREGATE)
+        sharing = self._topology().sharing
+        self.assertEqual([ss.id], list(sharing))
+        self.assertEqual(ss.uuid, sharing[ss.id].uuid)
+        self.assertEqual(frozenset(), sharing[ss.id].anchors)
+
+        ss.set_aggregates([uuids.agg1])
+        self.assertEqual(
+            frozenset([(cn.id, cn.uuid), (ss.id, ss.uuid)]),
+            self._topology().sharing[ss.id].anchors)
+
+        tb.set_traits(ss)
+        self.assertEqual({}, self._topology().sharing)
+
+    def test_aggregate_swap(self):
+        """Providers exchanging their aggregates leave the number of
+        associations as it was, yet change which trees share with a sharing
+        provider.
+        """
+        cn1 = self._create_provider('cn1', uuids.agg1)
+        cn2 = self._create_provider('cn2', uuids.agg2)
+        ss = self._create_provider('ss', uuids.agg1)
+        tb.set_traits(ss, os_traits.MISC_SHARES_VIA_AGGREGATE)
+        self.assertEqual(
+            frozenset([(cn1.id, cn1.uuid), (ss.id, ss.uuid)]),
+            self._topology().sharing[ss.id].anchors)
+
+        cn1.set_aggregates([uuids.agg2])
+        cn2.set_aggregates([uuids.agg1])
+        self.assertEqual(
+            frozenset([(cn2.id, cn2.uuid), (ss.id, ss.uuid)]),
+            self._topology().sharing[ss.id].anchors)
+
+    def test_changes_by_other_process(self):
+        """A topology cached by another process, as another API worker
+        would, is reloaded once it reads a topology change.
+        """
+        cn = self._create_provider('cn')
+        self.assertFalse(self._topology().has_trees)
+        other = topology_cache.TopologyCache()
+        self.assertFalse(other.get(self.ctx).has_trees)
+
+        self._create_provider('numa0', parent=cn.uuid)
+        self.assertTrue(other.get(self.ctx).has_trees)
+        self.assertTrue(self._topology().has_trees)
+
+    def test_writers_record_topology_changes(self):
+        def _changed(since):
+            with db_api.placement_context_manager.reader.using(self.ctx):
+                return [rp_id for rp_id, topology in
+                        change_log.get_provider_changes(self.ctx, since)[1]
+                        if topology]
+
+        cn = self._create_provider('cn')
+        start = self._topology().marker
+        tb.add_inventory(cn, fields.ResourceClass.VCPU, 8)
+        self.assertEqual([], _changed(start))
+        cn.set_aggregates([uuids.agg1])
+        self.assertEqual([cn.id], _changed(start))
+        tb.set_traits(cn, 'CUSTOM_GOLD')
+        self.assertEqual([cn.id] * 2, _changed(start))
+        numa0 = self._create_provider('numa0', parent=cn.uuid)
+        self.assertEqual([cn.id] * 2 + [numa0.id], _changed(start))
+        numa0.destroy()
+        self.assertEqual([cn.id] * 2 + [numa0.id] * 2, _changed(start))
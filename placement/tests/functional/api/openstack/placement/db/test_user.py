@@ -10,6 +10,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import mock
+
 from nova.api.openstack.placement import exception
 from nova.api.openstack.placement.objects import user as user_obj
 from nova.tests.functional.api.openstack.placement.db import test_base as tb
@@ -29,3 +31,34 @@ class UserTestCase(tb.PlacementDbBaseTestCase):
         # User ID == 1 is fake-user created in setup
         self.assertEqual(2, u.id)
         self.assertRaises(exception.UserExists, u.create)
+
+    def test_get_or_create_all(self):
+        res = user_obj.User.get_or_create_all(
+            self.ctx, ['fake-user', 'new-user-1', 'new-user-2'])
+        self.assertEqual(
+            set(['fake-user', 'new-user-1', 'new-user-2']), set(res))
+        # The existing user is returned, not created again
+        self.assertEqual(self.user_obj.id, res['fake-user'].id)
+        for external_id in ('new-user-1', 'new-user-2'):
+            self.assertEqual(
+                res[external_id].id,
+                user_obj.User.get_by_external_id(
+                    self.ctx, external_id).id)
+
+    def test_get_or_create_all_concurrent_create(self):
+        # Simulate another thread creating one of the users between the
+        # lookup and the bulk insert
+        orig_get = user_obj._get_users_by_external_ids
+
+        def fake_get(ctx, external_ids):
+            res = orig_get(ctx, external_ids)
+            if 'racing-user' not in res:
+                user_obj.User(ctx, external_id='racing-user').create()
+            return res
+
+        with mock.patch.object(user_obj, '_get_users_by_external_ids',
+                               side_effect=fake_get):
+            res = user_obj.User.get_or_create_all(
+                self.ctx, ['racing-user', 'new-user'])
+        self.assertEqual(set(['racing-user', 'new-user']), set(res))
+        self.assertIsNotNone(res['new-user'].id)
@@ -122,6 +122,10 @@ class APIFixture(fixture.GabbiFixture):
     def _reset_db_flags():
         rp_obj._TRAITS_SYNCED = False
         rp_obj._RC_CACHE = None
+        rp_obj._SNAPSHOT_CACHE = None
+        rp_obj._TRAIT_CACHE = None
+        rp_obj._AGG_CACHE = None
+        rp_obj._TOPOLOGY_CACHE = None
 
 
 class AllocationFixture(APIFixture):
@@ -0,0 +1,101 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+
+import mock
+import sqlalchemy as sa
+
+from nova.api.openstack.placement import manage
+from nova.api.openstack.placement.objects import consumer as consumer_obj
+from nova.api.openstack.placement.objects import resource_provider as rp_obj
+from nova import rc_fields as fields
+from nova.tests.functional.api.openstack.placement.db import test_base as tb
+
+
+class TestOnlineDataMigrations(tb.PlacementDbBaseTestCase):
+
+    def setUp(self):
+        super(TestOnlineDataMigrations, self).setUp()
+        self.cn = self._create_provider('cn')
+        self.numa0 = self._create_provider('numa0', parent=self.cn.uuid)
+        tb.add_inventory(self.numa0, fields.ResourceClass.VCPU, 8)
+        self.allocate_from_provider(self.numa0, fields.ResourceClass.VCPU, 2)
+        # Records written by a service that did not maintain the closure and
+        # usages of the providers
+        with self.placement_db.get_engine().connect() as conn:
+            conn.execute(rp_obj._CLOSURE_TBL.delete())
+            conn.execute(rp_obj._USAGE_TBL.delete())
+
+    def _run(self, max_count=None):
+        config = mock.Mock()
+        config.command.max_count = max_count
+        return manage.DbCommands(config).db_online_data_migrations()
+
+    def _in_tree(self):
+        rps = rp_obj.ResourceProviderList.get_all_by_filters(
+            self.ctx, filters={'in_tree': self.cn.uuid})
+        return sorted(rp.name for rp in rps)
+
+    def _usages(self):
+        with self.placement_db.get_engine().connect() as conn:
+            sel = sa.select([rp_obj._USAGE_TBL.c.resource_provider_id,
+                             rp_obj._USAGE_TBL.c.used])
+            return [tuple(r) for r in conn.execute(sel)]
+
+    def test_migrations_run_until_complete(self):
+        self.assertEqual([], self._in_tree())
+        self.assertEqual(0, self._run())
+        self.assertEqual(['cn', 'numa0'], self._in_tree())
+        self.assertEqual([(self.numa0.id, 2)], self._usages())
+        # Nothing is left to migrate
+        self.assertEqual(0, self._run())
+
+    def test_incomplete_records(self):
+        """Records written before nested providers and consumer records
+        existed are completed.
+        """
+        with self.placement_db.get_engine().connect() as conn:
+            conn.execute(rp_obj._RP_TBL.update().where(
+                rp_obj._RP_TBL.c.id == self.cn.id).values(
+                    root_provider_id=None))
+            conn.execute(consumer_obj.CONSUMER_TBL.delete())
+        self.assertEqual(0, self._run())
+
+        with self.placement_db.get_engine().connect() as conn:
+            sel = sa.select([rp_obj._RP_TBL.c.root_provider_id]).where(
+                rp_obj._RP_TBL.c.id == self.cn.id)
+            self.assertEqual(self.cn.id, conn.execute(sel).scalar())
+            sel = sa.select([sa.func.count()]).select_from(
+                consumer_obj.CONSUMER_TBL)
+            self.assertEqual(1, conn.execute(sel).scalar())
+        self.assertEqual(['cn', 'numa0'], self._in_tree())
+
+    def test_max_count(self):
+        self.assertEqual(1, self._run(max_count=2))
+        self.assertEqual([], self._usages())
+        self.assertEqual(1, self._run(max_count=1))
+        self.assertEqual(0, self._run(max_count=2))
+        self.assertEqual(['cn', 'numa0'], self._in_tree())
+        self.assertEqual([(self.numa0.id, 2)], self._usages())
+
+    def test_invalid_max_count(self):
+        self.assertEqual(127, self._run(max_count=0))
+        self.assertEqual([], self._in_tree())
+
+    def test_failed_migration(self):
+        with mock.patch.object(rp_obj, 'repair_provider_closure',
+                               side_effect=ValueError) as repair:
+            repair.__name__ = 'repair_provider_closure'
+            with mock.patch.object(manage, 'online_migrations',
+                                   (repair, rp_obj.repair_provider_usages)):
+                self.assertEqual(2, self._run())
+        self.assertEqual([], self._in_tree())
+        self.assertEqual([(self.numa0.id, 2)], self._usages())
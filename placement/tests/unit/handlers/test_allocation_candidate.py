@@ -0,0 +1,112 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Unit tests for the streamed serialization of allocation candidates."""
+
+import copy
+
+import fixtures
+import microversion_parse
+from oslo_serialization import jsonutils
+import testtools
+
+from nova.api.openstack.placement.handlers import allocation_candidate
+from nova.api.openstack.placement import lib as placement_lib
+from nova.api.openstack.placement import microversion
+from nova.api.openstack.placement.objects import resource_provider as rp_obj
+from nova.tests import uuidsentinel
+
+
+class TestStreamAllocationCandidates(testtools.TestCase):
+
+    def setUp(self):
+        super(TestStreamAllocationCandidates, self).setUp()
+        rps = {}
+        for name in ('cn1', 'cn2', 'numa', 'ss'):
+            root = uuidsentinel.cn1 if name == 'numa' else getattr(
+                uuidsentinel, name)
+            rps[name] = rp_obj.ResourceProvider(
+                uuid=getattr(uuidsentinel, name), root_provider_uuid=root,
+                parent_provider_uuid=(
+                    uuidsentinel.cn1 if name == 'numa' else None))
+
+        def _areq(*resources):
+            return rp_obj.AllocationRequest(resource_requests=[
+                rp_obj.AllocationRequestResource(
+                    resource_provider=rps[name], resource_class=rc,
+                    amount=amount)
+                for name, rc, amount in resources])
+
+        def _psum(name, *resources):
+            return rp_obj.ProviderSummary(
+                resource_provider=rps[name],
+                resources=[
+                    rp_obj.ProviderSummaryResource(
+                        resource_class=rc, capacity=capacity, used=used)
+                    for rc, capacity, used in resources],
+                traits=[rp_obj.Trait(name='CUSTOM_' + name.upper())])
+
+        self.cands = rp_obj.AllocationCandidates(
+            allocation_requests=[
+                _areq(('cn1', 'VCPU', 1), ('ss', 'DISK_GB', 10)),
+                _areq(('cn2', 'VCPU', 1), ('cn2', 'DISK_GB', 10)),
+                _areq(('cn1', 'VCPU', 1), ('numa', 'DISK_GB', 10)),
+            ],
+            provider_summaries=[
+                _psum('cn1', ('VCPU', 8, 2), ('MEMORY_MB', 1024, 0)),
+                _psum('cn2', ('VCPU', 8, 0), ('DISK_GB', 100, 5)),
+                _psum('numa', ('DISK_GB', 100, 0)),
+                _psum('ss', ('DISK_GB', 1000, 10)),
+            ])
+        self.requests = {
+            '': placement_lib.RequestGroup(
+                use_same_provider=False,
+                resources={'VCPU': 1, 'DISK_GB': 10}),
+        }
+
+    @staticmethod
+    def _version(minor):
+        version = microversion_parse.Version(1, minor)
+        version.max_version = microversion_parse.parse_version_string(
+            microversion.max_version_string())
+        version.min_version = microversion_parse.parse_version_string(
+            microversion.min_version_string())
+        return version
+
+    def test_same_as_whole_body(self):
+        for minor in (10, 12, 17, 27, 29):
+            version = self._version(minor)
+            expected = allocation_candidate._transform_allocation_candidates(
+                copy.deepcopy(self.cands), self.requests, version)
+            body = b''.join(allocation_candidate._stream_allocation_candidates(
+                copy.deepcopy(self.cands), self.requests, version))
+            self.assertEqual(expected, jsonutils.loads(body), minor)
+
+    def test_chunks(self):
+        self.useFixture(fixtures.MockPatchObject(
+            allocation_candidate, '_STREAM_CHUNK_SIZE', 100))
+        version = self._version(29)
+        chunks = list(allocation_candidate._stream_allocation_candidates(
+            self.cands, self.requests, version))
+        self.assertGreater(len(chunks), 1)
+        for chunk in chunks:
+            self.assertIsInstance(chunk, bytes)
+        self.assertEqual(
+            3, len(jsonutils.loads(b''.join(chunks))['allocation_requests']))
+
+    def test_empty(self):
+        cands = rp_obj.AllocationCandidates(
+            allocation_requests=[], provider_summaries=[])
+        body = b''.join(allocation_candidate._stream_allocation_candidates(
+            cands, self.requests, self._version(29)))
+        self.assertEqual(
+            {'allocation_requests': [], 'provider_summaries': {}},
+            jsonutils.loads(body))
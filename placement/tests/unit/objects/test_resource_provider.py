@@ -10,6 +10,8 @@
 #    License for the specific language governing permissions and limitations
 #    under the License.
 
+import itertools
+
 import mock
 from oslo_utils import timeutils
 import six
@@ -264,8 +266,6 @@ class TestInventoryList(_TestCase):
 
 class TestAllocationListNoDB(_TestCase):
 
-    @mock.patch('nova.api.openstack.placement.objects.resource_provider.'
-                '_create_incomplete_consumers_for_provider')
     @mock.patch('nova.api.openstack.placement.objects.resource_provider.'
                 'ensure_rc_cache',
                 side_effect=_fake_ensure_cache)
@@ -273,7 +273,7 @@ class TestAllocationListNoDB(_TestCase):
                 '_get_allocations_by_provider_id',
                 return_value=[_ALLOCATION_DB])
     def test_get_allocations(self, mock_get_allocations_from_db,
-            mock_ensure_cache, mock_create_consumers):
+            mock_ensure_cache):
         mock_ensure_cache(self.context)
         rp = resource_provider.ResourceProvider(id=_RESOURCE_PROVIDER_ID,
                                                 uuid=uuids.resource_provider)
@@ -285,8 +285,6 @@ class TestAllocationListNoDB(_TestCase):
         mock_get_allocations_from_db.assert_called_once_with(self.context,
             rp.id)
         self.assertEqual(_ALLOCATION_DB['used'], allocations[0].used)
-        mock_create_consumers.assert_called_once_with(
-            self.context, _RESOURCE_PROVIDER_ID)
 
 
 class TestResourceClass(_TestCase):
@@ -328,3 +326,223 @@ class TestTraits(_TestCase):
         rp.set_traits(traits)
         mock_set_traits.assert_called_once_with(self.context, rp, traits)
         mock_reset.assert_called_once_with()
+
+
+class TestMergeCandidatesNoDB(_TestCase):
+
+    def setUp(self):
+        super(TestMergeCandidatesNoDB, self).setUp()
+        # Ten compute nodes, each with VCPU in the unnamed group and two
+        # possible providers of DISK_GB in group '1': the compute node itself
+        # and a sharing provider.
+        ss = resource_provider.ResourceProvider(
+            self.context, uuid=uuids.ss, root_provider_uuid=uuids.ss)
+        areqs = {'': [], '1': []}
+        psums = []
+        self.rps = []
+        for i in range(10):
+            cn_uuid = getattr(uuids, 'cn%d' % i)
+            cn = resource_provider.ResourceProvider(
+                self.context, uuid=cn_uuid, root_provider_uuid=cn_uuid)
+            self.rps.append(cn)
+            areqs[''].append(self._areq(cn, cn, fields.ResourceClass.VCPU))
+            for rp in (cn, ss):
+                areqs['1'].append(
+                    self._areq(cn, rp, fields.ResourceClass.DISK_GB))
+            psums.append(self._psum(cn, fields.ResourceClass.VCPU,
+                                    fields.ResourceClass.DISK_GB))
+        psums.append(self._psum(ss, fields.ResourceClass.DISK_GB))
+        self.candidates = {
+            '': (areqs[''], psums),
+            '1': (areqs['1'], psums),
+        }
+
+    def _areq(self, anchor, rp, rc):
+        return resource_provider.AllocationRequest(
+            self.context, anchor_root_provider_uuid=anchor.uuid,
+            use_same_provider=True,
+            resource_requests=[
+                resource_provider.AllocationRequestResource(
+                    self.context, resource_provider=rp, resource_class=rc,
+                    amount=1)])
+
+    def _psum(self, rp, *rcs):
+        return resource_provider.ProviderSummary(
+            self.context, resource_provider=rp, traits=[],
+            resources=[
+                resource_provider.ProviderSummaryResource(
+                    self.context, resource_class=rc, capacity=8, used=0,
+                    max_unit=8)
+                for rc in rcs])
+
+    def _merge(self, **kwargs):
+        consolidate = resource_provider._consolidate_allocation_requests
+        with mock.patch.object(
+                resource_provider, '_consolidate_allocation_requests',
+                side_effect=consolidate) as mock_consolidate:
+            areqs, psums = resource_provider._merge_candidates(
+                self.candidates, **kwargs)
+        return areqs, psums, mock_consolidate.call_count
+
+    def test_no_limit(self):
+        areqs, psums, consolidated = self._merge()
+        self.assertEqual(20, len(areqs))
+        self.assertEqual(20, consolidated)
+
+    def test_limit_stops_early(self):
+        full, _psums, _consolidated = self._merge()
+        areqs, psums, consolidated = self._merge(limit=3)
+        self.assertEqual(3, consolidated)
+        # The first results of the unlimited merge, in the same order
+        self.assertEqual([str(areq) for areq in full[:3]],
+                         [str(areq) for areq in areqs])
+        self.assertEqual(
+            set(areq.anchor_root_provider_uuid for areq in areqs) |
+            set([uuids.ss]),
+            set(psum.resource_provider.uuid for psum in psums))
+
+    def test_limit_randomized(self):
+        full, _psums, _consolidated = self._merge()
+        areqs, _psums, consolidated = self._merge(limit=5, randomize=True)
+        self.assertEqual(5, consolidated)
+        full_strs = set(str(areq) for areq in full)
+        self.assertEqual(5, len(set(str(areq) for areq in areqs)))
+        self.assertTrue(
+            set(str(areq) for areq in areqs).issubset(full_strs))
+
+    def test_limit_randomized_more_than_available(self):
+        full, _psums, _consolidated = self._merge()
+        areqs, _psums, _consolidated = self._merge(limit=50, randomize=True)
+        self.assertEqual(sorted(str(areq) for areq in full),
+                         sorted(str(areq) for areq in areqs))
+
+    def test_isolate(self):
+        # Both groups are granular: the DISK_GB of group '2' can't come from
+        # the compute node that provides the VCPU of group '1'.
+        self.candidates = {
+            '1': self.candidates[''],
+            '2': self.candidates['1'],
+        }
+        areqs, _psums, _consolidated = self._merge(group_policy='isolate')
+        self.assertEqual(10, len(areqs))
+        for areq in areqs:
+            self.assertEqual(
+                set([areq.anchor_root_provider_uuid, uuids.ss]),
+                set(arr.resource_provider.uuid
+                    for arr in areq.resource_requests))
+        areqs, _psums, _consolidated = self._merge(group_policy='none')
+        self.assertEqual(20, len(areqs))
+
+    def test_capacity_across_groups(self):
+        # Both groups ask for DISK_GB from the same sharing provider, which
+        # only has room for one of them.
+        self.candidates['2'] = self.candidates['1']
+        for _areqs, psums in self.candidates.values():
+            for psum in psums:
+                if psum.resource_provider.uuid == uuids.ss:
+                    psum.resources[0].capacity = 1
+        areqs, _psums, consolidated = self._merge()
+        # Of the four ways to pick DISK_GB for each compute node, the one
+        # taking both from the sharing provider is left out.
+        self.assertEqual(30, len(areqs))
+        self.assertEqual(30, consolidated)
+
+    def test_pruned_product(self):
+        choice_lists = [[1, 2, 3], [10, 20], [100, 200]]
+        visited = []
+
+        def extend(total, depth, item):
+            visited.append(item)
+            # Prune any combination starting with 2, or adding up to more
+            # than 220.
+            if depth == 0 and item == 2 or total + item > 220:
+                return None
+            return total + item
+
+        combinations = [
+            (combination, total) for combination, total in
+            resource_provider._pruned_product(choice_lists, extend, 0)]
+        expected = [c for c in itertools.product(*choice_lists)
+                    if c[0] != 2 and sum(c) <= 220]
+        self.assertEqual(expected, [c for c, _total in combinations])
+        self.assertEqual([sum(c) for c in expected],
+                         [total for _c, total in combinations])
+        # Nothing past the pruned 2 was visited
+        self.assertEqual(3 + 2 * (2 + 2 * 2), len(visited))
+        self.assertEqual(
+            [((), 5)],
+            list(resource_provider._pruned_product([], extend, 5)))
+
+    def test_sample_is_uniform(self):
+        counts = [0] * 10
+        for _i in range(2000):
+            for item in resource_provider._sample(iter(range(10)), 3):
+                counts[item] += 1
+        # Each item is picked with a probability of 3/10
+        for count in counts:
+            self.assertTrue(450 < count < 750, counts)
+
+
+class TestCandidateRecordsNoDB(_TestCase):
+
+    def test_objects_from_records(self):
+        cn = resource_provider._ProviderRecord(
+            id=1, uuid=uuids.cn, root_provider_uuid=uuids.cn)
+        ss = resource_provider._ProviderRecord(
+            id=2, uuid=uuids.ss, root_provider_uuid=uuids.ss)
+        areq = resource_provider._AllocationRequestRecord(
+            anchor_root_provider_uuid=uuids.cn,
+            resource_requests=[
+                resource_provider._AllocationRequestResourceRecord(
+                    resource_provider=rp, resource_class=rc, amount=amount)
+                for rp, rc, amount in (
+                    (cn, fields.ResourceClass.VCPU, 2),
+                    (ss, fields.ResourceClass.DISK_GB, 10))])
+        psums = [
+            resource_provider._ProviderSummaryRecord(
+                resource_provider=rp,
+                resources=[
+                    resource_provider._ProviderSummaryResourceRecord(
+                        resource_class=rc, capacity=100, used=1,
+                        max_unit=50)],
+                traits=[resource_provider._TraitRecord(name=trait)])
+            for rp, rc, trait in (
+                (cn, fields.ResourceClass.VCPU, 'CUSTOM_CN'),
+                (ss, fields.ResourceClass.DISK_GB, 'CUSTOM_SS'))
+        ]
+
+        areq_objs, psum_objs = resource_provider._objects_from_records(
+            self.context, [areq], psums)
+
+        self.assertEqual(1, len(areq_objs))
+        areq_obj = areq_objs[0]
+        self.assertIsInstance(areq_obj, resource_provider.AllocationRequest)
+        self.assertEqual(uuids.cn, areq_obj.anchor_root_provider_uuid)
+        self.assertFalse(areq_obj.use_same_provider)
+        self.assertEqual(
+            [(uuids.cn, 'VCPU', 2), (uuids.ss, 'DISK_GB', 10)],
+            [(arr.resource_provider.uuid, arr.resource_class, arr.amount)
+             for arr in areq_obj.resource_requests])
+        self.assertEqual(2, len(psum_objs))
+        cn_psum = psum_objs[0]
+        self.assertIsInstance(cn_psum, resource_provider.ProviderSummary)
+        self.assertEqual(set(['VCPU']), cn_psum.resource_class_names)
+        self.assertEqual(['CUSTOM_CN'], [t.name for t in cn_psum.traits])
+        self.assertEqual(50, cn_psum.resources[0].max_unit)
+        self.assertIsNone(cn_psum.resource_provider.parent_provider_uuid)
+        # Each provider is converted once
+        self.assertIs(areq_obj.resource_requests[0].resource_provider,
+                      cn_psum.resource_provider)
+
+    def test_record_repr(self):
+        rp = resource_provider._ProviderRecord(uuid=uuids.cn)
+        areq = resource_provider._AllocationRequestRecord(
+            anchor_root_provider_uuid=uuids.cn, use_same_provider=True,
+            resource_requests=[
+                resource_provider._AllocationRequestResourceRecord(
+                    resource_provider=rp, resource_class='VCPU', amount=1)])
+        self.assertEqual(
+            'AllocationRequest(anchor=...%s, same_provider=True, '
+            'resource_requests=[AllocationRequestResource(%s, VCPU=1)])' %
+            (uuids.cn[-8:], uuids.cn), repr(areq))
+        self.assertIn(uuids.cn, repr(rp))
@@ -0,0 +1,68 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Tests for the allocation write retry policy and contention counters."""
+
+import mock
+import testtools
+
+from nova.api.openstack.placement import contention
+from nova.tests import uuidsentinel
+
+
+class TestRetryPolicy(testtools.TestCase):
+
+    @mock.patch('random.uniform', side_effect=lambda low, high: high)
+    def test_backoff_is_exponential_and_bounded(self, mock_uniform):
+        policy = contention.RetryPolicy(5, 0.01, 0.05)
+        self.assertEqual([0.01, 0.02, 0.04, 0.05, 0.05],
+                         [policy.backoff(retry) for retry in range(5)])
+        mock_uniform.assert_called_with(0, 0.05)
+
+    def test_backoff_is_jittered(self):
+        policy = contention.RetryPolicy(5, 0.01, 0.05)
+        for retry in range(5):
+            delay = policy.backoff(retry)
+            self.assertTrue(0 <= delay <= 0.05)
+
+    @mock.patch('time.sleep')
+    def test_no_interval_does_not_sleep(self, mock_sleep):
+        policy = contention.RetryPolicy(5, 0, 0.5)
+        self.assertEqual(0, policy.backoff(3))
+        policy.wait(3)
+        self.assertFalse(mock_sleep.called)
+
+    def test_set_retry_policy(self):
+        self.addCleanup(contention.set_retry_policy, None)
+        policy = contention.RetryPolicy(1, 0, 0)
+        contention.set_retry_policy(policy)
+        self.assertIs(policy, contention.get_retry_policy())
+        contention.set_retry_policy(None)
+        self.assertIsNot(policy, contention.get_retry_policy())
+
+
+class TestContentionCounters(testtools.TestCase):
+
+    def test_counters(self):
+        counters = contention.ContentionCounters()
+        counters.record_conflict([uuidsentinel.rp1, uuidsentinel.rp2])
+        counters.record_conflict([uuidsentinel.rp2])
+        counters.record_exhausted([uuidsentinel.rp2])
+        self.assertEqual([(uuidsentinel.rp2, 2), (uuidsentinel.rp1, 1)],
+                         counters.most_contended())
+        self.assertEqual([(uuidsentinel.rp2, 2)],
+                         counters.most_contended(1))
+        self.assertEqual({'conflicts': 2, 'retries_exhausted': 1},
+                         counters.get(uuidsentinel.rp2))
+        self.assertEqual({'conflicts': 0, 'retries_exhausted': 0},
+                         counters.get(uuidsentinel.rp3))
+        counters.reset()
+        self.assertEqual([], counters.most_contended())
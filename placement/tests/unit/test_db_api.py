@@ -0,0 +1,73 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Unit tests for the routing of GET handlers to the database replica."""
+
+import fixtures
+import mock
+from oslo_config import cfg
+from oslo_config import fixture as config_fixture
+import testtools
+import webob
+
+from nova.api.openstack.placement import db_api
+
+
+CONF = cfg.CONF
+
+
+class TestReplicaReader(testtools.TestCase):
+
+    def setUp(self):
+        super(TestReplicaReader, self).setUp()
+        self.conf_fixture = self.useFixture(config_fixture.Config(CONF))
+        self.conf_fixture.config(group='placement', replica_max_lag=1)
+        self.ctxt_mgr = self.useFixture(fixtures.MockPatchObject(
+            db_api, 'placement_context_manager')).mock
+        self.patch_last_write(0)
+        self.req = webob.Request.blank('/resource_providers')
+        self.req.environ['placement.context'] = mock.sentinel.context
+
+        @db_api.replica_reader
+        def handler(req):
+            return mock.sentinel.response
+
+        self.handler = handler
+
+    def patch_last_write(self, value):
+        self.useFixture(fixtures.MockPatchObject(db_api, '_LAST_WRITE', value))
+
+    @mock.patch('time.time', return_value=100)
+    def test_reads_from_replica(self, mock_time):
+        self.assertEqual(mock.sentinel.response, self.handler(self.req))
+        self.ctxt_mgr.async_.using.assert_called_once_with(
+            mock.sentinel.context)
+
+    @mock.patch('time.time', return_value=100)
+    def test_reads_from_primary_after_write(self, mock_time):
+        db_api.note_write()
+        mock_time.return_value = 100.5
+        self.assertEqual(mock.sentinel.response, self.handler(self.req))
+        self.assertFalse(self.ctxt_mgr.async_.using.called)
+
+        # Once the replica is expected to have caught up
+        mock_time.return_value = 101
+        self.assertEqual(mock.sentinel.response, self.handler(self.req))
+        self.ctxt_mgr.async_.using.assert_called_once_with(
+            mock.sentinel.context)
+
+    @mock.patch('time.time', return_value=100)
+    def test_no_lag(self, mock_time):
+        self.conf_fixture.config(group='placement', replica_max_lag=0)
+        db_api.note_write()
+        self.assertEqual(mock.sentinel.response, self.handler(self.req))
+        self.ctxt_mgr.async_.using.assert_called_once_with(
+            mock.sentinel.context)
@@ -79,6 +79,32 @@ class DispatchTest(testtools.TestCase):
         self.assertEqual(uuidsentinel.foobar,
                          environ['wsgiorg.routing_args'][1]['id'])
 
+    @mock.patch('nova.api.openstack.placement.db_api.note_write')
+    def test_write_is_noted(self, mock_note):
+        self.mapper.connect('/foobar', action=self.route_handler,
+                            conditions=dict(method=['GET', 'PUT']))
+        handler.dispatch(_environ(path='/foobar'), start_response,
+                         self.mapper)
+        self.assertFalse(mock_note.called)
+        self.route_handler.side_effect = webob.exc.HTTPConflict
+        self.assertRaises(webob.exc.HTTPConflict, handler.dispatch,
+                          _environ(path='/foobar', method='PUT'),
+                          start_response, self.mapper)
+        mock_note.assert_called_once_with()
+
+    @mock.patch('nova.api.openstack.placement.objects.resource_provider.'
+                'validate_caches')
+    def test_caches_are_validated(self, mock_validate):
+        self.mapper.connect('/foobar', action=self.route_handler,
+                            conditions=dict(method=['GET']))
+        handler.dispatch(_environ(path='/foobar'), start_response,
+                         self.mapper)
+        self.assertFalse(mock_validate.called)
+        environ = _environ(path='/foobar')
+        environ['placement.context'] = mock.sentinel.context
+        handler.dispatch(environ, start_response, self.mapper)
+        mock_validate.assert_called_once_with(mock.sentinel.context)
+
 
 class MapperTest(testtools.TestCase):
 
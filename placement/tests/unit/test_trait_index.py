@@ -0,0 +1,93 @@
+#    Licensed under the Apache License, Version 2.0 (the "License"); you may
+#    not use this file except in compliance with the License. You may obtain
+#    a copy of the License at
+#
+#         http://www.apache.org/licenses/LICENSE-2.0
+#
+#    Unless required by applicable law or agreed to in writing, software
+#    distributed under the License is distributed on an "AS IS" BASIS, WITHOUT
+#    WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied. See the
+#    License for the specific language governing permissions and limitations
+#    under the License.
+"""Tests for the trait bitmask index."""
+
+import testtools
+
+from nova.api.openstack.placement import trait_index
+
+
+class TestTraitIndex(testtools.TestCase):
+
+    def setUp(self):
+        super(TestTraitIndex, self).setUp()
+        # Two trees: 1 -> (2, 3) and 4 -> (5). Provider 6 has no traits.
+        self.index = trait_index.TraitIndex(
+            {
+                1: ['CUSTOM_ROOT'],
+                2: ['HW_CPU_X86_AVX2', 'CUSTOM_GOLD'],
+                3: ['HW_NIC_OFFLOAD_GENEVE'],
+                4: ['CUSTOM_ROOT', 'HW_CPU_X86_AVX2'],
+                5: ['HW_NIC_OFFLOAD_GENEVE', 'CUSTOM_GOLD'],
+                6: [],
+            },
+            roots={1: 1, 2: 1, 3: 1, 4: 4, 5: 4, 6: 6})
+
+    def test_masks(self):
+        self.assertEqual(4, len(self.index))
+        self.assertNotIn(6, self.index.masks)
+        self.assertEqual(0, self.index.provider_mask(6))
+        mask = self.index.provider_mask(2)
+        self.assertEqual(['CUSTOM_GOLD', 'HW_CPU_X86_AVX2'],
+                         self.index.traits_from_mask(mask))
+        self.assertTrue(self.index.matches(
+            mask, self.index.required_mask(['CUSTOM_GOLD']),
+            self.index.forbidden_mask(['CUSTOM_ROOT'])))
+        self.assertFalse(self.index.matches(
+            mask, self.index.required_mask(['CUSTOM_ROOT']), 0))
+
+    def test_unknown_traits(self):
+        self.assertIsNone(self.index.required_mask(['CUSTOM_GOLD', 'NOPE']))
+        self.assertEqual(0, self.index.forbidden_mask(['NOPE']))
+        self.assertEqual(
+            [], self.index.provider_ids_matching(required=['NOPE']))
+        self.assertEqual([2, 5], self.index.provider_ids_matching(
+            required=['CUSTOM_GOLD'], forbidden=['NOPE']))
+
+    def test_provider_ids_matching(self):
+        self.assertEqual([2, 4], self.index.provider_ids_matching(
+            required=['HW_CPU_X86_AVX2']))
+        self.assertEqual([4], self.index.provider_ids_matching(
+            required=['HW_CPU_X86_AVX2', 'CUSTOM_ROOT']))
+        self.assertEqual([4], self.index.provider_ids_matching(
+            required=['HW_CPU_X86_AVX2'], forbidden=['CUSTOM_GOLD']))
+        # Without required traits, providers without any trait only match if
+        # they are supplied.
+        self.assertEqual([1, 3, 4], self.index.provider_ids_matching(
+            forbidden=['CUSTOM_GOLD']))
+        self.assertEqual([3, 6], self.index.provider_ids_matching(
+            forbidden=['CUSTOM_GOLD', 'CUSTOM_ROOT'], rp_ids=[2, 3, 6]))
+
+    def test_provider_ids_having_any(self):
+        self.assertEqual([2, 3, 5], self.index.provider_ids_having_any(
+            ['CUSTOM_GOLD', 'HW_NIC_OFFLOAD_GENEVE']))
+        self.assertEqual([], self.index.provider_ids_having_any(['NOPE']))
+
+    def test_root_ids_matching(self):
+        # The traits of the providers of a tree are collective
+        self.assertEqual(set([1, 4]), self.index.root_ids_matching(
+            [2, 3, 4, 5], required=['HW_CPU_X86_AVX2', 'CUSTOM_GOLD']))
+        self.assertEqual(set([1]), self.index.root_ids_matching(
+            [2, 3, 5], required=['HW_CPU_X86_AVX2', 'HW_NIC_OFFLOAD_GENEVE']))
+        # Only the supplied providers count
+        self.assertEqual(set(), self.index.root_ids_matching(
+            [2, 5], required=['HW_NIC_OFFLOAD_GENEVE', 'CUSTOM_ROOT']))
+        # A provider with a forbidden trait does not contribute its traits
+        self.assertEqual(set([4]), self.index.root_ids_matching(
+            [2, 3, 4, 5], required=['HW_CPU_X86_AVX2'],
+            forbidden=['CUSTOM_GOLD']))
+        # Without required traits, any supplied provider without a forbidden
+        # trait keeps its tree
+        self.assertEqual(set([1, 6]), self.index.root_ids_matching(
+            [2, 3, 5, 6], forbidden=['CUSTOM_GOLD', 'CUSTOM_ROOT']))
+        # Providers with no known root are ignored
+        self.assertEqual(set(), self.index.root_ids_matching([7]))
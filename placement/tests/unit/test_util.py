@@ -343,6 +343,25 @@ class TestPlacementURLs(testtools.TestCase):
         self.assertEqual(expected_url, util.resource_class_url(
             environ, self.resource_class))
 
+    def test_next_page_url(self):
+        req = webob.Request.blank(
+            '/resource_providers?limit=2&name=foo&marker=%s' %
+            uuidsentinel.rp1)
+        self.assertEqual(
+            '/resource_providers?limit=2&name=foo&marker=%s' %
+            uuidsentinel.rp2,
+            util.next_page_url(req, uuidsentinel.rp2))
+
+    def test_next_page_url_prefix(self):
+        # SCRIPT_NAME represents the mount point of a WSGI
+        # application when it is hosted at a path/prefix.
+        req = webob.Request.blank('/resource_providers?limit=2',
+                                  environ={'SCRIPT_NAME': '/placement'})
+        self.assertEqual(
+            '/placement/resource_providers?limit=2&marker=%s' %
+            uuidsentinel.rp1,
+            util.next_page_url(req, uuidsentinel.rp1))
+
 
 class TestNormalizeResourceQsParam(testtools.TestCase):
 
@@ -433,6 +452,22 @@ class TestNormalizeTraitsQsParam(testtools.TestCase):
                               util.normalize_traits_qs_param, fmt % traits)
 
 
+class TestNormalizeFieldsQsParam(testtools.TestCase):
+
+    allowed = ('uuid', 'name', 'links')
+
+    def test_success(self):
+        self.assertEqual(
+            ['uuid', 'links'],
+            util.normalize_fields_qs_param(' links,uuid ', self.allowed))
+
+    def test_400_unknown(self):
+        for qs in ('', 'uuid,', 'uuid,generation'):
+            self.assertRaises(
+                webob.exc.HTTPBadRequest, util.normalize_fields_qs_param,
+                qs, self.allowed)
+
+
 class TestParseQsRequestGroups(testtools.TestCase):
 
     @staticmethod
@@ -903,6 +938,65 @@ class TestPickLastModified(testtools.TestCase):
             mock_utc.assert_called_once_with(with_timezone=True)
 
 
+class TestConditionalRequests(testtools.TestCase):
+
+    def setUp(self):
+        super(TestConditionalRequests, self).setUp()
+        self.want_version = self._version(1, 30)
+
+    @staticmethod
+    def _version(major, minor):
+        mv_parsed = microversion_parse.Version(major, minor)
+        mv_parsed.max_version = microversion_parse.parse_version_string(
+            microversion.max_version_string())
+        mv_parsed.min_version = microversion_parse.parse_version_string(
+            microversion.min_version_string())
+        return mv_parsed
+
+    def _req(self, headers=None):
+        req = webob.Request.blank('/', headers=headers)
+        req.environ[microversion.MICROVERSION_ENVIRON] = self.want_version
+        # Normally set by webob.dec.wsgify
+        req.response = webob.Response()
+        return req
+
+    def test_make_etag(self):
+        etag = util.make_etag(self.want_version, 1, 5)
+        self.assertEqual(etag, util.make_etag(self.want_version, 1, 5))
+        self.assertNotEqual(etag, util.make_etag(self.want_version, 1, 6))
+        self.assertNotEqual(etag, util.make_etag(self.want_version, 15))
+
+    def test_make_etag_old_microversion(self):
+        self.assertIsNone(util.make_etag(self._version(1, 29), 1, 5))
+
+    def test_check_if_none_match(self):
+        etag = util.make_etag(self.want_version, 1, 5)
+        self.assertIsNone(util.check_if_none_match(self._req(), etag))
+        self.assertIsNone(util.check_if_none_match(
+            self._req({'If-None-Match': '"other"'}), etag))
+        resp = util.check_if_none_match(
+            self._req({'If-None-Match': '"other", "%s"' % etag}), etag)
+        self.assertEqual(304, resp.status_int)
+        self.assertEqual('"%s"' % etag, resp.headers['etag'])
+        self.assertEqual(b'', resp.body)
+
+    def test_check_if_none_match_no_etag(self):
+        self.assertIsNone(
+            util.check_if_none_match(self._req({'If-None-Match': '*'}), None))
+
+    def test_check_if_match(self):
+        etag = util.make_etag(self.want_version, 1, 5)
+        util.check_if_match(self._req(), etag)
+        util.check_if_match(self._req({'If-Match': '"%s"' % etag}), etag)
+        util.check_if_match(self._req({'If-Match': '*'}), etag)
+        self.assertRaises(webob.exc.HTTPPreconditionFailed,
+                          util.check_if_match,
+                          self._req({'If-Match': '"other"'}), etag)
+
+    def test_check_if_match_no_etag(self):
+        util.check_if_match(self._req({'If-Match': '"other"'}), None)
+
+
 class TestEnsureConsumer(testtools.TestCase):
     def setUp(self):
         super(TestEnsureConsumer, self).setUp()
@@ -1087,3 +1181,109 @@ class TestEnsureConsumer(testtools.TestCase):
             util.ensure_consumer,
             self.ctx, self.consumer_id, self.project_id, self.user_id,
             consumer_gen, self.after_version)
+
+
+class TestEnsureConsumers(testtools.TestCase):
+    def setUp(self):
+        super(TestEnsureConsumers, self).setUp()
+        self.mock_projects = self.useFixture(fixtures.MockPatch(
+            'nova.api.openstack.placement.objects.project.'
+            'Project.get_or_create_all')).mock
+        self.mock_users = self.useFixture(fixtures.MockPatch(
+            'nova.api.openstack.placement.objects.user.'
+            'User.get_or_create_all')).mock
+        self.mock_consumers_get = self.useFixture(fixtures.MockPatch(
+            'nova.api.openstack.placement.objects.consumer.'
+            'Consumer.get_all_by_uuids')).mock
+        self.mock_consumers_create = self.useFixture(fixtures.MockPatch(
+            'nova.api.openstack.placement.objects.consumer.'
+            'Consumer.create_all')).mock
+        self.mock_consumer_update = self.useFixture(fixtures.MockPatch(
+            'nova.api.openstack.placement.objects.consumer.'
+            'Consumer.update')).mock
+        self.ctx = mock.sentinel.ctx
+        self.proj = project_obj.Project(
+            self.ctx, id=1, external_id=uuidsentinel.project)
+        self.user = user_obj.User(
+            self.ctx, id=1, external_id=uuidsentinel.user)
+        self.mock_projects.return_value = {uuidsentinel.project: self.proj}
+        self.mock_users.return_value = {uuidsentinel.user: self.user}
+        self.existing = consumer_obj.Consumer(
+            self.ctx, id=1, uuid=uuidsentinel.existing, project=self.proj,
+            user=self.user, generation=3)
+        self.mock_consumers_get.return_value = {
+            uuidsentinel.existing: self.existing}
+        mv_parsed = microversion_parse.Version(1, 28)
+        mv_parsed.max_version = microversion_parse.parse_version_string(
+            microversion.max_version_string())
+        mv_parsed.min_version = microversion_parse.parse_version_string(
+            microversion.min_version_string())
+        self.after_version = mv_parsed
+
+    def _data(self, existing_gen, new_gen):
+        return {
+            uuidsentinel.existing: {
+                'project_id': uuidsentinel.project,
+                'user_id': uuidsentinel.user,
+                'consumer_generation': existing_gen,
+            },
+            uuidsentinel.new: {
+                'project_id': uuidsentinel.project,
+                'user_id': uuidsentinel.user,
+                'consumer_generation': new_gen,
+            },
+        }
+
+    def test_success(self):
+        res = util.ensure_consumers(
+            self.ctx, self._data(3, None), self.after_version)
+
+        self.mock_projects.assert_called_once_with(
+            self.ctx, set([uuidsentinel.project]))
+        self.mock_users.assert_called_once_with(
+            self.ctx, set([uuidsentinel.user]))
+        self.mock_consumers_get.assert_called_once()
+        self.assertEqual((self.existing, False), res[uuidsentinel.existing])
+        new_consumer, created = res[uuidsentinel.new]
+        self.assertTrue(created)
+        self.assertEqual(uuidsentinel.new, new_consumer.uuid)
+        self.mock_consumers_create.assert_called_once_with(
+            self.ctx, [new_consumer])
+        self.mock_consumer_update.assert_not_called()
+
+    def test_generation_conflict_creates_nothing(self):
+        for data in (self._data(2, None), self._data(3, 1)):
+            self.assertRaises(
+                webob.exc.HTTPConflict,
+                util.ensure_consumers,
+                self.ctx, data, self.after_version)
+        self.mock_consumers_create.assert_not_called()
+
+    def test_concurrent_create(self):
+        self.mock_consumers_create.side_effect = exception.ConsumerExists(
+            uuid=uuidsentinel.new)
+        raced = consumer_obj.Consumer(
+            self.ctx, id=2, uuid=uuidsentinel.new, project=self.proj,
+            user=self.user, generation=0)
+        with mock.patch.object(
+                consumer_obj.Consumer, 'create',
+                side_effect=exception.ConsumerExists(uuid=uuidsentinel.new)), \
+                mock.patch.object(consumer_obj.Consumer, 'get_by_uuid',
+                                  return_value=raced):
+            res = util.ensure_consumers(
+                self.ctx, self._data(3, None), self.after_version)
+        self.assertEqual((raced, False), res[uuidsentinel.new])
+
+    def test_use_incomplete(self):
+        data = {uuidsentinel.new: {'project_id': None, 'user_id': None}}
+        incomplete_proj = CONF.placement.incomplete_consumer_project_id
+        incomplete_user = CONF.placement.incomplete_consumer_user_id
+        self.mock_projects.return_value = {incomplete_proj: self.proj}
+        self.mock_users.return_value = {incomplete_user: self.user}
+        self.mock_consumers_get.return_value = {}
+        res = util.ensure_consumers(self.ctx, data, self.after_version)
+        self.mock_projects.assert_called_once_with(
+            self.ctx, set([incomplete_proj]))
+        self.mock_users.assert_called_once_with(
+            self.ctx, set([incomplete_user]))
+        self.assertTrue(res[uuidsentinel.new][1])